@@ -9,6 +9,11 @@ from datetime import datetime
 import logging
 import asyncio
 import io
+from broadcast_jobs import BroadcastJobManager
+from analytics_snapshot import AnalyticsSnapshotExecutor
+from load_shaping import SendCalendar
+from segments import SEGMENTS
+from .router import AdminRouter
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +26,13 @@ class AdminBaseMixin:
         self.admin_chat_id = admin_chat_id
         self.waiting_for = {}  # Словарь для отслеживания ожидания ввода
         self.broadcast_drafts = {}  # Черновики массовых рассылок
+        self.job_manager = BroadcastJobManager(db)  # Фоновые массовые рассылки
+        self.analytics = AnalyticsSnapshotExecutor(db)  # Тяжелые отчеты на снимке БД
+        self.send_calendar = SendCalendar.from_env(db)  # Прогноз загрузки отправок воронки
+        self.users_browser = {}  # Курсоры страниц списка пользователей по админам
+        # Таблицы маршрутов CALLBACK_ROUTES / INPUT_ROUTES всех миксинов
+        self.callback_router = AdminRouter.collect(type(self), 'CALLBACK_ROUTES')
+        self.input_router = AdminRouter.collect(type(self), 'INPUT_ROUTES')
     
     async def cleanup_old_waiting_states(self):
         """Очистка старых состояний ожидания ввода"""
@@ -198,6 +210,7 @@ class AdminBaseMixin:
             "mass_time": "⏰ Через сколько часов отправить рассылку?\n\nПримеры: 1, 2.5, 24\n\nОставьте пустым для отправки сейчас:",
             "mass_button_text": "✏️ Отправьте текст для кнопки:",
             "mass_button_url": "🔗 Отправьте URL для кнопки:",
+            "mass_segment_param": SEGMENTS[kwargs['segment']].prompt if kwargs.get('segment') in SEGMENTS else "✏️ Отправьте значение сегмента:",
             
             # === ПЛАТЕЖИ ===
             "payment_message_text": "✏️ Отправьте новый текст сообщения после оплаты:\n\n💡 Можно использовать переменную {amount} - она будет заменена на сумму платежа.",
@@ -239,6 +252,9 @@ class AdminBaseMixin:
             "paid_mass_time": "💰 ⏰ Через сколько часов отправить рассылку оплативших?\n\nПримеры: 1, 2.5, 24\n\nОставьте пустым для отправки сейчас:",
             "paid_mass_button_text": "💰 ✏️ Отправьте текст для кнопки:",
             "paid_mass_button_url": "💰 🔗 Отправьте URL для кнопки:",
+            
+            # === ПОЛЬЗОВАТЕЛИ ===
+            "user_search": "🔍 Отправьте ID пользователя, @username или имя (можно начало слова):",
         }
         
         # Получаем текст подсказки
@@ -259,6 +275,8 @@ class AdminBaseMixin:
             cancel_callback_data = "admin_welcome"
         elif input_type == "payment_message_text" or input_type == "payment_message_photo":
             cancel_callback_data = "admin_payment_message"
+        elif input_type == "user_search":
+            cancel_callback_data = "admin_users"
         else:
             cancel_callback_data = "admin_back"
         
@@ -7,6 +7,7 @@ from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
 import logging
 import asyncio
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +15,30 @@ logger = logging.getLogger(__name__)
 class BroadcastsMixin:
     """Миксин для работы с основными рассылками"""
     
+    CALLBACK_ROUTES = (
+        route("admin_broadcast", "show_broadcast_menu"),
+        route("admin_broadcast_status", "show_broadcast_status"),
+        route("admin_scheduled_broadcasts", "show_scheduled_broadcasts"),
+        route("enable_broadcast", "_handle_broadcast_switch", enabled=True),
+        route("disable_broadcast", "_handle_broadcast_switch", enabled=False),
+        prompt("set_broadcast_timer", "broadcast_timer"),
+        route("add_message", "_start_add_message"),
+        route("edit_msg_{message_number}", "show_message_edit"),
+        prompt("edit_text_{message_number}", "broadcast_text"),
+        prompt("edit_delay_{message_number}", "broadcast_delay"),
+        prompt("edit_photo_{message_number}", "broadcast_photo"),
+        route("remove_photo_{message_number}", "_handle_remove_message_photo"),
+        route("delete_msg_{message_number}", "_show_delete_message_confirm"),
+        route("confirm_delete_{message_number}", "_handle_confirm_delete_message"),
+    )
+    INPUT_ROUTES = (
+        route("broadcast_timer", "handle_broadcast_timer"),
+        route("add_message", "handle_add_message"),
+        route("broadcast_text", "_handle_broadcast_text_input"),
+        route("broadcast_delay", "_handle_broadcast_delay_input"),
+        route("broadcast_photo", "_handle_photo_url_text_input", "broadcast_photo"),
+    )
+    
     async def show_broadcast_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню управления рассылкой"""
         messages = self.db.get_all_broadcast_messages()
@@ -199,8 +224,7 @@ class BroadcastsMixin:
         
         if broadcasts:
             for broadcast_id, message_text, photo_url, scheduled_time, is_sent, created_at in broadcasts:
-                scheduled_dt = datetime.fromisoformat(scheduled_time)
-                time_str = scheduled_dt.strftime("%d.%m %H:%M")
+                time_str = scheduled_time.strftime("%d.%m %H:%M")
                 
                 # Получаем количество кнопок
                 buttons = self.db.get_scheduled_broadcast_buttons(broadcast_id)
@@ -305,83 +329,3 @@ class BroadcastsMixin:
             # Очищаем состояние
             if user_id in self.waiting_for:
                 del self.waiting_for[user_id]
-    
-    # === ДОПОЛНИТЕЛЬНЫЕ ОБРАБОТЧИКИ ===
-    
-    async def handle_additional_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Дополнительные обработчики callback для рассылок"""
-        query = update.callback_query
-        data = query.data
-        
-        # Обработка для основных сообщений рассылки
-        if data.startswith("edit_text_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_text", message_number=message_number)
-        elif data.startswith("edit_delay_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_delay", message_number=message_number)
-        elif data.startswith("edit_photo_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_photo", message_number=message_number)
-        elif data.startswith("remove_photo_"):
-            message_number = int(data.split("_")[2])
-            self.db.update_broadcast_message(message_number, photo_url="")
-            await self.show_message_edit(update, context, message_number)
-        elif data.startswith("delete_msg_"):
-            message_number = int(data.split("_")[2])
-            # Подтверждение удаления
-            keyboard = [
-                [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{message_number}")],
-                [InlineKeyboardButton("❌ Отмена", callback_data=f"edit_msg_{message_number}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                f"⚠️ Вы уверены, что хотите удалить сообщение {message_number}?\n\nЭто также отменит все запланированные отправки этого сообщения.",
-                reply_markup
-            )
-        elif data.startswith("confirm_delete_"):
-            message_number = int(data.split("_")[2])
-            self.db.delete_broadcast_message(message_number)
-            await self.show_broadcast_menu(update, context)
-        elif data == "add_message":
-            # Инициализация для добавления сообщения
-            user_id = update.callback_query.from_user.id
-            self.waiting_for[user_id] = {
-                "type": "add_message", 
-                "created_at": datetime.now(), 
-                "step": "text"
-            }
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                "✏️ Отправьте текст нового сообщения:\n\n💡 После этого мы попросим задержку для отправки.",
-                InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_broadcast")]])
-            )
-        elif data.startswith("add_button_"):
-            message_number = int(data.split("_")[2])
-            # Проверяем лимит кнопок
-            existing_buttons = self.db.get_message_buttons(message_number)
-            if len(existing_buttons) >= 3:
-                await query.answer("❌ Максимум 3 кнопки на сообщение!", show_alert=True)
-                return False
-            
-            # Инициализируем ожидание ввода кнопки
-            user_id = update.callback_query.from_user.id
-            self.waiting_for[user_id] = {
-                "type": "add_button", 
-                "message_number": message_number,
-                "step": "text",
-                "created_at": datetime.now()
-            }
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                "✏️ Отправьте текст для кнопки:",
-                InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=f"manage_buttons_{message_number}")]])
-            )
-        else:
-            return False  # Не обработано
-        
-        return True  # Обработано
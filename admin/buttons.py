@@ -6,6 +6,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from datetime import datetime
 import logging
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,43 @@ logger = logging.getLogger(__name__)
 class ButtonsMixin:
     """Миксин для работы с кнопками всех типов"""
     
+    CALLBACK_ROUTES = (
+        # Кнопки сообщений воронки
+        route("manage_buttons_{message_number}", "show_message_buttons"),
+        route("add_button_{message_number}", "_handle_add_button_callback"),
+        route("edit_button_{button_id}", "show_button_edit"),
+        prompt("edit_button_text_{button_id}", "edit_button_text"),
+        prompt("edit_button_url_{button_id}", "edit_button_url"),
+        route("delete_button_{button_id}", "_handle_delete_button"),
+        
+        # Кнопки приветствия
+        route("manage_welcome_buttons", "show_welcome_buttons_management"),
+        prompt("add_welcome_button", "add_welcome_button"),
+        route("edit_welcome_button_{button_id}", "show_welcome_button_edit"),
+        prompt("edit_welcome_button_text_{button_id}", "edit_welcome_button_text"),
+        route("delete_welcome_button_{button_id}", "show_welcome_button_delete_confirm"),
+        route("confirm_delete_welcome_button_{button_id}", "_handle_confirm_delete_welcome_button"),
+        
+        # Кнопки прощания
+        route("manage_goodbye_buttons", "show_goodbye_buttons_management"),
+        prompt("add_goodbye_button", "add_goodbye_button"),
+        route("edit_goodbye_button_{button_id}", "show_goodbye_button_edit"),
+        prompt("edit_goodbye_button_text_{button_id}", "edit_goodbye_button_text"),
+        prompt("edit_goodbye_button_url_{button_id}", "edit_goodbye_button_url"),
+        route("delete_goodbye_button_{button_id}", "show_goodbye_button_delete_confirm"),
+        route("confirm_delete_goodbye_button_{button_id}", "_handle_confirm_delete_goodbye_button"),
+    )
+    INPUT_ROUTES = (
+        route("add_button", "handle_add_button"),
+        route("edit_button_text", "_handle_edit_button_text_input"),
+        route("edit_button_url", "_handle_edit_button_url_input"),
+        route("add_welcome_button", "handle_add_welcome_button_input"),
+        route("edit_welcome_button_text", "handle_edit_welcome_button_text_input"),
+        route("add_goodbye_button", "handle_add_goodbye_button_input"),
+        route("edit_goodbye_button_text", "handle_edit_goodbye_button_text_input"),
+        route("edit_goodbye_button_url", "handle_edit_goodbye_button_url_input"),
+    )
+    
     # === КНОПКИ СООБЩЕНИЙ РАССЫЛКИ ===
     
     async def show_message_buttons(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number):
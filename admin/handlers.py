@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import logging
 import asyncio
 import utm_utils
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,11 @@ logger = logging.getLogger(__name__)
 class HandlersMixin:
     """Миксин для обработки событий админ-панели"""
     
+    CALLBACK_ROUTES = (
+        route("admin_back", "show_main_menu"),
+        route("noop", None),
+    )
+    
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка всех callback запросов админ-панели"""
         query = update.callback_query
@@ -28,128 +34,7 @@ class HandlersMixin:
                 logger.warning(f"⚠️ Ошибка при ответе на callback: {e}")
         
         try:
-            # === Основные команды ===
-            if data == "admin_back":
-                await self.show_main_menu(update, context)
-            elif data == "admin_stats":
-                await self.show_statistics(update, context)
-            elif data == "admin_broadcast":
-                await self.show_broadcast_menu(update, context)
-            elif data == "admin_paid_broadcast":
-                await self.show_paid_broadcast_menu(update, context)
-            elif data == "paid_send_all":
-                await self.show_paid_send_all_menu(update, context)
-            elif data == "paid_scheduled_broadcasts":
-                await self.show_paid_scheduled_broadcasts(update, context)
-            elif data == "admin_broadcast_status":
-                await self.show_broadcast_status(update, context)
-            elif data == "admin_users":
-                await self.show_users_list(update, context)
-            elif data == "admin_send_all":
-                await self.show_send_all_menu(update, context)
-            elif data == "admin_welcome":
-                await self.show_welcome_edit(update, context)
-            elif data == "admin_goodbye":
-                await self.show_goodbye_edit(update, context)
-            elif data == "admin_success_message":
-                await self.show_success_message_edit(update, context)
-            elif data == "admin_scheduled_broadcasts":
-                await self.show_scheduled_broadcasts(update, context)
-            elif data == "download_csv":
-                await self.send_csv_file(update, context)
-            elif data == "enable_broadcast":
-                self.db.set_broadcast_status(True, None)
-                await self.show_broadcast_status(update, context)
-            elif data == "disable_broadcast":
-                self.db.set_broadcast_status(False, None)
-                await self.show_broadcast_status(update, context)
-            elif data == "set_broadcast_timer":
-                await self.request_text_input(update, context, "broadcast_timer")
-            
-            # === ✅ НОВОЕ: Переключение сообщения подтверждения ===
-            elif data == "toggle_success_message":
-                # Переключаем статус
-                current_status = self.db.is_success_message_enabled()
-                new_status = not current_status
-                self.db.set_success_message_enabled(new_status)
-                
-                status_text = "включено" if new_status else "выключено"
-                await query.answer(f"✅ Сообщение подтверждения {status_text}!")
-                
-                # Обновляем меню
-                await self.show_success_message_edit(update, context)
-            
-            # === Продление подписок ===
-            elif data == "admin_renewal":
-                await self.show_renewal_menu(update, context)
-            
-            # === Платежи ===
-            elif data == "admin_payment_message":
-                await self.show_payment_message_edit(update, context)
-            elif data == "admin_payment_stats":
-                await self.show_payment_statistics(update, context)
-            
-            # === 📊 НОВОЕ: Статистика воронки ===
-            elif data == "admin_funnel_stats":
-                await self.show_funnel_statistics(update, context)
-            elif data.startswith("admin_msg_detail_"):
-                # Извлекаем номер сообщения из callback данных
-                message_number = int(data.split("_")[3])
-                await self.show_message_details(update, context, message_number)
-            
-            elif data == "edit_payment_message_text":
-                await self.request_text_input(update, context, "payment_message_text")
-            elif data == "edit_payment_message_photo":
-                await self.request_text_input(update, context, "payment_message_photo")
-            elif data == "remove_payment_message_photo":
-                await self._handle_remove_payment_photo(update, context)
-            elif data == "reset_payment_message":
-                await self._handle_reset_payment_message(update, context)
-            
-            # === Массовые рассылки ===
-            elif data == "mass_edit_text":
-                await self.request_text_input(update, context, "mass_text")
-            elif data == "mass_add_photo":
-                await self.request_text_input(update, context, "mass_photo")
-            elif data == "mass_set_time":
-                await self.request_text_input(update, context, "mass_time")
-            elif data == "mass_add_button":
-                await self.request_text_input(update, context, "mass_button_text")
-            elif data == "mass_remove_photo":
-                await self._handle_mass_remove_photo(update, context)
-            elif data == "mass_remove_button":
-                await self._handle_mass_remove_button(update, context)
-            elif data == "mass_preview":
-                await self.show_mass_broadcast_preview(update, context)
-            elif data == "mass_send_now":
-                await self._handle_mass_send_now(update, context)
-            elif data == "mass_confirm_send":
-                await self.execute_mass_broadcast(update, context)
-            
-            # === Платные массовые рассылки ===
-            elif data == "paid_mass_edit_text":
-                await self.request_text_input(update, context, "paid_mass_text")
-            elif data == "paid_mass_add_photo":
-                await self.request_text_input(update, context, "paid_mass_photo")
-            elif data == "paid_mass_set_time":
-                await self.request_text_input(update, context, "paid_mass_time")
-            elif data == "paid_mass_add_button":
-                await self.request_text_input(update, context, "paid_mass_button_text")
-            elif data == "paid_mass_remove_photo":
-                await self._handle_paid_mass_remove_photo(update, context)
-            elif data == "paid_mass_remove_button":
-                await self._handle_paid_mass_remove_button(update, context)
-            elif data == "paid_mass_preview":
-                await self.show_paid_mass_broadcast_preview(update, context)
-            elif data == "paid_mass_send_now":
-                await self._handle_paid_mass_send_now(update, context)
-            elif data == "paid_mass_confirm_send":
-                await self.execute_paid_mass_broadcast(update, context)
-            
-            # === Остальные обработчики ===
-            elif await self.handle_specific_callbacks(update, context):
-                pass
-            else:
+            if not await self.callback_router.dispatch(self, data, update, context):
                 await self.show_error_message(update, context, "❌ Неизвестная команда.")
                 
         except Exception as e:
@@ -157,155 +42,6 @@ class HandlersMixin:
                 logger.error(f"❌ Ошибка при обработке callback {data}: {e}")
             await self.show_error_message(update, context, "❌ Произошла ошибка. Попробуйте еще раз.")
     
-    async def handle_specific_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка специфических callback запросов"""
-        query = update.callback_query
-        data = query.data
-        
-        # === Обработчики для продления подписок ===
-        if await self.handle_renewal_callbacks(update, context):
-            return True
-        
-        # Обработка для основных сообщений рассылки
-        elif data.startswith("edit_msg_"):
-            message_number = int(data.split("_")[2])
-            await self.show_message_edit(update, context, message_number)
-        elif data.startswith("manage_buttons_"):
-            message_number = int(data.split("_")[2])
-            await self.show_message_buttons(update, context, message_number)
-        elif data.startswith("edit_button_") and not data.startswith("edit_button_text_") and not data.startswith("edit_button_url_"):
-            button_id = int(data.split("_")[2])
-            await self.show_button_edit(update, context, button_id)
-        elif data.startswith("edit_button_text_"):
-            button_id = int(data.split("_")[3])
-            await self.request_text_input(update, context, "edit_button_text", button_id=button_id)
-        elif data.startswith("edit_button_url_"):
-            button_id = int(data.split("_")[3])
-            await self.request_text_input(update, context, "edit_button_url", button_id=button_id)
-        elif data.startswith("delete_button_"):
-            await self._handle_delete_button(update, context, data)
-        
-        # Обработка для платных сообщений рассылки
-        elif data.startswith("edit_paid_msg_"):
-            message_number = int(data.split("_")[3])
-            await self.show_paid_message_edit(update, context, message_number)
-        elif data.startswith("manage_paid_buttons_"):
-            message_number = int(data.split("_")[3])
-            await self.show_paid_message_buttons(update, context, message_number)
-        elif data.startswith("edit_paid_button_") and not data.startswith("edit_paid_button_text_") and not data.startswith("edit_paid_button_url_"):
-            button_id = int(data.split("_")[3])
-            await self.show_paid_button_edit(update, context, button_id)
-        elif data.startswith("add_paid_button_"):
-            message_number = int(data.split("_")[3])
-            await self.request_text_input(update, context, "add_paid_button", message_number=message_number)
-        elif data == "add_paid_message":
-            user_id = update.callback_query.from_user.id
-            self.waiting_for[user_id] = {
-                "type": "add_paid_message", 
-                "created_at": datetime.now(), 
-                "step": "text"
-            }
-            await self.safe_edit_or_send_message(
-                update, context,
-                "💰 ✏️ Отправьте текст нового сообщения для оплативших:\n\n💡 После этого мы попросим задержку для отправки.",
-                InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_paid_broadcast")]])
-            )
-        # Редактирование платных сообщений
-        elif data.startswith("edit_paid_text_"):
-            message_number = int(data.split("_")[3])
-            await self.request_text_input(update, context, "paid_broadcast_text", message_number=message_number)
-        elif data.startswith("edit_paid_delay_"):
-            message_number = int(data.split("_")[3])
-            await self.request_text_input(update, context, "paid_broadcast_delay", message_number=message_number)
-        elif data.startswith("edit_paid_photo_"):
-            message_number = int(data.split("_")[3])
-            await self.request_text_input(update, context, "paid_broadcast_photo", message_number=message_number)
-        elif data.startswith("remove_paid_photo_"):
-            message_number = int(data.split("_")[3])
-            self.db.update_paid_broadcast_message(message_number, photo_url="")
-            await self.show_paid_message_edit(update, context, message_number)
-        elif data.startswith("delete_paid_msg_"):
-            message_number = int(data.split("_")[3])
-            # Подтверждение удаления
-            keyboard = [
-                [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_paid_{message_number}")],
-                [InlineKeyboardButton("❌ Отмена", callback_data=f"edit_paid_msg_{message_number}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                f"⚠️ Вы уверены, что хотите удалить сообщение для оплативших {message_number}?\n\nЭто также отменит все запланированные отправки этого сообщения.",
-                reply_markup
-            )
-        elif data.startswith("confirm_delete_paid_"):
-            message_number = int(data.split("_")[3])
-            self.db.delete_paid_broadcast_message(message_number)
-            await self.show_paid_broadcast_menu(update, context)
-        
-        # Управление приветственными кнопками
-        elif data == "manage_welcome_buttons":
-            await self.show_welcome_buttons_management(update, context)
-        elif data == "add_welcome_button":
-            await self.request_text_input(update, context, "add_welcome_button")
-        elif data.startswith("edit_welcome_button_") and not data.startswith("edit_welcome_button_text_"):
-            button_id = int(data.split("_")[3])
-            await self.show_welcome_button_edit(update, context, button_id)
-        elif data.startswith("edit_welcome_button_text_"):
-            button_id = int(data.split("_")[4])
-            await self.request_text_input(update, context, "edit_welcome_button_text", button_id=button_id)
-        elif data.startswith("delete_welcome_button_"):
-            button_id = int(data.split("_")[3])
-            await self.show_welcome_button_delete_confirm(update, context, button_id)
-        elif data.startswith("confirm_delete_welcome_button_"):
-            await self._handle_confirm_delete_welcome_button(update, context, data)
-        
-        # Управление прощальными кнопками
-        elif data == "manage_goodbye_buttons":
-            await self.show_goodbye_buttons_management(update, context)
-        elif data == "add_goodbye_button":
-            await self.request_text_input(update, context, "add_goodbye_button")
-        elif data.startswith("edit_goodbye_button_") and not data.startswith("edit_goodbye_button_text_") and not data.startswith("edit_goodbye_button_url_"):
-            button_id = int(data.split("_")[3])
-            await self.show_goodbye_button_edit(update, context, button_id)
-        elif data.startswith("edit_goodbye_button_text_"):
-            button_id = int(data.split("_")[4])
-            await self.request_text_input(update, context, "edit_goodbye_button_text", button_id=button_id)
-        elif data.startswith("edit_goodbye_button_url_"):
-            button_id = int(data.split("_")[4])
-            await self.request_text_input(update, context, "edit_goodbye_button_url", button_id=button_id)
-        elif data.startswith("delete_goodbye_button_"):
-            button_id = int(data.split("_")[3])
-            await self.show_goodbye_button_delete_confirm(update, context, button_id)
-        elif data.startswith("confirm_delete_goodbye_button_"):
-            await self._handle_confirm_delete_goodbye_button(update, context, data)
-        
-        # Редактирование сообщений
-        elif data == "edit_welcome_text":
-            await self.request_text_input(update, context, "welcome")
-        elif data == "edit_welcome_photo":
-            await self.request_text_input(update, context, "welcome_photo")
-        elif data == "remove_welcome_photo":
-            await self._handle_remove_welcome_photo(update, context)
-        elif data == "edit_goodbye_text":
-            await self.request_text_input(update, context, "goodbye")
-        elif data == "edit_goodbye_photo":
-            await self.request_text_input(update, context, "goodbye_photo")
-        elif data == "remove_goodbye_photo":
-            await self._handle_remove_goodbye_photo(update, context)
-        elif data == "edit_success_message_text":
-            await self.request_text_input(update, context, "success_message")
-        elif data == "reset_success_message":
-            await self._handle_reset_success_message(update, context)
-        
-        # Дополнительные обработчики для основных сообщений
-        elif await self.handle_additional_callbacks(update, context):
-            pass
-        else:
-            return False  # Не обработано
-        
-        return True  # Обработано
-    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка текстовых сообщений и фото от админа"""
         user_id = update.effective_user.id
@@ -350,150 +86,69 @@ class HandlersMixin:
     
     async def _route_input_by_type(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                                  text: str, input_type: str, waiting_data: dict):
-        """Маршрутизация ввода по типам"""
-        # === Продление подписок ===
-        if input_type == "renewal_text":
-            await self.handle_renewal_text_input(update, context, text)
-        elif input_type == "renewal_button_text":
-            await self.handle_renewal_button_text_input(update, context, text)
-        elif input_type == "renewal_button_url":
-            await self.handle_renewal_button_url_input(update, context, text)
-        
-        # Кнопки приветствия
-        elif input_type == "add_welcome_button":
-            await self.handle_add_welcome_button_input(update, context, text)
-        elif input_type == "edit_welcome_button_text":
-            await self.handle_edit_welcome_button_text_input(update, context, text)
-        
-        # Кнопки прощания
-        elif input_type == "add_goodbye_button":
-            await self.handle_add_goodbye_button_input(update, context, text)
-        elif input_type == "edit_goodbye_button_text":
-            await self.handle_edit_goodbye_button_text_input(update, context, text)
-        elif input_type == "edit_goodbye_button_url":
-            await self.handle_edit_goodbye_button_url_input(update, context, text)
-            
-        # Платежи
-        elif input_type == "payment_message_text":
-            await self.handle_payment_message_input(update, context, text, "payment_message_text")
-        elif input_type == "payment_message_photo":
-            await self.handle_payment_message_input(update, context, text, "payment_message_photo")
-        
-        # Массовая рассылка
-        elif input_type == "mass_text":
-            await self.handle_mass_text_input(update, context, text)
-        elif input_type == "mass_photo":
-            await self.handle_mass_photo_input(update, context, text)
-        elif input_type == "mass_time":
-            await self.handle_mass_time_input(update, context, text)
-        elif input_type == "mass_button_text":
-            await self.handle_mass_button_text_input(update, context, text)
-        elif input_type == "mass_button_url":
-            await self.handle_mass_button_url_input(update, context, text)
-        
-        # Платные рассылки
-        elif input_type == "add_paid_message":
-            await self.handle_add_paid_message(update, context, text)
-        elif input_type == "add_paid_button":
-            await self.handle_add_paid_button(update, context, text)
-        elif input_type == "paid_mass_text":
-            await self.handle_paid_mass_text_input(update, context, text)
-        elif input_type == "paid_mass_photo":
-            await self.handle_paid_mass_photo_input(update, context, text)
-        elif input_type == "paid_mass_time":
-            await self.handle_paid_mass_time_input(update, context, text)
-        elif input_type == "paid_mass_button_text":
-            await self.handle_paid_mass_button_text_input(update, context, text)
-        elif input_type == "paid_mass_button_url":
-            await self.handle_paid_mass_button_url_input(update, context, text)
-        
-        # Платные сообщения рассылки
-        elif input_type == "paid_broadcast_text":
-            await self.handle_paid_broadcast_text_input(update, context, text)
-        elif input_type == "paid_broadcast_delay":
-            await self.handle_paid_broadcast_delay_input(update, context, text)
-        elif input_type == "paid_broadcast_photo":
-            await self.handle_paid_broadcast_photo_input(update, context, text)
-        
-        # Остальные типы
-        elif input_type == "broadcast_timer":
-            await self.handle_broadcast_timer(update, context, text)
-        elif input_type == "add_message":
-            await self.handle_add_message(update, context, text)
-        elif input_type == "add_button":
-            await self.handle_add_button(update, context, text)
-        
-        # Базовые настройки
-        elif await self._handle_basic_message_types(update, context, text, input_type, waiting_data):
-            pass
-        else:
+        """Маршрутизация ввода по типам (таблицы INPUT_ROUTES миксинов)"""
+        if not await self.input_router.dispatch(self, input_type, update, context, text):
             await self.show_error_message(update, context, "❌ Неизвестный тип ввода.")
     
-    async def _handle_basic_message_types(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                        text: str, input_type: str, waiting_data: dict):
-        """Обработка базовых типов сообщений"""
+    # === Обработчики базовых типов ввода ===
+    
+    async def _handle_welcome_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Новый текст приветственного сообщения"""
         user_id = update.effective_user.id
-        
-        if input_type == "welcome":
-            if len(text) > 4096:
-                await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
-                return True
-            self.db.set_welcome_message(text)
-            await update.message.reply_text("✅ Приветственное сообщение обновлено!")
-            del self.waiting_for[user_id]
-            await self.show_welcome_edit_from_context(update, context)
-            
-        elif input_type == "goodbye":
-            if len(text) > 4096:
-                await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
-                return True
-            self.db.set_goodbye_message(text)
-            await update.message.reply_text("✅ Прощальное сообщение обновлено!")
-            del self.waiting_for[user_id]
-            await self.show_goodbye_edit_from_context(update, context)
-        
-        elif input_type == "success_message":
-            if len(text) > 4096:
-                await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
-                return True
-            conn = self.db._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('success_message', text))
-            conn.commit()
-            conn.close()
-            await update.message.reply_text("✅ Сообщение подтверждения обновлено!")
-            del self.waiting_for[user_id]
-            await self.show_success_message_edit_from_context(update, context)
-        
-        elif input_type == "broadcast_text":
-            message_number = waiting_data["message_number"]
-            if len(text) > 4096:
-                await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
-                return True
-            self.db.update_broadcast_message(message_number, text=text)
-            await update.message.reply_text(f"✅ Текст сообщения {message_number} обновлён!")
-            del self.waiting_for[user_id]
-            await self.show_message_edit_from_context(update, context, message_number)
-        
-        elif input_type == "broadcast_delay":
-            await self._handle_broadcast_delay_input(update, context, text, waiting_data)
-        
-        elif input_type in ["broadcast_photo", "welcome_photo", "goodbye_photo", "payment_message_photo", "renewal_photo"]:
-            if text.startswith("http://") or text.startswith("https://"):
-                await self.handle_photo_url_input(update, context, text, input_type, **waiting_data)
-            else:
-                await update.message.reply_text("❌ Отправьте фото или ссылку на фото (начинающуюся с http:// или https://)")
-        
-        elif input_type == "edit_button_text":
-            await self._handle_edit_button_text_input(update, context, text, waiting_data)
-        
-        elif input_type == "edit_button_url":
-            await self._handle_edit_button_url_input(update, context, text, waiting_data)
-        
+        if len(text) > 4096:
+            await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
+            return
+        self.db.set_welcome_message(text)
+        await update.message.reply_text("✅ Приветственное сообщение обновлено!")
+        del self.waiting_for[user_id]
+        await self.show_welcome_edit_from_context(update, context)
+    
+    async def _handle_goodbye_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Новый текст прощального сообщения"""
+        user_id = update.effective_user.id
+        if len(text) > 4096:
+            await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
+            return
+        self.db.set_goodbye_message(text)
+        await update.message.reply_text("✅ Прощальное сообщение обновлено!")
+        del self.waiting_for[user_id]
+        await self.show_goodbye_edit_from_context(update, context)
+    
+    async def _handle_success_message_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Новый текст сообщения подтверждения"""
+        user_id = update.effective_user.id
+        if len(text) > 4096:
+            await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
+            return
+        conn = self.db._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('success_message', text))
+        conn.commit()
+        conn.close()
+        await update.message.reply_text("✅ Сообщение подтверждения обновлено!")
+        del self.waiting_for[user_id]
+        await self.show_success_message_edit_from_context(update, context)
+    
+    async def _handle_broadcast_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Новый текст сообщения воронки"""
+        user_id = update.effective_user.id
+        message_number = self.waiting_for[user_id]["message_number"]
+        if len(text) > 4096:
+            await update.message.reply_text("❌ Текст слишком длинный. Максимум 4096 символов.")
+            return
+        self.db.update_broadcast_message(message_number, text=text)
+        await update.message.reply_text(f"✅ Текст сообщения {message_number} обновлён!")
+        del self.waiting_for[user_id]
+        await self.show_message_edit_from_context(update, context, message_number)
+    
+    async def _handle_photo_url_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                           text: str, input_type: str):
+        """Ссылка на фото вместо самого фото"""
+        if text.startswith("http://") or text.startswith("https://"):
+            waiting_data = self.waiting_for[update.effective_user.id]
+            await self.handle_photo_url_input(update, context, text, input_type, **waiting_data)
         else:
-            return False
-        
-        return True
+            await update.message.reply_text("❌ Отправьте фото или ссылку на фото (начинающуюся с http:// или https://)")
     
     async def handle_add_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка добавления новой кнопки"""
@@ -598,6 +253,104 @@ class HandlersMixin:
     
     # === Вспомогательные методы для обработки ===
     
+    async def _handle_broadcast_switch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, enabled: bool):
+        """Включение и выключение рассылки"""
+        self.db.set_broadcast_status(enabled, None)
+        await self.show_broadcast_status(update, context)
+    
+    async def _handle_toggle_success_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Переключение сообщения подтверждения"""
+        new_status = not self.db.is_success_message_enabled()
+        self.db.set_success_message_enabled(new_status)
+        
+        status_text = "включено" if new_status else "выключено"
+        await update.callback_query.answer(f"✅ Сообщение подтверждения {status_text}!")
+        
+        # Обновляем меню
+        await self.show_success_message_edit(update, context)
+    
+    async def _start_add_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Начало добавления сообщения воронки"""
+        user_id = update.callback_query.from_user.id
+        self.waiting_for[user_id] = {
+            "type": "add_message", 
+            "created_at": datetime.now(), 
+            "step": "text"
+        }
+        
+        await self.safe_edit_or_send_message(
+            update, context,
+            "✏️ Отправьте текст нового сообщения:\n\n💡 После этого мы попросим задержку для отправки.",
+            InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_broadcast")]])
+        )
+    
+    async def _start_add_paid_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Начало добавления сообщения для оплативших"""
+        user_id = update.callback_query.from_user.id
+        self.waiting_for[user_id] = {
+            "type": "add_paid_message", 
+            "created_at": datetime.now(), 
+            "step": "text"
+        }
+        await self.safe_edit_or_send_message(
+            update, context,
+            "💰 ✏️ Отправьте текст нового сообщения для оплативших:\n\n💡 После этого мы попросим задержку для отправки.",
+            InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_paid_broadcast")]])
+        )
+    
+    async def _handle_remove_message_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Удаление фото сообщения воронки"""
+        self.db.update_broadcast_message(message_number, photo_url="")
+        await self.show_message_edit(update, context, message_number)
+    
+    async def _handle_remove_paid_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Удаление фото сообщения для оплативших"""
+        self.db.update_paid_broadcast_message(message_number, photo_url="")
+        await self.show_paid_message_edit(update, context, message_number)
+    
+    async def _show_delete_message_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Подтверждение удаления сообщения воронки"""
+        keyboard = [
+            [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{message_number}")],
+            [InlineKeyboardButton("❌ Отмена", callback_data=f"edit_msg_{message_number}")]
+        ]
+        
+        await self.safe_edit_or_send_message(
+            update, context,
+            f"⚠️ Вы уверены, что хотите удалить сообщение {message_number}?\n\nЭто также отменит все запланированные отправки этого сообщения.",
+            InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def _show_delete_paid_message_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Подтверждение удаления сообщения для оплативших"""
+        keyboard = [
+            [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_paid_{message_number}")],
+            [InlineKeyboardButton("❌ Отмена", callback_data=f"edit_paid_msg_{message_number}")]
+        ]
+        
+        await self.safe_edit_or_send_message(
+            update, context,
+            f"⚠️ Вы уверены, что хотите удалить сообщение для оплативших {message_number}?\n\nЭто также отменит все запланированные отправки этого сообщения.",
+            InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def _handle_confirm_delete_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Удаление сообщения воронки"""
+        self.db.delete_broadcast_message(message_number)
+        await self.show_broadcast_menu(update, context)
+    
+    async def _handle_confirm_delete_paid_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Удаление сообщения для оплативших"""
+        self.db.delete_paid_broadcast_message(message_number)
+        await self.show_paid_broadcast_menu(update, context)
+    
+    async def _handle_add_button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
+        """Добавление кнопки к сообщению воронки (не больше 3 кнопок)"""
+        if len(self.db.get_message_buttons(message_number)) >= 3:
+            await update.callback_query.answer("❌ Максимум 3 кнопки на сообщение!", show_alert=True)
+            return
+        await self.request_text_input(update, context, "add_button", message_number=message_number, step="text")
+    
     async def _handle_remove_payment_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Удаление фото из сообщения об оплате"""
         current_data = self.db.get_payment_success_message()
@@ -667,9 +420,8 @@ class HandlersMixin:
             self.broadcast_drafts[user_id]["scheduled_hours"] = None
             await self.show_paid_mass_broadcast_preview(update, context)
     
-    async def _handle_delete_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    async def _handle_delete_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, button_id: int):
         """Удаление кнопки сообщения"""
-        button_id = int(data.split("_")[2])
         conn = self.db._get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT message_number FROM message_buttons WHERE id = ?', (button_id,))
@@ -681,16 +433,14 @@ class HandlersMixin:
             self.db.delete_message_button(button_id)
             await self.show_message_buttons(update, context, message_number)
     
-    async def _handle_confirm_delete_welcome_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    async def _handle_confirm_delete_welcome_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, button_id: int):
         """Подтверждение удаления кнопки приветствия"""
-        button_id = int(data.split("_")[4])
         self.db.delete_welcome_button(button_id)
         await update.callback_query.answer("✅ Кнопка удалена!")
         await self.show_welcome_buttons_management(update, context)
     
-    async def _handle_confirm_delete_goodbye_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    async def _handle_confirm_delete_goodbye_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, button_id: int):
         """Подтверждение удаления кнопки прощания"""
-        button_id = int(data.split("_")[4])
         self.db.delete_goodbye_button(button_id)
         await update.callback_query.answer("✅ Кнопка удалена!")
         await self.show_goodbye_buttons_management(update, context)
@@ -728,10 +478,10 @@ class HandlersMixin:
         conn.close()
         await self.show_success_message_edit(update, context)
     
-    async def _handle_broadcast_delay_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                                          text: str, waiting_data: dict):
+    async def _handle_broadcast_delay_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка ввода задержки для рассылки"""
         user_id = update.effective_user.id
+        waiting_data = self.waiting_for[user_id]
         message_number = waiting_data["message_number"]
         
         delay_hours, delay_display = self.parse_delay_input(text)
@@ -751,10 +501,10 @@ class HandlersMixin:
                 parse_mode='HTML'
             )
     
-    async def _handle_edit_button_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                           text: str, waiting_data: dict):
+    async def _handle_edit_button_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка изменения текста кнопки"""
         user_id = update.effective_user.id
+        waiting_data = self.waiting_for[user_id]
         button_id = waiting_data["button_id"]
         
         if len(text) > 64:
@@ -766,10 +516,10 @@ class HandlersMixin:
         del self.waiting_for[user_id]
         await self.show_button_edit_from_context(update, context, button_id)
     
-    async def _handle_edit_button_url_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                          text: str, waiting_data: dict):
+    async def _handle_edit_button_url_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Обработка изменения URL кнопки"""
         user_id = update.effective_user.id
+        waiting_data = self.waiting_for[user_id]
         button_id = waiting_data["button_id"]
         
         if not (text.startswith("http://") or text.startswith("https://")):
@@ -945,67 +695,3 @@ class HandlersMixin:
         except Exception as e:
             logger.error(f"❌ Ошибка при показе кнопок сообщения {message_number}: {e}")
             await self.show_error_message(update, context, "❌ Произошла ошибка. Попробуйте еще раз.")
-    
-    async def handle_additional_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Дополнительные обработчики callback для рассылок"""
-        query = update.callback_query
-        data = query.data
-        
-        # Обработка для основных сообщений рассылки
-        if data.startswith("edit_text_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_text", message_number=message_number)
-        elif data.startswith("edit_delay_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_delay", message_number=message_number)
-        elif data.startswith("edit_photo_"):
-            message_number = int(data.split("_")[2])
-            await self.request_text_input(update, context, "broadcast_photo", message_number=message_number)
-        elif data.startswith("remove_photo_"):
-            message_number = int(data.split("_")[2])
-            self.db.update_broadcast_message(message_number, photo_url="")
-            await self.show_message_edit(update, context, message_number)
-        elif data.startswith("delete_msg_"):
-            message_number = int(data.split("_")[2])
-            # Подтверждение удаления
-            keyboard = [
-                [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{message_number}")],
-                [InlineKeyboardButton("❌ Отмена", callback_data=f"edit_msg_{message_number}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                f"⚠️ Вы уверены, что хотите удалить сообщение {message_number}?\n\nЭто также отменит все запланированные отправки этого сообщения.",
-                reply_markup
-            )
-        elif data.startswith("confirm_delete_"):
-            message_number = int(data.split("_")[2])
-            self.db.delete_broadcast_message(message_number)
-            await self.show_broadcast_menu(update, context)
-        elif data == "add_message":
-            # Инициализация для добавления сообщения
-            user_id = update.callback_query.from_user.id
-            self.waiting_for[user_id] = {
-                "type": "add_message", 
-                "created_at": datetime.now(), 
-                "step": "text"
-            }
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                "✏️ Отправьте текст нового сообщения:\n\n💡 После этого мы попросим задержку для отправки.",
-                InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_broadcast")]])
-            )
-        elif data.startswith("add_button_"):
-            message_number = int(data.split("_")[2])
-            # Проверяем лимит кнопок
-            existing_buttons = self.db.get_message_buttons(message_number)
-            if len(existing_buttons) >= 3:
-                await query.answer("❌ Максимум 3 кнопки на сообщение!", show_alert=True)
-                return False
-            await self.request_text_input(update, context, "add_button", message_number=message_number, step="text")
-        else:
-            return False  # Не обработано
-        
-        return True  # Обработано
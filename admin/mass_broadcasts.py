@@ -8,6 +8,8 @@ from datetime import datetime, timedelta
 import logging
 import asyncio
 import utm_utils
+from segments import DEFAULT_SEGMENT, SEGMENTS, describe_segment, segment_spec
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +17,31 @@ logger = logging.getLogger(__name__)
 class MassBroadcastsMixin:
     """Миксин для работы с массовыми рассылками"""
     
+    CALLBACK_ROUTES = (
+        route("admin_send_all", "show_send_all_menu"),
+        prompt("mass_edit_text", "mass_text"),
+        prompt("mass_add_photo", "mass_photo"),
+        prompt("mass_set_time", "mass_time"),
+        prompt("mass_add_button", "mass_button_text"),
+        route("mass_remove_photo", "_handle_mass_remove_photo"),
+        route("mass_remove_button", "_handle_mass_remove_button"),
+        route("mass_preview", "show_mass_broadcast_preview"),
+        route("mass_segment", "show_mass_segment_menu"),
+        route("mass_segment_{kind:str}", "handle_mass_segment_choice"),
+        route("mass_send_now", "_handle_mass_send_now"),
+        route("mass_confirm_send", "execute_mass_broadcast"),
+        # Фоновые рассылки: пауза / продолжение / отмена
+        route("job_{command:str}", "handle_broadcast_job_control"),
+    )
+    INPUT_ROUTES = (
+        route("mass_text", "handle_mass_text_input"),
+        route("mass_photo", "handle_mass_photo_input"),
+        route("mass_time", "handle_mass_time_input"),
+        route("mass_button_text", "handle_mass_button_text_input"),
+        route("mass_button_url", "handle_mass_button_url_input"),
+        route("mass_segment_param", "handle_mass_segment_param_input"),
+    )
+    
     async def show_send_all_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню массовой рассылки с отдельными пунктами"""
         user_id = update.effective_user.id
@@ -63,9 +90,8 @@ class MassBroadcastsMixin:
         else:
             text += "⏰ <b>Время отправки:</b> <i>Сразу</i>\n"
         
-        # Получаем количество пользователей
-        users_count = len(self.db.get_users_with_bot_started())
-        text += f"\n👥 <b>Получателей:</b> {users_count} пользователей\n"
+        # Аудитория и количество получателей (подсчет по индексам сегмента)
+        text += "\n" + self._mass_segment_summary(draft, await self._count_mass_recipients(draft))
         text += "\n💡 <i>Все ссылки автоматически получат UTM метки для отслеживания.</i>\n"
         
         text += "\n<b>Выберите действие:</b>"
@@ -75,6 +101,7 @@ class MassBroadcastsMixin:
             [InlineKeyboardButton("🖼 Добавить фото", callback_data="mass_add_photo")],
             [InlineKeyboardButton("⏰ Время отправки", callback_data="mass_set_time")],
             [InlineKeyboardButton("🔘 Добавить кнопку", callback_data="mass_add_button")],
+            [InlineKeyboardButton("🎯 Аудитория", callback_data="mass_segment")],
         ]
         
         # Кнопка удаления фото (если есть)
@@ -141,9 +168,8 @@ class MassBroadcastsMixin:
         else:
             text += "⏰ <b>Время отправки:</b> <i>Сразу</i>\n"
         
-        # Получаем количество пользователей
-        users_count = len(self.db.get_users_with_bot_started())
-        text += f"\n👥 <b>Получателей:</b> {users_count} пользователей\n"
+        # Аудитория и количество получателей (подсчет по индексам сегмента)
+        text += "\n" + self._mass_segment_summary(draft, await self._count_mass_recipients(draft))
         text += "\n💡 <i>Все ссылки автоматически получат UTM метки для отслеживания.</i>\n"
         
         text += "\n<b>Выберите действие:</b>"
@@ -153,6 +179,7 @@ class MassBroadcastsMixin:
             [InlineKeyboardButton("🖼 Добавить фото", callback_data="mass_add_photo")],
             [InlineKeyboardButton("⏰ Время отправки", callback_data="mass_set_time")],
             [InlineKeyboardButton("🔘 Добавить кнопку", callback_data="mass_add_button")],
+            [InlineKeyboardButton("🎯 Аудитория", callback_data="mass_segment")],
         ]
         
         # Кнопка удаления фото (если есть)
@@ -202,8 +229,7 @@ class MassBroadcastsMixin:
             preview_text += "🚀 <b>Отправка:</b> Немедленно\n\n"
         
         # Получатели
-        users_count = len(self.db.get_users_with_bot_started())
-        preview_text += f"👥 <b>Получателей:</b> {users_count} пользователей\n\n"
+        preview_text += self._mass_segment_summary(draft, await self._count_mass_recipients(draft)) + "\n"
         
         # Фото
         if draft["photo_data"]:
@@ -274,10 +300,12 @@ class MassBroadcastsMixin:
             if draft["scheduled_hours"]:
                 # Запланированная рассылка
                 scheduled_time = datetime.now() + timedelta(hours=draft["scheduled_hours"])
+                segment = draft.get("segment", DEFAULT_SEGMENT)
                 broadcast_id = self.db.add_scheduled_broadcast(
                     draft["message_text"], 
                     scheduled_time, 
-                    draft["photo_data"]
+                    draft["photo_data"],
+                    segment=None if segment == DEFAULT_SEGMENT else segment
                 )
                 
                 # Добавляем кнопки если есть
@@ -300,95 +328,27 @@ class MassBroadcastsMixin:
                 )
                 
             else:
-                # Немедленная рассылка
-                users_with_bot = self.db.get_users_with_bot_started()
+                # Немедленная рассылка — отправляется в фоне
+                recipient_ids = await asyncio.to_thread(self.db.get_segment_user_ids, draft.get("segment", DEFAULT_SEGMENT))
                 
-                if not users_with_bot:
+                if not recipient_ids:
                     await update.callback_query.answer("❌ Нет пользователей для рассылки!", show_alert=True)
                     return
                 
-                # Создаем клавиатуру если есть кнопки
-                reply_markup = None
-                if draft["buttons"]:
-                    keyboard = []
-                    for button in draft["buttons"]:
-                        keyboard.append([InlineKeyboardButton(button["text"], url=button["url"])])
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                sent_count = 0
-                failed_count = 0
-                
-                await update.callback_query.answer("🚀 Начинаем рассылку...")
-                
-                # Отправляем прогресс для больших рассылок
-                progress_message = None
-                if len(users_with_bot) > 50:
-                    try:
-                        progress_message = await context.bot.send_message(
-                            chat_id=user_id,
-                            text="🚀 <b>Рассылка начата...</b>\n\n📊 Прогресс: 0%",
-                            parse_mode='HTML'
-                        )
-                    except Exception as e:
-                        if 'Event loop is closed' not in str(e):
-                            logger.error(f"❌ Ошибка при отправке сообщения прогресса: {e}")
+                job = self.job_manager.submit(
+                    context.bot,
+                    user_id,
+                    draft,
+                    recipient_ids,
+                    title="📢 Массовая рассылка"
+                )
                 
-                for i, user in enumerate(users_with_bot):
-                    user_id_to_send = user[0]
-                    try:
-                        await asyncio.sleep(0.1)  # Небольшая задержка
-                        
-                        # Обрабатываем текст и кнопки с UTM метками
-                        processed_text = utm_utils.process_text_links(draft["message_text"], user_id_to_send)
-                        
-                        processed_reply_markup = reply_markup
-                        if draft["buttons"]:
-                            keyboard = []
-                            for button in draft["buttons"]:
-                                processed_url = utm_utils.add_utm_to_url(button["url"], user_id_to_send)
-                                keyboard.append([InlineKeyboardButton(button["text"], url=processed_url)])
-                            processed_reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        if draft["photo_data"]:
-                            await context.bot.send_photo(
-                                chat_id=user_id_to_send,
-                                photo=draft["photo_data"],
-                                caption=processed_text,
-                                parse_mode='HTML',
-                                reply_markup=processed_reply_markup
-                            )
-                        else:
-                            await context.bot.send_message(
-                                chat_id=user_id_to_send,
-                                text=processed_text,
-                                parse_mode='HTML',
-                                reply_markup=processed_reply_markup
-                            )
-                        sent_count += 1
-                        
-                        # Обновляем прогресс каждые 25 пользователей
-                        if progress_message and i % 25 == 0:
-                            progress = int((i / len(users_with_bot)) * 100)
-                            try:
-                                await progress_message.edit_text(
-                                    f"🚀 <b>Рассылка в процессе...</b>\n\n"
-                                    f"📊 Прогресс: {progress}%\n"
-                                    f"✅ Отправлено: {sent_count}/{len(users_with_bot)}",
-                                    parse_mode='HTML'
-                                )
-                            except Exception as e:
-                                if 'Event loop is closed' not in str(e):
-                                    logger.warning(f"⚠️ Ошибка при обновлении прогресса: {e}")
-                        
-                    except Exception as e:
-                        failed_count += 1
-                        if 'Event loop is closed' not in str(e):
-                            logger.error(f"❌ Не удалось отправить рассылку пользователю {user_id_to_send}: {e}")
+                await update.callback_query.answer("🚀 Рассылка поставлена в очередь!")
                 
                 result_text = (
-                    f"✅ <b>Рассылка завершена!</b>\n\n"
-                    f"📤 <b>Успешно отправлено:</b> {sent_count}\n"
-                    f"❌ <b>Ошибок:</b> {failed_count}\n\n"
+                    f"🚀 <b>Рассылка #{job.job_id} запущена в фоне</b>\n\n"
+                    f"👥 <b>Получателей:</b> {job.total}\n\n"
+                    f"📊 Прогресс и кнопки паузы/отмены — в отдельном сообщении.\n"
                     f"🔗 <i>Все ссылки содержат UTM метки для отслеживания конверсий.</i>"
                 )
             
@@ -416,6 +376,89 @@ class MassBroadcastsMixin:
                 logger.error(f"❌ Ошибка при выполнении рассылки: {e}")
             await update.callback_query.answer("❌ Ошибка при отправке рассылки!", show_alert=True)
     
+    async def _count_mass_recipients(self, draft):
+        """Число получателей сегмента черновика; подсчет идет в потоке, не блокируя event loop"""
+        return await asyncio.to_thread(self.db.count_segment, draft.get("segment", DEFAULT_SEGMENT))
+    
+    def _mass_segment_summary(self, draft, recipients):
+        """Строки «Аудитория» и «Получателей» для меню и предпросмотра рассылки"""
+        segment = draft.get("segment", DEFAULT_SEGMENT)
+        return (
+            f"🎯 <b>Аудитория:</b> {describe_segment(segment)}\n"
+            f"👥 <b>Получателей:</b> {recipients} пользователей\n"
+        )
+    
+    async def show_mass_segment_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Выбор аудитории массовой рассылки"""
+        user_id = update.effective_user.id
+        draft = self.broadcast_drafts.get(user_id, {})
+        
+        text = "🎯 <b>Аудитория рассылки</b>\n\n"
+        text += self._mass_segment_summary(draft, await self._count_mass_recipients(draft))
+        text += "\n<b>Выберите сегмент:</b>"
+        
+        keyboard = [
+            [InlineKeyboardButton(segment.title, callback_data=f"mass_segment_{segment.kind}")]
+            for segment in SEGMENTS.values()
+        ]
+        keyboard.append([InlineKeyboardButton("« Назад", callback_data="admin_send_all")])
+        
+        await self.safe_edit_or_send_message(update, context, text, InlineKeyboardMarkup(keyboard))
+    
+    async def handle_mass_segment_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str):
+        """Выбран сегмент: без параметра — сразу в черновик, с параметром — запросить значение"""
+        user_id = update.effective_user.id
+        segment = SEGMENTS.get(kind)
+        
+        if segment is None or user_id not in self.broadcast_drafts:
+            await update.callback_query.answer("❌ Черновик не найден!", show_alert=True)
+            return
+        
+        if segment.param is not None:
+            await self.request_text_input(update, context, "mass_segment_param", segment=kind)
+            return
+        
+        self.broadcast_drafts[user_id]["segment"] = segment_spec(kind)
+        await self.show_send_all_menu(update, context)
+    
+    async def handle_broadcast_job_control(self, update: Update, context: ContextTypes.DEFAULT_TYPE, command: str):
+        """Пауза, продолжение и отмена фоновой рассылки (job_pause_N / job_resume_N / job_cancel_N)"""
+        query = update.callback_query
+        action, job_id = command.split("_")
+        job_id = int(job_id)
+        
+        actions = {
+            "pause": (self.job_manager.pause, "⏸ Рассылка поставлена на паузу"),
+            "resume": (self.job_manager.resume, "▶️ Рассылка продолжена"),
+            "cancel": (self.job_manager.cancel, "⏹ Рассылка отменена"),
+        }
+        if action not in actions:
+            return
+        
+        handler, success_text = actions[action]
+        job = self.job_manager.get(job_id)
+        
+        if not job or not handler(job_id):
+            success_text = "❌ Рассылка уже завершена или не найдена"
+        
+        try:
+            # Callback мог быть уже подтвержден выше по цепочке
+            await query.answer(success_text)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить на callback рассылки #{job_id}: {e}")
+        
+        if not job:
+            return
+        
+        try:
+            await query.edit_message_text(
+                job.progress_text(),
+                parse_mode='HTML',
+                reply_markup=job.control_markup()
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение рассылки #{job_id}: {e}")
+    
     # === Обработчики ввода для массовых рассылок ===
     
     async def handle_mass_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
@@ -553,3 +596,25 @@ class MassBroadcastsMixin:
         del self.waiting_for[user_id]
         
         await self.show_send_all_menu_from_context(update, context)
+    
+    async def handle_mass_segment_param_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Обработка ввода параметра сегмента (дни, номер сообщения, utm_source)"""
+        user_id = update.effective_user.id
+        
+        if user_id not in self.broadcast_drafts:
+            await update.message.reply_text("❌ Черновик не найден!")
+            return
+        
+        segment = SEGMENTS[self.waiting_for[user_id]["segment"]]
+        try:
+            value = segment.parse_value(text)
+        except ValueError:
+            await update.message.reply_text("❌ Некорректное значение. Попробуйте еще раз.")
+            return
+        
+        spec = segment_spec(segment.kind, value)
+        self.broadcast_drafts[user_id]["segment"] = spec
+        await update.message.reply_text(f"✅ Аудитория: {describe_segment(spec)}")
+        del self.waiting_for[user_id]
+        
+        await self.show_send_all_menu_from_context(update, context)
@@ -6,6 +6,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from datetime import datetime
 import logging
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,40 @@ logger = logging.getLogger(__name__)
 class MessagesMixin:
     """Миксин для работы с сообщениями бота"""
     
+    CALLBACK_ROUTES = (
+        # Приветствие и прощание
+        route("admin_welcome", "show_welcome_edit"),
+        prompt("edit_welcome_text", "welcome"),
+        prompt("edit_welcome_photo", "welcome_photo"),
+        route("remove_welcome_photo", "_handle_remove_welcome_photo"),
+        route("admin_goodbye", "show_goodbye_edit"),
+        prompt("edit_goodbye_text", "goodbye"),
+        prompt("edit_goodbye_photo", "goodbye_photo"),
+        route("remove_goodbye_photo", "_handle_remove_goodbye_photo"),
+        
+        # Сообщение подтверждения
+        route("admin_success_message", "show_success_message_edit"),
+        route("toggle_success_message", "_handle_toggle_success_message"),
+        prompt("edit_success_message_text", "success_message"),
+        route("reset_success_message", "_handle_reset_success_message"),
+        
+        # Сообщение после оплаты
+        route("admin_payment_message", "show_payment_message_edit"),
+        prompt("edit_payment_message_text", "payment_message_text"),
+        prompt("edit_payment_message_photo", "payment_message_photo"),
+        route("remove_payment_message_photo", "_handle_remove_payment_photo"),
+        route("reset_payment_message", "_handle_reset_payment_message"),
+    )
+    INPUT_ROUTES = (
+        route("welcome", "_handle_welcome_input"),
+        route("welcome_photo", "_handle_photo_url_text_input", "welcome_photo"),
+        route("goodbye", "_handle_goodbye_input"),
+        route("goodbye_photo", "_handle_photo_url_text_input", "goodbye_photo"),
+        route("success_message", "_handle_success_message_input"),
+        route("payment_message_text", "handle_payment_message_input", "payment_message_text"),
+        route("payment_message_photo", "handle_payment_message_input", "payment_message_photo"),
+    )
+    
     # === ПРИВЕТСТВЕННОЕ СООБЩЕНИЕ ===
     
     async def show_welcome_edit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -7,6 +7,7 @@ from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
 import logging
 import asyncio
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +15,25 @@ logger = logging.getLogger(__name__)
 class PaidBroadcastsMixin:
     """Миксин для работы с рассылками для оплативших пользователей"""
     
+    CALLBACK_ROUTES = (
+        route("admin_paid_broadcast", "show_paid_broadcast_menu"),
+        route("paid_scheduled_broadcasts", "show_paid_scheduled_broadcasts"),
+        route("add_paid_message", "_start_add_paid_message"),
+        route("edit_paid_msg_{message_number}", "show_paid_message_edit"),
+        prompt("edit_paid_text_{message_number}", "paid_broadcast_text"),
+        prompt("edit_paid_delay_{message_number}", "paid_broadcast_delay"),
+        prompt("edit_paid_photo_{message_number}", "paid_broadcast_photo"),
+        route("remove_paid_photo_{message_number}", "_handle_remove_paid_photo"),
+        route("delete_paid_msg_{message_number}", "_show_delete_paid_message_confirm"),
+        route("confirm_delete_paid_{message_number}", "_handle_confirm_delete_paid_message"),
+    )
+    INPUT_ROUTES = (
+        route("add_paid_message", "handle_add_paid_message"),
+        route("paid_broadcast_text", "handle_paid_broadcast_text_input"),
+        route("paid_broadcast_delay", "handle_paid_broadcast_delay_input"),
+        route("paid_broadcast_photo", "handle_paid_broadcast_photo_input"),
+    )
+    
     async def show_paid_broadcast_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню управления рассылкой для оплативших"""
         messages = self.db.get_all_paid_broadcast_messages()
@@ -187,8 +207,7 @@ class PaidBroadcastsMixin:
         
         if broadcasts:
             for broadcast_id, message_text, photo_url, scheduled_time, is_sent, created_at in broadcasts:
-                scheduled_dt = datetime.fromisoformat(scheduled_time)
-                time_str = scheduled_dt.strftime("%d.%m %H:%M")
+                time_str = scheduled_time.strftime("%d.%m %H:%M")
                 
                 # Получаем количество кнопок
                 buttons = self.db.get_paid_scheduled_broadcast_buttons(broadcast_id)
@@ -6,6 +6,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from datetime import datetime
 import logging
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,15 @@ logger = logging.getLogger(__name__)
 class PaidButtonsMixin:
     """Миксин для работы с кнопками платных рассылок"""
     
+    CALLBACK_ROUTES = (
+        route("manage_paid_buttons_{message_number}", "show_paid_message_buttons"),
+        route("edit_paid_button_{button_id}", "show_paid_button_edit"),
+        prompt("add_paid_button_{message_number}", "add_paid_button"),
+    )
+    INPUT_ROUTES = (
+        route("add_paid_button", "handle_add_paid_button"),
+    )
+    
     async def show_paid_message_buttons(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number):
         """Показать меню управления кнопками сообщения для оплативших"""
         buttons = self.db.get_paid_message_buttons(message_number)
@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import logging
 import asyncio
 import utm_utils
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,26 @@ logger = logging.getLogger(__name__)
 class PaidMassBroadcastsMixin:
     """Миксин для работы с массовыми рассылками для оплативших"""
     
+    CALLBACK_ROUTES = (
+        route("paid_send_all", "show_paid_send_all_menu"),
+        prompt("paid_mass_edit_text", "paid_mass_text"),
+        prompt("paid_mass_add_photo", "paid_mass_photo"),
+        prompt("paid_mass_set_time", "paid_mass_time"),
+        prompt("paid_mass_add_button", "paid_mass_button_text"),
+        route("paid_mass_remove_photo", "_handle_paid_mass_remove_photo"),
+        route("paid_mass_remove_button", "_handle_paid_mass_remove_button"),
+        route("paid_mass_preview", "show_paid_mass_broadcast_preview"),
+        route("paid_mass_send_now", "_handle_paid_mass_send_now"),
+        route("paid_mass_confirm_send", "execute_paid_mass_broadcast"),
+    )
+    INPUT_ROUTES = (
+        route("paid_mass_text", "handle_paid_mass_text_input"),
+        route("paid_mass_photo", "handle_paid_mass_photo_input"),
+        route("paid_mass_time", "handle_paid_mass_time_input"),
+        route("paid_mass_button_text", "handle_paid_mass_button_text_input"),
+        route("paid_mass_button_url", "handle_paid_mass_button_url_input"),
+    )
+    
     async def execute_paid_mass_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Выполнение массовой рассылки для оплативших"""
         user_id = update.effective_user.id
@@ -60,95 +81,27 @@ class PaidMassBroadcastsMixin:
                 )
                 
             else:
-                # Немедленная рассылка для оплативших
+                # Немедленная рассылка для оплативших — отправляется в фоне
                 paid_users = self.db.get_users_with_payment()
                 
                 if not paid_users:
                     await update.callback_query.answer("❌ Нет оплативших пользователей для рассылки!", show_alert=True)
                     return
                 
-                # Создаем клавиатуру если есть кнопки
-                reply_markup = None
-                if draft["buttons"]:
-                    keyboard = []
-                    for button in draft["buttons"]:
-                        keyboard.append([InlineKeyboardButton(button["text"], url=button["url"])])
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                sent_count = 0
-                failed_count = 0
-                
-                await update.callback_query.answer("🚀 Начинаем рассылку для оплативших...")
-                
-                # Отправляем прогресс для больших рассылок
-                progress_message = None
-                if len(paid_users) > 10:
-                    try:
-                        progress_message = await context.bot.send_message(
-                            chat_id=user_id,
-                            text="💰 <b>Рассылка для оплативших начата...</b>\n\n📊 Прогресс: 0%",
-                            parse_mode='HTML'
-                        )
-                    except Exception as e:
-                        if 'Event loop is closed' not in str(e):
-                            logger.error(f"❌ Ошибка при отправке сообщения прогресса: {e}")
+                job = self.job_manager.submit(
+                    context.bot,
+                    user_id,
+                    draft,
+                    [user[0] for user in paid_users],
+                    title="💰 Рассылка для оплативших"
+                )
                 
-                for i, user in enumerate(paid_users):
-                    user_id_to_send = user[0]
-                    try:
-                        await asyncio.sleep(0.1)  # Небольшая задержка
-                        
-                        # Обрабатываем текст и кнопки с UTM метками
-                        processed_text = utm_utils.process_text_links(draft["message_text"], user_id_to_send)
-                        
-                        processed_reply_markup = reply_markup
-                        if draft["buttons"]:
-                            keyboard = []
-                            for button in draft["buttons"]:
-                                processed_url = utm_utils.add_utm_to_url(button["url"], user_id_to_send)
-                                keyboard.append([InlineKeyboardButton(button["text"], url=processed_url)])
-                            processed_reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        if draft["photo_data"]:
-                            await context.bot.send_photo(
-                                chat_id=user_id_to_send,
-                                photo=draft["photo_data"],
-                                caption=processed_text,
-                                parse_mode='HTML',
-                                reply_markup=processed_reply_markup
-                            )
-                        else:
-                            await context.bot.send_message(
-                                chat_id=user_id_to_send,
-                                text=processed_text,
-                                parse_mode='HTML',
-                                reply_markup=processed_reply_markup
-                            )
-                        sent_count += 1
-                        
-                        # Обновляем прогресс каждые 5 пользователей
-                        if progress_message and i % 5 == 0:
-                            progress = int((i / len(paid_users)) * 100)
-                            try:
-                                await progress_message.edit_text(
-                                    f"💰 <b>Рассылка для оплативших в процессе...</b>\n\n"
-                                    f"📊 Прогресс: {progress}%\n"
-                                    f"✅ Отправлено: {sent_count}/{len(paid_users)}",
-                                    parse_mode='HTML'
-                                )
-                            except Exception as e:
-                                if 'Event loop is closed' not in str(e):
-                                    logger.warning(f"⚠️ Ошибка при обновлении прогресса: {e}")
-                        
-                    except Exception as e:
-                        failed_count += 1
-                        if 'Event loop is closed' not in str(e):
-                            logger.error(f"❌ Не удалось отправить рассылку оплатившему пользователю {user_id_to_send}: {e}")
+                await update.callback_query.answer("🚀 Рассылка для оплативших поставлена в очередь!")
                 
                 result_text = (
-                    f"💰 <b>Рассылка для оплативших завершена!</b>\n\n"
-                    f"📤 <b>Успешно отправлено:</b> {sent_count}\n"
-                    f"❌ <b>Ошибок:</b> {failed_count}\n\n"
+                    f"💰 <b>Рассылка для оплативших #{job.job_id} запущена в фоне</b>\n\n"
+                    f"👥 <b>Получателей:</b> {job.total}\n\n"
+                    f"📊 Прогресс и кнопки паузы/отмены — в отдельном сообщении.\n"
                     f"🔗 <i>Все ссылки содержат UTM метки для отслеживания конверсий.</i>"
                 )
             
@@ -6,6 +6,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from datetime import datetime
 import logging
+from .router import route, prompt
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,26 @@ logger = logging.getLogger(__name__)
 class RenewalMixin:
     """Миксин для работы с сообщениями продления подписки"""
     
+    CALLBACK_ROUTES = (
+        route("admin_renewal", "show_renewal_menu"),
+        prompt("renewal_edit_text", "renewal_text"),
+        prompt("renewal_edit_photo", "renewal_photo"),
+        route("renewal_edit_button", "show_renewal_button_setup"),
+        prompt("renewal_edit_button_text", "renewal_button_text"),
+        prompt("renewal_edit_button_url", "renewal_button_url"),
+        route("renewal_remove_photo", "_handle_renewal_remove_photo"),
+        route("renewal_remove_button", "_handle_renewal_remove_button"),
+        route("renewal_preview", "show_renewal_preview"),
+        route("renewal_reset", "_show_renewal_reset_confirm"),
+        route("renewal_confirm_reset", "_handle_renewal_confirm_reset"),
+    )
+    INPUT_ROUTES = (
+        route("renewal_text", "handle_renewal_text_input"),
+        route("renewal_button_text", "handle_renewal_button_text_input"),
+        route("renewal_button_url", "handle_renewal_button_url_input"),
+        route("renewal_photo", "_handle_photo_url_text_input", "renewal_photo"),
+    )
+    
     async def show_renewal_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню управления сообщениями продления"""
         renewal_data = self.db.get_renewal_message()
@@ -333,74 +354,48 @@ class RenewalMixin:
     
     # === ДОПОЛНИТЕЛЬНЫЕ ОБРАБОТЧИКИ ===
     
-    async def handle_renewal_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Дополнительные обработчики callback для продления"""
-        query = update.callback_query
-        data = query.data
-        
-        if data == "renewal_edit_text":
-            await self.request_text_input(update, context, "renewal_text")
-        
-        elif data == "renewal_edit_photo":
-            await self.request_text_input(update, context, "renewal_photo")
-        
-        elif data == "renewal_edit_button":
-            await self.show_renewal_button_setup(update, context)
-        
-        elif data == "renewal_edit_button_text":
-            await self.request_text_input(update, context, "renewal_button_text")
-        
-        elif data == "renewal_edit_button_url":
-            await self.request_text_input(update, context, "renewal_button_url")
-        
-        elif data == "renewal_remove_photo":
-            self.db.set_renewal_message(photo_url="")
-            await update.callback_query.answer("✅ Фото удалено!")
-            await self.show_renewal_menu(update, context)
-        
-        elif data == "renewal_remove_button":
-            self.db.set_renewal_message(button_text="", button_url="")
-            await update.callback_query.answer("✅ Кнопка удалена!")
-            await self.show_renewal_menu(update, context)
-        
-        elif data == "renewal_preview":
-            await self.show_renewal_preview(update, context)
-        
-        elif data == "renewal_reset":
-            # Подтверждение сброса
-            keyboard = [
-                [InlineKeyboardButton("✅ Да, сбросить", callback_data="renewal_confirm_reset")],
-                [InlineKeyboardButton("❌ Отмена", callback_data="admin_renewal")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.safe_edit_or_send_message(
-                update, context,
-                "⚠️ <b>Подтверждение сброса</b>\n\n"
-                "Вы уверены, что хотите сбросить настройки сообщения продления к стандартным?\n\n"
-                "Это действие нельзя отменить.",
-                reply_markup
-            )
+    async def _handle_renewal_remove_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Удаление фото сообщения продления"""
+        self.db.set_renewal_message(photo_url="")
+        await update.callback_query.answer("✅ Фото удалено!")
+        await self.show_renewal_menu(update, context)
+    
+    async def _handle_renewal_remove_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Удаление кнопки сообщения продления"""
+        self.db.set_renewal_message(button_text="", button_url="")
+        await update.callback_query.answer("✅ Кнопка удалена!")
+        await self.show_renewal_menu(update, context)
+    
+    async def _show_renewal_reset_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Подтверждение сброса сообщения продления"""
+        keyboard = [
+            [InlineKeyboardButton("✅ Да, сбросить", callback_data="renewal_confirm_reset")],
+            [InlineKeyboardButton("❌ Отмена", callback_data="admin_renewal")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        elif data == "renewal_confirm_reset":
-            # Сброс к стандартным настройкам
-            default_message = (
-                "⏰ <b>Ваша подписка истекает сегодня!</b>\n\n"
-                "💳 Чтобы продолжить получать эксклюзивные материалы, продлите подписку.\n\n"
-                "✨ Не упустите возможность оставаться в курсе всех новинок!"
-            )
-            
-            self.db.set_renewal_message(
-                text=default_message,
-                photo_url="",
-                button_text="Продлить подписку",
-                button_url=""
-            )
-            
-            await update.callback_query.answer("✅ Настройки сброшены к стандартным!")
-            await self.show_renewal_menu(update, context)
+        await self.safe_edit_or_send_message(
+            update, context,
+            "⚠️ <b>Подтверждение сброса</b>\n\n"
+            "Вы уверены, что хотите сбросить настройки сообщения продления к стандартным?\n\n"
+            "Это действие нельзя отменить.",
+            reply_markup
+        )
+    
+    async def _handle_renewal_confirm_reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сброс сообщения продления к стандартным настройкам"""
+        default_message = (
+            "⏰ <b>Ваша подписка истекает сегодня!</b>\n\n"
+            "💳 Чтобы продолжить получать эксклюзивные материалы, продлите подписку.\n\n"
+            "✨ Не упустите возможность оставаться в курсе всех новинок!"
+        )
         
-        else:
-            return False  # Не обработано
+        self.db.set_renewal_message(
+            text=default_message,
+            photo_url="",
+            button_text="Продлить подписку",
+            button_url=""
+        )
         
-        return True  # Обработано
+        await update.callback_query.answer("✅ Настройки сброшены к стандартным!")
+        await self.show_renewal_menu(update, context)
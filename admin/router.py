@@ -0,0 +1,169 @@
+"""
+Табличная маршрутизация callback-запросов и текстового ввода админ-панели
+
+Миксины объявляют маршруты атрибутами класса CALLBACK_ROUTES и INPUT_ROUTES,
+AdminRouter собирает их по MRO один раз при создании панели:
+
+- точные значения ("admin_stats") лежат в словаре — поиск за O(1);
+- параметризованные ("admin_msg_detail_{message_number}") — в префиксном
+  дереве по сегментам callback_data, разделенным "_". Поиск идет от самого
+  длинного префикса к короткому, поэтому "edit_button_text_{button_id}"
+  не путается с "edit_button_{button_id}". Глубина дерева ограничена длиной
+  callback_data (64 байта), а не числом маршрутов — промах тоже O(1).
+
+Параметр в конце шаблона по умолчанию целое число ({button_id}); {kind:str}
+берет остаток строки как есть. Если параметр не разобрался, маршрут не подходит.
+У каждого маршрута считаются вызовы, ошибки и суммарное время обработки.
+"""
+
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+_PARAM = re.compile(r'^(?P<prefix>.*)\{(?P<name>\w+)(?::(?P<kind>int|str))?\}$')
+_CONVERTERS = {'int': int, 'str': str}
+
+
+class Route:
+    """Маршрут: шаблон, метод админ-панели с фиксированными аргументами и счетчики"""
+
+    __slots__ = ('pattern', 'method', 'args', 'kwargs', 'prefix', 'param', 'convert',
+                 'calls', 'errors', 'total_seconds')
+
+    def __init__(self, pattern, method, *args, **kwargs):
+        self.pattern = pattern
+        self.method = method  # None — маршрут ничего не делает (например, "noop")
+        self.args = args
+        self.kwargs = kwargs
+
+        match = _PARAM.match(pattern)
+        if match:
+            self.prefix = match.group('prefix')
+            self.param = match.group('name')
+            self.convert = _CONVERTERS[match.group('kind') or 'int']
+        else:
+            self.prefix, self.param, self.convert = pattern, None, None
+
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+
+def route(pattern, method, *args, **kwargs):
+    """Маршрут на метод: method(update, context, [text], *args, **kwargs, **{param: значение})"""
+    return Route(pattern, method, *args, **kwargs)
+
+
+def prompt(pattern, input_type, **kwargs):
+    """Маршрут, который запрашивает у админа ввод типа input_type"""
+    return Route(pattern, 'request_text_input', input_type, **kwargs)
+
+
+class AdminRouter:
+    """Скомпилированная таблица маршрутов: словарь точных значений и дерево префиксов"""
+
+    def __init__(self, routes=()):
+        self.exact = {}
+        self._tree = {}  # сегмент -> (маршрут или None, поддерево)
+        self.misses = 0
+        for item in routes:
+            self.add(item)
+
+    @classmethod
+    def collect(cls, panel_class, attribute):
+        """Маршруты из атрибута attribute всех классов MRO панели"""
+        routes = []
+        for klass in reversed(panel_class.__mro__):
+            routes.extend(klass.__dict__.get(attribute, ()))
+        return cls(Route(item.pattern, item.method, *item.args, **item.kwargs) for item in routes)
+
+    def add(self, item):
+        if item.param is None:
+            if item.pattern in self.exact:
+                raise ValueError(f"Маршрут {item.pattern!r} объявлен дважды")
+            self.exact[item.pattern] = item
+            return
+
+        if not item.prefix.endswith('_'):
+            raise ValueError(f"Параметр маршрута {item.pattern!r} должен идти после '_'")
+        node = None
+        children = self._tree
+        for segment in item.prefix[:-1].split('_'):
+            node = children.setdefault(segment, [None, {}])
+            children = node[1]
+        if node[0] is not None:
+            raise ValueError(f"Маршрут {item.pattern!r} конфликтует с {node[0].pattern!r}")
+        node[0] = item
+
+    def resolve(self, data):
+        """(маршрут, параметры) для data или (None, None)"""
+        item = self.exact.get(data)
+        if item is not None:
+            return item, {}
+
+        # Спускаемся по сегментам и запоминаем маршруты на пути: от длинного к короткому
+        segments = data.split('_')
+        candidates = []
+        children = self._tree
+        for index, segment in enumerate(segments[:-1]):
+            node = children.get(segment)
+            if node is None:
+                break
+            if node[0] is not None:
+                candidates.append((node[0], index + 1))
+            children = node[1]
+
+        for item, consumed in reversed(candidates):
+            try:
+                value = item.convert('_'.join(segments[consumed:]))
+            except ValueError:
+                continue
+            return item, {item.param: value}
+        return None, None
+
+    async def dispatch(self, panel, data, update, context, *call_args):
+        """Вызвать обработчик маршрута; False, если маршрута нет"""
+        item, params = self.resolve(data)
+        if item is None:
+            self.misses += 1
+            return False
+        if item.method is None:
+            item.calls += 1
+            return True
+
+        handler = getattr(panel, item.method)
+        started = time.perf_counter()
+        try:
+            await handler(update, context, *call_args, *item.args, **item.kwargs, **params)
+        except Exception:
+            item.errors += 1
+            raise
+        finally:
+            item.calls += 1
+            item.total_seconds += time.perf_counter() - started
+        return True
+
+    def stats(self, limit=None):
+        """Маршруты с вызовами: самые частые первыми"""
+        routes = list(self.exact.values())
+        nodes = [self._tree]
+        while nodes:
+            for item, children in nodes.pop().values():
+                if item is not None:
+                    routes.append(item)
+                nodes.append(children)
+
+        used = sorted((item for item in routes if item.calls), key=lambda item: item.calls, reverse=True)
+        return {
+            'misses': self.misses,
+            'routes': {
+                item.pattern: {
+                    'calls': item.calls,
+                    'errors': item.errors,
+                    'avg_ms': round(item.total_seconds / item.calls * 1000, 2),
+                }
+                for item in used[:limit]
+            },
+        }
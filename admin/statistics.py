@@ -4,21 +4,43 @@
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import logging
-import io
+import asyncio
 import html
 
+from cohorts import cohort_rate
+from csv_export import EXPORT_TITLES, export_cohorts_csv_gzip, export_csv_gzip
+from .router import route, prompt
+
 logger = logging.getLogger(__name__)
 
 
 class StatisticsMixin:
     """Миксин для работы со статистикой"""
     
+    CALLBACK_ROUTES = (
+        route("admin_stats", "show_statistics"),
+        route("admin_payment_stats", "show_payment_statistics"),
+        route("admin_funnel_stats", "show_funnel_statistics"),
+        route("admin_send_load", "show_send_load"),
+        route("admin_cohorts", "show_cohorts"),
+        route("export_cohorts", "send_cohorts_export"),
+        route("admin_msg_detail_{message_number}", "show_message_details"),
+        route("admin_users", "show_users_list"),
+        route("users_page_{page}", "show_users_list"),
+        prompt("users_search", "user_search"),
+        route("download_csv", "show_export_menu"),
+        route("export_csv_{export:str}", "send_csv_export_callback"),
+    )
+    INPUT_ROUTES = (
+        route("user_search", "handle_user_search_input"),
+    )
+    
     async def show_statistics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать расширенную статистику"""
-        stats = self.db.get_user_statistics()
-        payment_stats = self.db.get_payment_statistics()
+        stats = await self.analytics.query('get_user_statistics')
+        payment_stats = await self.analytics.query('get_payment_statistics')
         
         text = (
             "📊 <b>Статистика бота</b>\n\n"
@@ -44,15 +66,94 @@ class StatisticsMixin:
         keyboard = [
             [InlineKeyboardButton("📊 Детали платежей", callback_data="admin_payment_stats")],
             [InlineKeyboardButton("🔄 Статистика воронки", callback_data="admin_funnel_stats")],
+            [InlineKeyboardButton("📈 Нагрузка на 24 часа", callback_data="admin_send_load")],
+            [InlineKeyboardButton("📅 Когорты по неделям", callback_data="admin_cohorts")],
             [InlineKeyboardButton("« Назад", callback_data="admin_back")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await self.safe_edit_or_send_message(update, context, text, reply_markup)
     
+    async def show_send_load(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показать прогноз отправок воронки по часам на ближайшие 24 часа"""
+        calendar = self.send_calendar
+        projection = await asyncio.to_thread(calendar.projected_load, 24)
+        
+        text = "📈 <b>Прогноз отправок воронки на 24 часа</b>\n\n"
+        if calendar.enabled:
+            text += (
+                f"⚙️ Бюджет: <b>{calendar.budget}</b> в минуту, окно ±{calendar.jitter_minutes} мин\n"
+                f"↔️ Сдвинуто с запуска: {calendar.shifted}, без свободной минуты: {calendar.overflow}\n\n"
+            )
+        else:
+            text += "⚙️ Сглаживание выключено (FUNNEL_SEND_BUDGET не задан)\n\n"
+        
+        busiest = max(sends for hour_start, sends, peak, over_budget in projection) or 1
+        lines = []
+        for hour_start, sends, peak, over_budget in projection:
+            bar = "█" * round(sends / busiest * 10)
+            line = f"{hour_start.strftime('%H:%M')} {bar:<10} {sends:>6} пик {peak}/мин"
+            if over_budget:
+                line += f" ⚠️{over_budget}"
+            lines.append(line)
+        text += "<pre>" + "\n".join(lines) + "</pre>\n\n"
+        
+        total = sum(sends for hour_start, sends, peak, over_budget in projection)
+        peak = max(peak for hour_start, sends, peak, over_budget in projection)
+        text += f"📬 Всего: <b>{total}</b>, пиковая минута: <b>{peak}</b>"
+        if calendar.enabled:
+            text += "\n⚠️N — минут в часе сверх бюджета"
+        
+        keyboard = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_send_load")],
+            [InlineKeyboardButton("« Назад", callback_data="admin_stats")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await self.safe_edit_or_send_message(update, context, text, reply_markup)
+    
+    async def show_cohorts(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показать когорты по неделе прихода и время до первой оплаты"""
+        report = await self.analytics.query('get_cohort_report')
+        
+        if not report:
+            text = "❌ <b>Ошибка при построении когортного отчета</b>"
+            keyboard = [[InlineKeyboardButton("« Назад", callback_data="admin_stats")]]
+            await self.safe_edit_or_send_message(update, context, text, InlineKeyboardMarkup(keyboard))
+            return
+        
+        text = (
+            "📅 <b>Когорты по неделе прихода</b>\n\n"
+            "Старт — запустили бота, Опл — оплатили, Прод — продлили (% от оплативших)\n\n"
+        )
+        lines = [f"{'Неделя':<6} {'Пришли':>6} {'Старт':>6} {'Опл':>6} {'Прод':>6}"]
+        for cohort in report['cohorts']:
+            lines.append(
+                f"{cohort['week_start'].strftime('%d.%m'):<6} {cohort['joined']:>6} "
+                f"{cohort_rate(cohort['started'], cohort['joined']):>5}% "
+                f"{cohort_rate(cohort['paid'], cohort['joined']):>5}% "
+                f"{cohort_rate(cohort['renewed'], cohort['paid']):>5}%"
+            )
+        text += "<pre>" + "\n".join(lines) + "</pre>\n\n"
+        
+        text += f"⏱ <b>Время до первой оплаты</b> ({report['paid_users']} оплативших):\n"
+        for label, count in report['time_to_pay']:
+            text += f"• {label}: {count} ({cohort_rate(count, report['paid_users'])}%)\n"
+        if report['median_hours'] is not None:
+            text += f"\nМедиана: <b>{report['median_hours']} ч</b>"
+        
+        keyboard = [
+            [InlineKeyboardButton("📥 Выгрузить CSV", callback_data="export_cohorts")],
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_cohorts")],
+            [InlineKeyboardButton("« Назад", callback_data="admin_stats")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await self.safe_edit_or_send_message(update, context, text, reply_markup)
+    
     async def show_payment_statistics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать статистику платежей"""
-        stats = self.db.get_payment_statistics()
+        stats = await self.analytics.query('get_payment_statistics')
         
         if not stats:
             text = "❌ <b>Ошибка при получении статистики платежей</b>"
@@ -83,7 +184,7 @@ class StatisticsMixin:
             text += "📋 <b>Последние платежи:</b>\n"
             for user_id, first_name, username, amount, created_at in stats['recent_payments'][:5]:
                 username_str = f"@{username}" if username else "без username"
-                date_str = datetime.fromisoformat(created_at).strftime("%d.%m %H:%M")
+                date_str = created_at.strftime("%d.%m %H:%M")
                 text += f"• {html.escape(str(first_name))} ({html.escape(username_str)}): {amount} руб. - {date_str}\n"
         
         keyboard = [
@@ -98,7 +199,7 @@ class StatisticsMixin:
         """Показать статистику воронки рассылки"""
         try:
             # Получаем данные воронки
-            funnel_data = self.db.get_funnel_data()
+            funnel_data = await self.analytics.query('get_funnel_data')
             
             if not funnel_data:
                 text = (
@@ -113,7 +214,7 @@ class StatisticsMixin:
                 text = "📊 <b>ВОРОНКА РАССЫЛКИ</b>\n\n"
                 
                 # Находим сообщение с максимальным отвалом
-                biggest_drop = self.db.get_biggest_drop_message()
+                biggest_drop = self.db.get_biggest_drop_message(funnel_data)
                 
                 for msg_data in funnel_data:
                     message_number = msg_data['message_number']
@@ -181,11 +282,24 @@ class StatisticsMixin:
             reply_markup = InlineKeyboardMarkup(keyboard)
             await self.safe_edit_or_send_message(update, context, text, reply_markup)
     
+    @staticmethod
+    def _format_duration(seconds):
+        """Длительность для отчетов: 45 сек, 3 мин 20 сек, 2 ч 5 мин"""
+        if seconds < 60:
+            return f"{int(seconds)} сек"
+        if seconds < 3600:
+            minutes = int(seconds / 60)
+            rest = int(seconds % 60)
+            return f"{minutes} мин {rest} сек" if rest else f"{minutes} мин"
+        hours = int(seconds / 3600)
+        minutes = int((seconds % 3600) / 60)
+        return f"{hours} ч {minutes} мин" if minutes else f"{hours} ч"
+    
     async def show_message_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_number: int):
         """Показать детальную статистику по конкретному сообщению"""
         try:
             # Получаем детализацию
-            details = self.db.get_message_details(message_number)
+            details = await self.analytics.query('get_message_details', message_number)
             
             if not details:
                 text = f"❌ <b>Сообщение {message_number} не найдено</b>"
@@ -214,20 +328,22 @@ class StatisticsMixin:
             else:
                 text += f"📬 <b>Отправлено:</b> {delivered} пользователям\n"
                 
-                # Среднее время реакции
+                # Время реакции: среднее и перцентили по гистограмме
                 if avg_reaction_time > 0:
-                    if avg_reaction_time < 60:
-                        time_str = f"{int(avg_reaction_time)} сек"
-                    elif avg_reaction_time < 3600:
-                        minutes = int(avg_reaction_time / 60)
-                        seconds = int(avg_reaction_time % 60)
-                        time_str = f"{minutes} мин {seconds} сек"
-                    else:
-                        hours = int(avg_reaction_time / 3600)
-                        minutes = int((avg_reaction_time % 3600) / 60)
-                        time_str = f"{hours} ч {minutes} мин"
+                    text += f"⏰ <b>Среднее время реакции:</b> {self._format_duration(avg_reaction_time)}\n"
+                    
+                    percentiles = details['reaction_percentiles']
+                    if percentiles:
+                        text += "📈 <b>Реакция (перцентили):</b> " + ", ".join(
+                            f"p{p} ≤ {self._format_duration(seconds)}" for p, seconds in sorted(percentiles.items())
+                        ) + "\n"
                     
-                    text += f"⏰ <b>Среднее время реакции:</b> {time_str}\n\n"
+                    clicked_within = details['clicked_within']
+                    if clicked_within:
+                        text += "⚡ <b>Нажали за:</b> " + ", ".join(
+                            f"{self._format_duration(minutes * 60)} — {count}" for minutes, count in sorted(clicked_within.items())
+                        ) + "\n"
+                    text += "\n"
                 else:
                     text += f"⏰ <b>Среднее время реакции:</b> Нет данных\n\n"
                 
@@ -285,57 +401,181 @@ class StatisticsMixin:
             reply_markup = InlineKeyboardMarkup(keyboard)
             await self.safe_edit_or_send_message(update, context, text, reply_markup)
     
-    async def show_users_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Показать список пользователей"""
-        users = self.db.get_latest_users(10)
+    # Пользователей на странице списка и результатов поиска
+    USERS_PAGE_SIZE = 10
+    
+    def _format_user_line(self, user):
+        """Строка пользователя для списка и результатов поиска"""
+        user_id_db, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at = user
+        paid_icon = "💰" if has_paid else ""
+        active_icon = "" if is_active else "🚫"
+        
+        username_str = f"@{username}" if username else "без username"
+        join_date = joined_at.strftime("%d.%m.%Y %H:%M")
+        bot_status = "💬" if bot_started else "❌"
+        # Экранируем пользовательские данные
+        return f"• {html.escape(str(first_name))} ({html.escape(username_str)}) {bot_status}{paid_icon}{active_icon}\n  ID: {user_id_db}, {join_date}\n\n"
+    
+    async def show_users_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page=None, query=None):
+        """Показать список пользователей (или результаты поиска) постранично
+        
+        Страницы листаются keyset-курсорами: для страницы N хранится курсор
+        последней строки страницы N-1, поэтому каждая страница стоит O(размер
+        страницы) без OFFSET. Курсоры лежат в памяти у админа, в callback_data
+        передается только номер страницы.
+        """
+        admin_id = update.effective_user.id
+        browser = self.users_browser.get(admin_id)
+        
+        if page is None or browser is None:
+            # Новый список или новый поиск
+            browser = {"query": query, "cursors": [None]}
+            self.users_browser[admin_id] = browser
+            page = 1
+        elif page > len(browser["cursors"]):
+            # Курсор страницы потерян (например, после перезапуска) — начинаем сначала
+            page = 1
+        
+        cursor_before = browser["cursors"][page - 1]
+        if browser["query"] is None:
+            users, next_cursor = await asyncio.to_thread(
+                self.db.get_users_page, self.USERS_PAGE_SIZE, cursor_before
+            )
+            total = (await self.analytics.query('get_user_statistics'))["total_users"]
+            title = "👥 <b>Список пользователей</b>\n\n"
+            empty_text = "Пользователей пока нет."
+            header = "<b>Новые регистрации:</b>\n\n"
+        else:
+            users, next_cursor, total = await asyncio.to_thread(
+                self.db.search_users, browser["query"], self.USERS_PAGE_SIZE, cursor_before
+            )
+            title = f"🔍 <b>Поиск:</b> <code>{html.escape(browser['query'])}</code>\n\n"
+            empty_text = "Никого не найдено."
+            header = f"<b>Найдено: {total}</b>\n\n"
+        
+        # Курсор следующей страницы запоминаем, как только он стал известен
+        del browser["cursors"][page:]
+        if next_cursor is not None:
+            browser["cursors"].append(next_cursor)
         
         if not users:
-            text = "👥 <b>Список пользователей</b>\n\nПользователей пока нет."
+            text = title + empty_text
         else:
-            text = "👥 <b>Список пользователей</b>\n\n<b>Последние 10 регистраций:</b>\n\n"
+            text = title + header
             for user in users:
-                if len(user) >= 8:  # Новый формат с полями has_paid и paid_at
-                    user_id_db, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at = user
-                    paid_icon = "💰" if has_paid else ""
-                else:  # Старый формат
-                    user_id_db, username, first_name, joined_at, is_active, bot_started = user
-                    paid_icon = ""
-                
-                username_str = f"@{username}" if username else "без username"
-                join_date = datetime.fromisoformat(joined_at).strftime("%d.%m.%Y %H:%M")
-                bot_status = "💬" if bot_started else "❌"
-                # Экранируем пользовательские данные
-                text += f"• {html.escape(str(first_name))} ({html.escape(username_str)}) {bot_status}{paid_icon}\n  ID: {user_id_db}, {join_date}\n\n"
+                text += self._format_user_line(user)
             
             text += "\n💬 - может получать рассылки\n❌ - нужно написать боту /start\n💰 - оплатил"
+            if browser["query"] is not None:
+                text += "\n🚫 - отписался"
         
-        keyboard = [
-            [InlineKeyboardButton("📊 Скачать CSV", callback_data="download_csv")],
-            [InlineKeyboardButton("« Назад", callback_data="admin_back")]
+        # Счетчик может немного отставать от данных — страниц не меньше, чем уже открыто
+        total_pages = max((total + self.USERS_PAGE_SIZE - 1) // self.USERS_PAGE_SIZE, len(browser["cursors"]))
+        pagination = [
+            InlineKeyboardButton(button["text"], callback_data=button["callback_data"])
+            for button in self.create_pagination_buttons(page, total_pages, prefix="users_page")
         ]
+        
+        keyboard = []
+        if pagination:
+            keyboard.append(pagination)
+        keyboard.append([InlineKeyboardButton("🔍 Поиск по имени / ID", callback_data="users_search")])
+        if browser["query"] is not None:
+            keyboard.append([InlineKeyboardButton("👥 Все пользователи", callback_data="admin_users")])
+        keyboard.append([InlineKeyboardButton("📥 Выгрузить CSV", callback_data="download_csv")])
+        keyboard.append([InlineKeyboardButton("« Назад", callback_data="admin_back")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await self.safe_edit_or_send_message(update, context, text, reply_markup)
     
-    async def send_csv_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить CSV файл с пользователями"""
+    async def handle_user_search_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Обработка запроса поиска пользователей"""
+        user_id = update.effective_user.id
+        # Ищем по исходному тексту, а не по HTML-разметке
+        query = (update.message.text or "").strip()
+        
+        if not query or len(query) > 64:
+            await update.message.reply_text("❌ Введите от 1 до 64 символов: ID, @username или имя.")
+            return
+        
+        del self.waiting_for[user_id]
+        await self.show_users_list(update, context, query=query)
+    
+    async def show_export_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Меню выгрузок CSV: что выгрузить и за какой период"""
+        text = (
+            "📥 <b>Выгрузка данных</b>\n\n"
+            "Файлы приходят в формате <b>.csv.gz</b> (сжатый CSV — открывается "
+            "архиватором или напрямую в Excel / Google Таблицах после распаковки).\n\n"
+            "Выберите данные и период:"
+        )
+        
+        keyboard = []
+        for kind, (title, caption) in EXPORT_TITLES.items():
+            keyboard.append([
+                InlineKeyboardButton(f"{title}: 7 дн.", callback_data=f"export_csv_{kind}_7"),
+                InlineKeyboardButton("30 дн.", callback_data=f"export_csv_{kind}_30"),
+                InlineKeyboardButton("Всё", callback_data=f"export_csv_{kind}_0"),
+            ])
+        keyboard.append([InlineKeyboardButton("« Назад", callback_data="admin_users")])
+        
+        await self.safe_edit_or_send_message(update, context, text, InlineKeyboardMarkup(keyboard))
+    
+    async def send_csv_export_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, export: str):
+        """Кнопка выгрузки: export_csv_{вид}_{дней}"""
+        kind, days = export.rsplit("_", 1)
+        if kind not in EXPORT_TITLES:
+            await self.show_error_message(update, context, "❌ Неизвестная выгрузка.")
+            return
+        await self.send_csv_export(update, context, kind, int(days))
+    
+    async def send_csv_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE, kind, days=0):
+        """Отправить сжатую выгрузку CSV (строки идут потоком в gzip во временный файл)"""
+        chat_id = update.callback_query.from_user.id
+        date_from = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+        
+        export_file = None
         try:
-            csv_content = self.db.export_users_to_csv()
-            
-            csv_file = io.BytesIO()
-            csv_file.write(csv_content.encode('utf-8'))
-            csv_file.seek(0)
+            export_file, rows_count = await asyncio.to_thread(export_csv_gzip, self.db, kind, date_from)
             
+            title, caption = EXPORT_TITLES[kind]
+            period = f"за {days} дн." if days else "за всё время"
             await context.bot.send_document(
-                chat_id=update.callback_query.from_user.id,
-                document=csv_file,
-                filename=f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                caption="📊 Список всех пользователей бота"
+                chat_id=chat_id,
+                document=export_file,
+                filename=f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv.gz",
+                caption=f"{caption} {period}: {rows_count} строк"
             )
             
-            await update.callback_query.answer("CSV файл отправлен!")
+        except Exception as e:
+            if 'Event loop is closed' not in str(e):
+                logger.error(f"Ошибка при выгрузке CSV {kind}: {e}")
+            await context.bot.send_message(chat_id=chat_id, text="❌ Ошибка при создании файла!")
+        finally:
+            if export_file is not None:
+                export_file.close()
+    
+    async def send_cohorts_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отправить когортный отчет за все недели сжатым CSV (считается на снимке, как и экран)"""
+        chat_id = update.callback_query.from_user.id
+        
+        export_file = None
+        try:
+            report = await self.analytics.query('get_cohort_report', None)
+            if not report:
+                raise RuntimeError("когортный отчет не построен")
+            export_file, rows_count = await asyncio.to_thread(export_cohorts_csv_gzip, report)
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=export_file,
+                filename=f"cohorts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv.gz",
+                caption=f"📅 Когорты по неделе прихода: {rows_count} недель"
+            )
             
         except Exception as e:
             if 'Event loop is closed' not in str(e):
-                logger.error(f"Ошибка при отправке CSV: {e}")
-            await update.callback_query.answer("Ошибка при создании файла!", show_alert=True)
+                logger.error(f"Ошибка при выгрузке когорт: {e}")
+            await context.bot.send_message(chat_id=chat_id, text="❌ Ошибка при создании файла!")
+        finally:
+            if export_file is not None:
+                export_file.close()
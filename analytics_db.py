@@ -0,0 +1,250 @@
+"""
+Отдельная SQLite база для аналитических событий
+
+Таблицы событий (message_deliveries, button_clicks, payments) живут в своем
+файле рядом с основной БД. У него свой WAL и своя блокировка записи, поэтому
+логирование событий и тяжелые отчеты не конкурируют с циклом отправки
+за блокировку основной БД.
+
+- AnalyticsConnectionPool — переиспользуемые соединения с аналитической БД,
+  основная БД подключена к ним через ATTACH как `bot` (для join с users)
+- AnalyticsWriteQueue — фоновый поток, который пачками пишет события
+"""
+
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Имя схемы основной БД внутри аналитических соединений
+BOT_SCHEMA = 'bot'
+
+
+def read_only_uri(path):
+    """URI для открытия SQLite файла только на чтение"""
+    return f"{Path(path).resolve().as_uri()}?mode=ro"
+
+
+class AnalyticsConnectionPool:
+    """Небольшой пул соединений с аналитической БД"""
+
+    def __init__(self, analytics_path, bot_db_path, size=4, read_only=False):
+        self.analytics_path = str(analytics_path)
+        self.bot_db_path = str(bot_db_path)
+        self.size = size
+        self.read_only = read_only
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        if self.read_only:
+            conn = sqlite3.connect(
+                read_only_uri(self.analytics_path),
+                timeout=30,
+                check_same_thread=False,
+                isolation_level=None,
+                uri=True
+            )
+            conn.execute(f'ATTACH DATABASE ? AS {BOT_SCHEMA}', (read_only_uri(self.bot_db_path),))
+        else:
+            conn = sqlite3.connect(
+                self.analytics_path,
+                timeout=30,
+                check_same_thread=False,
+                isolation_level=None  # Автокоммит
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'ATTACH DATABASE ? AS {BOT_SCHEMA}', (self.bot_db_path,))
+        conn.execute('PRAGMA cache_size=10000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def acquire(self):
+        """Взять соединение из пула (или открыть новое, если свободных нет)"""
+        if os.getpid() != self._pid:
+            # После fork соединения родителя использовать нельзя
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """Вернуть соединение в пул; лишние соединения закрываются"""
+        if conn is None:
+            return
+        if self.closed or os.getpid() != self._pid or self._idle.qsize() >= self.size:
+            conn.close()
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except Exception:
+            conn.close()
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class AnalyticsWriteQueue:
+    """Очередь записи событий: фоновый поток пишет их пачками в одной транзакции
+
+    Временные ошибки SQLite (БД занята, ошибка ввода-вывода) повторяются
+    с растущей паузой. Если пачку отвергает само событие, пачка делится
+    пополам, пока не останется одно плохое событие — отбрасывается только оно.
+    """
+
+    # Коды SQLite, после которых пачку стоит повторить целиком
+    TRANSIENT_ERRORS = frozenset((
+        sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED, sqlite3.SQLITE_IOERR, sqlite3.SQLITE_FULL,
+    ))
+
+    def __init__(self, analytics_path, batch_size=500, flush_interval=0.5, retry_attempts=5, retry_backoff=0.5):
+        self.analytics_path = str(analytics_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue()
+        self._conn = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, sql, params):
+        """Поставить INSERT в очередь, не дожидаясь записи на диск"""
+        self._ensure_started()
+        self._queue.put((sql, params))
+
+    def flush(self, timeout=None):
+        """Дождаться записи всех событий, поставленных в очередь"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        if timeout is None:
+            self._queue.join()
+            return
+
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # Поток родителя после fork не существует — начинаем с чистой очереди
+                self._queue = queue.Queue()
+                self._conn = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush, 5)
+
+    def _take_batch(self):
+        """Дождаться первого события и добрать пачку из того, что уже в очереди"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, conn, batch):
+        grouped = {}
+        for sql, params in batch:
+            grouped.setdefault(sql, []).append(params)
+
+        conn.execute('BEGIN')
+        try:
+            for sql, rows in grouped.items():
+                conn.executemany(sql, rows)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _is_transient(self, error):
+        return (
+            isinstance(error, sqlite3.OperationalError)
+            and (getattr(error, 'sqlite_errorcode', sqlite3.SQLITE_BUSY) & 0xff) in self.TRANSIENT_ERRORS
+        )
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.analytics_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn = conn
+        return self._conn
+
+    def _reconnect(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _write(self, batch):
+        """Записать пачку: временные ошибки повторить, на остальных изолировать плохое событие"""
+        for attempt in range(self.retry_attempts):
+            try:
+                self._write_batch(self._connection(), batch)
+                logger.debug(f"📝 Записано аналитических событий: {len(batch)}")
+                return
+            except Exception as e:
+                if not self._is_transient(e):
+                    if self._conn is None:
+                        # БД не открылась — события ни при чем, делить пачку бессмысленно
+                        raise
+                    error = e
+                    break
+                self._reconnect()
+                if attempt + 1 == self.retry_attempts:
+                    logger.error(f"❌ Не удалось записать {len(batch)} аналитических событий после {self.retry_attempts} попыток: {e}")
+                    return
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f"⚠️ Аналитическая БД недоступна ({e}), повтор через {delay:.1f} сек")
+                time.sleep(delay)
+
+        if len(batch) == 1:
+            sql, params = batch[0]
+            logger.error(f"❌ Аналитическое событие отброшено: {error}; {' '.join(sql.split())} {params}")
+            return
+
+        middle = len(batch) // 2
+        self._write(batch[:middle])
+        self._write(batch[middle:])
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"❌ Не удалось записать {len(batch)} аналитических событий: {e}")
+                self._reconnect()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
@@ -0,0 +1,184 @@
+"""
+Тяжелые отчеты админ-панели на read-only снимке БД
+
+Статистика и воронка считаются не на живой БД и не в потоке event loop:
+запросы выполняются в пуле потоков на копии, сделанной через SQLite online
+backup API и открытой в режиме mode=ro. Снимок обновляется не чаще чем раз
+в max_age секунд (и только когда отчеты запрашивают), результаты отчетов
+кэшируются на ttl секунд — повторные нажатия "🔄 Обновить" ничего не стоят.
+
+Цена снимка: каждое обновление — полная копия обеих БД на диск (чтение
+всей БД и запись такого же объема), и на время, пока отчеты дорабатывают
+на прошлом снимке, на диске лежат две копии. На большой БД интервал
+(ANALYTICS_SNAPSHOT_MAX_AGE, секунды) стоит увеличить, а каталог снимков
+(ANALYTICS_SNAPSHOT_DIR, по умолчанию системный tmp) вынести на диск, где
+хватает места для двух копий.
+"""
+
+import asyncio
+import atexit
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from analytics_db import AnalyticsConnectionPool, read_only_uri
+from cohorts import CohortColumns
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotDatabase(Database):
+    """Database поверх read-only копии: миграции не выполняются, запись невозможна"""
+
+    def __init__(self, db_path, analytics_db_path, schema_version, cohorts=None):
+        self.db_path = str(db_path)
+        self.analytics_db_path = str(analytics_db_path)
+        self._analytics_pool = AnalyticsConnectionPool(self.analytics_db_path, self.db_path, read_only=True)
+        self._analytics_writes = None
+        self.last_diagnostics = None
+        self.schema_version = schema_version
+        # Колонки когорт общие со всеми снимками: каждый дочитывает только новое
+        self.cohorts = cohorts if cohorts is not None else CohortColumns()
+        # Отчеты, которые сейчас выполняются на снимке; retired — снимок уже заменен новым
+        self.in_use = 0
+        self.retired = False
+
+    def _get_connection(self):
+        return sqlite3.connect(
+            read_only_uri(self.db_path),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+            uri=True
+        )
+
+    def close(self):
+        self._analytics_pool.close()
+
+
+class AnalyticsSnapshotExecutor:
+    """Выполнение методов отчетов Database на снимке в пуле потоков с TTL кэшем"""
+
+    def __init__(self, db, max_age: float = None, ttl: float = 30.0, workers: int = 2, snapshot_dir=None):
+        self.db = db
+        if max_age is None:
+            max_age = float(os.environ.get('ANALYTICS_SNAPSHOT_MAX_AGE', 30))
+        self.max_age = max_age
+        self.ttl = ttl
+        # Каталог, в котором создаются снимки (None — системный tmp)
+        self.snapshot_dir = snapshot_dir or os.environ.get('ANALYTICS_SNAPSHOT_DIR') or None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analytics-snapshot')
+        self._refresh_lock = threading.Lock()
+        self._snapshot_root = None
+        self._snapshot = None
+        self._snapshot_taken_at = 0.0
+        self._generation = 0
+        self._memo = {}
+
+    async def query(self, method, *args):
+        """Выполнить метод отчета Database (например, 'get_funnel_data') на снимке"""
+        key = (method, args)
+        now = time.monotonic()
+        self._memo = {k: v for k, v in self._memo.items() if v[0] > now}
+
+        cached = self._memo.get(key)
+        if cached:
+            # Одинаковые запросы, пришедшие одновременно, ждут одно вычисление
+            future = cached[1]
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, self._call, method, args)
+            self._memo[key] = (now + self.ttl, future)
+
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self._memo.pop(key, None)
+            raise
+
+    def invalidate(self):
+        """Сбросить кэш отчетов (следующий запрос пересчитается на свежем снимке)"""
+        self._memo.clear()
+        self._snapshot_taken_at = 0.0
+
+    def _call(self, method, args):
+        snapshot = self._acquire()
+        try:
+            return getattr(snapshot, method)(*args)
+        finally:
+            self._release(snapshot)
+
+    def _acquire(self):
+        """Текущий снимок (обновленный при необходимости), занятый до _release"""
+        with self._refresh_lock:
+            if self._snapshot is None or time.monotonic() - self._snapshot_taken_at > self.max_age:
+                self._refresh()
+            self._snapshot.in_use += 1
+            return self._snapshot
+
+    def _release(self, snapshot):
+        with self._refresh_lock:
+            snapshot.in_use -= 1
+            if snapshot.retired and not snapshot.in_use:
+                self._dispose(snapshot)
+
+    @staticmethod
+    def _dispose(snapshot):
+        """Закрыть снимок и удалить его файлы (когда на нем не идет ни один отчет)"""
+        snapshot.close()
+        shutil.rmtree(os.path.dirname(snapshot.db_path), ignore_errors=True)
+
+    def _refresh(self):
+        """Сделать новый снимок обеих БД и переключить на него отчеты (под _refresh_lock)"""
+        started = time.monotonic()
+
+        if self._snapshot_root is None:
+            self._snapshot_root = tempfile.mkdtemp(prefix='bot_snapshot_', dir=self.snapshot_dir)
+            atexit.register(shutil.rmtree, self._snapshot_root, True)
+
+        self._generation += 1
+        snapshot_dir = os.path.join(self._snapshot_root, str(self._generation))
+        os.makedirs(snapshot_dir)
+
+        db_copy = os.path.join(snapshot_dir, 'bot.db')
+        analytics_copy = os.path.join(snapshot_dir, 'analytics.db')
+        self._backup(self.db.db_path, db_copy)
+        self._backup(self.db.analytics_db_path, analytics_copy)
+
+        previous = self._snapshot
+        self._snapshot = SnapshotDatabase(db_copy, analytics_copy, self.db.schema_version, self.db.cohorts)
+        self._snapshot_taken_at = time.monotonic()
+
+        if previous is not None:
+            # Отчеты, которые еще идут на старом снимке, открывают новые соединения
+            # к его файлам — удаляем его, только когда последний из них завершится
+            previous.retired = True
+            if not previous.in_use:
+                self._dispose(previous)
+
+        logger.info(f"📸 Снимок БД для аналитики обновлен за {(time.monotonic() - started) * 1000:.0f} мс")
+
+    @staticmethod
+    def _backup(source_path, target_path):
+        source = sqlite3.connect(source_path, timeout=30)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+            # Копия читается только в mode=ro, WAL ей не нужен
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+            source.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._snapshot is not None:
+            self._snapshot.close()
+        if self._snapshot_root is not None:
+            shutil.rmtree(self._snapshot_root, ignore_errors=True)
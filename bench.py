@@ -0,0 +1,989 @@
+"""
+Бенчмарки бота
+
+Запуск:
+    python bench.py startup --users 100000
+    python bench.py next-msg --users 50000 --clicks 2000
+    python bench.py funnel-engine --users 100000
+    python bench.py stats --users 100000
+    python bench.py export --users 500000
+    python bench.py users --users 1000000
+    python bench.py click-redirect --users 10000 --clicks 20000
+    python bench.py admin-router --clicks 100000
+    python bench.py logging --clicks 20000
+    python bench.py telegram-transport --clicks 2000
+    python bench.py join-burst --clicks 300
+    python bench.py epoch-ranges --users 200000
+    python bench.py promo-spike --users 5000
+    python bench.py user-state --users 100000
+    python bench.py segments --users 1000000
+    python bench.py cohorts --users 1000000
+
+Каждая подкоманда работает на временной копии БД и печатает результаты в stdout.
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import ClientSession, web
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from admin import AdminPanel
+from admin.router import AdminRouter
+from click_tracking import ClickTracker
+from csv_export import export_csv_gzip
+from database import Database
+from join_pipeline import JoinPipeline
+from load_shaping import SendCalendar
+from log_pipeline import recipient, setup_logging
+from scheduler import MessageScheduler
+from telegram_transport import BULK, INTERACTIVE, TelegramTransport
+
+
+def _timeit(func, repeat):
+    """Выполнить func repeat раз, вернуть список длительностей в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def _report(title, timings):
+    median = statistics.median(timings)
+    print(f"  {title:<45} медиана {median:8.2f} мс, макс {max(timings):8.2f} мс")
+
+
+def _report_percentiles(title, timings):
+    ordered = sorted(timings)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"  {title:<45} p50 {p50:8.2f} мс, p99 {p99:8.2f} мс")
+
+
+class _FakeBot:
+    """Bot без сети: измеряется только работа бота, а не Telegram API"""
+
+    async def send_message(self, **kwargs):
+        return None
+
+    async def send_photo(self, **kwargs):
+        return None
+
+
+class _FakeContext:
+    def __init__(self):
+        self.bot = _FakeBot()
+
+
+def fill_database(db_path, users):
+    """Создать БД и наполнить её пользователями, сообщениями и событиями воронки"""
+    db = Database(db_path)
+    now = datetime.now()
+
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        'INSERT INTO users (user_id, username, first_name, is_active, bot_started, has_paid) VALUES (?, ?, ?, 1, 1, ?)',
+        ((user_id, f"user{user_id}", "Bench", int(user_id % 10 == 0)) for user_id in range(1, users + 1))
+    )
+    conn.executemany(
+        'INSERT INTO scheduled_messages (user_id, message_number, scheduled_time, is_sent) VALUES (?, ?, ?, ?)',
+        ((user_id, n, int((now + timedelta(hours=n)).timestamp()), int(n < 3))
+         for user_id in range(1, users + 1) for n in range(1, 6))
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(db.analytics_db_path)
+    conn.executemany(
+        'INSERT INTO message_deliveries (user_id, message_number) VALUES (?, ?)',
+        ((user_id, n) for user_id in range(1, users + 1) for n in range(1, 3))
+    )
+    conn.commit()
+    conn.close()
+    return db
+
+
+def bench_startup(args):
+    """Время старта: конструктор Database и диагностика на заполненной БД"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        fill_database(db_path, args.users)
+        print(f"  размер БД: {os.path.getsize(db_path) / (1024 * 1024):.1f} МБ")
+
+        cold_path = os.path.join(tmp_dir, 'cold.db')
+        cold_analytics_path = os.path.join(tmp_dir, 'cold_analytics.db')
+
+        def cold_start():
+            for path in (cold_path, cold_analytics_path):
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+            Database(cold_path)
+
+        db = Database(db_path)
+
+        print("\n🚀 Старт:")
+        _report("Database() на пустой БД (все миграции)", _timeit(cold_start, args.repeat))
+        _report("Database() на актуальной схеме", _timeit(lambda: Database(db_path), args.repeat))
+
+        print("\n🔍 Диагностика:")
+        _report("get_database_info() (легкая)", _timeit(db.get_database_info, args.repeat))
+        _report("get_database_info(full=True)", _timeit(lambda: db.get_database_info(full=True), args.repeat))
+
+
+def _legacy_next_message_click(db, user_id):
+    """Прежний путь нажатия: поиск последнего отправленного, захват следующего, кнопки"""
+    conn = db._get_connection()
+    conn.execute('''
+        SELECT message_number FROM scheduled_messages
+        WHERE user_id = ? AND is_sent = 1
+        ORDER BY id DESC LIMIT 1
+    ''', (user_id,)).fetchone()
+    conn.close()
+
+    conn = db._get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    claimed = conn.execute('''
+        UPDATE scheduled_messages SET claimed_by = 'bench'
+        WHERE id = (
+            SELECT id FROM scheduled_messages
+            WHERE user_id = ? AND is_sent = 0
+            ORDER BY message_number ASC LIMIT 1
+        )
+        RETURNING id, message_number
+    ''', (user_id,)).fetchone()
+    conn.execute('''
+        SELECT bm.text, bm.photo_url FROM scheduled_messages sm
+        JOIN broadcast_messages bm ON sm.message_number = bm.message_number
+        WHERE sm.id = ?
+    ''', (claimed[0],)).fetchone()
+    conn.execute('COMMIT')
+    conn.close()
+
+    db.get_message_buttons(claimed[1])
+    db.mark_message_sent(claimed[0])
+
+
+def bench_next_message(args):
+    """Задержка нажатия "следующее сообщение": прежний путь против курсора и payload"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        db = fill_database(db_path, args.users)
+        scheduler = MessageScheduler(db)
+        context = _FakeContext()
+
+        # В работающем боте БД всегда держит открытой пул аналитики; без этого
+        # закрытие последнего соединения делает checkpoint WAL и искажает замеры
+        keeper = sqlite3.connect(db_path)
+        keeper.execute('SELECT 1 FROM users LIMIT 1').fetchone()
+
+        # Разные пользователи для двух путей, чтобы они не влияли друг на друга
+        clicks = min(args.clicks, args.users // 2)
+        users = random.sample(range(1, args.users + 1), clicks * 2)
+        legacy_users, cursor_users = users[:clicks], users[clicks:]
+
+        legacy = _timeit_each(lambda user_id: _legacy_next_message_click(db, user_id), legacy_users)
+
+        async def click(user_id):
+            # У пользователей из fill_database отправлены шаги 1 и 2
+            await scheduler.send_next_scheduled_message(context, user_id, 2)
+
+        async def run_clicks():
+            timings = []
+            for user_id in cursor_users:
+                started = time.perf_counter()
+                await click(user_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            return timings
+
+        current = asyncio.run(run_clicks())
+        db.flush_analytics()
+        keeper.close()
+
+        print(f"\n👆 {clicks} нажатий подряд:")
+        _report_percentiles("прежний путь (поиск последнего шага)", legacy)
+        _report_percentiles("шаг в payload + готовый контент", current)
+
+
+def _table_size(db_path, table):
+    """Строки и занимаемое место таблицы вместе с её индексами (через dbstat)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        size = conn.execute('''
+            SELECT COALESCE(SUM(pgsize), 0) FROM dbstat
+            WHERE name = ? OR name IN (SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)
+        ''', (table, table)).fetchone()[0]
+        return rows, size
+    finally:
+        conn.close()
+
+
+def bench_funnel_engine(args):
+    """Размер расписания воронки: строка на шаг против курсора на пользователя"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        db = fill_database(db_path, args.users)
+
+        rows_before, size_before = _table_size(db_path, 'scheduled_messages')
+
+        started = time.perf_counter()
+        db.migrate_funnel_to_cursors('free')
+        migration_ms = (time.perf_counter() - started) * 1000
+
+        conn = sqlite3.connect(db_path)
+        conn.execute('VACUUM')
+        conn.close()
+        rows_after, size_after = _table_size(db_path, 'funnel_cursors')
+
+        # Захват пачки курсоров: сдвигаем начало воронки в прошлое, чтобы шаги были готовы
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE funnel_cursors SET started_at = started_at - 10 * 86400 WHERE started_at IS NOT NULL")
+        conn.commit()
+        conn.close()
+        conn = db._get_connection()
+        db._recompute_funnel_due_times(conn.cursor(), 'free')
+        conn.close()
+
+        print("\n🧭 Расписание воронки:")
+        print(f"  scheduled_messages: {rows_before} строк, {size_before / (1024 * 1024):.1f} МБ")
+        print(f"  funnel_cursors:     {rows_after} строк, {size_after / (1024 * 1024):.1f} МБ")
+        print(f"  перевод на курсоры: {migration_ms:.0f} мс")
+        _report("захват 50 готовых курсоров", _timeit(lambda: db.claim_due_funnel_cursors('bench', 'free', 50, 1), args.repeat))
+
+
+def bench_stats(args):
+    """Экраны статистики и health check на счетчиках против сверки полным пересчетом"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        db = fill_database(db_path, args.users)
+
+        print("\n🔢 Статистика:")
+        _report("get_user_statistics()", _timeit(db.get_user_statistics, args.repeat))
+        _report("get_payment_statistics()", _timeit(db.get_payment_statistics, args.repeat))
+        _report("get_database_health_check()", _timeit(db.get_database_health_check, args.repeat))
+        _report("reconcile_counters() (полный пересчет)", _timeit(db.reconcile_counters, args.repeat))
+
+
+def _export_peak_rss(db_path, kind, streaming, results):
+    """Выгрузка в отдельном процессе: прирост пикового RSS (МБ), время и размер файла"""
+    db = Database(db_path)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+
+    if streaming:
+        export_file, rows_count = export_csv_gzip(db, kind)
+        # send_document читает файл целиком — считаем и эту копию (уже сжатую)
+        size = len(export_file.read())
+        export_file.close()
+    else:
+        # Прежний путь: fetchall -> StringIO -> строка -> BytesIO
+        schema, header, query, date_column, order = db.EXPORTS[kind]
+        conn = db._get_analytics_connection() if schema == 'analytics' else db._get_connection()
+        rows = conn.execute(f'{query} ORDER BY {order}').fetchall()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(header)
+        writer.writerows(rows)
+        csv_file = io.BytesIO(output.getvalue().encode('utf-8'))
+        size = len(csv_file.getvalue())
+
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(((peak - baseline) / 1024, elapsed, size))
+
+
+def bench_export(args):
+    """Пиковая память выгрузки CSV: прежняя в памяти против потоковой с gzip"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей ({args.users * 2} доставок)...")
+        fill_database(db_path, args.users)
+
+        # Каждый замер — в чистом процессе, иначе пиковый RSS общий на весь бенчмарк
+        context = multiprocessing.get_context('spawn')
+        print("\n📥 Выгрузка доставок:")
+        for title, streaming in (("в памяти (прежний путь)", False), ("поток + gzip", True)):
+            results = context.Queue()
+            process = context.Process(target=_export_peak_rss, args=(db_path, 'deliveries', streaming, results))
+            process.start()
+            rss_mb, elapsed, size = results.get()
+            process.join()
+            print(f"  {title:<45} пик RSS +{rss_mb:7.1f} МБ, {elapsed:6.2f} с, файл {size / (1024 * 1024):6.1f} МБ")
+
+
+def bench_users(args):
+    """Страница списка пользователей: keyset-курсор против OFFSET, и поиск через FTS5"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        db = fill_database(db_path, args.users)
+        middle = args.users // 2
+
+        conn = db._get_connection()
+        joined_at, user_id = conn.execute(
+            'SELECT joined_at, user_id FROM users WHERE is_active = 1 '
+            'ORDER BY joined_at DESC, user_id DESC LIMIT 1 OFFSET ?', (middle,)
+        ).fetchone()
+
+        def offset_page():
+            conn.execute(
+                'SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at '
+                'FROM users WHERE is_active = 1 ORDER BY joined_at DESC, user_id DESC LIMIT 10 OFFSET ?', (middle,)
+            ).fetchall()
+
+        print(f"\n👥 Страница из середины списка (позиция {middle}):")
+        _report("OFFSET", _timeit(offset_page, args.repeat))
+        _report("keyset get_users_page()", _timeit(lambda: db.get_users_page(10, (joined_at, user_id)), args.repeat))
+        conn.close()
+
+        print("\n🔍 Поиск:")
+        _report("search_users('user12')", _timeit(lambda: db.search_users('user12'), args.repeat))
+        _report("search_users('@user123')", _timeit(lambda: db.search_users('@user123'), args.repeat))
+        _report(f"search_users('{middle}') по ID", _timeit(lambda: db.search_users(str(middle)), args.repeat))
+
+
+def bench_click_redirect(args):
+    """Пропускная способность редиректа /r/{token}: разбор токена, запись клика, 302"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+
+        print(f"📦 Заполняем БД: {args.users} пользователей...")
+        db = fill_database(db_path, args.users)
+        db.add_message_button(1, "Сайт", "https://example.com/landing?ref=bot")
+        button_id = db.get_message_buttons(1)[-1][0]
+
+        tracker = ClickTracker('bench-secret', 'http://127.0.0.1')
+        tokens = [
+            tracker.make_token('free', random.randint(1, args.users), 1, button_id)
+            for _ in range(args.clicks)
+        ]
+
+        print(f"\n🔐 В процессе ({args.clicks} токенов):")
+        started = time.perf_counter()
+        for token in tokens:
+            tracker.parse_token(token)
+        elapsed = time.perf_counter() - started
+        print(f"  parse_token()                               {args.clicks / elapsed:>10.0f} / с")
+
+        started = time.perf_counter()
+        for token in tokens:
+            tracker.resolve_click(db, token)
+        elapsed = time.perf_counter() - started
+        print(f"  resolve_click() (+ постановка в очередь)    {args.clicks / elapsed:>10.0f} / с")
+        db.flush_analytics()
+
+        async def run_http():
+            app = web.Application()
+            app.router.add_get(ClickTracker.ROUTE, tracker.redirect_handler(db))
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+
+            queue = iter(tokens)
+            statuses = []
+
+            async def client(session):
+                for token in queue:
+                    async with session.get(f"http://127.0.0.1:{port}/r/{token}", allow_redirects=False) as response:
+                        statuses.append(response.status)
+
+            async with ClientSession() as session:
+                started = time.perf_counter()
+                await asyncio.gather(*(client(session) for _ in range(50)))
+                elapsed = time.perf_counter() - started
+
+            await runner.cleanup()
+            return statuses, elapsed
+
+        statuses, elapsed = asyncio.run(run_http())
+        db.flush_analytics()
+        print(f"\n🌐 HTTP, 50 параллельных клиентов:")
+        print(f"  GET /r/{{token}} -> 302                       {len(statuses) / elapsed:>10.0f} / с")
+        print(f"  ответов 302: {statuses.count(302)} из {len(statuses)}")
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        clicks = conn.execute("SELECT COUNT(*) FROM button_clicks WHERE button_type = 'url'").fetchone()[0]
+        conn.close()
+        print(f"  записано кликов: {clicks} (ожидалось {2 * args.clicks})")
+
+
+def bench_admin_router(args):
+    """Поиск маршрута админ-панели: точное значение, параметр в конце, неизвестная команда"""
+    router = AdminRouter.collect(AdminPanel, 'CALLBACK_ROUTES')
+    print(f"🧭 Маршрутов: {len(router.exact)} точных + параметризованные")
+
+    for title, data in (
+        ("точное значение (paid_mass_confirm_send)", "paid_mass_confirm_send"),
+        ("параметр (confirm_delete_goodbye_button_7)", "confirm_delete_goodbye_button_7"),
+        ("неизвестная команда", "definitely_not_a_route_42"),
+    ):
+        started = time.perf_counter()
+        for _ in range(args.clicks):
+            router.resolve(data)
+        elapsed = time.perf_counter() - started
+        print(f"  {title:<45} {elapsed / args.clicks * 1e9:8.0f} нс")
+
+
+def _legacy_send_logging(log, user_id, message_number):
+    """Строки лога одной отправки воронки до перехода на log_pipeline"""
+    log.debug(f"📤 Отправляем сообщение {message_number} пользователю {user_id}")
+    log.debug(f"🔘 Добавлены кнопки к сообщению {message_number}: {2} кнопок")
+    log.debug(f"📝 Отправлено текстовое сообщение")
+    log.info(f"✅ Отправлено сообщение {message_number} пользователю {user_id} с UTM метками")
+
+
+def _send_logging(log, user_id, message_number):
+    """Те же строки в нынешнем виде: ленивые аргументы и поля получателя"""
+    log.debug("📤 Отправляем сообщение %s пользователю %s", message_number, user_id)
+    log.debug("🔘 Добавлены кнопки к сообщению %s: %s кнопок", message_number, 2)
+    log.debug("📝 Отправлено текстовое сообщение")
+    log.info("✅ Отправлено сообщение %s пользователю %s с UTM метками", message_number, user_id,
+             extra=recipient(user_id, message_number, 'free', 12.5))
+
+
+def bench_logging(args):
+    """Время логирования в цикле отправки: синхронный stdout против очереди с семплированием"""
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    log = logging.getLogger('scheduler')
+
+    def run(send_logging):
+        started = time.perf_counter()
+        for index in range(args.clicks):
+            send_logging(log, 1000 + index, index % 7 + 1)
+        return (time.perf_counter() - started) / args.clicks * 1e6
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                open(os.path.join(tmp_dir, 'log.txt'), 'w', encoding='utf-8') as stream:
+            print(f"📝 {args.clicks} отправок, лог пишется в файл (stdout Render)")
+
+            root.handlers = []
+            logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                level=logging.INFO, stream=stream, force=True)
+            legacy_us = run(_legacy_send_logging)
+            print(f"  {'до: f-строки, запись в потоке event loop':<45} {legacy_us:8.2f} мкс на отправку")
+
+            for title, fmt, per_second in (
+                ("после: очередь, text, без семплирования", 'text', 0),
+                ("после: очередь, json, без семплирования", 'json', 0),
+                ("после: очередь, json, 20 строк/с", 'json', 20),
+            ):
+                listener = setup_logging('INFO', fmt, per_second, stream)
+                elapsed_us = run(_send_logging)
+                flush_started = time.perf_counter()
+                listener.stop()
+                flush_ms = (time.perf_counter() - flush_started) * 1000
+                print(f"  {title:<45} {elapsed_us:8.2f} мкс на отправку (дозапись очереди {flush_ms:.0f} мс)")
+    finally:
+        root.handlers, root.level = saved_handlers, saved_level
+
+
+async def _start_fake_bot_api(latency):
+    """Локальный Bot API: отвечает на любой метод через latency секунд"""
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+    me = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+        result = me if request.match_info['method'] == 'getMe' else message
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/bot"
+
+
+def bench_telegram_transport(args):
+    """Рассылка и ответы на нажатия одновременно: общий пул против раздельных"""
+    senders, latency = 32, 0.03
+
+    async def run(bulk_request, interactive_request):
+        runner, base_url = await _start_fake_bot_api(latency)
+        bulk_bot = Bot('1:bench', base_url=base_url, request=bulk_request, get_updates_request=bulk_request)
+        interactive_bot = Bot('1:bench', base_url=base_url, request=interactive_request,
+                              get_updates_request=interactive_request)
+        await bulk_bot.initialize()
+        await interactive_bot.initialize()
+
+        remaining = iter(range(args.clicks))
+        replies = []
+
+        async def sender():
+            for user_id in remaining:
+                await bulk_bot.send_message(chat_id=user_id, text="Рассылка")
+
+        async def admin_clicks(done):
+            while not done.is_set():
+                started = time.perf_counter()
+                await interactive_bot.send_message(chat_id=1, text="Ответ на нажатие")
+                replies.append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(0.01)
+
+        done = asyncio.Event()
+        clicks = asyncio.create_task(admin_clicks(done))
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(senders)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await clicks
+
+        await bulk_bot.shutdown()
+        await interactive_bot.shutdown()
+        await runner.cleanup()
+        return elapsed, replies
+
+    print(f"📡 {args.clicks} отправок из {senders} потоков рассылки, ответ API {latency * 1000:.0f} мс,")
+    print("   параллельно ответы на нажатия каждые 10 мс")
+
+    # Как было: один HTTPXRequest на 8 соединений для всего
+    shared = HTTPXRequest(connection_pool_size=8)
+    elapsed, replies = asyncio.run(run(shared, shared))
+    print(f"\n  {'до: общий пул на 8 соединений':<45} {args.clicks / elapsed:8.0f} отправок/с")
+    _report_percentiles("    ответ на нажатие", replies)
+
+    bulk, interactive = TelegramTransport(BULK), TelegramTransport(INTERACTIVE)
+    elapsed, replies = asyncio.run(run(bulk, interactive))
+    print(f"  {f'после: bulk {BULK.connections_per_bot} + interactive {INTERACTIVE.connections_per_bot}':<45} {args.clicks / elapsed:8.0f} отправок/с")
+    _report_percentiles("    ответ на нажатие", replies)
+    print(f"    метрики bulk: {bulk.stats()}")
+    print(f"    метрики interactive: {interactive.stats()}")
+
+
+class _BenchJoinRequest:
+    """Заявка на вступление: approve() отвечает через latency секунд"""
+
+    def __init__(self, user_id, latency):
+        self.from_user = _BenchUser(user_id)
+        self.latency = latency
+
+    async def approve(self):
+        await asyncio.sleep(self.latency)
+
+
+class _BenchUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Bench"
+        self.last_name = None
+
+
+class _SlowBot:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def send_message(self, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    async def send_photo(self, **kwargs):
+        await asyncio.sleep(self.latency)
+
+
+def bench_join_burst(args):
+    """Всплеск заявок на вступление: по одной в апдейте против пачечной очереди"""
+    latency, rate = 0.02, 200
+    personalize = lambda text, user: text.replace('{first_name}', user.first_name)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"🚪 {args.clicks} заявок, ответ API {latency * 1000:.0f} мс, лимит очереди {rate} запросов/с")
+
+        db = Database(os.path.join(tmp_dir, 'legacy.db'))
+        bot = _SlowBot(latency)
+
+        async def legacy():
+            # Апдейты приложение обрабатывает по одному: заявки идут строго друг за другом
+            for user_id in range(1, args.clicks + 1):
+                request = _BenchJoinRequest(user_id, latency)
+                await request.approve()
+                db.add_user(user_id, request.from_user.username, request.from_user.first_name)
+                welcome = db.get_welcome_message()
+                db.get_welcome_buttons()
+                await bot.send_message(chat_id=user_id, text=personalize(welcome['text'], request.from_user))
+
+        started = time.perf_counter()
+        asyncio.run(legacy())
+        elapsed = time.perf_counter() - started
+        print(f"  {'до: заявка целиком в своем апдейте':<45} {args.clicks / elapsed:8.0f} заявок/с")
+
+        db = Database(os.path.join(tmp_dir, 'pipeline.db'))
+        pipeline = JoinPipeline(db, personalize, rate_per_second=rate)
+
+        async def batched():
+            for user_id in range(1, args.clicks + 1):
+                await pipeline.submit(_BenchJoinRequest(user_id, latency), bot)
+            await pipeline.drain()
+
+        started = time.perf_counter()
+        asyncio.run(batched())
+        elapsed = time.perf_counter() - started
+        print(f"  {'после: очередь, пачки, UPSERT одной транзакцией':<45} {args.clicks / elapsed:8.0f} заявок/с")
+        for stage, metrics in pipeline.stats()['stages'].items():
+            print(f"    {stage:<12} {metrics['count']:6} раз, среднее {metrics['avg_ms']:8.2f} мс, макс {metrics['max_ms']:8.2f} мс")
+
+
+class _TextTimestampsDatabase(Database):
+    """Схема до миграции 9: время хранится текстом"""
+    MIGRATIONS = Database.MIGRATIONS[:8]
+
+
+def _fill_time_ranges(db, users, epoch):
+    """Одинаковые данные в обеих схемах: регистрации за 90 дней, расписание и события воронки"""
+    now = datetime.now()
+    utc_now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rng = random.Random(42)
+    offsets = [rng.randint(0, 90 * 86400) for _ in range(users)]
+
+    def local(moment):
+        return int(moment.timestamp()) if epoch else str(moment)
+
+    def utc(moment):
+        return int(moment.replace(tzinfo=timezone.utc).timestamp()) if epoch else moment.strftime('%Y-%m-%d %H:%M:%S')
+
+    conn = sqlite3.connect(db.db_path)
+    conn.executemany(
+        'INSERT INTO users (user_id, username, first_name, joined_at, bot_started) VALUES (?, ?, ?, ?, 1)',
+        ((user_id, f"user{user_id}", "Bench", utc(utc_now - timedelta(seconds=offsets[user_id - 1])))
+         for user_id in range(1, users + 1))
+    )
+    conn.executemany(
+        'INSERT INTO scheduled_messages (user_id, message_number, scheduled_time) VALUES (?, ?, ?)',
+        ((user_id, n, local(now + timedelta(seconds=n * 3600 - offsets[user_id - 1] / 30)))
+         for user_id in range(1, users + 1) for n in range(1, 6))
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(db.analytics_db_path)
+    conn.executemany(
+        'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (?, ?, ?)',
+        ((user_id, n, utc(utc_now - timedelta(seconds=offsets[user_id - 1] - n * 3600)))
+         for user_id in range(1, users + 1) for n in range(1, 3))
+    )
+    conn.executemany(
+        "INSERT INTO button_clicks (user_id, message_number, button_type, clicked_at) VALUES (?, 1, 'callback', ?)",
+        ((user_id, utc(utc_now - timedelta(seconds=offsets[user_id - 1] - 3600 - rng.randint(1, 1200))))
+         for user_id in range(1, users + 1, 2))
+    )
+    conn.commit()
+    # Без статистики планировщик соединяет клики с доставками по индексу message_number
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def _index_size(db_path, index):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = ?', (index,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def bench_epoch_ranges(args):
+    """Диапазонные запросы по времени: текстовые даты против INTEGER секунд unix"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"📦 Заполняем две БД: {args.users} пользователей, {args.users * 5} сообщений в расписании...")
+        schemas = {}
+        for title, db_class, epoch in (("текст", _TextTimestampsDatabase, False), ("секунды", Database, True)):
+            os.mkdir(os.path.join(tmp_dir, title))
+            db = db_class(os.path.join(tmp_dir, title, 'bench.db'))
+            _fill_time_ranges(db, args.users, epoch)
+            schemas[title] = (db, epoch)
+
+        print("\n📐 Размер индексов:")
+        for index, path_of in (('idx_scheduled_messages_claim', 'db_path'), ('idx_users_joined_at', 'db_path'),
+                               ('idx_deliveries_time', 'analytics_db_path')):
+            sizes = [_index_size(getattr(db, path_of), index) / (1024 * 1024) for db, epoch in schemas.values()]
+            print(f"  {index:<45} {sizes[0]:6.1f} МБ -> {sizes[1]:6.1f} МБ")
+
+        for title, (db, epoch) in schemas.items():
+            now = datetime.now()
+            week_ago = now - timedelta(days=7)
+            param = (lambda moment: int(moment.timestamp())) if epoch else (lambda moment: moment)
+            utc_param = (lambda moment: int(moment.timestamp())) if epoch else (
+                lambda moment: moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+            parse = datetime.fromtimestamp if epoch else datetime.fromisoformat
+            reaction = 'bc.clicked_at - md.delivered_at <= 600' if epoch else (
+                '(julianday(bc.clicked_at) - julianday(md.delivered_at)) * 24 * 60 <= 10')
+
+            conn = sqlite3.connect(db.db_path)
+            conn.execute('ATTACH DATABASE ? AS analytics', (db.analytics_db_path,))
+
+            def ready_to_send():
+                conn.execute(
+                    'SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 0 AND scheduled_time <= ?', (param(now),)
+                ).fetchone()
+
+            def new_users_week():
+                conn.execute('SELECT COUNT(*) FROM users WHERE joined_at >= ? AND is_active = 1', (utc_param(week_ago),)).fetchone()
+
+            def day_of_schedule():
+                rows = conn.execute(
+                    'SELECT scheduled_time FROM scheduled_messages WHERE scheduled_time >= ? AND scheduled_time < ?',
+                    (param(now - timedelta(days=1)), param(now))
+                ).fetchall()
+                [parse(scheduled_time) for scheduled_time, in rows]
+
+            def clicked_within_10_min():
+                conn.execute(f'''
+                    SELECT COUNT(DISTINCT bc.user_id) FROM analytics.button_clicks bc
+                    JOIN analytics.message_deliveries md ON bc.user_id = md.user_id AND bc.message_number = md.message_number
+                    WHERE bc.message_number = 1 AND bc.button_type = 'callback' AND {reaction}
+                ''').fetchone()
+
+            print(f"\n⏱ Время хранится как {title}:")
+            _report("готовые к отправке (scheduled_time <= now)", _timeit(ready_to_send, args.repeat))
+            _report("новые за неделю (joined_at >= ?)", _timeit(new_users_week, args.repeat))
+            _report("расписание за сутки + разбор в datetime", _timeit(day_of_schedule, args.repeat))
+            _report("нажали за 10 минут (воронка)", _timeit(clicked_within_10_min, args.repeat))
+            conn.close()
+
+
+def bench_promo_spike(args):
+    """Промо: все пришли в одну минуту — пики отправок воронки без календаря и с бюджетом по минутам"""
+    budget, jitter = 100, 30
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"📣 {args.users} пользователей начинают воронку одновременно, бюджет {budget}/мин, окно ±{jitter} мин")
+        for title, calendar_budget in (("без календаря", 0), ("с календарем", budget)):
+            db = Database(os.path.join(tmp_dir, f"spike_{calendar_budget}.db"))
+            conn = sqlite3.connect(db.db_path)
+            conn.executemany(
+                'INSERT INTO users (user_id, username, first_name, bot_started) VALUES (?, ?, ?, 1)',
+                ((user_id, f"user{user_id}", "Bench") for user_id in range(1, args.users + 1))
+            )
+            conn.commit()
+            conn.close()
+
+            calendar = SendCalendar(db, budget_per_minute=calendar_budget, jitter_minutes=jitter)
+            scheduler = MessageScheduler(db, engine=MessageScheduler.ENGINE_ROWS, send_calendar=calendar)
+            logging.disable(logging.CRITICAL)
+            try:
+                timings = _timeit_each(lambda user_id: asyncio.run(scheduler.schedule_user_messages(None, user_id)),
+                                       range(1, args.users + 1))
+            finally:
+                logging.disable(logging.NOTSET)
+
+            load = db.get_send_load([(0, 2 ** 40)])
+            over_budget = sum(1 for sends in load.values() if sends > budget)
+            print(f"\n⏱ {title}:")
+            _report_percentiles("планирование воронки пользователя", timings)
+            print(f"  пиковая минута: {max(load.values())} отправок, минут сверх бюджета: {over_budget}, "
+                  f"занято минут: {len(load)}, сдвинуто сообщений: {calendar.shifted}")
+
+
+def bench_user_state(args):
+    """Проверка аудитории перед отправкой: get_user на каждого получателя против пачки из кэша состояний"""
+    batch = 100
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = fill_database(os.path.join(tmp_dir, 'bot.db'), args.users)
+        funnel = db.FUNNELS['free']
+        batches = [list(range(start, min(start + batch, args.users + 1))) for start in range(1, args.users + 1, batch)]
+        print(f"👥 {args.users} пользователей, пачки по {batch}")
+
+        def per_recipient():
+            return sum(1 for user_ids in batches for user_id in user_ids if funnel.accepts(db.get_user(user_id)))
+
+        def batched():
+            accepted = 0
+            for user_ids in batches:
+                states = db.get_user_states(user_ids)
+                accepted += sum(1 for user_id in user_ids if funnel.accepts(states.get(user_id)))
+            return accepted
+
+        assert per_recipient() == batched()
+        db.user_states.clear()
+        print("\n⏱ Проверка всех получателей:")
+        _report("get_user на каждого получателя", _timeit(per_recipient, args.repeat))
+        db.user_states.clear()
+        _report("холодный кэш (первый проход)", _timeit(batched, 1))
+        _report("теплый кэш", _timeit(batched, args.repeat))
+        print(f"  кэш: {db.user_states.stats()}")
+
+
+def bench_segments(args):
+    """Сегменты аудитории: COUNT для экрана рассылки и выборка получателей по индексам"""
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        conn = sqlite3.connect(db.db_path)
+        conn.executemany(
+            'INSERT INTO users (user_id, joined_at, is_active, bot_started, has_paid, paid_at) VALUES (?, ?, ?, 1, ?, ?)',
+            ((user_id, now - (user_id % 90) * 86400, int(user_id % 50 != 0), int(user_id % 10 == 0),
+              '2024-01-01 00:00:00' if user_id % 10 in (0, 1) else None)
+             for user_id in range(1, args.users + 1))
+        )
+        conn.commit()
+        conn.close()
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        conn.executemany(
+            'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (?, 3, ?)',
+            ((user_id, now) for user_id in range(1, args.users + 1, 2))
+        )
+        conn.executemany(
+            "INSERT INTO button_clicks (user_id, message_number, button_type, clicked_at) VALUES (?, 3, 'url', ?)",
+            ((user_id, now) for user_id in range(1, args.users + 1, 6))
+        )
+        conn.executemany(
+            "INSERT INTO payments (user_id, amount, payment_status, utm_source) VALUES (?, 990, 'success', ?)",
+            ((user_id, ('vk', 'tg', 'ads')[user_id % 3]) for user_id in range(10, args.users + 1, 10))
+        )
+        conn.commit()
+        conn.close()
+
+        print(f"🎯 {args.users} пользователей")
+        print("\n⏱ Раньше: получатели «всем» списком строк пользователей")
+        _report("len(get_users_with_bot_started())", _timeit(lambda: len(db.get_users_with_bot_started()), args.repeat))
+
+        for segment in ('all', 'paid', 'new:7', 'no_click:3', 'lapsed', 'utm:vk'):
+            print(f"\n⏱ Сегмент {segment} ({db.count_segment(segment, fresh=True)} получателей):")
+            _report("count_segment (экран рассылки)", _timeit(lambda: db.count_segment(segment, fresh=True), args.repeat))
+            _report("get_segment_user_ids (отправка)", _timeit(lambda: db.get_segment_user_ids(segment), args.repeat))
+
+
+def bench_cohorts(args):
+    """Когортный отчет: запрос на каждую неделю против колонок с инкрементальным дочитыванием"""
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        conn = sqlite3.connect(db.db_path)
+        conn.executemany(
+            'INSERT INTO users (user_id, joined_at, is_active, bot_started, has_paid) VALUES (?, ?, 1, ?, ?)',
+            ((user_id, now - (user_id % 180) * 86400, int(user_id % 3 != 0), int(user_id % 10 == 0))
+             for user_id in range(1, args.users + 1))
+        )
+        conn.commit()
+        conn.close()
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        conn.executemany(
+            'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (?, 1, ?)',
+            ((user_id, now) for user_id in range(1, args.users + 1, 2))
+        )
+        conn.executemany(
+            "INSERT INTO payments (user_id, amount, payment_status, created_at) VALUES (?, 990, 'success', ?)",
+            ((user_id, now - (user_id % 180) * 86400 + (user_id % 97) * 3600)
+             for user_id in list(range(10, args.users + 1, 10)) + list(range(30, args.users + 1, 30)))
+        )
+        conn.commit()
+        conn.close()
+
+        def per_cohort_sql():
+            conn = db._get_analytics_connection()
+            try:
+                weeks = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT (joined_at + 259200) / 604800 FROM bot.users'
+                )]
+                for week in weeks:
+                    bounds = (week * 604800 - 259200, (week + 1) * 604800 - 259200)
+                    conn.execute('SELECT COUNT(*), SUM(bot_started) FROM bot.users WHERE joined_at >= ? AND joined_at < ?',
+                                 bounds).fetchone()
+                    conn.execute('''
+                        SELECT COUNT(DISTINCT p.user_id) FROM payments p JOIN bot.users u ON u.user_id = p.user_id
+                        WHERE p.payment_status = 'success' AND u.joined_at >= ? AND u.joined_at < ?
+                    ''', bounds).fetchone()
+                    conn.execute('''
+                        SELECT COUNT(DISTINCT d.user_id) FROM message_deliveries d JOIN bot.users u ON u.user_id = d.user_id
+                        WHERE u.joined_at >= ? AND u.joined_at < ?
+                    ''', bounds).fetchone()
+            finally:
+                db._release_analytics_connection(conn)
+
+        print(f"📅 {args.users} пользователей, 26 недель")
+        print("\n⏱ Раньше: запросы на каждую неделю")
+        _report("per-cohort SQL", _timeit(per_cohort_sql, 1))
+
+        print("\n⏱ Колонки:")
+        _report("первое построение", _timeit(lambda: (db.cohorts._reset(), db.get_cohort_report()), 1))
+        _report("повтор без изменений (кэш)", _timeit(db.get_cohort_report, args.repeat))
+
+        def with_new_rows():
+            new_id = args.users + random.randrange(1, 10 ** 9)
+            conn = sqlite3.connect(db.db_path)
+            conn.execute('INSERT INTO users (user_id, joined_at, bot_started) VALUES (?, ?, 1)', (new_id, int(time.time())))
+            conn.commit()
+            conn.close()
+            db.log_payment(new_id, 990, 'success')
+            db.get_cohort_report()
+
+        _report("дочитать нового пользователя и оплату", _timeit(with_new_rows, args.repeat))
+        report = db.get_cohort_report()
+        print(f"\n👥 {report['users']} пользователей, {report['paid_users']} оплативших, "
+              f"медиана до оплаты {report['median_hours']} ч")
+
+
+def _timeit_each(func, items):
+    timings = []
+    for item in items:
+        started = time.perf_counter()
+        func(item)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'next-msg': bench_next_message,
+    'funnel-engine': bench_funnel_engine,
+    'stats': bench_stats,
+    'export': bench_export,
+    'users': bench_users,
+    'click-redirect': bench_click_redirect,
+    'admin-router': bench_admin_router,
+    'logging': bench_logging,
+    'telegram-transport': bench_telegram_transport,
+    'join-burst': bench_join_burst,
+    'epoch-ranges': bench_epoch_ranges,
+    'promo-spike': bench_promo_spike,
+    'user-state': bench_user_state,
+    'segments': bench_segments,
+    'cohorts': bench_cohorts,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--users', type=int, default=50000, help="Количество пользователей в тестовой БД")
+    parser.add_argument('--repeat', type=int, default=5, help="Количество повторов каждого замера")
+    parser.add_argument('--clicks', type=int, default=1000, help="Количество нажатий кнопок в бенчмарке next-msg")
+    args = parser.parse_args(argv)
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+"""
+Фоновые задачи массовых рассылок из админ-панели
+
+Админ ставит рассылку в очередь и сразу получает ответ, а сама отправка идет
+в отдельной asyncio-задаче. Рассылки бота (арендатора) идут одновременно
+в пределах общего бюджета скорости; BROADCAST_MAX_CONCURRENT ограничивает их
+число, и тогда остальные ждут свободного слота в очереди, а рассылка на паузе
+свой слот освобождает. Прогресс публикуется с ограничением частоты, рассылку
+можно поставить на паузу, продолжить или отменить кнопками под сообщением
+прогресса — в том числе пока она ждет в очереди.
+"""
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden, BadRequest, RetryAfter
+from datetime import datetime
+import logging
+import asyncio
+import itertools
+import os
+import time
+import utm_utils
+from log_pipeline import recipient
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket: общий лимит отправок в секунду для всех фоновых рассылок"""
+
+    def __init__(self, rate_per_second: float, burst: int = None):
+        self.rate = float(rate_per_second)
+        self.capacity = float(burst or max(1, int(rate_per_second)))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться разрешения на одну отправку"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def penalize(self, seconds: float):
+        """Telegram попросил подождать (RetryAfter) — тормозим всех держателей бюджета"""
+        async with self._lock:
+            await asyncio.sleep(seconds)
+            self._tokens = 0
+            self._updated_at = time.monotonic()
+
+
+class ProgressReporter:
+    """Публикация прогресса рассылки не чаще одного раза в interval секунд"""
+
+    def __init__(self, bot, chat_id, interval: float = 3.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message = None
+        self._last_text = None
+        self._last_published_at = 0.0
+
+    async def publish(self, text, reply_markup=None, force=False):
+        """Отправить или отредактировать сообщение прогресса с учетом троттлинга"""
+        now = time.monotonic()
+        if not force and now - self._last_published_at < self.interval:
+            return
+        if text == self._last_text and not force:
+            return
+
+        self._last_published_at = now
+        self._last_text = text
+
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=text,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup
+                )
+            else:
+                await self.message.edit_text(text, parse_mode='HTML', reply_markup=reply_markup)
+        except BadRequest as e:
+            # "Message is not modified" и подобные ошибки не критичны
+            logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+        except Exception as e:
+            if 'Event loop is closed' not in str(e):
+                logger.warning(f"⚠️ Ошибка при обновлении прогресса: {e}")
+
+
+class BroadcastJob:
+    """Одна фоновая массовая рассылка"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    CANCELLED = 'cancelled'
+    DONE = 'done'
+
+    STATUS_TITLES = {
+        QUEUED: "🕓 В очереди",
+        RUNNING: "🚀 Отправляется",
+        PAUSED: "⏸ На паузе",
+        CANCELLED: "⏹ Отменена",
+        DONE: "✅ Завершена",
+    }
+
+    def __init__(self, job_id, admin_id, draft, recipients, title):
+        self.job_id = job_id
+        self.admin_id = admin_id
+        self.title = title
+        self.message_text = draft["message_text"]
+        self.photo_data = draft.get("photo_data")
+        self.buttons = list(draft.get("buttons") or [])
+        self.recipients = list(recipients)
+        self.status = self.QUEUED
+        self.sent = 0
+        self.failed = 0
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    @property
+    def total(self):
+        return len(self.recipients)
+
+    @property
+    def processed(self):
+        return self.sent + self.failed
+
+    @property
+    def is_finished(self):
+        return self.status in (self.CANCELLED, self.DONE)
+
+    def progress_text(self):
+        """Текст сообщения прогресса"""
+        percent = int(self.processed / self.total * 100) if self.total else 100
+        return (
+            f"{self.title} <b>#{self.job_id}</b>\n\n"
+            f"📌 <b>Статус:</b> {self.STATUS_TITLES[self.status]}\n"
+            f"📊 <b>Прогресс:</b> {percent}%\n"
+            f"✅ <b>Отправлено:</b> {self.sent}/{self.total}\n"
+            f"❌ <b>Ошибок:</b> {self.failed}"
+        )
+
+    def control_markup(self):
+        """Кнопки управления рассылкой (пусто, когда рассылка завершена)"""
+        if self.is_finished:
+            return None
+
+        if self.status == self.PAUSED:
+            toggle = InlineKeyboardButton("▶️ Продолжить", callback_data=f"job_resume_{self.job_id}")
+        else:
+            toggle = InlineKeyboardButton("⏸ Пауза", callback_data=f"job_pause_{self.job_id}")
+
+        return InlineKeyboardMarkup([
+            [toggle, InlineKeyboardButton("⏹ Отменить", callback_data=f"job_cancel_{self.job_id}")]
+        ])
+
+    def build_reply_markup(self, user_id):
+        """Клавиатура с UTM метками для конкретного получателя"""
+        if not self.buttons:
+            return None
+        keyboard = [
+            [InlineKeyboardButton(button["text"], url=utm_utils.add_utm_to_url(button["url"], user_id))]
+            for button in self.buttons
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+
+class BroadcastJobManager:
+    """Фоновые рассылки: идут одновременно с общим бюджетом скорости"""
+
+    # Сколько завершенных задач хранить для просмотра статуса
+    FINISHED_JOBS_TO_KEEP = 20
+
+    def __init__(self, db, rate_per_second: float = None, progress_interval: float = 3.0,
+                 max_concurrent: int = None):
+        self.db = db
+        rate = rate_per_second or float(os.environ.get('BROADCAST_RATE_PER_SECOND', '10'))
+        self.rate_limiter = RateLimiter(rate)
+        self.progress_interval = progress_interval
+        # Бот для самих отправок (пул bulk); прогресс админу редактируется ботом из submit
+        self.send_bot = None
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        # Предел одновременно отправляемых рассылок (0 — без предела)
+        if max_concurrent is None:
+            max_concurrent = int(os.environ.get('BROADCAST_MAX_CONCURRENT', '0'))
+        self.max_concurrent = max_concurrent
+        # id рассылок, занимающих слот; событие будит ждущих слота
+        self._sending = set()
+        self._slots_changed = asyncio.Event()
+
+    def submit(self, bot, admin_id, draft, recipients, title="📢 Массовая рассылка"):
+        """Поставить рассылку в очередь и сразу вернуть задачу"""
+        job = BroadcastJob(next(self._ids), admin_id, draft, recipients, title)
+        self.jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(bot, job))
+        self._forget_finished_jobs()
+        logger.info(f"📥 Рассылка #{job.job_id} поставлена в очередь: {job.total} получателей")
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def active_jobs(self):
+        return [job for job in self.jobs.values() if not job.is_finished]
+
+    def pause(self, job_id):
+        """Поставить рассылку на паузу"""
+        job = self.jobs.get(job_id)
+        if not job or job.is_finished:
+            return False
+        job.status = BroadcastJob.PAUSED
+        job._resume.clear()
+        self._slots_changed.set()
+        logger.info(f"⏸ Рассылка #{job_id} поставлена на паузу")
+        return True
+
+    def resume(self, job_id):
+        """Продолжить рассылку после паузы"""
+        job = self.jobs.get(job_id)
+        if not job or job.status != BroadcastJob.PAUSED:
+            return False
+        # Пауза в очереди снимается обратно в очередь
+        job.status = BroadcastJob.RUNNING if job.started_at else BroadcastJob.QUEUED
+        job._resume.set()
+        logger.info(f"▶️ Рассылка #{job_id} продолжена")
+        return True
+
+    def cancel(self, job_id):
+        """Отменить рассылку; уже отправленные сообщения остаются у получателей"""
+        job = self.jobs.get(job_id)
+        if not job or job.is_finished:
+            return False
+        job.status = BroadcastJob.CANCELLED
+        job._resume.set()
+        self._slots_changed.set()
+        logger.info(f"⏹ Рассылка #{job_id} отменена")
+        return True
+
+    def _forget_finished_jobs(self):
+        finished = [job for job in self.jobs.values() if job.is_finished]
+        for job in finished[:-self.FINISHED_JOBS_TO_KEEP]:
+            del self.jobs[job.job_id]
+
+    async def _run(self, bot, job):
+        """Отправка рассылки в фоне"""
+        reporter = ProgressReporter(bot, job.admin_id, self.progress_interval)
+        sender = self.send_bot or bot
+
+        try:
+            await reporter.publish(job.progress_text(), job.control_markup(), force=True)
+            await self._send_all(sender, job, reporter)
+
+        except Exception as e:
+            job.status = BroadcastJob.CANCELLED
+            logger.error(f"❌ Критическая ошибка в фоновой рассылке #{job.job_id}: {e}", exc_info=True)
+        finally:
+            job.finished_at = datetime.now()
+            await reporter.publish(job.progress_text(), job.control_markup(), force=True)
+
+    async def _send_all(self, sender, job, reporter):
+        """Отправка всем получателям рассылки"""
+        try:
+            for user_id in job.recipients:
+                if not await self._wait_turn(job, reporter):
+                    break
+
+                await self.rate_limiter.acquire()
+                await self._send_one(sender, job, user_id)
+                await reporter.publish(job.progress_text(), job.control_markup())
+        finally:
+            self._release_slot(job)
+
+        if job.status != BroadcastJob.CANCELLED:
+            job.status = BroadcastJob.DONE
+
+        logger.info(f"✅ Рассылка #{job.job_id} завершена: отправлено {job.sent}, ошибок {job.failed}")
+
+    async def _wait_turn(self, job, reporter):
+        """Дождаться снятия паузы и свободного слота; False — рассылка отменена"""
+        while True:
+            if job.status == BroadcastJob.PAUSED:
+                # На паузе слот не держим: остальные рассылки идут дальше
+                self._release_slot(job)
+                await reporter.publish(job.progress_text(), job.control_markup(), force=True)
+                await job._resume.wait()
+                continue
+
+            if job.status == BroadcastJob.CANCELLED:
+                return False
+
+            if job.job_id in self._sending:
+                return True
+
+            if self.max_concurrent and len(self._sending) >= self.max_concurrent:
+                if job.status != BroadcastJob.QUEUED:
+                    job.status = BroadcastJob.QUEUED
+                    await reporter.publish(job.progress_text(), job.control_markup(), force=True)
+                    continue
+                self._slots_changed.clear()
+                await self._slots_changed.wait()
+                continue
+
+            self._sending.add(job.job_id)
+            job.started_at = job.started_at or datetime.now()
+            job.status = BroadcastJob.RUNNING
+            await reporter.publish(job.progress_text(), job.control_markup(), force=True)
+            return True
+
+    def _release_slot(self, job):
+        if job.job_id in self._sending:
+            self._sending.discard(job.job_id)
+            self._slots_changed.set()
+
+    async def _send_one(self, bot, job, user_id, retry=True):
+        """Отправить рассылку одному получателю с UTM метками"""
+        try:
+            processed_text = utm_utils.process_text_links(job.message_text, user_id)
+            reply_markup = job.build_reply_markup(user_id)
+
+            if job.photo_data:
+                await bot.send_photo(
+                    chat_id=user_id,
+                    photo=job.photo_data,
+                    caption=processed_text,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup
+                )
+            else:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=processed_text,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup
+                )
+            job.sent += 1
+
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning(f"⚠️ Telegram просит подождать {retry_after} сек (рассылка #{job.job_id})")
+            await self.rate_limiter.penalize(retry_after)
+            if retry:
+                await self._send_one(bot, job, user_id, retry=False)
+            else:
+                job.failed += 1
+
+        except Forbidden as e:
+            logger.warning("❌ Пользователь %s заблокировал бота при рассылке #%s: %s", user_id, job.job_id, e,
+                           extra=recipient(user_id, queue='mass'))
+            self.db.deactivate_user(user_id)
+            job.failed += 1
+
+        except Exception as e:
+            job.failed += 1
+            if 'Event loop is closed' not in str(e):
+                logger.error("❌ Не удалось отправить рассылку #%s пользователю %s: %s", job.job_id, user_id, e,
+                             extra=recipient(user_id, queue='mass'))
@@ -0,0 +1,125 @@
+"""
+Учет нажатий URL-кнопок воронки через редирект /r/{token}
+
+URL-кнопка ведет не прямо на сайт, а на бота: токен в ссылке несет
+(воронка, пользователь, сообщение, кнопка) и подпись HMAC. Обработчик
+проверяет подпись, ставит клик в очередь записи аналитики (она пишет
+пачками) и отвечает 302 на адрес кнопки с UTM метками. Адрес кнопки берется
+из готового контента воронки в памяти — на горячем пути нет запросов к БД.
+
+Формат токена — 24 байта в base64url (32 символа без padding):
+    воронка (1) | user_id (8) | message_number (2) | button_id (4) | HMAC-SHA256[:9]
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import struct
+
+from aiohttp import web
+
+import utm_utils
+from funnels import FUNNELS
+
+logger = logging.getLogger(__name__)
+
+_PAYLOAD = struct.Struct('>BqHI')
+_MAC_SIZE = 9
+TOKEN_LENGTH = 32  # (15 + 9) байт -> 32 символа base64url
+
+# Код воронки в токене и тип кнопки в button_clicks
+FUNNEL_CODES = {funnel.name: funnel.code for funnel in FUNNELS.values()}
+FUNNEL_NAMES = {code: funnel for funnel, code in FUNNEL_CODES.items()}
+CLICK_TYPES = {funnel.name: funnel.click_type for funnel in FUNNELS.values()}
+
+
+class ClickTracker:
+    """Подписанные ссылки /r/{token} и разбор нажатий по ним"""
+
+    ROUTE = '/r/{token}'
+
+    def __init__(self, secret, base_url=None):
+        # Отдельный ключ, производный от секрета: сам токен бота в подписи не участвует
+        self._key = hashlib.sha256(b'click-tracking:' + secret.encode()).digest()
+        self.base_url = base_url.rstrip('/') if base_url else None
+
+    @classmethod
+    def from_env(cls, secret=None, base_url=None):
+        """Трекер из окружения; без адреса бота (WEBHOOK_URL) кнопки ведут прямо на сайт
+
+        В мультиарендном режиме secret — токен бота арендатора, base_url — его адрес.
+        Общий CLICK_TRACKING_SECRET подмешивается к токену бота, а не заменяет
+        его: ссылка одного арендатора не проходит проверку у другого.
+        """
+        secret = os.environ.get('CLICK_TRACKING_SECRET', '') + (secret or os.environ.get('BOT_TOKEN') or '')
+        base_url = base_url or os.environ.get('WEBHOOK_URL')
+        if os.environ.get('CLICK_TRACKING', 'on') == 'off' or not secret:
+            base_url = None
+        return cls(secret, base_url)
+
+    @property
+    def enabled(self):
+        return self.base_url is not None
+
+    def make_token(self, funnel, user_id, message_number, button_id):
+        payload = _PAYLOAD.pack(FUNNEL_CODES[funnel], user_id, message_number, button_id)
+        mac = hmac.digest(self._key, payload, 'sha256')[:_MAC_SIZE]
+        return base64.urlsafe_b64encode(payload + mac).decode('ascii')
+
+    def parse_token(self, token):
+        """(воронка, user_id, message_number, button_id) или None, если токен чужой или испорчен"""
+        if len(token) != TOKEN_LENGTH:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token)
+        except ValueError:
+            return None
+
+        payload = raw[:_PAYLOAD.size]
+        expected = hmac.digest(self._key, payload, 'sha256')[:_MAC_SIZE]
+        # Сравнение за постоянное время — подпись нельзя подобрать побайтно
+        if not hmac.compare_digest(expected, raw[_PAYLOAD.size:]):
+            return None
+
+        funnel_code, user_id, message_number, button_id = _PAYLOAD.unpack(payload)
+        funnel = FUNNEL_NAMES.get(funnel_code)
+        if funnel is None:
+            return None
+        return funnel, user_id, message_number, button_id
+
+    def redirect_url(self, funnel, user_id, message_number, button_id):
+        """Адрес редиректа с учетом клика для URL-кнопки воронки"""
+        return f"{self.base_url}/r/{self.make_token(funnel, user_id, message_number, button_id)}"
+
+    def resolve_click(self, db, token):
+        """Разобрать нажатие: записать клик и вернуть адрес редиректа (None — не найдено)"""
+        click = self.parse_token(token)
+        if click is None:
+            return None
+        funnel, user_id, message_number, button_id = click
+
+        prepared = db.get_prepared_broadcast_message(message_number, funnel)
+        if not prepared:
+            return None
+        for prepared_button_id, button_text, url, position in prepared[2]:
+            if prepared_button_id == button_id and url:
+                db.log_button_click(user_id, message_number, button_id, CLICK_TYPES[funnel], button_text)
+                return utm_utils.add_utm_to_url(url, user_id)
+        return None
+
+    def redirect_handler(self, db):
+        """aiohttp-обработчик маршрута ROUTE: 302 на адрес кнопки или 404"""
+        async def handle(request):
+            try:
+                target_url = self.resolve_click(db, request.match_info['token'])
+            except Exception as e:
+                logger.error(f"❌ Ошибка при обработке клика по ссылке: {e}")
+                target_url = None
+
+            if target_url is None:
+                return web.Response(text='Ссылка недействительна', status=404)
+            return web.Response(status=302, headers={'Location': target_url})
+
+        return handle
@@ -0,0 +1,294 @@
+"""
+Когортная аналитика: конверсии по неделе прихода и время до оплаты
+
+Экраны статистики показывали только итоговые счетчики. Когортный отчет
+группирует пользователей по неделе прихода (joined_at, недели с понедельника
+по UTC) и считает для каждой недели: сколько пришло, запустили бота, получили
+хотя бы одно сообщение воронки, оплатили и продлили (две и больше успешные
+оплаты), а также распределение времени от прихода до первой оплаты.
+
+Вместо запроса на каждую когорту users, message_deliveries и payments один
+раз читаются потоком в колонки array (строка — пользователь), а отчет
+считается проходами по целым колонкам: Counter, compress и map выполняются
+в C, без цикла Python по строкам. Колонки обновляются инкрементально:
+
+- users — по отметке joined_at (индекс idx_users_joined_at);
+- bot_started — перечитывается, только если число запустивших в БД
+  изменилось иначе, чем за счет новых пользователей;
+- message_deliveries и payments — только строки с id больше прошлой отметки.
+
+Флаги «запустил» и «оплатил» не сбрасываются: когорта считает, дошел ли
+пользователь до шага хоть раз. Раз в REBUILD_SECONDS колонки строятся
+заново, чтобы не накапливать расхождений. Готовый отчет кэшируется до
+следующего изменения колонок.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import compress, repeat
+from operator import sub
+
+WEEK = 7 * 86400
+# 1970-01-01 — четверг: сдвиг на 3 дня делает границы недель понедельниками
+WEEK_SHIFT = 3 * 86400
+
+# Сколько последних недель показывать в отчете по умолчанию
+COHORT_WEEKS = 12
+
+# Продление — вторая успешная оплата
+RENEWAL_PAYMENTS = 2
+
+# Корзины времени до первой оплаты: верхние границы в секундах и подписи
+TIME_TO_PAY_BOUNDS = (3600, 86400, 3 * 86400, 7 * 86400, 30 * 86400)
+TIME_TO_PAY_LABELS = ("< 1 ч", "1 ч – 1 дн", "1–3 дн", "3–7 дн", "7–30 дн", "30+ дн")
+
+# Полная перестройка колонок не реже этого интервала
+REBUILD_SECONDS = 3600
+
+# Размер пачки при потоковом чтении
+FETCH_SIZE = 5000
+
+
+def week_start(week):
+    """Номер недели -> дата ее понедельника (UTC)"""
+    return datetime.fromtimestamp(week * WEEK - WEEK_SHIFT, timezone.utc).date()
+
+
+class CohortColumns:
+    """Колонки пользователей для когортного отчета; строка i — один пользователь
+
+    refresh() принимает курсор аналитической БД, к которой основная
+    подключена как bot. Методы потокобезопасны.
+    """
+
+    def __init__(self, rebuild_seconds=REBUILD_SECONDS):
+        self.rebuild_seconds = rebuild_seconds
+        self._lock = threading.Lock()
+        # Сколько раз bot_started перечитывался целиком (для диагностики и тестов)
+        self.started_rescans = 0
+        self._reset()
+
+    def _reset(self):
+        self.user_ids = array('q')
+        self.joined = array('q')
+        self.weeks = array('l')
+        self.started = array('b')
+        self.reached = array('b')
+        self.first_paid = array('q')  # 0 — не оплачивал
+        self.payments = array('l')
+        self._rows = {}
+        self._joined_mark = None
+        self._delivery_mark = 0
+        self._payment_mark = 0
+        # Число запустивших бота в БД при прошлой проверке и запустившие среди новых строк
+        self._started_in_db = 0
+        self._new_started = 0
+        self._built_at = time.monotonic()
+        self.version = 0
+        self._report = None
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    # ===== ЗАГРУЗКА =====
+
+    def refresh(self, cursor):
+        """Дочитать изменения из БД; возвращает число измененных строк"""
+        with self._lock:
+            if self.version and time.monotonic() - self._built_at > self.rebuild_seconds:
+                self._reset()
+            changed = (
+                self._load_users(cursor)
+                + self._load_started(cursor)
+                + self._load_deliveries(cursor)
+                + self._load_payments(cursor)
+            )
+            if changed or not self.version:
+                self.version += 1
+            return changed
+
+    def _load_users(self, cursor):
+        """Новые пользователи: joined_at не раньше прошлой отметки"""
+        if self._joined_mark is None:
+            cursor.execute('SELECT user_id, joined_at, bot_started FROM bot.users WHERE joined_at IS NOT NULL')
+        else:
+            # Равные отметке перечитываются: в ту же секунду могли прийти еще пользователи
+            cursor.execute('''
+                SELECT user_id, joined_at, bot_started FROM bot.users INDEXED BY idx_users_joined_at
+                WHERE joined_at >= ?
+            ''', (self._joined_mark,))
+
+        rows_map, added = self._rows, 0
+        mark = self._joined_mark
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for user_id, joined_at, bot_started in rows:
+                if mark is None or joined_at > mark:
+                    mark = joined_at
+                if user_id in rows_map:
+                    continue
+                rows_map[user_id] = len(self.user_ids)
+                self.user_ids.append(user_id)
+                self.joined.append(joined_at)
+                self.weeks.append((joined_at + WEEK_SHIFT) // WEEK)
+                self.started.append(1 if bot_started else 0)
+                if bot_started:
+                    self._new_started += 1
+                self.reached.append(0)
+                self.first_paid.append(0)
+                self.payments.append(0)
+                added += 1
+        self._joined_mark = mark
+        return added
+
+    def _load_started(self, cursor):
+        """Запустившие бота: перечитываются, только если их число в БД изменилось не только за счет новых
+
+        Сравнение идет с числом в БД при прошлой проверке, а не с колонкой: флаги
+        в колонке не сбрасываются, и вернувшийся пользователь с bot_started = 0
+        иначе вызывал бы полный перечет при каждом обновлении.
+        """
+        cursor.execute('SELECT COUNT(*) FROM bot.users WHERE bot_started = 1')
+        in_db = cursor.fetchone()[0]
+        expected = self._started_in_db + self._new_started
+        self._started_in_db, self._new_started = in_db, 0
+        if in_db == expected:
+            return 0
+
+        self.started_rescans += 1
+        cursor.execute('SELECT user_id FROM bot.users INDEXED BY idx_users_bot_started WHERE bot_started = 1')
+        rows_map, started, changed = self._rows, self.started, 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for (user_id,) in rows:
+                i = rows_map.get(user_id)
+                if i is not None and not started[i]:
+                    started[i] = 1
+                    changed += 1
+        return changed
+
+    def _load_deliveries(self, cursor):
+        """Получившие сообщения воронки: доставки с id после прошлой отметки"""
+        cursor.execute('SELECT MAX(id) FROM message_deliveries')
+        top = cursor.fetchone()[0] or 0
+        if top <= self._delivery_mark:
+            return 0
+
+        cursor.execute('''
+            SELECT DISTINCT user_id FROM message_deliveries WHERE id > ? AND id <= ?
+        ''', (self._delivery_mark, top))
+        rows_map, reached, changed = self._rows, self.reached, 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for (user_id,) in rows:
+                i = rows_map.get(user_id)
+                if i is not None and not reached[i]:
+                    reached[i] = 1
+                    changed += 1
+        self._delivery_mark = top
+        return changed
+
+    def _load_payments(self, cursor):
+        """Успешные оплаты с id после прошлой отметки: число оплат и время первой"""
+        cursor.execute('SELECT MAX(id) FROM payments')
+        top = cursor.fetchone()[0] or 0
+        if top <= self._payment_mark:
+            return 0
+
+        cursor.execute('''
+            SELECT user_id, created_at FROM payments
+            WHERE id > ? AND id <= ? AND payment_status = 'success'
+        ''', (self._payment_mark, top))
+        rows_map, first_paid, payments, changed = self._rows, self.first_paid, self.payments, 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for user_id, created_at in rows:
+                i = rows_map.get(user_id)
+                if i is None or created_at is None:
+                    continue
+                payments[i] += 1
+                if not first_paid[i] or created_at < first_paid[i]:
+                    first_paid[i] = created_at
+                changed += 1
+        self._payment_mark = top
+        return changed
+
+    # ===== ОТЧЕТ =====
+
+    def report(self, weeks=COHORT_WEEKS):
+        """Когорты за последние weeks недель (свежие первыми) и время до оплаты
+
+        Пересчитывается только после изменения колонок.
+        """
+        with self._lock:
+            if self._report is not None and self._report[0] == (self.version, weeks):
+                return self._report[1]
+
+            paid_mask = self.first_paid
+            week_counts = {
+                'joined': Counter(self.weeks),
+                'started': Counter(compress(self.weeks, self.started)),
+                'reached': Counter(compress(self.weeks, self.reached)),
+                'paid': Counter(compress(self.weeks, paid_mask)),
+                'renewed': Counter(compress(self.weeks, map(RENEWAL_PAYMENTS.__le__, self.payments))),
+            }
+
+            # Время до первой оплаты; оплата раньше joined_at (вернувшийся пользователь) — в первую корзину
+            delays = array('q', map(sub, compress(self.first_paid, paid_mask), compress(self.joined, paid_mask)))
+            buckets = array('b', map(bisect_right, repeat(TIME_TO_PAY_BOUNDS), delays))
+            by_week = Counter(zip(compress(self.weeks, paid_mask), buckets))
+            overall = Counter(buckets)
+
+            cohorts = []
+            for week in sorted(week_counts['joined'], reverse=True)[:weeks]:
+                cohort = {'week_start': week_start(week)}
+                cohort.update((name, counts[week]) for name, counts in week_counts.items())
+                cohort['time_to_pay'] = [by_week[(week, bucket)] for bucket in range(len(TIME_TO_PAY_LABELS))]
+                cohorts.append(cohort)
+
+            ordered = sorted(delays)
+            result = {
+                'cohorts': cohorts,
+                'users': len(self.user_ids),
+                'paid_users': len(delays),
+                'time_to_pay': [(label, overall[bucket]) for bucket, label in enumerate(TIME_TO_PAY_LABELS)],
+                'median_hours': round(max(ordered[len(ordered) // 2], 0) / 3600, 1) if ordered else None,
+            }
+            self._report = ((self.version, weeks), result)
+            return result
+
+
+def cohort_rate(part, total):
+    """Доля в процентах с одним знаком"""
+    return round(part / total * 100, 1) if total else 0.0
+
+
+# Колонки выгрузки когорт в CSV
+COHORT_EXPORT_HEADER = [
+    'Неделя', 'Пришли', 'Запустили бота', 'Получили воронку', 'Оплатили', 'Продлили',
+    '% запуска', '% оплаты', '% продления от оплативших',
+] + [f'До оплаты {label}' for label in TIME_TO_PAY_LABELS]
+
+
+def cohort_export_rows(report):
+    """Строки когортного отчета для CSV"""
+    for cohort in report['cohorts']:
+        yield [
+            cohort['week_start'].isoformat(), cohort['joined'], cohort['started'], cohort['reached'],
+            cohort['paid'], cohort['renewed'],
+            cohort_rate(cohort['started'], cohort['joined']),
+            cohort_rate(cohort['paid'], cohort['joined']),
+            cohort_rate(cohort['renewed'], cohort['paid']),
+        ] + cohort['time_to_pay']
@@ -3,14 +3,181 @@ import json
 import os
 import csv
 import io
+import re
+import time
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import logging
+from collections import OrderedDict
+from analytics_db import AnalyticsConnectionPool, AnalyticsWriteQueue
+from cohorts import COHORT_WEEKS, CohortColumns
+from funnels import BUILTIN_FUNNELS, FUNNELS
+from segments import parse_segment
+from user_state import UserState, UserStateCache
 
 logger = logging.getLogger(__name__)
 
 class Database:
-    def __init__(self, db_path=None):
+    # Воронки (funnels.FUNNELS): таблицы, аудитория и формат кнопок каждой воронки
+    FUNNELS = FUNNELS
+
+    @staticmethod
+    def _job_queue_tables(funnels):
+        return tuple(
+            [funnel.queue_table for funnel in funnels.values()] +
+            [funnel.broadcasts_table for funnel in funnels.values()]
+        )
+
+    # Очереди, задачи из которых воркеры захватывают через аренду (lease);
+    # у экземпляра пересчитываются по его FUNNELS
+    JOB_QUEUE_TABLES = _job_queue_tables(FUNNELS)
+
+    # Время аренды задачи по умолчанию (секунды)
+    DEFAULT_LEASE_SECONDS = 300
+
+    # Через сколько секунд повторить шаг воронки после временной ошибки отправки
+    FUNNEL_RETRY_DELAY_SECONDS = 60
+
+    # Упорядоченные миграции схемы: (версия, метод). Новые добавляются только в конец.
+    # Миграция — зафиксированный DDL своей версии: имена таблиц и колонки пишутся
+    # в ней явно, а не берутся из FUNNELS и шаблонов ниже, которые описывают
+    # текущую схему и могут меняться
+    MIGRATIONS = (
+        (1, '_migration_001_base_schema'),
+        (2, '_migration_002_job_leases'),
+        (3, '_migration_003_analytics_database'),
+        (4, '_migration_004_funnel_cursors'),
+        (5, '_migration_005_cursor_funnel_engine'),
+        (6, '_migration_006_stat_counters'),
+        (7, '_migration_007_user_search'),
+        (8, '_migration_008_reaction_histograms'),
+        (9, '_migration_009_epoch_timestamps'),
+        (10, '_migration_010_subscription_expiry'),
+        (11, '_migration_011_in_flight_jobs'),
+        (12, '_migration_012_audience_segments'),
+    )
+
+    # Значение по умолчанию для колонок времени в секундах unix (миграция 9)
+    EPOCH_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+    # Текущая схема таблиц воронки из конфигурации (не встроенной — их создают миграции):
+    # колонки очереди сообщений и очереди массовых рассылок
+    FUNNEL_QUEUE_COLUMNS = '''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_number INTEGER,
+                scheduled_time INTEGER,
+                is_sent INTEGER DEFAULT 0,
+                claimed_by TEXT DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES {messages}(message_number)
+        '''
+    FUNNEL_BROADCAST_COLUMNS = f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_text TEXT NOT NULL,
+                photo_url TEXT DEFAULT NULL,
+                scheduled_time INTEGER NOT NULL,
+                is_sent INTEGER DEFAULT 0,
+                created_at INTEGER DEFAULT ({EPOCH_NOW_SQL}),
+                claimed_by TEXT DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL,
+                segment TEXT DEFAULT NULL
+        '''
+
+    # Сколько курсоров воронки держать в памяти
+    FUNNEL_CURSOR_CACHE_SIZE = 10000
+
+    # Кэш состояний пользователей для проверок аудитории перед отправкой
+    USER_STATE_CACHE_SIZE = 50000
+    USER_STATE_TTL_SECONDS = 60
+
+    # Сколько секунд экраны рассылок показывают закэшированный размер сегмента
+    SEGMENT_COUNT_TTL_SECONDS = 30
+
+    # Сколько последних доставок (user_id, message_number) -> время помнить для расчета реакции
+    RECENT_DELIVERIES_SIZE = 50000
+
+    # Границы корзин гистограммы времени реакции (секунды): 4 корзины на удвоение
+    # до ~40 суток плюс "круглые" границы, чтобы "нажали за N минут" считалось точно
+    REACTION_BUCKET_BOUNDS = tuple(sorted(
+        {round(2 ** (k / 4), 3) for k in range(88)} | {60, 300, 600, 1800, 3600, 21600, 86400}
+    ))
+
+    # Таблицы событий, вынесенные в отдельную аналитическую БД
+    ANALYTICS_TABLES = ('message_deliveries', 'button_clicks', 'payments')
+
+    # Выгрузки CSV: вид -> (БД, заголовки, запрос, колонка даты для фильтра, порядок)
+    EXPORTS = {
+        'users': (
+            'main',
+            ['ID', 'Username', 'Имя', 'Дата регистрации', 'Статус', 'Разговор с ботом', 'Оплатил', 'Дата оплаты'],
+            '''
+                SELECT user_id, COALESCE(username, ''), COALESCE(first_name, ''), datetime(joined_at, 'unixepoch'),
+                       CASE WHEN is_active THEN 'Активен' ELSE 'Отписался' END,
+                       CASE WHEN bot_started THEN 'Да' ELSE 'Нет' END,
+                       CASE WHEN has_paid THEN 'Да' ELSE 'Нет' END,
+                       COALESCE(paid_at, '')
+                FROM users
+            ''',
+            'joined_at',
+            'joined_at DESC',
+        ),
+        'payments': (
+            'analytics',
+            ['ID', 'ID пользователя', 'Username', 'Имя', 'Сумма', 'Статус', 'UTM source', 'UTM id', 'Дата'],
+            '''
+                SELECT p.id, p.user_id, COALESCE(u.username, ''), COALESCE(u.first_name, ''),
+                       p.amount, p.payment_status, COALESCE(p.utm_source, ''), COALESCE(p.utm_id, ''),
+                       datetime(p.created_at, 'unixepoch')
+                FROM payments p
+                LEFT JOIN bot.users u ON p.user_id = u.user_id
+            ''',
+            'p.created_at',
+            'p.id',
+        ),
+        'deliveries': (
+            'analytics',
+            ['ID', 'ID пользователя', 'Номер сообщения', 'Дата доставки'],
+            "SELECT id, user_id, message_number, datetime(delivered_at, 'unixepoch') FROM message_deliveries",
+            'delivered_at',
+            'id',
+        ),
+        'clicks': (
+            'analytics',
+            ['ID', 'ID пользователя', 'Номер сообщения', 'ID кнопки', 'Тип кнопки', 'Текст кнопки', 'Дата нажатия'],
+            '''
+                SELECT id, user_id, message_number, button_id, button_type, COALESCE(button_text, ''),
+                       datetime(clicked_at, 'unixepoch')
+                FROM button_clicks
+            ''',
+            'clicked_at',
+            'id',
+        ),
+    }
+
+    # Счетчики статистики, которые ведут триггеры: имя -> (таблица, вклад строки {row})
+    COUNTERS = {
+        'users_total': ('users', '1'),
+        'users_active': ('users', '{row}.is_active IS 1'),
+        'users_inactive': ('users', '{row}.is_active IS 0'),
+        'users_bot_started': ('users', '{row}.bot_started IS 1'),
+        'users_active_bot_started': ('users', '{row}.is_active IS 1 AND {row}.bot_started IS 1'),
+        'users_paid': ('users', '{row}.has_paid IS 1'),
+        'scheduled_total': ('scheduled_messages', '1'),
+        'scheduled_pending': ('scheduled_messages', '{row}.is_sent IS 0'),
+        'scheduled_sent': ('scheduled_messages', '{row}.is_sent IS 1'),
+    }
+
+    # То же для таблиц аналитической БД (триггер видит только таблицы своей БД)
+    ANALYTICS_COUNTERS = {
+        'payments_total': ('payments', '1'),
+        'payments_success': ('payments', "{row}.payment_status IS 'success'"),
+        'payments_revenue_count': ('payments', "{row}.payment_status IS 'success' AND {row}.amount != ''"),
+        'payments_revenue': ('payments', "CASE WHEN {row}.payment_status IS 'success' AND {row}.amount != '' THEN CAST({row}.amount AS REAL) ELSE 0 END"),
+    }
+
+    def __init__(self, db_path=None, analytics_db_path=None):
         """Инициализация базы данных для Render с Disk"""
         if db_path is None:
             # Проверяем переменную окружения для Render Disk
@@ -31,498 +198,1041 @@ class Database:
             db_path = db_dir / 'bot_database.db'
         
         self.db_path = str(db_path)
+        self.JOB_QUEUE_TABLES = self._job_queue_tables(self.FUNNELS)
         
-        # Проверяем права доступа
-        try:
-            db_dir = Path(self.db_path).parent
-            if not db_dir.exists():
-                db_dir.mkdir(parents=True, exist_ok=True)
-                logger.info(f"Создана директория для БД: {db_dir}")
-            
-            # Проверяем права на запись
-            test_file = db_dir / 'test_write.tmp'
-            try:
-                test_file.write_text('test')
-                test_file.unlink()
-                logger.info(f"✅ Права на запись в {db_dir} подтверждены")
-            except Exception as e:
-                logger.error(f"❌ Нет прав на запись в {db_dir}: {e}")
-                raise
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка при проверке директории БД: {e}")
-            raise
+        # Проверяем права доступа (без создания тестовых файлов на диске)
+        db_dir = Path(self.db_path).parent
+        if not db_dir.exists():
+            db_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Создана директория для БД: {db_dir}")
+        
+        if not os.access(db_dir, os.W_OK):
+            logger.error(f"❌ Нет прав на запись в {db_dir}")
+            raise PermissionError(f"Нет прав на запись в {db_dir}")
+        
+        # Аналитическая БД (события воронки и платежи) лежит рядом с основной
+        if analytics_db_path is None:
+            analytics_db_path = os.environ.get('ANALYTICS_DB_PATH') or \
+                Path(self.db_path).with_name(f"{Path(self.db_path).stem}_analytics.db")
+        self.analytics_db_path = str(analytics_db_path)
+        self._analytics_pool = AnalyticsConnectionPool(self.analytics_db_path, self.db_path)
+        self._analytics_writes = AnalyticsWriteQueue(self.analytics_db_path)
+        
+        # Результат последней полной диагностики (заполняется в фоне)
+        self.last_diagnostics = None
+        self.schema_version = 0
+        
+        # Курсоры воронки (user_id, funnel) -> (step, next_due_at) и готовый контент сообщений
+        self._funnel_cursors = OrderedDict()
+        self._broadcast_content = {}
+        # Состояния пользователей (is_active, bot_started, has_paid, payed_till) — write-through
+        self.user_states = UserStateCache(self.USER_STATE_CACHE_SIZE, self.USER_STATE_TTL_SECONDS)
+        # Размеры сегментов для экранов рассылок: {сегмент: (количество, время подсчета)}
+        self._segment_counts = {}
+        # Колонки когортного отчета (cohorts.py) — дочитываются инкрементально
+        self.cohorts = CohortColumns()
+        # Готовое приветствие и его версия: меняется при каждом изменении текста, фото или кнопок
+        self._welcome_content = None
+        self._welcome_version = 0
+        # Недавние доставки (user_id, message_number) -> time.time() для гистограмм реакции
+        self._recent_deliveries = OrderedDict()
         
         self.init_db()
         logger.info(f"✅ База данных инициализирована: {self.db_path}")
     
     def init_db(self):
-        """Создание таблиц в базе данных"""
+        """Применение недостающих миграций схемы (уже примененные пропускаются)"""
         try:
-            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
             cursor = conn.cursor()
             
             # Включаем WAL режим для лучшей производительности и конкуррентности
             cursor.execute('PRAGMA journal_mode=WAL')
             cursor.execute('PRAGMA synchronous=NORMAL')
-            cursor.execute('PRAGMA cache_size=10000')
-            cursor.execute('PRAGMA temp_store=MEMORY')
-            
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active INTEGER DEFAULT 1,
-                    bot_started INTEGER DEFAULT 0,
-                    has_paid INTEGER DEFAULT 0,
-                    paid_at TIMESTAMP DEFAULT NULL
-                )
-            ''')
-            
-            # Добавляем новые колонки для платежей если их нет
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [column[1] for column in cursor.fetchall()]
-            
-            if 'bot_started' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN bot_started INTEGER DEFAULT 0')
-                logger.info("Добавлена колонка bot_started в users")
-            
-            if 'has_paid' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN has_paid INTEGER DEFAULT 0')
-                logger.info("Добавлена колонка has_paid в users")
-            
-            if 'paid_at' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN paid_at TIMESTAMP DEFAULT NULL')
-                logger.info("Добавлена колонка paid_at в users")
-            
-            # НОВАЯ КОЛОНКА: payed_till
-            if 'payed_till' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN payed_till DATE DEFAULT NULL')
-                logger.info("Добавлена колонка payed_till в users")
-            
-            # Новая таблица платежей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS payments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount TEXT,
-                    payment_status TEXT,
-                    utm_source TEXT,
-                    utm_id TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # ========================================
-            # 📊 ТАБЛИЦЫ ДЛЯ ОТСЛЕЖИВАНИЯ ВОРОНКИ
-            # ========================================
-            
-            # Таблица отправленных сообщений
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS message_deliveries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    message_number INTEGER NOT NULL,
-                    delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
-                )
-            ''')
-            
-            # Таблица кликов по кнопкам
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS button_clicks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    message_number INTEGER NOT NULL,
-                    button_id INTEGER,
-                    button_type TEXT NOT NULL,
-                    button_text TEXT,
-                    clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
-                )
-            ''')
-            
-            # ========================================
-            # ОСТАЛЬНЫЕ ТАБЛИЦЫ (без изменений)
-            # ========================================
             
-            # НОВАЯ ТАБЛИЦА: Таблица настроек продления подписки
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS renewal_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             
-            # Инициализация настроек продления
-            cursor.execute('''
-                INSERT OR IGNORE INTO renewal_settings (key, value) 
-                VALUES ('renewal_message', ?)
-            ''', ("⏰ <b>Ваша подписка истекает сегодня!</b>\n\n"
-                 "💳 Чтобы продолжить получать эксклюзивные материалы, продлите подписку.\n\n"
-                 "✨ Не упустите возможность оставаться в курсе всех новинок!",))
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO renewal_settings (key, value) 
-                VALUES ('renewal_photo_url', '')
-            ''')
+            cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            current_version = cursor.fetchone()[0]
             
-            cursor.execute('''
-                INSERT OR IGNORE INTO renewal_settings (key, value) 
-                VALUES ('renewal_button_text', 'Продлить подписку')
-            ''')
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO renewal_settings (key, value) 
-                VALUES ('renewal_button_url', '')
-            ''')
+            # Быстрый путь: схема актуальна, ничего не делаем
+            if current_version >= self.MIGRATIONS[-1][0]:
+                self.schema_version = current_version
+                self._create_configured_funnels(cursor)
+                return
             
-            # Обновляем таблицу сообщений рассылки - добавляем поле для фото
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS broadcast_messages (
-                    message_number INTEGER PRIMARY KEY,
-                    text TEXT NOT NULL,
-                    delay_hours INTEGER DEFAULT 24,
-                    photo_url TEXT DEFAULT NULL
-                )
-            ''')
+            # ATTACH нельзя выполнить внутри транзакции, поэтому подключаем
+            # аналитическую БД заранее — её таблицы создает миграция 3
+            cursor.execute('ATTACH DATABASE ? AS analytics', (self.analytics_db_path,))
+            cursor.execute('PRAGMA analytics.journal_mode=WAL')
             
-            # Добавляем колонку photo_url если её нет (для существующих БД)
-            cursor.execute("PRAGMA table_info(broadcast_messages)")
-            columns = [column[1] for column in cursor.fetchall()]
-            if 'photo_url' not in columns:
-                cursor.execute('ALTER TABLE broadcast_messages ADD COLUMN photo_url TEXT DEFAULT NULL')
-                logger.info("Добавлена колонка photo_url в broadcast_messages")
+            for version, name in self.MIGRATIONS:
+                if version <= current_version:
+                    continue
+                
+                # Каждая миграция — отдельная транзакция под блокировкой записи,
+                # чтобы параллельно стартующие процессы не применили её дважды
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    cursor.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,))
+                    if cursor.fetchone():
+                        cursor.execute('COMMIT')
+                        continue
+                    
+                    getattr(self, name)(cursor)
+                    cursor.execute(
+                        'INSERT INTO schema_version (version, name) VALUES (?, ?)',
+                        (version, name)
+                    )
+                    cursor.execute('COMMIT')
+                    logger.info(f"✅ Применена миграция схемы {version}: {name}")
+                except Exception:
+                    cursor.execute('ROLLBACK')
+                    raise
             
-            # Таблица кнопок для сообщений рассылки
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS message_buttons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_number INTEGER,
-                    button_text TEXT NOT NULL,
-                    button_url TEXT NOT NULL,
-                    position INTEGER DEFAULT 1,
-                    FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
-                )
-            ''')
+            cursor.execute('SELECT MAX(version) FROM schema_version')
+            self.schema_version = cursor.fetchone()[0]
+            self._create_configured_funnels(cursor)
             
-            # НОВАЯ: Таблица кнопок для приветственного сообщения (механические кнопки)
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка при инициализации базы данных: {e}")
+            raise
+        finally:
+            if 'conn' in locals():
+                conn.close()
+    
+    def _create_configured_funnels(self, cursor):
+        """Таблицы воронок из конфигурации, которых нет среди встроенных (создаются по шаблону)"""
+        extra = [funnel for name, funnel in self.FUNNELS.items() if name not in BUILTIN_FUNNELS]
+        if not extra:
+            return
+
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for funnel in extra:
+                self._create_funnel_tables(cursor, funnel)
+                self._add_broadcast_segment_column(cursor, funnel.broadcasts_table)
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def _create_funnel_tables(self, cursor, funnel):
+        """Схема воронки по шаблону: сообщения, кнопки, расписание, массовые рассылки и их кнопки"""
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {funnel.messages_table} (
+                message_number INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                delay_hours REAL DEFAULT 24,
+                photo_url TEXT DEFAULT NULL
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {funnel.buttons_table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_number INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (message_number) REFERENCES {funnel.messages_table}(message_number)
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {funnel.queue_table} (
+                {self.FUNNEL_QUEUE_COLUMNS.format(messages=funnel.messages_table)}
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {funnel.broadcasts_table} (
+                {self.FUNNEL_BROADCAST_COLUMNS}
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {funnel.broadcast_buttons_table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                broadcast_id INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (broadcast_id) REFERENCES {funnel.broadcasts_table}(id)
+            )
+        ''')
+
+        queue = funnel.queue_table
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{queue}_claim ON {queue}(is_sent, scheduled_time)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{queue}_user_number ON {queue}(user_id, message_number)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{funnel.broadcasts_table}_claim ON {funnel.broadcasts_table}(is_sent, scheduled_time)')
+        self._create_in_flight_index(cursor, queue)
+
+    def _add_broadcast_segment_column(self, cursor, table):
+        """Колонка segment у рассылок воронки, созданной до ее появления в шаблоне (NULL — вся аудитория)"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if 'segment' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN segment TEXT DEFAULT NULL')
+
+    def _create_in_flight_index(self, cursor, queue):
+        """Частичный индекс арендованных и еще не закрытых шагов — для списания брошенных аренд"""
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{queue}_in_flight ON {queue}(lease_until)
+            WHERE is_sent = 0 AND claimed_by IS NOT NULL
+        ''')
+
+    # ========================================
+    # 🧱 МИГРАЦИИ СХЕМЫ
+    # ========================================
+    
+    def _migration_001_base_schema(self, cursor):
+        """Базовая схема: таблицы, настройки по умолчанию и индексы"""
+
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active INTEGER DEFAULT 1,
+                bot_started INTEGER DEFAULT 0,
+                has_paid INTEGER DEFAULT 0,
+                paid_at TIMESTAMP DEFAULT NULL
+            )
+        ''')
+        
+        # Добавляем новые колонки для платежей если их нет
+        cursor.execute("PRAGMA table_info(users)")
+        columns = [column[1] for column in cursor.fetchall()]
+        
+        if 'bot_started' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN bot_started INTEGER DEFAULT 0')
+            logger.info("Добавлена колонка bot_started в users")
+        
+        if 'has_paid' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN has_paid INTEGER DEFAULT 0')
+            logger.info("Добавлена колонка has_paid в users")
+        
+        if 'paid_at' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN paid_at TIMESTAMP DEFAULT NULL')
+            logger.info("Добавлена колонка paid_at в users")
+        
+        # НОВАЯ КОЛОНКА: payed_till
+        if 'payed_till' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN payed_till DATE DEFAULT NULL')
+            logger.info("Добавлена колонка payed_till в users")
+        
+        # Новая таблица платежей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount TEXT,
+                payment_status TEXT,
+                utm_source TEXT,
+                utm_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # ========================================
+        # 📊 ТАБЛИЦЫ ДЛЯ ОТСЛЕЖИВАНИЯ ВОРОНКИ
+        # ========================================
+        
+        # Таблица отправленных сообщений
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_deliveries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
+            )
+        ''')
+        
+        # Таблица кликов по кнопкам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS button_clicks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                button_id INTEGER,
+                button_type TEXT NOT NULL,
+                button_text TEXT,
+                clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
+            )
+        ''')
+        
+        # ========================================
+        # ОСТАЛЬНЫЕ ТАБЛИЦЫ (без изменений)
+        # ========================================
+        
+        # НОВАЯ ТАБЛИЦА: Таблица настроек продления подписки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS renewal_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        
+        # Инициализация настроек продления
+        cursor.execute('''
+            INSERT OR IGNORE INTO renewal_settings (key, value) 
+            VALUES ('renewal_message', ?)
+        ''', ("⏰ <b>Ваша подписка истекает сегодня!</b>\n\n"
+             "💳 Чтобы продолжить получать эксклюзивные материалы, продлите подписку.\n\n"
+             "✨ Не упустите возможность оставаться в курсе всех новинок!",))
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO renewal_settings (key, value) 
+            VALUES ('renewal_photo_url', '')
+        ''')
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO renewal_settings (key, value) 
+            VALUES ('renewal_button_text', 'Продлить подписку')
+        ''')
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO renewal_settings (key, value) 
+            VALUES ('renewal_button_url', '')
+        ''')
+        
+        # Обновляем таблицу сообщений рассылки - добавляем поле для фото
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_messages (
+                message_number INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                delay_hours INTEGER DEFAULT 24,
+                photo_url TEXT DEFAULT NULL
+            )
+        ''')
+        
+        # Добавляем колонку photo_url если её нет (для существующих БД)
+        cursor.execute("PRAGMA table_info(broadcast_messages)")
+        columns = [column[1] for column in cursor.fetchall()]
+        if 'photo_url' not in columns:
+            cursor.execute('ALTER TABLE broadcast_messages ADD COLUMN photo_url TEXT DEFAULT NULL')
+            logger.info("Добавлена колонка photo_url в broadcast_messages")
+        
+        # Таблица кнопок для сообщений рассылки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_number INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
+            )
+        ''')
+        
+        # НОВАЯ: Таблица кнопок для приветственного сообщения (механические кнопки)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS welcome_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                button_text TEXT NOT NULL UNIQUE,
+                position INTEGER DEFAULT 1
+            )
+        ''')
+        
+        # НОВАЯ: Таблица последующих сообщений после нажатия кнопок приветствия
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS welcome_follow_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                welcome_button_id INTEGER,
+                message_number INTEGER,
+                text TEXT NOT NULL,
+                photo_url TEXT DEFAULT NULL,
+                FOREIGN KEY (welcome_button_id) REFERENCES welcome_buttons(id)
+            )
+        ''')
+        
+        # Проверяем, есть ли старая структура с callback_data и обновляем
+        cursor.execute("PRAGMA table_info(welcome_buttons)")
+        columns = [column[1] for column in cursor.fetchall()]
+        if 'callback_data' in columns:
+            # Создаем новую таблицу
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS welcome_buttons (
+                CREATE TABLE IF NOT EXISTS welcome_buttons_new (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     button_text TEXT NOT NULL UNIQUE,
                     position INTEGER DEFAULT 1
                 )
             ''')
             
-            # НОВАЯ: Таблица последующих сообщений после нажатия кнопок приветствия
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS welcome_follow_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    welcome_button_id INTEGER,
-                    message_number INTEGER,
-                    text TEXT NOT NULL,
-                    photo_url TEXT DEFAULT NULL,
-                    FOREIGN KEY (welcome_button_id) REFERENCES welcome_buttons(id)
-                )
-            ''')
-            
-            # Проверяем, есть ли старая структура с callback_data и обновляем
-            cursor.execute("PRAGMA table_info(welcome_buttons)")
-            columns = [column[1] for column in cursor.fetchall()]
-            if 'callback_data' in columns:
-                # Создаем новую таблицу
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS welcome_buttons_new (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        button_text TEXT NOT NULL UNIQUE,
-                        position INTEGER DEFAULT 1
-                    )
-                ''')
-                
-                # Копируем данные, убирая callback_data
-                cursor.execute('''
-                    INSERT INTO welcome_buttons_new (id, button_text, position)
-                    SELECT id, button_text, position FROM welcome_buttons
-                ''')
-                
-                # Удаляем старую таблицу и переименовываем новую
-                cursor.execute('DROP TABLE welcome_buttons')
-                cursor.execute('ALTER TABLE welcome_buttons_new RENAME TO welcome_buttons')
-                
-                logger.info("Обновлена структура таблицы welcome_buttons для механических кнопок")
-            
-            # НОВАЯ: Таблица кнопок для прощального сообщения
+            # Копируем данные, убирая callback_data
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS goodbye_buttons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    button_text TEXT NOT NULL,
-                    button_url TEXT NOT NULL,
-                    position INTEGER DEFAULT 1
-                )
+                INSERT INTO welcome_buttons_new (id, button_text, position)
+                SELECT id, button_text, position FROM welcome_buttons
             ''')
             
-            # НОВАЯ: Таблица запланированных массовых рассылок
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_text TEXT NOT NULL,
-                    photo_url TEXT DEFAULT NULL,
-                    scheduled_time TIMESTAMP NOT NULL,
-                    is_sent INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            # Удаляем старую таблицу и переименовываем новую
+            cursor.execute('DROP TABLE welcome_buttons')
+            cursor.execute('ALTER TABLE welcome_buttons_new RENAME TO welcome_buttons')
             
-            # НОВАЯ: Таблица кнопок для запланированных рассылок
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS scheduled_broadcast_buttons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    broadcast_id INTEGER,
-                    button_text TEXT NOT NULL,
-                    button_url TEXT NOT NULL,
-                    position INTEGER DEFAULT 1,
-                    FOREIGN KEY (broadcast_id) REFERENCES scheduled_broadcasts(id)
-                )
-            ''')
+            logger.info("Обновлена структура таблицы welcome_buttons для механических кнопок")
+        
+        # НОВАЯ: Таблица кнопок для прощального сообщения
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS goodbye_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1
+            )
+        ''')
+        
+        # НОВАЯ: Таблица запланированных массовых рассылок
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_text TEXT NOT NULL,
+                photo_url TEXT DEFAULT NULL,
+                scheduled_time TIMESTAMP NOT NULL,
+                is_sent INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # НОВАЯ: Таблица кнопок для запланированных рассылок
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_broadcast_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                broadcast_id INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (broadcast_id) REFERENCES scheduled_broadcasts(id)
+            )
+        ''')
 
-            # НОВЫЕ ТАБЛИЦЫ ДЛЯ РАССЫЛОК ОПЛАТИВШИХ ПОЛЬЗОВАТЕЛЕЙ
+        # НОВЫЕ ТАБЛИЦЫ ДЛЯ РАССЫЛОК ОПЛАТИВШИХ ПОЛЬЗОВАТЕЛЕЙ
 
-            # Таблица сообщений рассылки для оплативших
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS paid_broadcast_messages (
-                    message_number INTEGER PRIMARY KEY,
-                    text TEXT NOT NULL,
-                    delay_hours REAL DEFAULT 24,
-                    photo_url TEXT DEFAULT NULL
-                )
-            ''')
+        # Таблица сообщений рассылки для оплативших
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS paid_broadcast_messages (
+                message_number INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                delay_hours REAL DEFAULT 24,
+                photo_url TEXT DEFAULT NULL
+            )
+        ''')
 
-            # Таблица кнопок для сообщений рассылки оплативших
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS paid_message_buttons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_number INTEGER,
-                    button_text TEXT NOT NULL,
-                    button_url TEXT NOT NULL,
-                    position INTEGER DEFAULT 1,
-                    FOREIGN KEY (message_number) REFERENCES paid_broadcast_messages(message_number)
-                )
-            ''')
+        # Таблица кнопок для сообщений рассылки оплативших
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS paid_message_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_number INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (message_number) REFERENCES paid_broadcast_messages(message_number)
+            )
+        ''')
 
-            # Таблица запланированных сообщений для оплативших
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS paid_scheduled_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    message_number INTEGER,
-                    scheduled_time TIMESTAMP,
-                    is_sent INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (message_number) REFERENCES paid_broadcast_messages(message_number)
-                )
-            ''')
+        # Таблица запланированных сообщений для оплативших
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS paid_scheduled_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_number INTEGER,
+                scheduled_time TIMESTAMP,
+                is_sent INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES paid_broadcast_messages(message_number)
+            )
+        ''')
 
-            # Запланированные массовые рассылки для оплативших
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS paid_scheduled_broadcasts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_text TEXT NOT NULL,
-                    photo_url TEXT DEFAULT NULL,
-                    scheduled_time TIMESTAMP NOT NULL,
-                    is_sent INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        # Запланированные массовые рассылки для оплативших
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS paid_scheduled_broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_text TEXT NOT NULL,
+                photo_url TEXT DEFAULT NULL,
+                scheduled_time TIMESTAMP NOT NULL,
+                is_sent INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
 
-            # Кнопки для запланированных рассылок оплативших
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS paid_scheduled_broadcast_buttons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    broadcast_id INTEGER,
-                    button_text TEXT NOT NULL,
-                    button_url TEXT NOT NULL,
-                    position INTEGER DEFAULT 1,
-                    FOREIGN KEY (broadcast_id) REFERENCES paid_scheduled_broadcasts(id)
-                )
-            ''')
-            
-            # Таблица для управления статусом рассылки
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS broadcast_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            ''')
-            
-            # Инициализация настроек рассылки
-            cursor.execute('''
-                INSERT OR IGNORE INTO broadcast_settings (key, value) 
-                VALUES ('broadcast_enabled', '1')
-            ''')
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO broadcast_settings (key, value) 
-                VALUES ('auto_resume_time', '')
-            ''')
-            
-            # Таблица запланированных сообщений (автоматическая рассылка)
+        # Кнопки для запланированных рассылок оплативших
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS paid_scheduled_broadcast_buttons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                broadcast_id INTEGER,
+                button_text TEXT NOT NULL,
+                button_url TEXT NOT NULL,
+                position INTEGER DEFAULT 1,
+                FOREIGN KEY (broadcast_id) REFERENCES paid_scheduled_broadcasts(id)
+            )
+        ''')
+        
+        # Таблица для управления статусом рассылки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        
+        # Инициализация настроек рассылки
+        cursor.execute('''
+            INSERT OR IGNORE INTO broadcast_settings (key, value) 
+            VALUES ('broadcast_enabled', '1')
+        ''')
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO broadcast_settings (key, value) 
+            VALUES ('auto_resume_time', '')
+        ''')
+        
+        # Таблица запланированных сообщений (автоматическая рассылка)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_number INTEGER,
+                scheduled_time TIMESTAMP,
+                is_sent INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
+            )
+        ''')
+        
+        # Таблица настроек - добавляем поле для фото приветствия и сообщения при отписке
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        
+        # Инициализация приветственного сообщения
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('welcome_message', ?)
+        ''', ("🎉 <b>Добро пожаловать!</b>\n\n"
+             "Рады видеть вас в нашем канале! 🚀\n\n"
+             "Для получения полезных материалов выберите одно из действий ниже:",))
+        
+        # Добавляем сообщение при отписке
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('goodbye_message', ?)
+        ''', ("😢 Жаль, что вы покидаете нас!\n\n"
+             "Если передумаете - всегда будем рады видеть вас снова в нашем канале.\n\n"
+             "Удачи! 👋",))
+        
+        # Добавляем URL фото для приветствия (опционально)
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('welcome_photo_url', '')
+        ''')
+        
+        # Добавляем URL фото для прощания (опционально)
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('goodbye_photo_url', '')
+        ''')
+        
+        # НОВЫЕ настройки для сообщений после оплаты
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('payment_success_message', ?)
+        ''', ("🎉 <b>Спасибо за покупку!</b>\n\n"
+             "💰 Ваш платеж успешно обработан!\n\n"
+             "✅ Вы получили полный доступ ко всем материалам.\n\n"
+             "📚 Если у вас есть вопросы - обращайтесь к нашей поддержке.\n\n"
+             "🙏 Благодарим за доверие!",))
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('payment_success_photo_url', '')
+        ''')
+        
+        # ✅ НОВОЕ: Инициализация настройки для включения/выключения сообщения подтверждения
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value) 
+            VALUES ('success_message_enabled', '1')
+        ''')
+        
+        # Инициализация сообщений рассылки по умолчанию
+        default_messages = [
+            ("Сообщение 1: Основы работы с нашим сервисом 📚", 0.05, None),    # 3 минуты
+            ("Сообщение 2: Продвинутые функции и возможности 🔧", 4, None),   # 4 часа
+            ("Сообщение 3: Лучшие практики и советы 💡", 8, None),          # 8 часов
+            ("Сообщение 4: Частые вопросы и ответы ❓", 12, None),           # 12 часов
+            ("Сообщение 5: Примеры успешных кейсов 📈", 16, None),          # 16 часов
+            ("Сообщение 6: Дополнительные ресурсы 📖", 20, None),           # 20 часов
+            ("Сообщение 7: Благодарность и обратная связь 🙏", 23, None)     # 23 часа
+        ]
+        
+        for i, (text, delay, photo) in enumerate(default_messages, 1):
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS scheduled_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    message_number INTEGER,
-                    scheduled_time TIMESTAMP,
-                    is_sent INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (message_number) REFERENCES broadcast_messages(message_number)
-                )
+                INSERT OR IGNORE INTO broadcast_messages (message_number, text, delay_hours, photo_url)
+                VALUES (?, ?, ?, ?)
+            ''', (i, text, delay, photo))
+
+        # ========================================
+        # 📊 ИНДЕКСЫ ДЛЯ ПРОИЗВОДИТЕЛЬНОСТИ
+        # ========================================
+        
+        # Основные индексы
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_bot_started ON users(bot_started)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_paid ON users(has_paid)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_messages_time ON scheduled_messages(scheduled_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_messages_sent ON scheduled_messages(is_sent)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(payment_status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_paid_scheduled_messages_time ON paid_scheduled_messages(scheduled_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_paid_scheduled_messages_sent ON paid_scheduled_messages(is_sent)')
+        # 📊 Индексы для воронки
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_user ON message_deliveries(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_message ON message_deliveries(message_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_time ON message_deliveries(delivered_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_user ON button_clicks(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_message ON button_clicks(message_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_time ON button_clicks(clicked_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_type ON button_clicks(button_type)')
+
+    def _migration_002_job_leases(self, cursor):
+        """Колонки аренды задач для параллельных воркеров"""
+
+        # ========================================
+        # 🔒 АРЕНДА ЗАДАЧ ДЛЯ ПАРАЛЛЕЛЬНЫХ ВОРКЕРОВ
+        # ========================================
+
+        job_tables = ('scheduled_messages', 'paid_scheduled_messages',
+                      'scheduled_broadcasts', 'paid_scheduled_broadcasts')
+        for table in job_tables:
+            cursor.execute(f"PRAGMA table_info({table})")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            if 'claimed_by' not in columns:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN claimed_by TEXT DEFAULT NULL')
+                logger.info(f"Добавлена колонка claimed_by в {table}")
+
+            if 'lease_until' not in columns:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN lease_until TIMESTAMP DEFAULT NULL')
+                logger.info(f"Добавлена колонка lease_until в {table}")
+
+        # 🔒 Индексы для захвата задач воркерами
+        for table in job_tables:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_claim ON {table}(is_sent, scheduled_time)')
+
+    def _migration_003_analytics_database(self, cursor):
+        """Перенос таблиц событий в отдельную аналитическую БД (схема analytics)"""
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics.payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount TEXT,
+                payment_status TEXT,
+                utm_source TEXT,
+                utm_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics.message_deliveries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics.button_clicks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                button_id INTEGER,
+                button_type TEXT NOT NULL,
+                button_text TEXT,
+                clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Копируем накопленные события с сохранением id. Коммит в WAL режиме не атомарен
+        # между файлами, поэтому исходные таблицы не удаляются, а переименовываются
+        # в legacy_* — данные не потеряются, даже если сбой случится посреди коммита
+        copy_columns = {
+            'payments': 'id, user_id, amount, payment_status, utm_source, utm_id, created_at',
+            'message_deliveries': 'id, user_id, message_number, delivered_at',
+            'button_clicks': 'id, user_id, message_number, button_id, button_type, button_text, clicked_at',
+        }
+        for table, columns in copy_columns.items():
+            cursor.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if not cursor.fetchone():
+                continue
+
+            cursor.execute(f'INSERT OR IGNORE INTO analytics.{table} ({columns}) SELECT {columns} FROM main.{table}')
+            if cursor.rowcount:
+                logger.info(f"📦 Перенесено {cursor.rowcount} записей {table} в аналитическую БД")
+            cursor.execute(f'ALTER TABLE main.{table} RENAME TO legacy_{table}')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_payments_status ON payments(payment_status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_deliveries_user ON message_deliveries(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_deliveries_message ON message_deliveries(message_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_deliveries_time ON message_deliveries(delivered_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_clicks_user ON button_clicks(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_clicks_message ON button_clicks(message_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_clicks_time ON button_clicks(clicked_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_clicks_type ON button_clicks(button_type)')
+    
+    def _migration_004_funnel_cursors(self, cursor):
+        """Курсор воронки пользователя: последний отправленный шаг и время следующего"""
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_cursors (
+                user_id INTEGER NOT NULL,
+                funnel TEXT NOT NULL,
+                step INTEGER NOT NULL DEFAULT 0,
+                next_due_at TIMESTAMP DEFAULT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, funnel)
+            ) WITHOUT ROWID
+        ''')
+
+        for funnel, table in (('free', 'scheduled_messages'), ('paid', 'paid_scheduled_messages')):
+            # Поиск следующего сообщения пользователя — по индексу, без сканирования очереди
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_number ON {table}(user_id, message_number)')
+
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO funnel_cursors (user_id, funnel, step, next_due_at)
+                SELECT user_id, ?,
+                       COALESCE(MAX(CASE WHEN is_sent = 1 THEN message_number END), 0),
+                       MIN(CASE WHEN is_sent = 0 THEN scheduled_time END)
+                FROM {table}
+                GROUP BY user_id
+            ''', (funnel,))
+            if cursor.rowcount:
+                logger.info(f"🧭 Создано {cursor.rowcount} курсоров воронки {funnel}")
+
+    def _migration_005_cursor_funnel_engine(self, cursor):
+        """Движок воронки на курсорах: начало воронки и аренда курсора воркером"""
+
+        # started_at заполняется только у курсоров движка курсоров (FUNNEL_ENGINE=cursor)
+        cursor.execute('ALTER TABLE funnel_cursors ADD COLUMN started_at TIMESTAMP DEFAULT NULL')
+        cursor.execute('ALTER TABLE funnel_cursors ADD COLUMN claimed_by TEXT DEFAULT NULL')
+        cursor.execute('ALTER TABLE funnel_cursors ADD COLUMN lease_until TIMESTAMP DEFAULT NULL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_funnel_cursors_due ON funnel_cursors(funnel, next_due_at)')
+
+    def _migration_006_stat_counters(self, cursor):
+        """Счетчики статистики, которые ведут триггеры (вместо COUNT(*) на каждый экран)"""
+
+        for schema, counters in (('main', self.COUNTERS), ('analytics', self.ANALYTICS_COUNTERS)):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {schema}.counters (
+                    name TEXT PRIMARY KEY,
+                    value NUMERIC NOT NULL DEFAULT 0
+                ) WITHOUT ROWID
             ''')
-            
-            # Таблица настроек - добавляем поле для фото приветствия и сообщения при отписке
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
+            self._create_counter_triggers(cursor, counters, schema)
+
+            # Начальные значения — в той же транзакции, что и триггеры
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO {schema}.counters (name, value) VALUES (?, ?)',
+                self._count_counters(cursor, counters, schema).items()
+            )
+
+        # Новые пользователи за сутки считаются по диапазону, а не сканированием
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at)')
+
+    def _migration_007_user_search(self, cursor):
+        """Полнотекстовый поиск пользователей по username и имени (FTS5)"""
+
+        # Внешнее содержимое: текст хранится только в users, индекс ведут триггеры
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, first_name,
+                content='users', content_rowid='user_id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+                INSERT INTO users_fts (rowid, username, first_name)
+                VALUES (NEW.user_id, NEW.username, NEW.first_name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+                INSERT INTO users_fts (users_fts, rowid, username, first_name)
+                VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name ON users BEGIN
+                INSERT INTO users_fts (users_fts, rowid, username, first_name)
+                VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+                INSERT INTO users_fts (rowid, username, first_name)
+                VALUES (NEW.user_id, NEW.username, NEW.first_name);
+            END
+        ''')
+
+        # Индексируем уже существующих пользователей
+        cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+        # Страницы списка активных пользователей идут по индексу без сортировки
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_active_joined ON users(is_active, joined_at)')
+
+    def _migration_008_reaction_histograms(self, cursor):
+        """Гистограммы времени реакции на сообщения воронки, которые ведутся при записи клика"""
+
+        # Первое нажатие пользователя на кнопку каждого типа — дубликаты отсекает PRIMARY KEY
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics.reaction_first_clicks (
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                button_type TEXT NOT NULL,
+                reaction_seconds REAL NOT NULL,
+                PRIMARY KEY (user_id, message_number, button_type)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics.reaction_histogram (
+                message_number INTEGER NOT NULL,
+                button_type TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                clicks INTEGER NOT NULL DEFAULT 0,
+                seconds_sum REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (message_number, button_type, bucket)
+            ) WITHOUT ROWID
+        ''')
+
+        # Корзина считается в триггере: INSERT OR IGNORE повторного нажатия его не вызывает
+        bucket = ' '.join(
+            f"WHEN NEW.reaction_seconds < {bound} THEN {index}"
+            for index, bound in enumerate(self.REACTION_BUCKET_BOUNDS)
+        )
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS analytics.reaction_histogram_insert
+            AFTER INSERT ON reaction_first_clicks BEGIN
+                INSERT INTO reaction_histogram (message_number, button_type, bucket, clicks, seconds_sum)
+                VALUES (
+                    NEW.message_number, NEW.button_type,
+                    CASE {bucket} ELSE {len(self.REACTION_BUCKET_BOUNDS)} END,
+                    1, NEW.reaction_seconds
                 )
+                ON CONFLICT (message_number, button_type, bucket) DO UPDATE SET
+                    clicks = clicks + 1, seconds_sum = seconds_sum + excluded.seconds_sum;
+            END
+        ''')
+
+        # Уже накопленные клики: первое нажатие против последней доставки до него
+        cursor.execute('''
+            INSERT OR IGNORE INTO analytics.reaction_first_clicks
+                (user_id, message_number, button_type, reaction_seconds)
+            SELECT f.user_id, f.message_number, f.button_type,
+                   MAX(0, (julianday(f.clicked_at) - julianday(MAX(md.delivered_at))) * 86400)
+            FROM (
+                SELECT user_id, message_number, button_type, MIN(clicked_at) AS clicked_at
+                FROM analytics.button_clicks
+                GROUP BY user_id, message_number, button_type
+            ) f
+            JOIN analytics.message_deliveries md
+              ON md.user_id = f.user_id AND md.message_number = f.message_number
+             AND md.delivered_at <= f.clicked_at
+            GROUP BY f.user_id, f.message_number, f.button_type
+        ''')
+
+    def _migration_009_epoch_timestamps(self, cursor):
+        """Время расписания и событий — INTEGER секунды unix вместо текста
+
+        Раньше в колонках лежали строки двух видов: str(datetime.now()) в местном
+        времени (расписание, курсоры воронки, payed_till) и CURRENT_TIMESTAMP
+        в UTC (события, даты регистрации). Сравнивались они как строки.
+        SQLite не меняет тип колонки через ALTER, поэтому таблицы пересоздаются.
+        """
+        now = self.EPOCH_NOW_SQL
+
+        self._rebuild_table(cursor, 'main', 'users', f'''
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                joined_at INTEGER DEFAULT ({now}),
+                is_active INTEGER DEFAULT 1,
+                bot_started INTEGER DEFAULT 0,
+                has_paid INTEGER DEFAULT 0,
+                paid_at TIMESTAMP DEFAULT NULL,
+                payed_till INTEGER DEFAULT NULL
+        ''', utc=('joined_at',), local=('payed_till',))
+        for prefix in ('', 'paid_'):
+            self._rebuild_table(cursor, 'main', f'{prefix}scheduled_messages', f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_number INTEGER,
+                scheduled_time INTEGER,
+                is_sent INTEGER DEFAULT 0,
+                claimed_by TEXT DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (message_number) REFERENCES {prefix}broadcast_messages(message_number)
+            ''', local=('scheduled_time',))
+            self._rebuild_table(cursor, 'main', f'{prefix}scheduled_broadcasts', f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_text TEXT NOT NULL,
+                photo_url TEXT DEFAULT NULL,
+                scheduled_time INTEGER NOT NULL,
+                is_sent INTEGER DEFAULT 0,
+                created_at INTEGER DEFAULT ({now}),
+                claimed_by TEXT DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL
+            ''', utc=('created_at',), local=('scheduled_time',))
+        self._rebuild_table(cursor, 'main', 'funnel_cursors', '''
+                user_id INTEGER NOT NULL,
+                funnel TEXT NOT NULL,
+                step INTEGER NOT NULL DEFAULT 0,
+                next_due_at INTEGER DEFAULT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at INTEGER DEFAULT NULL,
+                claimed_by TEXT DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL,
+                PRIMARY KEY (user_id, funnel)
+        ''', local=('next_due_at', 'started_at'), options='WITHOUT ROWID')
+
+        self._rebuild_table(cursor, 'analytics', 'payments', f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount TEXT,
+                payment_status TEXT,
+                utm_source TEXT,
+                utm_id TEXT,
+                created_at INTEGER DEFAULT ({now})
+        ''', utc=('created_at',))
+        self._rebuild_table(cursor, 'analytics', 'message_deliveries', f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                delivered_at INTEGER DEFAULT ({now})
+        ''', utc=('delivered_at',))
+        self._rebuild_table(cursor, 'analytics', 'button_clicks', f'''
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message_number INTEGER NOT NULL,
+                button_id INTEGER,
+                button_type TEXT NOT NULL,
+                button_text TEXT,
+                clicked_at INTEGER DEFAULT ({now})
+        ''', utc=('clicked_at',))
+
+    def _migration_010_subscription_expiry(self, cursor):
+        """Индекс истекающих подписок: только оплатившие, по дате окончания"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_payed_till ON users(payed_till) WHERE has_paid = 1')
+
+    def _migration_011_in_flight_jobs(self, cursor):
+        """Индексы арендованных шагов воронок: брошенные аренды списываются, а не отправляются повторно"""
+        for queue in ('scheduled_messages', 'paid_scheduled_messages'):
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{queue}_in_flight ON {queue}(lease_until)
+                WHERE is_sent = 0 AND claimed_by IS NOT NULL
             ''')
-            
-            # Инициализация приветственного сообщения
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('welcome_message', ?)
-            ''', ("🎉 <b>Добро пожаловать!</b>\n\n"
-                 "Рады видеть вас в нашем канале! 🚀\n\n"
-                 "Для получения полезных материалов выберите одно из действий ниже:",))
-            
-            # Добавляем сообщение при отписке
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('goodbye_message', ?)
-            ''', ("😢 Жаль, что вы покидаете нас!\n\n"
-                 "Если передумаете - всегда будем рады видеть вас снова в нашем канале.\n\n"
-                 "Удачи! 👋",))
-            
-            # Добавляем URL фото для приветствия (опционально)
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('welcome_photo_url', '')
-            ''')
-            
-            # Добавляем URL фото для прощания (опционально)
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('goodbye_photo_url', '')
-            ''')
-            
-            # НОВЫЕ настройки для сообщений после оплаты
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('payment_success_message', ?)
-            ''', ("🎉 <b>Спасибо за покупку!</b>\n\n"
-                 "💰 Ваш платеж успешно обработан!\n\n"
-                 "✅ Вы получили полный доступ ко всем материалам.\n\n"
-                 "📚 Если у вас есть вопросы - обращайтесь к нашей поддержке.\n\n"
-                 "🙏 Благодарим за доверие!",))
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('payment_success_photo_url', '')
-            ''')
-            
-            # ✅ НОВОЕ: Инициализация настройки для включения/выключения сообщения подтверждения
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value) 
-                VALUES ('success_message_enabled', '1')
-            ''')
-            
-            # Инициализация сообщений рассылки по умолчанию
-            default_messages = [
-                ("Сообщение 1: Основы работы с нашим сервисом 📚", 0.05, None),    # 3 минуты
-                ("Сообщение 2: Продвинутые функции и возможности 🔧", 4, None),   # 4 часа
-                ("Сообщение 3: Лучшие практики и советы 💡", 8, None),          # 8 часов
-                ("Сообщение 4: Частые вопросы и ответы ❓", 12, None),           # 12 часов
-                ("Сообщение 5: Примеры успешных кейсов 📈", 16, None),          # 16 часов
-                ("Сообщение 6: Дополнительные ресурсы 📖", 20, None),           # 20 часов
-                ("Сообщение 7: Благодарность и обратная связь 🙏", 23, None)     # 23 часа
-            ]
-            
-            for i, (text, delay, photo) in enumerate(default_messages, 1):
-                cursor.execute('''
-                    INSERT OR IGNORE INTO broadcast_messages (message_number, text, delay_hours, photo_url)
-                    VALUES (?, ?, ?, ?)
-                ''', (i, text, delay, photo))
-            
-            conn.commit()
-            
-            # ========================================
-            # 📊 ИНДЕКСЫ ДЛЯ ПРОИЗВОДИТЕЛЬНОСТИ
-            # ========================================
-            
-            # Основные индексы
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_bot_started ON users(bot_started)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_paid ON users(has_paid)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_messages_time ON scheduled_messages(scheduled_time)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_messages_sent ON scheduled_messages(is_sent)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(payment_status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_paid_scheduled_messages_time ON paid_scheduled_messages(scheduled_time)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_paid_scheduled_messages_sent ON paid_scheduled_messages(is_sent)')
-            
-            # 📊 Индексы для воронки
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_user ON message_deliveries(user_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_message ON message_deliveries(message_number)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_time ON message_deliveries(delivered_at)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_user ON button_clicks(user_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_message ON button_clicks(message_number)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_time ON button_clicks(clicked_at)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clicks_type ON button_clicks(button_type)')
-            
-            conn.commit()
-            logger.info("✅ Индексы созданы для оптимизации производительности")
-            
-        except sqlite3.Error as e:
-            logger.error(f"❌ Ошибка при инициализации базы данных: {e}")
-            raise
-        finally:
-            if 'conn' in locals():
-                conn.close()
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_funnel_cursors_in_flight ON funnel_cursors(funnel, lease_until)
+            WHERE claimed_by IS NOT NULL
+        ''')
+
+    def _migration_012_audience_segments(self, cursor):
+        """Сегменты рассылок: колонка segment у запланированных рассылок и индексы под каждый вид сегмента"""
+        for table in ('scheduled_broadcasts', 'paid_scheduled_broadcasts'):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN segment TEXT DEFAULT NULL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_audience ON users(is_active, bot_started, has_paid)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_lapsed ON users(is_active, bot_started)
+            WHERE has_paid = 0 AND paid_at IS NOT NULL
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_deliveries_message_user ON message_deliveries(message_number, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_clicks_message_user ON button_clicks(message_number, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS analytics.idx_payments_utm_source ON payments(utm_source, payment_status, user_id)')
+
+    def _rebuild_table(self, cursor, schema, table, columns_sql, utc=(), local=(), options=''):
+        """Пересоздать таблицу с новыми типами колонок, сохранив строки, индексы и триггеры
+
+        Колонки utc и local переводятся из текста в секунды unix: в utc лежало
+        время CURRENT_TIMESTAMP, в local — местное время Python.
+        """
+        cursor.execute(f'''
+            SELECT sql FROM {schema}.sqlite_master
+            WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+        ''', (table,))
+        dependents = [row[0] for row in cursor.fetchall()]
+        cursor.execute(f"SELECT seq FROM {schema}.sqlite_sequence WHERE name = ?", (table,))
+        sequence = cursor.fetchone()
+
+        cursor.execute(f'PRAGMA {schema}.table_info({table})')
+        columns = [row[1] for row in cursor.fetchall()]
+        values = [
+            f"CAST(strftime('%s', {column}) AS INTEGER)" if column in utc
+            else f"CAST(strftime('%s', {column}, 'utc') AS INTEGER)" if column in local
+            else column
+            for column in columns
+        ]
+
+        cursor.execute(f'CREATE TABLE {schema}.{table}_rebuild ({columns_sql}) {options}')
+        cursor.execute(f'''
+            INSERT INTO {schema}.{table}_rebuild ({', '.join(columns)})
+            SELECT {', '.join(values)} FROM {schema}.{table}
+        ''')
+        cursor.execute(f'DROP TABLE {schema}.{table}')
+        cursor.execute(f'ALTER TABLE {schema}.{table}_rebuild RENAME TO {table}')
+        if sequence:
+            cursor.execute(f'UPDATE {schema}.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (sequence[0], table))
+
+        # В sqlite_master имя схемы не сохраняется — добавляем его обратно
+        for sql in dependents:
+            cursor.execute(re.sub(r'^CREATE (UNIQUE INDEX|INDEX|TRIGGER) ', f'CREATE \\1 {schema}.', sql))
     
     # ========================================
     # 📊 МЕТОДЫ ДЛЯ ОТСЛЕЖИВАНИЯ ВОРОНКИ
     # ========================================
     
     def log_message_delivery(self, user_id, message_number):
-        """Логирование отправки сообщения пользователю"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
+        """Логирование отправки сообщения пользователю (запись идет через очередь)"""
         try:
-            cursor.execute('''
-                INSERT INTO message_deliveries (user_id, message_number)
-                VALUES (?, ?)
-            ''', (user_id, message_number))
-            
-            conn.commit()
-            logger.debug(f"📬 Залогирована отправка сообщения {message_number} пользователю {user_id}")
+            self._analytics_writes.put('''
+                INSERT INTO message_deliveries (user_id, message_number, delivered_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, message_number, int(time.time())))
+
+            key = (user_id, message_number)
+            self._recent_deliveries[key] = time.time()
+            self._recent_deliveries.move_to_end(key)
+            while len(self._recent_deliveries) > self.RECENT_DELIVERIES_SIZE:
+                self._recent_deliveries.popitem(last=False)
+
+            logger.debug("📬 Залогирована отправка сообщения %s пользователю %s", message_number, user_id)
             return True
-            
+
         except Exception as e:
             logger.error(f"❌ Ошибка при логировании отправки сообщения {message_number} пользователю {user_id}: {e}")
-            try:
-                conn.rollback()
-            except:
-                pass
             return False
-        finally:
-            if conn:
-                conn.close()
+    
+    def log_message_deliveries(self, deliveries):
+        """Логирование пачки отправок [(user_id, message_number)] одним проходом"""
+        delivered_at = int(time.time())
+        for user_id, message_number in deliveries:
+            self._analytics_writes.put('''
+                INSERT INTO message_deliveries (user_id, message_number, delivered_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, message_number, delivered_at))
+
+            key = (user_id, message_number)
+            self._recent_deliveries[key] = time.time()
+            self._recent_deliveries.move_to_end(key)
+        while len(self._recent_deliveries) > self.RECENT_DELIVERIES_SIZE:
+            self._recent_deliveries.popitem(last=False)
     
     def log_button_click(self, user_id, message_number, button_id, button_type, button_text):
         """
@@ -535,30 +1245,91 @@ class Database:
             button_type: Тип кнопки ('callback' или 'url')
             button_text: Текст кнопки
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                INSERT INTO button_clicks (user_id, message_number, button_id, button_type, button_text)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, message_number, button_id, button_type, button_text))
-            
-            conn.commit()
-            logger.debug(f"🔘 Залогирован клик по кнопке '{button_text}' ({button_type}) в сообщении {message_number} от пользователя {user_id}")
+            clicked_at = int(time.time())
+            self._analytics_writes.put('''
+                INSERT INTO button_clicks (user_id, message_number, button_id, button_type, button_text, clicked_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, message_number, button_id, button_type, button_text, clicked_at))
+            self._log_reaction(user_id, message_number, button_type, clicked_at)
+
+            logger.debug("🔘 Залогирован клик по кнопке '%s' (%s) в сообщении %s от пользователя %s",
+                         button_text, button_type, message_number, user_id)
             return True
-            
+
         except Exception as e:
             logger.error(f"❌ Ошибка при логировании клика по кнопке: {e}")
-            try:
-                conn.rollback()
-            except:
-                pass
             return False
-        finally:
-            if conn:
-                conn.close()
     
+    def _log_reaction(self, user_id, message_number, button_type, clicked_at):
+        """Время реакции на сообщение — в гистограмму (учитывается первое нажатие каждого типа)"""
+        delivered = self._recent_deliveries.get((user_id, message_number))
+        if delivered is not None:
+            self._analytics_writes.put('''
+                INSERT OR IGNORE INTO reaction_first_clicks (user_id, message_number, button_type, reaction_seconds)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, message_number, button_type, max(0.0, time.time() - delivered)))
+            return
+
+        # Доставка была до перезапуска или вытеснена из памяти — берем ее время из БД
+        self._analytics_writes.put('''
+            INSERT OR IGNORE INTO reaction_first_clicks (user_id, message_number, button_type, reaction_seconds)
+            SELECT ?, ?, ?, MAX(0, ? - delivered_at)
+            FROM (
+                SELECT MAX(delivered_at) AS delivered_at FROM message_deliveries
+                WHERE user_id = ? AND message_number = ? AND delivered_at <= ?
+            )
+            WHERE delivered_at IS NOT NULL
+        ''', (user_id, message_number, button_type, clicked_at, user_id, message_number, clicked_at))
+
+    def get_reaction_histogram(self, message_number, button_type=None):
+        """Гистограмма времени реакции: {корзина: (нажатий, сумма секунд)}"""
+        conn = self._get_analytics_connection()
+        cursor = conn.cursor()
+
+        try:
+            if button_type is None:
+                cursor.execute('''
+                    SELECT bucket, SUM(clicks), SUM(seconds_sum) FROM reaction_histogram
+                    WHERE message_number = ? GROUP BY bucket
+                ''', (message_number,))
+            else:
+                cursor.execute('''
+                    SELECT bucket, clicks, seconds_sum FROM reaction_histogram
+                    WHERE message_number = ? AND button_type = ?
+                ''', (message_number, button_type))
+            return {bucket: (clicks, seconds_sum) for bucket, clicks, seconds_sum in cursor.fetchall()}
+        finally:
+            self._release_analytics_connection(conn)
+
+    def _bucket_upper_bound(self, bucket):
+        bounds = self.REACTION_BUCKET_BOUNDS
+        return bounds[bucket] if bucket < len(bounds) else bounds[-1]
+
+    def reaction_percentiles(self, histogram, percentiles=(50, 90, 99)):
+        """Перцентили времени реакции (верхняя граница корзины, секунды) или {} без данных"""
+        total = sum(clicks for clicks, seconds_sum in histogram.values())
+        if not total:
+            return {}
+
+        result = {}
+        seen = 0
+        targets = iter(sorted(percentiles))
+        target = next(targets)
+        for bucket in sorted(histogram):
+            seen += histogram[bucket][0]
+            while target is not None and seen * 100 >= target * total:
+                result[target] = self._bucket_upper_bound(bucket)
+                target = next(targets, None)
+        return result
+
+    def count_reacted_within(self, histogram, seconds):
+        """Сколько нажали не позже чем через seconds (точно на границах корзин, иначе с недобором)"""
+        return sum(
+            clicks for bucket, (clicks, seconds_sum) in histogram.items()
+            if bucket < len(self.REACTION_BUCKET_BOUNDS) and self.REACTION_BUCKET_BOUNDS[bucket] <= seconds
+        )
+
     def get_funnel_data(self):
         """
         Получение данных воронки для всех сообщений
@@ -576,13 +1347,13 @@ class Database:
                 'drop_rate': float (% отвалившихся)
             }
         """
-        conn = self._get_connection()
+        conn = self._get_analytics_connection()
         cursor = conn.cursor()
         
         try:
             # Получаем все сообщения рассылки
             cursor.execute('''
-                SELECT message_number, text FROM broadcast_messages 
+                SELECT message_number, text FROM bot.broadcast_messages 
                 ORDER BY message_number
             ''')
             messages = cursor.fetchall()
@@ -619,7 +1390,7 @@ class Database:
                     JOIN message_deliveries md ON bc.user_id = md.user_id AND bc.message_number = md.message_number
                     WHERE bc.message_number = ?
                     AND bc.button_type = 'callback'
-                    AND (julianday(bc.clicked_at) - julianday(md.delivered_at)) * 24 * 60 <= 10
+                    AND bc.clicked_at - md.delivered_at <= 600
                 ''', (message_number,))
                 clicked_callback = cursor.fetchone()[0]
                 
@@ -630,7 +1401,7 @@ class Database:
                     JOIN message_deliveries md ON bc.user_id = md.user_id AND bc.message_number = md.message_number
                     WHERE bc.message_number = ?
                     AND bc.button_type = 'url'
-                    AND (julianday(bc.clicked_at) - julianday(md.delivered_at)) * 24 * 60 <= 10
+                    AND bc.clicked_at - md.delivered_at <= 600
                 ''', (message_number,))
                 clicked_url = cursor.fetchone()[0]
                 
@@ -658,8 +1429,7 @@ class Database:
             logger.error(f"❌ Ошибка при получении данных воронки: {e}")
             return []
         finally:
-            if conn:
-                conn.close()
+            self._release_analytics_connection(conn)
     
     def get_message_details(self, message_number):
         """
@@ -674,16 +1444,18 @@ class Database:
                 'clicked_url_count': int,
                 'not_clicked': int,
                 'avg_reaction_time_seconds': float,
+                'reaction_percentiles': Dict[int, float] - {50: сек, 90: сек, 99: сек},
+                'clicked_within': Dict[int, int] - {минут: нажатий не позже},
                 'button_details': List[Dict] - детализация по каждой кнопке
             }
         """
-        conn = self._get_connection()
+        conn = self._get_analytics_connection()
         cursor = conn.cursor()
         
         try:
             # Получаем текст сообщения
             cursor.execute('''
-                SELECT text FROM broadcast_messages WHERE message_number = ?
+                SELECT text FROM bot.broadcast_messages WHERE message_number = ?
             ''', (message_number,))
             message_data = cursor.fetchone()
             
@@ -709,6 +1481,8 @@ class Database:
                     'clicked_url_count': 0,
                     'not_clicked': 0,
                     'avg_reaction_time_seconds': 0,
+                    'reaction_percentiles': {},
+                    'clicked_within': {},
                     'button_details': []
                 }
             
@@ -731,15 +1505,14 @@ class Database:
             # Не нажали ничего
             not_clicked = delivered - max(clicked_callback, clicked_url)
             
-            # Среднее время реакции (в секундах)
+            # Время реакции — из гистограммы, без соединения кликов с доставками
             cursor.execute('''
-                SELECT AVG((julianday(bc.clicked_at) - julianday(md.delivered_at)) * 24 * 60 * 60)
-                FROM button_clicks bc
-                JOIN message_deliveries md ON bc.user_id = md.user_id AND bc.message_number = md.message_number
-                WHERE bc.message_number = ?
+                SELECT bucket, SUM(clicks), SUM(seconds_sum) FROM reaction_histogram
+                WHERE message_number = ? GROUP BY bucket
             ''', (message_number,))
-            avg_time_result = cursor.fetchone()
-            avg_reaction_time = avg_time_result[0] if avg_time_result[0] else 0
+            histogram = {bucket: (clicks, seconds_sum) for bucket, clicks, seconds_sum in cursor.fetchall()}
+            reactions = sum(clicks for clicks, seconds_sum in histogram.values())
+            avg_reaction_time = sum(seconds_sum for clicks, seconds_sum in histogram.values()) / reactions if reactions else 0
             
             # Детализация по кнопкам
             cursor.execute('''
@@ -771,6 +1544,10 @@ class Database:
                 'clicked_url_count': clicked_url,
                 'not_clicked': not_clicked,
                 'avg_reaction_time_seconds': round(avg_reaction_time, 2),
+                'reaction_percentiles': self.reaction_percentiles(histogram),
+                'clicked_within': {
+                    minutes: self.count_reacted_within(histogram, minutes * 60) for minutes in (1, 10, 60)
+                },
                 'button_details': button_details
             }
             
@@ -778,17 +1555,20 @@ class Database:
             logger.error(f"❌ Ошибка при получении детальной статистики сообщения {message_number}: {e}")
             return None
         finally:
-            if conn:
-                conn.close()
+            self._release_analytics_connection(conn)
     
-    def get_biggest_drop_message(self):
+    def get_biggest_drop_message(self, funnel_data=None):
         """
         Определение сообщения с самым большим отвалом
         
+        Args:
+            funnel_data: уже полученные данные воронки (чтобы не считать её повторно)
+        
         Returns:
             Dict или None: информация о сообщении с максимальным отвалом
         """
-        funnel_data = self.get_funnel_data()
+        if funnel_data is None:
+            funnel_data = self.get_funnel_data()
         
         if not funnel_data:
             return None
@@ -811,7 +1591,7 @@ class Database:
         Args:
             days_old: количество дней для хранения данных
         """
-        conn = self._get_connection()
+        conn = self._get_analytics_connection()
         cursor = conn.cursor()
         
         try:
@@ -821,14 +1601,14 @@ class Database:
             cursor.execute('''
                 DELETE FROM message_deliveries 
                 WHERE delivered_at < ?
-            ''', (cutoff_date,))
+            ''', (self._epoch(cutoff_date),))
             deliveries_deleted = cursor.rowcount
             
             # Удаляем старые клики
             cursor.execute('''
                 DELETE FROM button_clicks 
                 WHERE clicked_at < ?
-            ''', (cutoff_date,))
+            ''', (self._epoch(cutoff_date),))
             clicks_deleted = cursor.rowcount
             
             conn.commit()
@@ -842,8 +1622,7 @@ class Database:
             logger.error(f"❌ Ошибка при очистке старых данных воронки: {e}")
             return 0, 0
         finally:
-            if conn:
-                conn.close()
+            self._release_analytics_connection(conn)
     
     # ========================================
     # ОСТАЛЬНЫЕ МЕТОДЫ (БЕЗ ИЗМЕНЕНИЙ)
@@ -869,6 +1648,8 @@ class Database:
                 conn.execute('PRAGMA cache_size=10000')
                 conn.execute('PRAGMA temp_store=MEMORY')
                 conn.execute('PRAGMA mmap_size=268435456')  # 256MB
+                # INSERT OR REPLACE должен вызывать DELETE-триггеры (счетчики, поисковый индекс)
+                conn.execute('PRAGMA recursive_triggers=ON')
                 
                 return conn
             except sqlite3.OperationalError as e:
@@ -881,8 +1662,52 @@ class Database:
                     logger.error(f"❌ Критическая ошибка подключения к БД после {max_retries} попыток: {e}")
                     raise
     
-    def get_database_info(self):
-        """Получение информации о базе данных для диагностики"""
+    def _get_analytics_connection(self):
+        """Соединение с аналитической БД из пула (основная БД подключена как bot)"""
+        return self._analytics_pool.acquire()
+    
+    def _release_analytics_connection(self, conn):
+        """Вернуть соединение с аналитической БД в пул"""
+        self._analytics_pool.release(conn)
+    
+    def flush_analytics(self, timeout=None):
+        """Дождаться записи событий из очереди в аналитическую БД"""
+        self._analytics_writes.flush(timeout)
+    
+    @staticmethod
+    def _epoch(value):
+        """datetime, date или строка ISO -> секунды unix для колонок времени
+
+        Наивное время считается местным, как у datetime.now() во всем боте.
+        """
+        if value is None or isinstance(value, int):
+            return value
+        if isinstance(value, float):
+            return int(value)
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, datetime.min.time())
+        return int(value.timestamp())
+
+    @staticmethod
+    def _from_epoch(value):
+        """Секунды unix -> наивное местное datetime (None остается None)"""
+        return None if value is None else datetime.fromtimestamp(value)
+
+    @classmethod
+    def _user_rows(cls, rows):
+        """Строки users (user_id, ..., joined_at, ...) с joined_at в виде datetime"""
+        return [row[:3] + (cls._from_epoch(row[3]),) + row[4:] for row in rows]
+    
+    def get_database_info(self, full=False):
+        """Получение информации о базе данных для диагностики
+
+        Легкий режим (по умолчанию) не читает таблицы целиком и подходит для
+        health check. full=True добавляет integrity_check и подсчет записей —
+        это долго на большой БД, поэтому полная диагностика запускается в фоне,
+        а ее результат сохраняется в self.last_diagnostics.
+        """
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
@@ -892,35 +1717,45 @@ class Database:
                 'db_size_mb': round(os.path.getsize(self.db_path) / (1024 * 1024), 2) if os.path.exists(self.db_path) else 0,
                 'disk_space_mb': self._get_disk_space(),
                 'render_disk_path': os.environ.get('RENDER_DISK_PATH', '/data'),
-                'wal_files': self._check_wal_files()
+                'analytics_db_path': self.analytics_db_path,
+                'analytics_db_size_mb': round(os.path.getsize(self.analytics_db_path) / (1024 * 1024), 2) if os.path.exists(self.analytics_db_path) else 0,
+                'wal_files': self._check_wal_files(),
+                'schema_version': self.schema_version
             }
             
+            # Количество таблиц
+            cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table'")
+            info['tables_count'] = cursor.fetchone()[0]
+            
+            if not full:
+                conn.close()
+                return info
+            
             # Проверяем целостность БД
             cursor.execute('PRAGMA integrity_check')
             integrity = cursor.fetchone()[0]
             info['integrity'] = integrity
             
-            # Количество таблиц
-            cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table'")
-            info['tables_count'] = cursor.fetchone()[0]
-            
             # Количество записей в основных таблицах
             try:
-                cursor.execute('SELECT COUNT(*) FROM users')
-                info['users_count'] = cursor.fetchone()[0]
-                
-                cursor.execute('SELECT COUNT(*) FROM scheduled_messages')
-                info['scheduled_messages_count'] = cursor.fetchone()[0]
-                
-                cursor.execute('SELECT COUNT(*) FROM payments')
-                info['payments_count'] = cursor.fetchone()[0]
-                
-                # Добавляем статистику воронки
-                cursor.execute('SELECT COUNT(*) FROM message_deliveries')
-                info['message_deliveries_count'] = cursor.fetchone()[0]
+                counters = self._read_counters(cursor)
+                info['users_count'] = counters.get('users_total', 0)
+                info['scheduled_messages_count'] = counters.get('scheduled_total', 0)
                 
-                cursor.execute('SELECT COUNT(*) FROM button_clicks')
-                info['button_clicks_count'] = cursor.fetchone()[0]
+                # Платежи и статистика воронки — в аналитической БД
+                analytics_conn = self._get_analytics_connection()
+                try:
+                    analytics_cursor = analytics_conn.cursor()
+                    
+                    info['payments_count'] = self._read_counters(analytics_cursor).get('payments_total', 0)
+                    
+                    analytics_cursor.execute('SELECT COUNT(*) FROM message_deliveries')
+                    info['message_deliveries_count'] = analytics_cursor.fetchone()[0]
+                    
+                    analytics_cursor.execute('SELECT COUNT(*) FROM button_clicks')
+                    info['button_clicks_count'] = analytics_cursor.fetchone()[0]
+                finally:
+                    self._release_analytics_connection(analytics_conn)
             except:
                 info['users_count'] = 'N/A'
                 info['scheduled_messages_count'] = 'N/A' 
@@ -929,6 +1764,8 @@ class Database:
                 info['button_clicks_count'] = 'N/A'
             
             conn.close()
+            info['checked_at'] = datetime.now().isoformat()
+            self.last_diagnostics = info
             return info
             
         except Exception as e:
@@ -970,7 +1807,7 @@ class Database:
                     UPDATE users 
                     SET has_paid = 1, paid_at = CURRENT_TIMESTAMP, payed_till = ?
                     WHERE user_id = ?
-                ''', (payed_till, user_id))
+                ''', (self._epoch(payed_till), user_id))
                 logger.info(f"✅ Пользователь {user_id} отмечен как оплативший ({amount}) до {payed_till}")
             else:
                 cursor.execute('''
@@ -985,6 +1822,10 @@ class Database:
                 return False
             
             conn.commit()
+            if payed_till:
+                self.user_states.update(user_id, has_paid=1, payed_till=self._from_epoch(self._epoch(payed_till)).date())
+            else:
+                self.user_states.update(user_id, has_paid=1)
             return True
             
         except Exception as e:
@@ -1000,7 +1841,7 @@ class Database:
     
     def log_payment(self, user_id, amount, payment_status, utm_source=None, utm_id=None):
         """Логирование платежа"""
-        conn = self._get_connection()
+        conn = self._get_analytics_connection()
         cursor = conn.cursor()
         
         try:
@@ -1021,8 +1862,7 @@ class Database:
                 pass
             return None
         finally:
-            if conn:
-                conn.close()
+            self._release_analytics_connection(conn)
     
     def get_payment_success_message(self):
         """Получение сообщения об успешной оплате"""
@@ -1076,40 +1916,35 @@ class Database:
     
     def get_payment_statistics(self):
         """Получение статистики платежей"""
-        conn = self._get_connection()
+        conn = self._get_analytics_connection()
         cursor = conn.cursor()
         
         try:
-            # Общее количество платежей
-            cursor.execute('SELECT COUNT(*) FROM payments WHERE payment_status = "success"')
-            total_payments = cursor.fetchone()[0]
+            counters = self._read_counters(cursor)
+            counters.update(self._read_counters(cursor, 'bot'))
             
-            # Общее количество пользователей, начавших разговор с ботом
-            cursor.execute('SELECT COUNT(*) FROM users WHERE bot_started = 1 AND is_active = 1')
-            total_users = cursor.fetchone()[0]
-            
-            # Количество оплативших
-            cursor.execute('SELECT COUNT(*) FROM users WHERE has_paid = 1')
-            paid_users = cursor.fetchone()[0]
+            total_payments = counters.get('payments_success', 0)
+            total_users = counters.get('users_active_bot_started', 0)
+            paid_users = counters.get('users_paid', 0)
+            total_revenue = counters.get('payments_revenue', 0)
             
             # Конверсия
             conversion_rate = (paid_users / total_users * 100) if total_users > 0 else 0
             
             # Средний чек
-            cursor.execute('SELECT AVG(CAST(amount AS REAL)) FROM payments WHERE payment_status = "success" AND amount != ""')
-            avg_amount_result = cursor.fetchone()
-            avg_amount = avg_amount_result[0] if avg_amount_result[0] is not None else 0
+            revenue_count = counters.get('payments_revenue_count', 0)
+            avg_amount = total_revenue / revenue_count if revenue_count else 0
             
             # Последние платежи
             cursor.execute('''
                 SELECT p.user_id, u.first_name, u.username, p.amount, p.created_at
                 FROM payments p
-                JOIN users u ON p.user_id = u.user_id
+                JOIN bot.users u ON p.user_id = u.user_id
                 WHERE p.payment_status = "success"
                 ORDER BY p.created_at DESC
                 LIMIT 10
             ''')
-            recent_payments = cursor.fetchall()
+            recent_payments = [row[:4] + (self._from_epoch(row[4]),) for row in cursor.fetchall()]
             
             # Платежи по UTM источникам
             cursor.execute('''
@@ -1126,6 +1961,7 @@ class Database:
                 'paid_users': paid_users,
                 'conversion_rate': round(conversion_rate, 2),
                 'avg_amount': round(avg_amount, 2) if avg_amount else 0,
+                'total_revenue': round(total_revenue, 2),
                 'recent_payments': recent_payments,
                 'utm_sources': utm_sources
             }
@@ -1134,8 +1970,30 @@ class Database:
             logger.error(f"❌ Ошибка при получении статистики платежей: {e}")
             return None
         finally:
-            if conn:
-                conn.close()
+            self._release_analytics_connection(conn)
+    
+    def get_cohort_report(self, weeks=COHORT_WEEKS):
+        """Когорты по неделе прихода: запуск бота, воронка, оплата, продление и время до оплаты
+
+        users, message_deliveries и payments дочитываются в колонки self.cohorts
+        с прошлых отметок, отчет считается по колонкам целиком (см. cohorts.py).
+        """
+        conn = self._get_analytics_connection()
+        cursor = conn.cursor()
+        
+        try:
+            started = time.monotonic()
+            changed = self.cohorts.refresh(cursor)
+            if changed:
+                logger.info(f"📅 Когорты: дочитано {changed} изменений за {(time.monotonic() - started) * 1000:.0f} мс")
+            return self.cohorts.report(weeks)
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка при построении когортного отчета: {e}")
+            return None
+        finally:
+            cursor.close()
+            self._release_analytics_connection(conn)
     
     def cancel_remaining_messages(self, user_id):
         """Отмена оставшихся запланированных сообщений для оплатившего пользователя"""
@@ -1155,6 +2013,7 @@ class Database:
                 DELETE FROM scheduled_messages 
                 WHERE user_id = ? AND is_sent = 0
             ''', (user_id,))
+            self._remember_funnel_cursor(user_id, 'free', self._sync_funnel_cursor(cursor, 'free', user_id))
             
             conn.commit()
             logger.info(f"🚫 Отменено {count} запланированных сообщений для оплатившего пользователя {user_id}")
@@ -1224,26 +2083,44 @@ class Database:
     
     def add_user(self, user_id, username, first_name):
         """Добавление нового пользователя"""
+        if not self.add_users_batch([(user_id, username, first_name)]):
+            return False
+        logger.info(f"✅ Добавлен пользователь {user_id} (@{username})")
+        return True
+    
+    def add_users_batch(self, users):
+        """Добавление пачки пользователей (user_id, username, first_name) одной транзакцией
+
+        Вернувшийся пользователь снова активен и снова должен дать согласие
+        (bot_started = 0), но оплата, подписка и дата первого вступления
+        сохраняются: строка обновляется, а не заменяется. Возвращает число строк.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, first_name, is_active, bot_started, has_paid)
+            cursor.executemany('''
+                INSERT INTO users (user_id, username, first_name, is_active, bot_started, has_paid)
                 VALUES (?, ?, ?, 1, 0, 0)
-            ''', (user_id, username, first_name))
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    is_active = 1,
+                    bot_started = 0
+            ''', users)
             
             conn.commit()
-            logger.info(f"✅ Добавлен пользователь {user_id} (@{username})")
-            return True
+            for user_id, username, first_name in users:
+                self.user_states.update(user_id, is_active=1, bot_started=0)
+            return len(users)
             
         except Exception as e:
-            logger.error(f"❌ Ошибка при добавлении пользователя {user_id}: {e}")
+            logger.error(f"❌ Ошибка при добавлении {len(users)} пользователей: {e}")
             try:
                 conn.rollback()
             except:
                 pass
-            return False
+            return 0
         finally:
             if conn:
                 conn.close()
@@ -1271,6 +2148,9 @@ class Database:
             
             # Если уже помечен как начавший разговор, все равно считаем успехом
             if current_bot_started:
+                conn.commit()
+                # Кэш — только после записи в БД
+                self.user_states.update(user_id, is_active=1)
                 logger.debug(f"ℹ️ Пользователь {user_id} уже помечен как начавший разговор с ботом")
                 return True
             
@@ -1285,6 +2165,7 @@ class Database:
                 return False
             
             conn.commit()
+            self.user_states.update(user_id, is_active=1, bot_started=1)
             logger.info(f"✅ Пользователь {user_id} помечен как начавший разговор с ботом")
             return True
             
@@ -1310,6 +2191,7 @@ class Database:
                 FROM users WHERE user_id = ?
             ''', (user_id,))
             user = cursor.fetchone()
+            user = self._user_rows([user])[0] if user else None
             
             if user:
                 logger.debug(f"🔍 Пользователь {user_id}: active={user[4]}, bot_started={user[5]}, has_paid={user[6]}")
@@ -1349,6 +2231,7 @@ class Database:
                     logger.info(f"✅ Пользователь {user_id} реактивирован")
             
             conn.commit()
+            self.user_states.update(user_id, is_active=1)
             return True
             
         except Exception as e:
@@ -1364,19 +2247,7 @@ class Database:
     
     def get_users_with_bot_started(self):
         """Получить только пользователей, которые начали разговор с ботом"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
-                FROM users WHERE is_active = 1 AND bot_started = 1
-            ''')
-            users = cursor.fetchall()
-            return users
-        finally:
-            if conn:
-                conn.close()
+        return self.get_funnel_broadcast_recipients('free')
     
     def deactivate_user(self, user_id):
         """Деактивация пользователя при отписке"""
@@ -1389,6 +2260,7 @@ class Database:
             ''', (user_id,))
             
             conn.commit()
+            self.user_states.update(user_id, is_active=0)
             logger.info(f"Деактивирован пользователь {user_id}")
         finally:
             if conn:
@@ -1405,11 +2277,55 @@ class Database:
                 FROM users WHERE user_id = ?
             ''', (user_id,))
             user = cursor.fetchone()
+            user = self._user_rows([user])[0] if user else None
             return user
         finally:
             if conn:
                 conn.close()
     
+    def get_user_state(self, user_id):
+        """Состояние пользователя (UserState) из кэша или БД; None — пользователя нет"""
+        return self.get_user_states([user_id]).get(user_id)
+
+    def get_user_states(self, user_ids):
+        """Состояния пачки пользователей за один проход: {user_id: UserState}
+
+        Попадания берутся из кэша, промахи читаются одним запросом IN (...)
+        и кладутся в кэш. Несуществующих пользователей в ответе нет.
+        """
+        states = {}
+        missing = []
+        # Изменения после этой точки делают прочитанное из БД устаревшим для кэша
+        generation = self.user_states.generation
+        for user_id in dict.fromkeys(user_ids):
+            state = self.user_states.get(user_id)
+            if state is None:
+                missing.append(user_id)
+            else:
+                states[user_id] = state
+        if not missing:
+            return states
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                cursor.execute(f'''
+                    SELECT user_id, is_active, bot_started, has_paid, payed_till
+                    FROM users WHERE user_id IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                for user_id, is_active, bot_started, has_paid, payed_till in cursor.fetchall():
+                    state = UserState(is_active, bot_started, has_paid,
+                                      self._from_epoch(payed_till).date() if payed_till is not None else None)
+                    self.user_states.put(user_id, state, generation)
+                    states[user_id] = state
+            return states
+        finally:
+            if conn:
+                conn.close()
+    
     def get_all_users(self):
         """Получение всех активных пользователей"""
         conn = self._get_connection()
@@ -1421,68 +2337,156 @@ class Database:
                 FROM users WHERE is_active = 1
             ''')
             users = cursor.fetchall()
-            return users
+            return self._user_rows(users)
         finally:
             if conn:
                 conn.close()
     
     def get_latest_users(self, limit=10):
         """Получение последних зарегистрированных пользователей"""
+        return self.get_users_page(limit)[0]
+    
+    def get_users_page(self, limit=10, before=None):
+        """Страница активных пользователей, от новых к старым (keyset-пагинация)
+
+        before — курсор (joined_at, user_id) последнего пользователя предыдущей
+        страницы. Возвращает (пользователи, курсор следующей страницы или None);
+        цена страницы — O(limit) по индексу joined_at, без OFFSET.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
-                FROM users 
-                WHERE is_active = 1 
-                ORDER BY joined_at DESC 
-                LIMIT ?
-            ''', (limit,))
+            if before is None:
+                cursor.execute('''
+                    SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
+                    FROM users 
+                    WHERE is_active = 1 
+                    ORDER BY joined_at DESC, user_id DESC 
+                    LIMIT ?
+                ''', (limit + 1,))
+            else:
+                cursor.execute('''
+                    SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
+                    FROM users 
+                    WHERE is_active = 1 AND (joined_at, user_id) < (?, ?) 
+                    ORDER BY joined_at DESC, user_id DESC 
+                    LIMIT ?
+                ''', (before[0], before[1], limit + 1))
             users = cursor.fetchall()
-            return users
+            
+            # Лишняя строка только показывает, что дальше есть еще страница;
+            # курсор хранит joined_at в секундах, как в индексе
+            if len(users) > limit:
+                users = users[:limit]
+                return self._user_rows(users), (users[-1][3], users[-1][0])
+            return self._user_rows(users), None
         finally:
             if conn:
                 conn.close()
     
-    def export_users_to_csv(self):
-        """Экспорт всех пользователей в CSV формат"""
+    @staticmethod
+    def _user_search_match(query):
+        """Запрос FTS5 из текста админа: каждое слово — префикс, спецсимволы экранируются"""
+        words = query.replace('@', ' ').split()
+        return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+    
+    def search_users(self, query, limit=10, after=None):
+        """Поиск пользователей по ID, username или имени (включая отписавшихся)
+
+        Число в запросе ищется как ID, иначе — по индексу users_fts.
+        after — user_id последнего пользователя предыдущей страницы.
+        Возвращает (пользователи, курсор следующей страницы или None, всего найдено).
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
-                FROM users 
-                ORDER BY joined_at DESC
-            ''')
-            users = cursor.fetchall()
-            
-            # Создаем CSV в памяти
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Заголовки
-            writer.writerow(['ID', 'Username', 'Имя', 'Дата регистрации', 'Статус', 'Разговор с ботом', 'Оплатил', 'Дата оплаты'])
+            query = query.strip()
+            if query.lstrip('-').isdigit():
+                cursor.execute('''
+                    SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
+                    FROM users WHERE user_id = ?
+                ''', (int(query),))
+                users = self._user_rows(cursor.fetchall())
+                return users, None, len(users)
             
-            # Данные
-            for user in users:
-                user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at = user
-                status = 'Активен' if is_active else 'Отписался'
-                bot_status = 'Да' if bot_started else 'Нет'
-                paid_status = 'Да' if has_paid else 'Нет'
-                paid_date = paid_at if paid_at else ''
-                writer.writerow([user_id, username or '', first_name or '', joined_at, status, bot_status, paid_status, paid_date])
+            match = self._user_search_match(query)
+            if not match:
+                return [], None, 0
             
-            # Возвращаем CSV как строку
-            csv_content = output.getvalue()
-            output.close()
+            cursor.execute('SELECT COUNT(*) FROM users_fts WHERE users_fts MATCH ?', (match,))
+            total = cursor.fetchone()[0]
             
-            return csv_content
+            # Порядок и курсор — по rowid индекса (= user_id), это диапазон внутри FTS5
+            cursor.execute('''
+                SELECT u.user_id, u.username, u.first_name, u.joined_at, u.is_active, u.bot_started, u.has_paid, u.paid_at 
+                FROM users_fts f 
+                JOIN users u ON u.user_id = f.rowid 
+                WHERE users_fts MATCH ? AND f.rowid < ? 
+                ORDER BY f.rowid DESC 
+                LIMIT ?
+            ''', (match, after if after is not None else 2 ** 63 - 1, limit + 1))
+            users = self._user_rows(cursor.fetchall())
+            
+            if len(users) > limit:
+                users = users[:limit]
+                return users, users[-1][0], total
+            return users, None, total
+        except sqlite3.OperationalError as e:
+            logger.error(f"❌ Ошибка поиска пользователей по запросу {query!r}: {e}")
+            return [], None, 0
         finally:
             if conn:
                 conn.close()
     
+    def iter_export_chunks(self, kind, date_from=None, date_to=None, chunk_size=5000):
+        """Строки выгрузки kind (см. EXPORTS) пачками по chunk_size, без загрузки всей таблицы
+
+        date_from / date_to (datetime, UTC) ограничивают выгрузку по дате события;
+        даты в выгрузке тоже в UTC.
+        """
+        schema, header, query, date_column, order = self.EXPORTS[kind]
+        
+        conditions, params = [], []
+        if date_from:
+            conditions.append(f'{date_column} >= ?')
+            params.append(self._epoch(date_from.replace(tzinfo=date_from.tzinfo or timezone.utc)))
+        if date_to:
+            conditions.append(f'{date_column} < ?')
+            params.append(self._epoch(date_to.replace(tzinfo=date_to.tzinfo or timezone.utc)))
+        
+        sql = query
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY {order}'
+        
+        conn = self._get_analytics_connection() if schema == 'analytics' else self._get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Незавершенный SELECT не должен вернуться в пул вместе с соединением
+            cursor.close()
+            if schema == 'analytics':
+                self._release_analytics_connection(conn)
+            else:
+                conn.close()
+    
+    def export_users_to_csv(self):
+        """Экспорт всех пользователей в CSV формат (строкой; для больших выгрузок — csv_export)"""
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(self.EXPORTS['users'][1])
+        for rows in self.iter_export_chunks('users'):
+            writer.writerows(rows)
+        return output.getvalue()
+    
     def get_welcome_message(self):
         """Получение приветственного сообщения и фото"""
         conn = self._get_connection()
@@ -1539,6 +2543,7 @@ class Database:
                 ''', (photo_url,))
             
             conn.commit()
+            self._invalidate_welcome_content()
         finally:
             if conn:
                 conn.close()
@@ -1595,6 +2600,7 @@ class Database:
             
             button_id = cursor.lastrowid
             conn.commit()
+            self._invalidate_welcome_content()
             
             logger.info(f"Добавлена механическая кнопка приветствия: {button_text}")
             return button_id
@@ -1614,6 +2620,7 @@ class Database:
                 ''', (button_text, button_id))
             
             conn.commit()
+            self._invalidate_welcome_content()
             logger.info(f"Обновлена кнопка приветствия #{button_id}")
         finally:
             if conn:
@@ -1650,11 +2657,33 @@ class Database:
             cursor.execute('DELETE FROM welcome_buttons WHERE id = ?', (button_id,))
             
             conn.commit()
+            self._invalidate_welcome_content()
             logger.info(f"Удалена кнопка приветствия #{button_id} со всеми связанными сообщениями")
         finally:
             if conn:
                 conn.close()
     
+    def get_prepared_welcome(self):
+        """Готовое приветствие из памяти: (версия, текст, фото, тексты кнопок)
+
+        Версия растет при каждом изменении приветствия — по ней можно
+        кэшировать собранную клавиатуру.
+        """
+        prepared = self._welcome_content
+        if prepared is None:
+            version = self._welcome_version
+            welcome = self.get_welcome_message()
+            buttons = tuple(button_text for button_id, button_text, position in self.get_welcome_buttons())
+            prepared = (version, welcome['text'], welcome['photo'], buttons)
+            # Приветствие изменили, пока мы его читали — не кэшируем устаревшее
+            if version == self._welcome_version:
+                self._welcome_content = prepared
+        return prepared
+    
+    def _invalidate_welcome_content(self):
+        self._welcome_version += 1
+        self._welcome_content = None
+    
     # ===== МЕТОДЫ ДЛЯ ПОСЛЕДУЮЩИХ СООБЩЕНИЙ ПОСЛЕ КНОПОК =====
     
     def get_welcome_follow_messages(self, welcome_button_id):
@@ -1883,21 +2912,26 @@ class Database:
                 ''')
             
             broadcasts = cursor.fetchall()
-            return broadcasts
+            return [
+                (broadcast_id, text, photo_url, self._from_epoch(scheduled_time), is_sent, self._from_epoch(created_at))
+                for broadcast_id, text, photo_url, scheduled_time, is_sent, created_at in broadcasts
+            ]
         finally:
             if conn:
                 conn.close()
     
-    def add_scheduled_broadcast(self, message_text, scheduled_time, photo_url=None):
-        """Добавление запланированной массовой рассылки"""
+    def add_scheduled_broadcast(self, message_text, scheduled_time, photo_url=None, segment=None):
+        """Добавление запланированной массовой рассылки (segment — сегмент аудитории, см. segments.py)"""
+        if segment is not None:
+            parse_segment(segment)
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
             cursor.execute('''
-                INSERT INTO scheduled_broadcasts (message_text, photo_url, scheduled_time)
-                VALUES (?, ?, ?)
-            ''', (message_text, photo_url, scheduled_time))
+                INSERT INTO scheduled_broadcasts (message_text, photo_url, scheduled_time, segment)
+                VALUES (?, ?, ?, ?)
+            ''', (message_text, photo_url, self._epoch(scheduled_time), segment))
             
             broadcast_id = cursor.lastrowid
             conn.commit()
@@ -1927,18 +2961,7 @@ class Database:
     
     def mark_broadcast_sent(self, broadcast_id):
         """Отметить рассылку как отправленную"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                UPDATE scheduled_broadcasts SET is_sent = 1 WHERE id = ?
-            ''', (broadcast_id,))
-            
-            conn.commit()
-        finally:
-            if conn:
-                conn.close()
+        self.mark_funnel_broadcast_sent('free', broadcast_id)
     
     def get_pending_broadcasts(self):
         """Получение рассылок, готовых к отправке"""
@@ -1946,16 +2969,15 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            current_time = datetime.now()
             cursor.execute('''
                 SELECT id, message_text, photo_url, scheduled_time
                 FROM scheduled_broadcasts 
                 WHERE is_sent = 0 AND scheduled_time <= ?
                 ORDER BY scheduled_time
-            ''', (current_time,))
+            ''', (int(time.time()),))
             
             broadcasts = cursor.fetchall()
-            return broadcasts
+            return [row[:3] + (self._from_epoch(row[3]),) for row in broadcasts]
         finally:
             if conn:
                 conn.close()
@@ -1964,22 +2986,7 @@ class Database:
     
     def get_scheduled_broadcast_buttons(self, broadcast_id):
         """Получение кнопок для запланированной рассылки"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT id, button_text, button_url, position 
-                FROM scheduled_broadcast_buttons 
-                WHERE broadcast_id = ? 
-                ORDER BY position
-            ''', (broadcast_id,))
-            
-            buttons = cursor.fetchall()
-            return buttons
-        finally:
-            if conn:
-                conn.close()
+        return self.get_funnel_broadcast_buttons('free', broadcast_id)
     
     def add_scheduled_broadcast_button(self, broadcast_id, button_text, button_url, position=1):
         """Добавление кнопки к запланированной рассылке"""
@@ -2015,32 +3022,11 @@ class Database:
     
     def get_broadcast_message(self, message_number):
         """Получение сообщения рассылки по номеру"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT text, delay_hours, photo_url FROM broadcast_messages 
-                WHERE message_number = ?
-            ''', (message_number,))
-            result = cursor.fetchone()
-            return result
-        finally:
-            if conn:
-                conn.close()
+        return self.get_funnel_message('free', message_number)
     
     def get_all_broadcast_messages(self):
         """Получение всех сообщений рассылки"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('SELECT * FROM broadcast_messages ORDER BY message_number')
-            messages = cursor.fetchall()
-            return messages
-        finally:
-            if conn:
-                conn.close()
+        return self.get_funnel_messages('free')
     
     def add_broadcast_message(self, text, delay_hours, photo_url=None):
         """Добавление нового сообщения рассылки"""
@@ -2062,6 +3048,7 @@ class Database:
             logger.info(f"Добавлено сообщение рассылки #{next_number}")
             return next_number
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
@@ -2089,9 +3076,12 @@ class Database:
                 WHERE message_number = ?
             ''', (message_number,))
             
+            self._recompute_funnel_due_times(cursor, 'free')
+            
             conn.commit()
             logger.info(f"Удалено сообщение рассылки #{message_number}")
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
@@ -2112,6 +3102,7 @@ class Database:
                     UPDATE broadcast_messages SET delay_hours = ? 
                     WHERE message_number = ?
                 ''', (delay_hours, message_number))
+                self._recompute_funnel_due_times(cursor, 'free')
             
             if photo_url is not None:
                 cursor.execute('''
@@ -2121,6 +3112,7 @@ class Database:
             
             conn.commit()
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
@@ -2138,6 +3130,7 @@ class Database:
             conn.commit()
             logger.info(f"Добавлена кнопка к сообщению #{message_number}")
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
@@ -2161,6 +3154,7 @@ class Database:
             
             conn.commit()
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
@@ -2173,27 +3167,13 @@ class Database:
             cursor.execute('DELETE FROM message_buttons WHERE id = ?', (button_id,))
             conn.commit()
         finally:
+            self._invalidate_broadcast_content()
             if conn:
                 conn.close()
     
     def get_message_buttons(self, message_number):
         """Получение всех кнопок для конкретного сообщения"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT id, button_text, button_url, position 
-                FROM message_buttons 
-                WHERE message_number = ? 
-                ORDER BY position
-            ''', (message_number,))
-            
-            buttons = cursor.fetchall()
-            return buttons
-        finally:
-            if conn:
-                conn.close()
+        return self.get_funnel_message_buttons('free', message_number)
     
     def get_broadcast_status(self):
         """Получение текущего статуса рассылки"""
@@ -2295,7 +3275,8 @@ class Database:
             cursor.execute('''
                 INSERT INTO scheduled_messages (user_id, message_number, scheduled_time)
                 VALUES (?, ?, ?)
-            ''', (user_id, message_number, scheduled_time))
+            ''', (user_id, message_number, self._epoch(scheduled_time)))
+            self._remember_funnel_cursor(user_id, 'free', self._sync_funnel_cursor(cursor, 'free', user_id))
             
             conn.commit()
             logger.debug(f"✅ Запланировано сообщение {message_number} для пользователя {user_id} на {scheduled_time}")
@@ -2324,7 +3305,7 @@ class Database:
                 FROM scheduled_messages sm
                 JOIN broadcast_messages bm ON sm.message_number = bm.message_number
                 WHERE sm.is_sent = 0 AND sm.scheduled_time <= ?
-            ''', (current_time,))
+            ''', (self._epoch(current_time),))
             
             messages = cursor.fetchall()
             return messages
@@ -2340,26 +3321,30 @@ class Database:
         try:
             current_time = datetime.now()
             
-            # Сначала получаем общую статистику для логирования
-            cursor.execute('SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 0')
-            total_scheduled = cursor.fetchone()[0]
-            
-            cursor.execute('''
-                SELECT COUNT(*) FROM scheduled_messages sm
-                JOIN users u ON sm.user_id = u.user_id
-                WHERE sm.is_sent = 0 AND u.is_active = 1 AND u.bot_started = 1 AND u.has_paid = 0
-            ''')
-            active_scheduled = cursor.fetchone()[0]
-            
-            cursor.execute('''
-                SELECT COUNT(*) FROM scheduled_messages sm
-                JOIN users u ON sm.user_id = u.user_id
-                WHERE sm.is_sent = 0 AND sm.scheduled_time <= ? AND u.is_active = 1 AND u.bot_started = 1 AND u.has_paid = 0
-            ''', (current_time,))
-            ready_to_send = cursor.fetchone()[0]
-            
-            if total_scheduled > 0:
-                logger.debug(f"📊 Статистика сообщений: всего запланировано {total_scheduled}, для активных неоплативших {active_scheduled}, готово к отправке {ready_to_send}")
+            # Статистика нужна только для отладочного лога: три COUNT по очереди
+            # не выполняем, когда DEBUG выключен
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                cursor.execute('SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 0')
+                total_scheduled = cursor.fetchone()[0]
+                
+                cursor.execute('''
+                    SELECT COUNT(*) FROM scheduled_messages sm
+                    JOIN users u ON sm.user_id = u.user_id
+                    WHERE sm.is_sent = 0 AND u.is_active = 1 AND u.bot_started = 1 AND u.has_paid = 0
+                ''')
+                active_scheduled = cursor.fetchone()[0]
+                
+                cursor.execute('''
+                    SELECT COUNT(*) FROM scheduled_messages sm
+                    JOIN users u ON sm.user_id = u.user_id
+                    WHERE sm.is_sent = 0 AND sm.scheduled_time <= ? AND u.is_active = 1 AND u.bot_started = 1 AND u.has_paid = 0
+                ''', (self._epoch(current_time),))
+                ready_to_send = cursor.fetchone()[0]
+                
+                if total_scheduled > 0:
+                    logger.debug("📊 Статистика сообщений: всего запланировано %s, для активных неоплативших %s, готово к отправке %s",
+                                 total_scheduled, active_scheduled, ready_to_send)
             
             # Получаем сообщения готовые к отправке (ТОЛЬКО ДЛЯ НЕОПЛАТИВШИХ)
             cursor.execute('''
@@ -2373,16 +3358,16 @@ class Database:
                 AND u.bot_started = 1
                 AND u.has_paid = 0
                 ORDER BY sm.scheduled_time ASC
-            ''', (current_time,))
+            ''', (self._epoch(current_time),))
             
             messages = cursor.fetchall()
             
             # Логируем детали каждого сообщения
-            for msg in messages:
-                message_id, user_id, message_number, text, photo_url, scheduled_time = msg
-                scheduled_dt = datetime.fromisoformat(scheduled_time) if isinstance(scheduled_time, str) else scheduled_time
-                delay_minutes = int((current_time - scheduled_dt).total_seconds() / 60)
-                logger.debug(f"📬 Сообщение {message_number} для пользователя {user_id} (опоздание: {delay_minutes} мин)")
+            if debug:
+                for msg in messages:
+                    message_id, user_id, message_number, text, photo_url, scheduled_time = msg
+                    delay_minutes = int((current_time - self._from_epoch(scheduled_time)).total_seconds() / 60)
+                    logger.debug("📬 Сообщение %s для пользователя %s (опоздание: %s мин)", message_number, user_id, delay_minutes)
             
             return [(m[0], m[1], m[2], m[3], m[4]) for m in messages]  # Возвращаем без scheduled_time
         finally:
@@ -2391,21 +3376,7 @@ class Database:
     
     def get_user_scheduled_messages(self, user_id):
         """Получение запланированных сообщений для пользователя"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT id, message_number, scheduled_time, is_sent
-                FROM scheduled_messages
-                WHERE user_id = ? AND is_sent = 0
-            ''', (user_id,))
-            
-            messages = cursor.fetchall()
-            return messages
-        finally:
-            if conn:
-                conn.close()
+        return self.get_user_funnel_messages(user_id, 'free')
     
     def get_user_scheduled_messages_count(self, user_id):
         """Получение количества запланированных сообщений для пользователя"""
@@ -2429,20 +3400,8 @@ class Database:
                 conn.close()
     
     def mark_message_sent(self, message_id):
-        """Отметка сообщения как отправленного"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                UPDATE scheduled_messages SET is_sent = 1 
-                WHERE id = ?
-            ''', (message_id,))
-            
-            conn.commit()
-        finally:
-            if conn:
-                conn.close()
+        """Отметка сообщения как отправленного (курсор воронки сдвигается на этот шаг)"""
+        self.mark_funnel_message_sent('free', message_id)
     
     def cancel_user_messages(self, user_id):
         """Удаляет ВСЕ запланированные сообщения пользователя"""
@@ -2457,6 +3416,10 @@ class Database:
             ''', (user_id,))
             
             affected = cursor.rowcount
+            
+            # Воронка начнется заново — сбрасываем курсор
+            cursor.execute("DELETE FROM funnel_cursors WHERE user_id = ? AND funnel = 'free'", (user_id,))
+            self._remember_funnel_cursor(user_id, 'free', None)
             conn.commit()
             
             logger.info(f"🗑️ Удалено {affected} запланированных сообщений для пользователя {user_id}")
@@ -2496,7 +3459,7 @@ class Database:
                 'user_id': user_data[0],
                 'username': user_data[1],
                 'first_name': user_data[2],
-                'joined_at': user_data[3],
+                'joined_at': self._from_epoch(user_data[3]),
                 'is_active': bool(user_data[4]),
                 'bot_started': bool(user_data[5]),
                 'has_paid': bool(user_data[6]),
@@ -2518,7 +3481,7 @@ class Database:
                 debug_info['scheduled_messages'].append({
                     'id': msg[0],
                     'message_number': msg[1],
-                    'scheduled_time': msg[2],
+                    'scheduled_time': self._from_epoch(msg[2]),
                     'is_sent': bool(msg[3])
                 })
             
@@ -2550,33 +3513,27 @@ class Database:
         try:
             health_info = {}
             
-            # Общая статистика
-            cursor.execute('SELECT COUNT(*) FROM users')
-            health_info['total_users'] = cursor.fetchone()[0]
+            # Общая статистика — из счетчиков, без сканирования таблиц
+            counters = self._read_counters(cursor)
+            health_info['total_users'] = counters.get('users_total', 0)
+            health_info['active_users'] = counters.get('users_active', 0)
+            health_info['bot_started_users'] = counters.get('users_bot_started', 0)
+            health_info['paid_users'] = counters.get('users_paid', 0)
+            health_info['pending_messages'] = counters.get('scheduled_pending', 0)
+            health_info['sent_messages'] = counters.get('scheduled_sent', 0)
             
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-            health_info['active_users'] = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM users WHERE bot_started = 1')
-            health_info['bot_started_users'] = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM users WHERE has_paid = 1')
-            health_info['paid_users'] = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 0')
-            health_info['pending_messages'] = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 1')
-            health_info['sent_messages'] = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM payments')
-            health_info['total_payments'] = cursor.fetchone()[0]
+            analytics_conn = self._get_analytics_connection()
+            try:
+                health_info['total_payments'] = self._read_counters(analytics_conn.cursor()).get('payments_total', 0)
+            finally:
+                self._release_analytics_connection(analytics_conn)
             
-            # Проверка на потерянные сообщения (запланированные для неактивных пользователей)
+            # Проверка на потерянные сообщения (запланированные для неактивных пользователей):
+            # идем от немногих неактивных пользователей к их сообщениям по индексу
             cursor.execute('''
-                SELECT COUNT(*) FROM scheduled_messages sm
-                JOIN users u ON sm.user_id = u.user_id
-                WHERE sm.is_sent = 0 AND (u.is_active = 0 OR u.bot_started = 0)
+                SELECT COUNT(*) FROM users u
+                JOIN scheduled_messages sm INDEXED BY idx_scheduled_messages_user_number ON sm.user_id = u.user_id
+                WHERE (u.is_active = 0 OR u.bot_started = 0) AND sm.is_sent = 0
             ''')
             health_info['orphaned_messages'] = cursor.fetchone()[0]
             
@@ -2584,7 +3541,7 @@ class Database:
             cursor.execute('''
                 SELECT COUNT(*) FROM (
                     SELECT user_id, message_number, COUNT(*) as cnt
-                    FROM scheduled_messages
+                    FROM scheduled_messages INDEXED BY idx_scheduled_messages_user_number
                     WHERE is_sent = 0
                     GROUP BY user_id, message_number
                     HAVING cnt > 1
@@ -2612,7 +3569,7 @@ class Database:
             cursor.execute('''
                 DELETE FROM scheduled_messages 
                 WHERE is_sent = 1 AND scheduled_time < ?
-            ''', (cutoff_date,))
+            ''', (self._epoch(cutoff_date),))
             
             deleted_count = cursor.rowcount
             conn.commit()
@@ -2630,524 +3587,1650 @@ class Database:
                 conn.close()
     
     def get_user_statistics(self):
-        """Получение статистики пользователей"""
+        """Получение статистики пользователей (счетчики читаются из counters)"""
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
-            # Общее количество пользователей
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-            total_users = cursor.fetchone()[0]
+            counters = self._read_counters(cursor)
             
-            # Пользователи, которые начали разговор с ботом
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1 AND bot_started = 1')
-            bot_started_users = cursor.fetchone()[0]
-            
-            # Пользователи за последние 24 часа
+            # Пользователи за последние 24 часа (диапазон по индексу joined_at)
             yesterday = datetime.now() - timedelta(days=1)
             cursor.execute('''
                 SELECT COUNT(*) FROM users 
                 WHERE joined_at >= ? AND is_active = 1
-            ''', (yesterday,))
+            ''', (self._epoch(yesterday),))
             new_users_24h = cursor.fetchone()[0]
             
-            # Количество отправленных сообщений
-            cursor.execute('SELECT COUNT(*) FROM scheduled_messages WHERE is_sent = 1')
-            sent_messages = cursor.fetchone()[0]
-            
-            # Количество отписавшихся
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 0')
-            unsubscribed = cursor.fetchone()[0]
-            
-            # НОВАЯ СТАТИСТИКА: Оплатившие пользователи
-            cursor.execute('SELECT COUNT(*) FROM users WHERE has_paid = 1')
-            paid_users = cursor.fetchone()[0]
-            
             return {
-                'total_users': total_users,
-                'bot_started_users': bot_started_users,
+                'total_users': counters.get('users_active', 0),
+                'bot_started_users': counters.get('users_active_bot_started', 0),
                 'new_users_24h': new_users_24h,
-                'sent_messages': sent_messages,
-                'unsubscribed': unsubscribed,
-                'paid_users': paid_users
+                'sent_messages': counters.get('scheduled_sent', 0),
+                'unsubscribed': counters.get('users_inactive', 0),
+                'paid_users': counters.get('users_paid', 0)
+            }
+        finally:
+            if conn:
+                conn.close()
+
+    # ===== 🔢 СЧЕТЧИКИ СТАТИСТИКИ (ВЕДУТСЯ ТРИГГЕРАМИ) =====
+
+    @staticmethod
+    def _counter_expr(expr, row):
+        """Вклад строки row в счетчик (NULL считается нулем)"""
+        return f"COALESCE(({expr.format(row=row)}), 0)"
+
+    def _create_counter_triggers(self, cursor, counters, schema='main'):
+        """Триггеры INSERT/UPDATE/DELETE, которые поддерживают счетчики в таблице counters"""
+        by_table = {}
+        for name, (table, expr) in counters.items():
+            by_table.setdefault(table, {})[name] = expr
+
+        for table, table_counters in by_table.items():
+            names = ', '.join(f"'{name}'" for name in table_counters)
+
+            def delta(build):
+                cases = ' '.join(f"WHEN '{name}' THEN {build(expr)}" for name, expr in table_counters.items())
+                return f"UPDATE counters SET value = value + CASE name {cases} ELSE 0 END WHERE name IN ({names});"
+
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {schema}.counters_{table}_insert AFTER INSERT ON {table}
+                BEGIN {delta(lambda expr: self._counter_expr(expr, 'NEW'))} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {schema}.counters_{table}_delete AFTER DELETE ON {table}
+                BEGIN {delta(lambda expr: '-' + self._counter_expr(expr, 'OLD'))} END
+            ''')
+
+            # UPDATE срабатывает только при изменении колонок, от которых зависят счетчики
+            columns = sorted({column for expr in table_counters.values() for column in re.findall(r'\{row\}\.(\w+)', expr)})
+            if columns:
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {schema}.counters_{table}_update AFTER UPDATE OF {', '.join(columns)} ON {table}
+                    BEGIN {delta(lambda expr: f"{self._counter_expr(expr, 'NEW')} - {self._counter_expr(expr, 'OLD')}")} END
+                ''')
+
+    def _count_counters(self, cursor, counters, schema='main'):
+        """Точные значения счетчиков полным сканированием (по одному проходу на таблицу)"""
+        by_table = {}
+        for name, (table, expr) in counters.items():
+            by_table.setdefault(table, {})[name] = expr
+
+        values = {}
+        for table, table_counters in by_table.items():
+            sums = ', '.join(f"COALESCE(SUM({self._counter_expr(expr, 't')}), 0)" for expr in table_counters.values())
+            cursor.execute(f'SELECT {sums} FROM {schema}.{table} t')
+            values.update(zip(table_counters, cursor.fetchone()))
+        return values
+
+    def _read_counters(self, cursor, schema='main'):
+        cursor.execute(f'SELECT name, value FROM {schema}.counters')
+        return dict(cursor.fetchall())
+
+    def _reconcile_counter_set(self, conn, counters):
+        """Сверить счетчики одной БД с таблицами и исправить расхождения"""
+        cursor = conn.cursor()
+        # Под блокировкой записи: пока идет подсчет, триггеры не сдвинут значения
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            actual = self._count_counters(cursor, counters)
+            stored = self._read_counters(cursor)
+
+            drift = {
+                name: (stored.get(name), value)
+                for name, value in actual.items()
+                if stored.get(name) is None or abs(stored[name] - value) > 1e-6
             }
+            if drift:
+                cursor.executemany(
+                    'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                    [(name, actual[name]) for name in drift]
+                )
+            cursor.execute('COMMIT')
+            return drift
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def reconcile_counters(self):
+        """Проверить счетчики полным пересчетом и исправить дрейф
+
+        Возвращает {имя: (было, стало)} для исправленных счетчиков.
+        """
+        drift = {}
+        try:
+            conn = self._get_connection()
+            try:
+                drift.update(self._reconcile_counter_set(conn, self.COUNTERS))
+            finally:
+                conn.close()
+
+            conn = self._get_analytics_connection()
+            try:
+                drift.update(self._reconcile_counter_set(conn, self.ANALYTICS_COUNTERS))
+            finally:
+                self._release_analytics_connection(conn)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сверке счетчиков статистики: {e}")
+            return drift
+
+        if drift:
+            logger.warning(f"🔢 Исправлены расхождения счетчиков статистики: {drift}")
+        else:
+            logger.info("🔢 Счетчики статистики сходятся с таблицами")
+        return drift
+
+    # ===== МЕТОДЫ ДЛЯ РАССЫЛОК ОПЛАТИВШИХ ПОЛЬЗОВАТЕЛЕЙ =====
+
+    def get_paid_broadcast_message(self, message_number):
+        """Получение сообщения рассылки для оплативших по номеру"""
+        return self.get_funnel_message('paid', message_number)
+
+    def get_all_paid_broadcast_messages(self):
+        """Получение всех сообщений рассылки для оплативших"""
+        return self.get_funnel_messages('paid')
+
+    def add_paid_broadcast_message(self, text, delay_hours, photo_url=None):
+        """Добавление нового сообщения рассылки для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Находим следующий доступный номер сообщения
+            cursor.execute('SELECT MAX(message_number) FROM paid_broadcast_messages')
+            max_number = cursor.fetchone()[0]
+            next_number = (max_number or 0) + 1
+            
+            cursor.execute('''
+                INSERT INTO paid_broadcast_messages (message_number, text, delay_hours, photo_url)
+                VALUES (?, ?, ?, ?)
+            ''', (next_number, text, delay_hours, photo_url))
+            
+            conn.commit()
+            logger.info(f"Добавлено сообщение рассылки для оплативших #{next_number}")
+            return next_number
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    def delete_paid_broadcast_message(self, message_number):
+        """Удаление сообщения рассылки для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Удаляем запланированные отправки
+            cursor.execute('''
+                DELETE FROM paid_scheduled_messages 
+                WHERE message_number = ? AND is_sent = 0
+            ''', (message_number,))
+            
+            # Удаляем кнопки сообщения
+            cursor.execute('''
+                DELETE FROM paid_message_buttons 
+                WHERE message_number = ?
+            ''', (message_number,))
+            
+            # Удаляем само сообщение
+            cursor.execute('''
+                DELETE FROM paid_broadcast_messages 
+                WHERE message_number = ?
+            ''', (message_number,))
+            
+            self._recompute_funnel_due_times(cursor, 'paid')
+            
+            conn.commit()
+            logger.info(f"Удалено сообщение рассылки для оплативших #{message_number}")
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    def update_paid_broadcast_message(self, message_number, text=None, delay_hours=None, photo_url=None):
+        """Обновление сообщения рассылки для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if text is not None:
+                cursor.execute('''
+                    UPDATE paid_broadcast_messages SET text = ? 
+                    WHERE message_number = ?
+                ''', (text, message_number))
+            
+            if delay_hours is not None:
+                cursor.execute('''
+                    UPDATE paid_broadcast_messages SET delay_hours = ? 
+                    WHERE message_number = ?
+                ''', (delay_hours, message_number))
+                self._recompute_funnel_due_times(cursor, 'paid')
+            
+            if photo_url is not None:
+                cursor.execute('''
+                    UPDATE paid_broadcast_messages SET photo_url = ? 
+                    WHERE message_number = ?
+                ''', (photo_url if photo_url else None, message_number))
+            
+            conn.commit()
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    # Методы для кнопок сообщений оплативших
+    def get_paid_message_buttons(self, message_number):
+        """Получение всех кнопок для конкретного сообщения оплативших"""
+        return self.get_funnel_message_buttons('paid', message_number)
+
+    def add_paid_message_button(self, message_number, button_text, button_url, position=1):
+        """Добавление кнопки к сообщению для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO paid_message_buttons (message_number, button_text, button_url, position)
+                VALUES (?, ?, ?, ?)
+            ''', (message_number, button_text, button_url, position))
+            
+            conn.commit()
+            logger.info(f"Добавлена кнопка к сообщению для оплативших #{message_number}")
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    def update_paid_message_button(self, button_id, button_text=None, button_url=None):
+        """Обновление кнопки сообщения для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if button_text is not None:
+                cursor.execute('''
+                    UPDATE paid_message_buttons SET button_text = ? 
+                    WHERE id = ?
+                ''', (button_text, button_id))
+            
+            if button_url is not None:
+                cursor.execute('''
+                    UPDATE paid_message_buttons SET button_url = ? 
+                    WHERE id = ?
+                ''', (button_url, button_id))
+            
+            conn.commit()
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    def delete_paid_message_button(self, button_id):
+        """Удаление кнопки сообщения для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('DELETE FROM paid_message_buttons WHERE id = ?', (button_id,))
+            conn.commit()
+        finally:
+            self._invalidate_broadcast_content()
+            if conn:
+                conn.close()
+
+    # Методы для планирования сообщений оплативших
+    def schedule_paid_message(self, user_id, message_number, scheduled_time):
+        """Планирование отправки сообщения для оплативших"""
+        return self.schedule_funnel_messages(user_id, 'paid', [(message_number, scheduled_time)]) is not None
+
+    def get_pending_paid_messages(self):
+        """Получение платных сообщений, готовых к отправке"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            current_time = datetime.now()
+            cursor.execute('''
+                SELECT psm.id, psm.user_id, psm.message_number, pbm.text, pbm.photo_url, psm.scheduled_time
+                FROM paid_scheduled_messages psm
+                JOIN paid_broadcast_messages pbm ON psm.message_number = pbm.message_number
+                JOIN users u ON psm.user_id = u.user_id
+                WHERE psm.is_sent = 0 
+                AND psm.scheduled_time <= ?
+                AND u.is_active = 1
+                AND u.has_paid = 1
+                ORDER BY psm.scheduled_time ASC
+            ''', (self._epoch(current_time),))
+            
+            messages = cursor.fetchall()
+            return [(m[0], m[1], m[2], m[3], m[4]) for m in messages]  # Возвращаем без scheduled_time
+        finally:
+            if conn:
+                conn.close()
+
+    def mark_paid_message_sent(self, message_id):
+        """Отметка платного сообщения как отправленного (курсор воронки сдвигается на этот шаг)"""
+        self.mark_funnel_message_sent('paid', message_id)
+
+    def get_user_paid_scheduled_messages(self, user_id):
+        """Получение запланированных платных сообщений для пользователя"""
+        return self.get_user_funnel_messages(user_id, 'paid')
+
+    # Методы для массовых рассылок оплативших
+    def add_paid_scheduled_broadcast(self, message_text, scheduled_time, photo_url=None):
+        """Добавление запланированной массовой рассылки для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO paid_scheduled_broadcasts (message_text, photo_url, scheduled_time)
+                VALUES (?, ?, ?)
+            ''', (message_text, photo_url, self._epoch(scheduled_time)))
+            
+            broadcast_id = cursor.lastrowid
+            conn.commit()
+            logger.info(f"Добавлена запланированная рассылка для оплативших #{broadcast_id} на {scheduled_time}")
+            return broadcast_id
+        finally:
+            if conn:
+                conn.close()
+
+    def get_paid_scheduled_broadcasts(self, include_sent=False):
+        """Получение запланированных массовых рассылок для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if include_sent:
+                cursor.execute('''
+                    SELECT id, message_text, photo_url, scheduled_time, is_sent, created_at
+                    FROM paid_scheduled_broadcasts 
+                    ORDER BY scheduled_time
+                ''')
+            else:
+                cursor.execute('''
+                    SELECT id, message_text, photo_url, scheduled_time, is_sent, created_at
+                    FROM paid_scheduled_broadcasts 
+                    WHERE is_sent = 0
+                    ORDER BY scheduled_time
+                ''')
+            
+            broadcasts = cursor.fetchall()
+            return [
+                (broadcast_id, text, photo_url, self._from_epoch(scheduled_time), is_sent, self._from_epoch(created_at))
+                for broadcast_id, text, photo_url, scheduled_time, is_sent, created_at in broadcasts
+            ]
+        finally:
+            if conn:
+                conn.close()
+
+    def get_pending_paid_broadcasts(self):
+        """Получение рассылок для оплативших, готовых к отправке"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT id, message_text, photo_url, scheduled_time
+                FROM paid_scheduled_broadcasts 
+                WHERE is_sent = 0 AND scheduled_time <= ?
+                ORDER BY scheduled_time
+            ''', (int(time.time()),))
+            
+            broadcasts = cursor.fetchall()
+            return [row[:3] + (self._from_epoch(row[3]),) for row in broadcasts]
+        finally:
+            if conn:
+                conn.close()
+
+    def mark_paid_broadcast_sent(self, broadcast_id):
+        """Отметить рассылку для оплативших как отправленную"""
+        self.mark_funnel_broadcast_sent('paid', broadcast_id)
+
+    def delete_paid_scheduled_broadcast(self, broadcast_id):
+        """Удаление запланированной рассылки для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Удаляем кнопки
+            cursor.execute('DELETE FROM paid_scheduled_broadcast_buttons WHERE broadcast_id = ?', (broadcast_id,))
+            
+            # Удаляем рассылку
+            cursor.execute('DELETE FROM paid_scheduled_broadcasts WHERE id = ?', (broadcast_id,))
+            
+            conn.commit()
+            logger.info(f"Удалена запланированная рассылка для оплативших #{broadcast_id}")
+        finally:
+            if conn:
+                conn.close()
+
+    # Методы для кнопок массовых рассылок оплативших
+    def get_paid_scheduled_broadcast_buttons(self, broadcast_id):
+        """Получение кнопок для запланированной рассылки оплативших"""
+        return self.get_funnel_broadcast_buttons('paid', broadcast_id)
+
+    def add_paid_scheduled_broadcast_button(self, broadcast_id, button_text, button_url, position=1):
+        """Добавление кнопки к запланированной рассылке для оплативших"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO paid_scheduled_broadcast_buttons (broadcast_id, button_text, button_url, position)
+                VALUES (?, ?, ?, ?)
+            ''', (broadcast_id, button_text, button_url, position))
+            
+            conn.commit()
+            logger.info(f"Добавлена кнопка к рассылке для оплативших #{broadcast_id}")
+        finally:
+            if conn:
+                conn.close()
+
+    def get_users_with_payment(self):
+        """Получить только пользователей, которые оплатили"""
+        return self.get_funnel_broadcast_recipients('paid')
+    
+    # ===== 🧩 ОБЩИЕ МЕТОДЫ ВОРОНОК (таблицы берутся из FUNNELS) =====
+
+    def get_funnel_messages(self, funnel):
+        """Все сообщения воронки: [(message_number, text, delay_hours, photo_url)]"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(f'SELECT * FROM {self.FUNNELS[funnel].messages_table} ORDER BY message_number')
+            return cursor.fetchall()
+        finally:
+            if conn:
+                conn.close()
+
+    def get_funnel_message(self, funnel, message_number):
+        """Сообщение воронки по номеру: (text, delay_hours, photo_url) или None"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(f'''
+                SELECT text, delay_hours, photo_url FROM {self.FUNNELS[funnel].messages_table}
+                WHERE message_number = ?
+            ''', (message_number,))
+            return cursor.fetchone()
+        finally:
+            if conn:
+                conn.close()
+
+    def get_funnel_message_buttons(self, funnel, message_number):
+        """Кнопки сообщения воронки: [(id, button_text, button_url, position)]"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(f'''
+                SELECT id, button_text, button_url, position
+                FROM {self.FUNNELS[funnel].buttons_table}
+                WHERE message_number = ?
+                ORDER BY position
+            ''', (message_number,))
+            return cursor.fetchall()
+        finally:
+            if conn:
+                conn.close()
+
+    def get_user_funnel_messages(self, user_id, funnel):
+        """Неотправленные сообщения воронки пользователя: [(id, message_number, scheduled_time, is_sent)]"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(f'''
+                SELECT id, message_number, scheduled_time, is_sent
+                FROM {self.FUNNELS[funnel].queue_table}
+                WHERE user_id = ? AND is_sent = 0
+            ''', (user_id,))
+            return [(message_id, number, self._from_epoch(scheduled_time), is_sent)
+                    for message_id, number, scheduled_time, is_sent in cursor.fetchall()]
+        finally:
+            if conn:
+                conn.close()
+
+    def schedule_funnel_messages(self, user_id, funnel, steps):
+        """Запланировать шаги воронки одной транзакцией: steps — [(message_number, scheduled_time)]
+
+        Пользователь должен входить в аудиторию воронки. Уже запланированные
+        и несуществующие шаги пропускаются. Возвращает число добавленных
+        строк или None, если планировать нельзя.
+        """
+        funnel = self.FUNNELS[funnel]
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'SELECT 1 FROM users u WHERE u.user_id = ? AND {funnel.audience_sql()}', (user_id,))
+            if not cursor.fetchone():
+                cursor.execute('ROLLBACK')
+                logger.error(f"❌ Пользователь {user_id} не входит в аудиторию воронки {funnel.name}, планирование пропущено")
+                return None
+
+            scheduled = self._insert_funnel_steps(cursor, funnel, [
+                (user_id, message_number, scheduled_time) for message_number, scheduled_time in steps
+            ])
+
+            cursor.execute('COMMIT')
+            logger.debug(f"✅ Запланировано {scheduled} сообщений воронки {funnel.name} для пользователя {user_id}")
+            return scheduled
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при планировании воронки {funnel.name} для пользователя {user_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return None
         finally:
             if conn:
                 conn.close()
 
-    # ===== МЕТОДЫ ДЛЯ РАССЫЛОК ОПЛАТИВШИХ ПОЛЬЗОВАТЕЛЕЙ =====
+    def _insert_funnel_steps(self, cursor, funnel, steps):
+        """Добавить строки очереди воронки (внутри транзакции): steps — [(user_id, message_number, scheduled_time)]
 
-    def get_paid_broadcast_message(self, message_number):
-        """Получение сообщения рассылки для оплативших по номеру"""
+        Уже запланированные и несуществующие шаги пропускаются, курсоры
+        воронки затронутых пользователей обновляются. Возвращает число строк.
+        """
+        if not steps:
+            return 0
+        cursor.executemany(f'''
+            INSERT INTO {funnel.queue_table} (user_id, message_number, scheduled_time)
+            SELECT ?1, m.message_number, ?3 FROM {funnel.messages_table} m
+            WHERE m.message_number = ?2 AND NOT EXISTS (
+                SELECT 1 FROM {funnel.queue_table} INDEXED BY idx_{funnel.queue_table}_user_number
+                WHERE user_id = ?1 AND message_number = ?2 AND is_sent = 0
+            )
+        ''', [(user_id, message_number, self._epoch(scheduled_time)) for user_id, message_number, scheduled_time in steps])
+        scheduled = cursor.rowcount
+
+        for user_id in dict.fromkeys(user_id for user_id, message_number, scheduled_time in steps):
+            self._remember_funnel_cursor(user_id, funnel.name, self._sync_funnel_cursor(cursor, funnel.name, user_id))
+        return scheduled
+
+    def mark_funnel_message_sent(self, funnel, message_id):
+        """Отметить сообщение воронки отправленным (курсор воронки сдвигается на этот шаг)"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('''
-                SELECT text, delay_hours, photo_url FROM paid_broadcast_messages 
-                WHERE message_number = ?
-            ''', (message_number,))
-            result = cursor.fetchone()
-            return result
+            cursor.execute(f'''
+                UPDATE {self.FUNNELS[funnel].queue_table} SET is_sent = 1
+                WHERE id = ?
+                RETURNING user_id, message_number
+            ''', (message_id,))
+            sent = cursor.fetchone()
+
+            if sent:
+                user_id, message_number = sent
+                self._remember_funnel_cursor(user_id, funnel, self._sync_funnel_cursor(cursor, funnel, user_id, message_number))
+
+            conn.commit()
         finally:
             if conn:
                 conn.close()
 
-    def get_all_paid_broadcast_messages(self):
-        """Получение всех сообщений рассылки для оплативших"""
+    def mark_funnel_broadcast_sent(self, funnel, broadcast_id):
+        """Отметить массовую рассылку воронки отправленной"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('SELECT * FROM paid_broadcast_messages ORDER BY message_number')
-            messages = cursor.fetchall()
-            return messages
+            cursor.execute(f'UPDATE {self.FUNNELS[funnel].broadcasts_table} SET is_sent = 1 WHERE id = ?', (broadcast_id,))
+            conn.commit()
         finally:
             if conn:
                 conn.close()
 
-    def add_paid_broadcast_message(self, text, delay_hours, photo_url=None):
-        """Добавление нового сообщения рассылки для оплативших"""
+    def get_funnel_broadcast_buttons(self, funnel, broadcast_id):
+        """Кнопки массовой рассылки воронки: [(id, button_text, button_url, position)]"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            # Находим следующий доступный номер сообщения
-            cursor.execute('SELECT MAX(message_number) FROM paid_broadcast_messages')
-            max_number = cursor.fetchone()[0]
-            next_number = (max_number or 0) + 1
-            
-            cursor.execute('''
-                INSERT INTO paid_broadcast_messages (message_number, text, delay_hours, photo_url)
-                VALUES (?, ?, ?, ?)
-            ''', (next_number, text, delay_hours, photo_url))
-            
-            conn.commit()
-            logger.info(f"Добавлено сообщение рассылки для оплативших #{next_number}")
-            return next_number
+            cursor.execute(f'''
+                SELECT id, button_text, button_url, position
+                FROM {self.FUNNELS[funnel].broadcast_buttons_table}
+                WHERE broadcast_id = ?
+                ORDER BY position
+            ''', (broadcast_id,))
+            return cursor.fetchall()
         finally:
             if conn:
                 conn.close()
 
-    def delete_paid_broadcast_message(self, message_number):
-        """Удаление сообщения рассылки для оплативших"""
+    def get_funnel_broadcast_segment(self, funnel, broadcast_id):
+        """Сегмент массовой рассылки воронки или None (вся аудитория рассылок)"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            # Удаляем запланированные отправки
-            cursor.execute('''
-                DELETE FROM paid_scheduled_messages 
-                WHERE message_number = ? AND is_sent = 0
-            ''', (message_number,))
-            
-            # Удаляем кнопки сообщения
-            cursor.execute('''
-                DELETE FROM paid_message_buttons 
-                WHERE message_number = ?
-            ''', (message_number,))
-            
-            # Удаляем само сообщение
-            cursor.execute('''
-                DELETE FROM paid_broadcast_messages 
-                WHERE message_number = ?
-            ''', (message_number,))
-            
-            conn.commit()
-            logger.info(f"Удалено сообщение рассылки для оплативших #{message_number}")
+            cursor.execute(f'SELECT segment FROM {self.FUNNELS[funnel].broadcasts_table} WHERE id = ?', (broadcast_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
         finally:
             if conn:
                 conn.close()
 
-    def update_paid_broadcast_message(self, message_number, text=None, delay_hours=None, photo_url=None):
-        """Обновление сообщения рассылки для оплативших"""
+    def get_funnel_broadcast_recipients(self, funnel):
+        """Получатели массовых рассылок воронки (строки как у get_user)"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            if text is not None:
-                cursor.execute('''
-                    UPDATE paid_broadcast_messages SET text = ? 
-                    WHERE message_number = ?
-                ''', (text, message_number))
-            
-            if delay_hours is not None:
-                cursor.execute('''
-                    UPDATE paid_broadcast_messages SET delay_hours = ? 
-                    WHERE message_number = ?
-                ''', (delay_hours, message_number))
-            
-            if photo_url is not None:
-                cursor.execute('''
-                    UPDATE paid_broadcast_messages SET photo_url = ? 
-                    WHERE message_number = ?
-                ''', (photo_url if photo_url else None, message_number))
-            
-            conn.commit()
+            cursor.execute(f'''
+                SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at
+                FROM users u WHERE {self.FUNNELS[funnel].audience_sql(broadcast=True)}
+            ''')
+            return self._user_rows(cursor.fetchall())
         finally:
             if conn:
                 conn.close()
 
-    # Методы для кнопок сообщений оплативших
-    def get_paid_message_buttons(self, message_number):
-        """Получение всех кнопок для конкретного сообщения оплативших"""
+    # ===== 🎯 СЕГМЕНТЫ АУДИТОРИИ РАССЫЛОК (segments.py) =====
+
+    def _segment_query(self, segment, select):
+        """SQL выборки select по сегменту и его параметры (ValueError — неверный сегмент)"""
+        definition, value = parse_segment(segment)
+        where, params = definition.compile(value)
+        return f'''
+            SELECT {select} FROM bot.users u {definition.index}
+            WHERE {self.FUNNELS['free'].audience_sql(broadcast=True)} AND ({where})
+        ''', params
+
+    def get_segment_user_ids(self, segment):
+        """ID получателей сегмента по возрастанию"""
+        sql, params = self._segment_query(segment, 'u.user_id')
+        conn = self._get_analytics_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(sql + ' ORDER BY u.user_id', params)
+            user_ids = [row[0] for row in cursor.fetchall()]
+            self._segment_counts[segment] = (len(user_ids), time.monotonic())
+            return user_ids
+        finally:
+            self._release_analytics_connection(conn)
+
+    def count_segment(self, segment, fresh=False):
+        """Размер сегмента для экранов рассылок (кэшируется на SEGMENT_COUNT_TTL_SECONDS)"""
+        cached = self._segment_counts.get(segment)
+        if cached and not fresh and time.monotonic() - cached[1] < self.SEGMENT_COUNT_TTL_SECONDS:
+            return cached[0]
+
+        sql, params = self._segment_query(segment, 'COUNT(*)')
+        conn = self._get_analytics_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(sql, params)
+            count = cursor.fetchone()[0]
+            self._segment_counts[segment] = (count, time.monotonic())
+            return count
+        finally:
+            self._release_analytics_connection(conn)
+
+    # ===== 🔒 АТОМАРНЫЙ ЗАХВАТ ЗАДАЧ ВОРКЕРАМИ (LEASE) =====
+    #
+    # Шаги воронок доставляются не более одного раза (at-most-once). Воркер
+    # захватывает пачку (одна транзакция), отправляет ее и записывает итоги
+    # всей пачки одной транзакцией (apply_funnel_send_outcomes /
+    # apply_funnel_cursor_outcomes). Если процесс упал между отправкой и
+    # записью итогов, аренда его пачки истекает и следующий захват списывает
+    # такие шаги как отправленные, а не шлет их снова: шаг может потеряться,
+    # но не придет дважды. Временные ошибки отправки явно возвращают шаг в
+    # очередь в итогах той же пачки, со сдвигом времени на
+    # FUNNEL_RETRY_DELAY_SECONDS (at-least-once для попыток): аренда повтора
+    # не доживает до конца обхода и не списывается, даже если обход длится
+    # дольше аренды. Массовые рассылки, наоборот, перехватываются после
+    # истечения аренды — их воркер продлевает аренду.
+
+    def _write_off_abandoned_jobs(self, cursor, funnel):
+        """Списать шаги воронки с истекшей арендой: их воркер мог успеть отправить (внутри транзакции)"""
+        cursor.execute(f'''
+            UPDATE {funnel.queue_table} INDEXED BY idx_{funnel.queue_table}_in_flight
+            SET is_sent = 1, claimed_by = NULL, lease_until = NULL
+            WHERE is_sent = 0 AND claimed_by IS NOT NULL AND lease_until < ?
+            RETURNING user_id, message_number
+        ''', (datetime.now(),))
+        abandoned = cursor.fetchall()
+        if not abandoned:
+            return 0
+
+        steps = {}
+        for user_id, message_number in abandoned:
+            steps[user_id] = max(steps.get(user_id, 0), message_number)
+        for user_id, message_number in steps.items():
+            self._remember_funnel_cursor(user_id, funnel.name, self._sync_funnel_cursor(cursor, funnel.name, user_id, message_number))
+        logger.warning(f"⚠️ Списано {len(abandoned)} шагов воронки {funnel.name} с истекшей арендой (не отправляются повторно)")
+        return len(abandoned)
+
+    def apply_funnel_send_outcomes(self, funnel, worker_id, closed_ids=(), blocked_users=(), retry_ids=(), deliveries=()):
+        """Записать итоги пачки отправок воронки одной транзакцией
+
+        closed_ids — шаги, которые больше не отправлять (доставлены, пропущены,
+        BadRequest, бот заблокирован); blocked_users деактивируются;
+        retry_ids возвращаются в очередь не раньше чем через
+        FUNNEL_RETRY_DELAY_SECONDS; deliveries [(user_id, message_number)]
+        пишутся в аналитику после коммита.
+        """
+        funnel = self.FUNNELS[funnel]
+        queue = funnel.queue_table
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('''
-                SELECT id, button_text, button_url, position 
-                FROM paid_message_buttons 
-                WHERE message_number = ? 
-                ORDER BY position
-            ''', (message_number,))
-            
-            buttons = cursor.fetchall()
-            return buttons
+            cursor.execute('BEGIN IMMEDIATE')
+            steps = {}
+            closed_ids = list(closed_ids)
+            for start in range(0, len(closed_ids), 500):
+                chunk = closed_ids[start:start + 500]
+                cursor.execute(f'''
+                    UPDATE {queue} SET is_sent = 1, claimed_by = NULL, lease_until = NULL
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                    RETURNING user_id, message_number
+                ''', chunk)
+                for user_id, message_number in cursor.fetchall():
+                    steps[user_id] = max(steps.get(user_id, 0), message_number)
+            # Повтор сдвигается вперед, чтобы та же выборка не захватила его снова
+            retry_at = self._epoch(datetime.now() + timedelta(seconds=self.FUNNEL_RETRY_DELAY_SECONDS))
+            for message_id in retry_ids:
+                cursor.execute(f'''
+                    UPDATE {queue}
+                    SET claimed_by = NULL, lease_until = NULL, scheduled_time = MAX(scheduled_time, ?)
+                    WHERE id = ? AND claimed_by = ? AND is_sent = 0
+                    RETURNING user_id
+                ''', (retry_at, message_id, worker_id))
+                for (user_id,) in cursor.fetchall():
+                    steps.setdefault(user_id, 0)
+            cursors = {user_id: self._sync_funnel_cursor(cursor, funnel.name, user_id, message_number)
+                       for user_id, message_number in steps.items()}
+
+            blocked_users = list(blocked_users)
+            self._deactivate_users(cursor, blocked_users)
+            cursor.execute('COMMIT')
+
+            for user_id, row in cursors.items():
+                self._remember_funnel_cursor(user_id, funnel.name, row)
+            for user_id in blocked_users:
+                self.user_states.update(user_id, is_active=0)
+            self.log_message_deliveries(deliveries)
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при записи итогов пачки воронки {funnel.name} воркера {worker_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return False
         finally:
             if conn:
                 conn.close()
 
-    def add_paid_message_button(self, message_number, button_text, button_url, position=1):
-        """Добавление кнопки к сообщению для оплативших"""
+    def _deactivate_users(self, cursor, user_ids):
+        """Деактивировать пользователей, заблокировавших бота (внутри транзакции)"""
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(f'''
+                UPDATE users SET is_active = 0 WHERE user_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+        if user_ids:
+            logger.info(f"Деактивировано пользователей, заблокировавших бота: {len(user_ids)}")
+
+    def _claim_jobs(self, cursor, table, worker_id, limit, lease_seconds, join_sql='', where_sql='', returning='id'):
+        """Атомарно захватить до limit готовых задач очереди table (вызывается внутри BEGIN IMMEDIATE)"""
+        if table not in self.JOB_QUEUE_TABLES:
+            raise ValueError(f"Неизвестная очередь задач: {table}")
+
+        current_time = datetime.now()
+        lease_until = current_time + timedelta(seconds=lease_seconds)
+
+        # Задача свободна, если её никто не арендовал или аренда истекла (воркер упал)
+        cursor.execute(f'''
+            UPDATE {table}
+            SET claimed_by = ?, lease_until = ?
+            WHERE id IN (
+                SELECT q.id FROM {table} q
+                {join_sql}
+                WHERE q.is_sent = 0
+                AND q.scheduled_time <= ?
+                AND (q.lease_until IS NULL OR q.lease_until < ?)
+                {where_sql}
+                ORDER BY q.scheduled_time ASC
+                LIMIT ?
+            )
+            RETURNING {returning}
+        ''', (worker_id, lease_until, self._epoch(current_time), current_time, limit))
+
+        return cursor.fetchall()
+
+    def claim_funnel_messages(self, worker_id, funnel, limit=50, lease_seconds=None):
+        """Захватить готовые сообщения воронки для пользователей из ее аудитории
+
+        Возвращает [(id, user_id, message_number, text, photo_url)] по времени отправки.
+        """
+        funnel = self.FUNNELS[funnel]
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('''
-                INSERT INTO paid_message_buttons (message_number, button_text, button_url, position)
-                VALUES (?, ?, ?, ?)
-            ''', (message_number, button_text, button_url, position))
-            
-            conn.commit()
-            logger.info(f"Добавлена кнопка к сообщению для оплативших #{message_number}")
+            cursor.execute('BEGIN IMMEDIATE')
+            self._write_off_abandoned_jobs(cursor, funnel)
+            claimed = self._claim_jobs(
+                cursor, funnel.queue_table, worker_id, limit,
+                lease_seconds or self.DEFAULT_LEASE_SECONDS,
+                join_sql=f'''
+                    JOIN {funnel.messages_table} m ON q.message_number = m.message_number
+                    JOIN users u ON q.user_id = u.user_id
+                ''',
+                where_sql=f'AND {funnel.audience_sql()}'
+            )
+
+            messages = []
+            if claimed:
+                ids = [row[0] for row in claimed]
+                placeholders = ','.join('?' * len(ids))
+                cursor.execute(f'''
+                    SELECT q.id, q.user_id, q.message_number, m.text, m.photo_url
+                    FROM {funnel.queue_table} q
+                    JOIN {funnel.messages_table} m ON q.message_number = m.message_number
+                    WHERE q.id IN ({placeholders})
+                    ORDER BY q.scheduled_time ASC
+                ''', ids)
+                messages = cursor.fetchall()
+
+            cursor.execute('COMMIT')
+            return messages
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при захвате сообщений воронки {funnel.name} воркером {worker_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return []
         finally:
             if conn:
                 conn.close()
 
-    def update_paid_message_button(self, button_id, button_text=None, button_url=None):
-        """Обновление кнопки сообщения для оплативших"""
+    def claim_pending_messages(self, worker_id, limit=50, lease_seconds=None):
+        """Захватить сообщения воронки для активных неоплативших пользователей"""
+        return self.claim_funnel_messages(worker_id, 'free', limit, lease_seconds)
+
+    def claim_pending_paid_messages(self, worker_id, limit=50, lease_seconds=None):
+        """Захватить платные сообщения для активных оплативших пользователей"""
+        return self.claim_funnel_messages(worker_id, 'paid', limit, lease_seconds)
+
+    def _claim_broadcasts(self, table, worker_id, limit, lease_seconds):
+        """Захватить запланированные массовые рассылки из очереди table"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            if button_text is not None:
-                cursor.execute('''
-                    UPDATE paid_message_buttons SET button_text = ? 
-                    WHERE id = ?
-                ''', (button_text, button_id))
-            
-            if button_url is not None:
-                cursor.execute('''
-                    UPDATE paid_message_buttons SET button_url = ? 
-                    WHERE id = ?
-                ''', (button_url, button_id))
-            
-            conn.commit()
+            cursor.execute('BEGIN IMMEDIATE')
+            broadcasts = self._claim_jobs(
+                cursor, table, worker_id, limit,
+                lease_seconds or self.DEFAULT_LEASE_SECONDS,
+                returning='id, message_text, photo_url, scheduled_time'
+            )
+            cursor.execute('COMMIT')
+            return [row[:3] + (self._from_epoch(row[3]),) for row in sorted(broadcasts, key=lambda b: b[3])]
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при захвате рассылок из {table} воркером {worker_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return []
         finally:
             if conn:
                 conn.close()
 
-    def delete_paid_message_button(self, button_id):
-        """Удаление кнопки сообщения для оплативших"""
+    def claim_funnel_broadcasts(self, worker_id, funnel, limit=1, lease_seconds=None):
+        """Захватить массовые рассылки воронки, готовые к отправке"""
+        return self._claim_broadcasts(self.FUNNELS[funnel].broadcasts_table, worker_id, limit, lease_seconds)
+
+    def claim_pending_broadcasts(self, worker_id, limit=1, lease_seconds=None):
+        """Захватить запланированные массовые рассылки, готовые к отправке"""
+        return self.claim_funnel_broadcasts(worker_id, 'free', limit, lease_seconds)
+
+    def claim_pending_paid_broadcasts(self, worker_id, limit=1, lease_seconds=None):
+        """Захватить запланированные рассылки для оплативших, готовые к отправке"""
+        return self.claim_funnel_broadcasts(worker_id, 'paid', limit, lease_seconds)
+
+    def renew_job_lease(self, table, job_id, worker_id, lease_seconds=None):
+        """Продлить аренду задачи; False — задачу уже перехватил другой воркер"""
+        if table not in self.JOB_QUEUE_TABLES:
+            raise ValueError(f"Неизвестная очередь задач: {table}")
+
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('DELETE FROM paid_message_buttons WHERE id = ?', (button_id,))
+            lease_until = datetime.now() + timedelta(seconds=lease_seconds or self.DEFAULT_LEASE_SECONDS)
+            cursor.execute(f'''
+                UPDATE {table} SET lease_until = ?
+                WHERE id = ? AND claimed_by = ? AND is_sent = 0
+            ''', (lease_until, job_id, worker_id))
+
             conn.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ Ошибка при продлении аренды задачи {table}#{job_id}: {e}")
+            return False
         finally:
             if conn:
                 conn.close()
 
-    # Методы для планирования сообщений оплативших
-    def schedule_paid_message(self, user_id, message_number, scheduled_time):
-        """Планирование отправки сообщения для оплативших"""
+    def release_job(self, table, job_id, worker_id):
+        """Вернуть задачу в очередь, не дожидаясь истечения аренды"""
+        if table not in self.JOB_QUEUE_TABLES:
+            raise ValueError(f"Неизвестная очередь задач: {table}")
+
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            # Проверяем, что пользователь оплатил
-            cursor.execute('''
-                SELECT has_paid FROM users WHERE user_id = ?
-            ''', (user_id,))
-            user_data = cursor.fetchone()
-            
-            if not user_data or not user_data[0]:
-                logger.error(f"❌ Попытка запланировать платное сообщение для неоплатившего пользователя {user_id}")
-                return False
-            
-            # Проверяем, нет ли уже запланированного сообщения
-            cursor.execute('''
-                SELECT id FROM paid_scheduled_messages 
-                WHERE user_id = ? AND message_number = ? AND is_sent = 0
-            ''', (user_id, message_number))
-            existing_message = cursor.fetchone()
-            
-            if existing_message:
-                logger.debug(f"ℹ️ Платное сообщение {message_number} уже запланировано для пользователя {user_id}")
-                return True
-            
-            # Планируем сообщение
-            cursor.execute('''
-                INSERT INTO paid_scheduled_messages (user_id, message_number, scheduled_time)
-                VALUES (?, ?, ?)
-            ''', (user_id, message_number, scheduled_time))
-            
+            cursor.execute(f'''
+                UPDATE {table} SET claimed_by = NULL, lease_until = NULL
+                WHERE id = ? AND claimed_by = ? AND is_sent = 0
+            ''', (job_id, worker_id))
+
             conn.commit()
-            logger.debug(f"✅ Запланировано платное сообщение {message_number} для пользователя {user_id} на {scheduled_time}")
-            return True
-            
+            return cursor.rowcount > 0
         except Exception as e:
-            logger.error(f"❌ Ошибка при планировании платного сообщения для пользователя {user_id}: {e}")
-            try:
-                conn.rollback()
-            except:
-                pass
+            logger.error(f"❌ Ошибка при возврате задачи {table}#{job_id} в очередь: {e}")
             return False
         finally:
             if conn:
                 conn.close()
 
-    def get_pending_paid_messages(self):
-        """Получение платных сообщений, готовых к отправке"""
+    def get_send_load(self, ranges):
+        """Запланированные отправки воронок по минутам: {минута unix: количество}
+
+        ranges — [(начало, конец)] в секундах unix. Считаются неотправленные
+        строки очередей всех воронок и следующие шаги курсоров движка cursor
+        (started_at задан; у движка rows курсор лишь повторяет очередь).
+        """
+        queues = ' UNION ALL '.join(f'''
+            SELECT scheduled_time / 60 AS minute, COUNT(*) AS sends FROM {table}
+            WHERE is_sent = 0 AND scheduled_time >= :start AND scheduled_time < :end
+            GROUP BY minute
+        ''' for table in (funnel.queue_table for funnel in self.FUNNELS.values()))
+        funnels = ', '.join(f"'{funnel}'" for funnel in self.FUNNELS)
+
         conn = self._get_connection()
         cursor = conn.cursor()
-        
-        try:
-            current_time = datetime.now()
-            cursor.execute('''
-                SELECT psm.id, psm.user_id, psm.message_number, pbm.text, pbm.photo_url, psm.scheduled_time
-                FROM paid_scheduled_messages psm
-                JOIN paid_broadcast_messages pbm ON psm.message_number = pbm.message_number
-                JOIN users u ON psm.user_id = u.user_id
-                WHERE psm.is_sent = 0 
-                AND psm.scheduled_time <= ?
-                AND u.is_active = 1
-                AND u.has_paid = 1
-                ORDER BY psm.scheduled_time ASC
-            ''', (current_time,))
-            
-            messages = cursor.fetchall()
-            return [(m[0], m[1], m[2], m[3], m[4]) for m in messages]  # Возвращаем без scheduled_time
+
+        try:
+            load = {}
+            for start, end in ranges:
+                cursor.execute(f'''
+                    SELECT minute, SUM(sends) FROM (
+                        {queues}
+                        UNION ALL
+                        SELECT next_due_at / 60 AS minute, COUNT(*) AS sends FROM funnel_cursors
+                        WHERE funnel IN ({funnels}) AND next_due_at >= :start AND next_due_at < :end
+                        AND started_at IS NOT NULL
+                        GROUP BY minute
+                    )
+                    GROUP BY minute
+                ''', {'start': start, 'end': end})
+                # Окна могут пересекаться: значение минуты одно и то же
+                load.update(cursor.fetchall())
+            return load
+        except Exception as e:
+            logger.error(f"❌ Ошибка при подсчете загрузки календаря отправок: {e}")
+            return {}
         finally:
             if conn:
                 conn.close()
 
-    def mark_paid_message_sent(self, message_id):
-        """Отметка платного сообщения как отправленного"""
+    # ===== 🧭 КУРСОР ВОРОНКИ И ГОТОВЫЙ КОНТЕНТ СООБЩЕНИЙ =====
+
+    def _sync_funnel_cursor(self, cursor, funnel, user_id, step=0):
+        """Обновить курсор воронки пользователя (вызывается внутри транзакции)
+
+        Шаг только растет, время следующего шага берется из ближайшего
+        неотправленного сообщения (индекс по user_id, без сканирования очереди).
+        """
+        table = self.FUNNELS[funnel].queue_table
+        cursor.execute(f'''
+            INSERT INTO funnel_cursors (user_id, funnel, step, next_due_at, updated_at)
+            VALUES (?, ?, ?, (
+                SELECT MIN(scheduled_time) FROM {table} INDEXED BY idx_{table}_user_number
+                WHERE user_id = ? AND is_sent = 0
+            ), CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id, funnel) DO UPDATE SET
+                step = MAX(funnel_cursors.step, excluded.step),
+                next_due_at = excluded.next_due_at,
+                updated_at = excluded.updated_at
+            RETURNING step, next_due_at
+        ''', (user_id, funnel, step or 0, user_id))
+        return cursor.fetchone()
+
+    def _remember_funnel_cursor(self, user_id, funnel, row):
+        """Положить курсор (step, next_due_at) в память и вернуть его (None — забыть)"""
+        key = (user_id, funnel)
+        if row is None:
+            self._funnel_cursors.pop(key, None)
+            return None
+
+        funnel_cursor = (row[0], self._from_epoch(row[1]))
+        self._funnel_cursors[key] = funnel_cursor
+        self._funnel_cursors.move_to_end(key)
+        while len(self._funnel_cursors) > self.FUNNEL_CURSOR_CACHE_SIZE:
+            self._funnel_cursors.popitem(last=False)
+        return funnel_cursor
+
+    def get_funnel_cursor(self, user_id, funnel='free'):
+        """Курсор воронки пользователя: (последний отправленный шаг, время следующего шага)"""
+        key = (user_id, funnel)
+        if key in self._funnel_cursors:
+            self._funnel_cursors.move_to_end(key)
+            return self._funnel_cursors[key]
+
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
             cursor.execute('''
-                UPDATE paid_scheduled_messages SET is_sent = 1 
-                WHERE id = ?
-            ''', (message_id,))
-            
-            conn.commit()
+                SELECT step, next_due_at FROM funnel_cursors
+                WHERE user_id = ? AND funnel = ?
+            ''', (user_id, funnel))
+            return self._remember_funnel_cursor(user_id, funnel, cursor.fetchone())
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении курсора воронки {funnel} пользователя {user_id}: {e}")
+            return None
         finally:
             if conn:
                 conn.close()
 
-    def get_user_paid_scheduled_messages(self, user_id):
-        """Получение запланированных платных сообщений для пользователя"""
+    def claim_user_message_after(self, worker_id, user_id, after_message_number=None, lease_seconds=None):
+        """Захватить следующее сообщение пользователя после указанного шага (по кнопке)
+
+        Шаг приходит из callback кнопки; если его нет (старые кнопки) —
+        берется из курсора воронки. Возвращает (id, message_number) или None.
+        """
+        if after_message_number is None:
+            funnel_cursor = self.get_funnel_cursor(user_id, 'free')
+            after_message_number = funnel_cursor[0] if funnel_cursor else 0
+
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
+            current_time = datetime.now()
+            lease_until = current_time + timedelta(seconds=lease_seconds or self.DEFAULT_LEASE_SECONDS)
+
             cursor.execute('''
-                SELECT id, message_number, scheduled_time, is_sent
-                FROM paid_scheduled_messages
-                WHERE user_id = ? AND is_sent = 0
-            ''', (user_id,))
-            
-            messages = cursor.fetchall()
-            return messages
+                UPDATE scheduled_messages
+                SET claimed_by = ?, lease_until = ?
+                WHERE id = (
+                    SELECT id FROM scheduled_messages INDEXED BY idx_scheduled_messages_user_number
+                    WHERE user_id = ? AND message_number > ? AND is_sent = 0
+                    AND (lease_until IS NULL OR lease_until < ?)
+                    ORDER BY message_number ASC
+                    LIMIT 1
+                )
+                RETURNING id, message_number
+            ''', (worker_id, lease_until, user_id, after_message_number, current_time))
+            return cursor.fetchone()
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при захвате сообщения пользователя {user_id} после шага {after_message_number}: {e}")
+            return None
         finally:
             if conn:
                 conn.close()
 
-    # Методы для массовых рассылок оплативших
-    def add_paid_scheduled_broadcast(self, message_text, scheduled_time, photo_url=None):
-        """Добавление запланированной массовой рассылки для оплативших"""
+    def get_prepared_broadcast_message(self, message_number, funnel='free'):
+        """Готовый контент сообщения воронки из памяти: (text, photo_url, buttons) или None
+
+        Кэш сбрасывается методами, которые меняют сообщения и их кнопки.
+        """
+        key = (funnel, message_number)
+        prepared = self._broadcast_content.get(key)
+        if prepared is not None:
+            return prepared
+
+        message = self.get_funnel_message(funnel, message_number)
+        if not message:
+            return None
+
+        text, delay_hours, photo_url = message
+        prepared = (text, photo_url, tuple(self.get_funnel_message_buttons(funnel, message_number)))
+        self._broadcast_content[key] = prepared
+        return prepared
+
+    def _invalidate_broadcast_content(self):
+        self._broadcast_content.clear()
+
+    # ===== 🧭 ДВИЖОК ВОРОНКИ НА КУРСОРАХ (FUNNEL_ENGINE=cursor) =====
+    #
+    # Вместо строки на каждый шаг воронки у пользователя одна строка
+    # funnel_cursors: последний отправленный шаг и время начала воронки.
+    # Время следующего шага = started_at + delay_hours следующего сообщения,
+    # поэтому изменение задержек сразу действует на всех пользователей.
+
+    def _funnel_due_sql(self, funnel, step_sql='funnel_cursors.step'):
+        """SQL-выражение: время первого сообщения воронки после шага step_sql (NULL — воронка пройдена)"""
+        messages = self.FUNNELS[funnel].messages_table
+        return f'''(
+            SELECT funnel_cursors.started_at + CAST(ROUND(m.delay_hours * 3600) AS INTEGER)
+            FROM {messages} m
+            WHERE m.message_number > {step_sql}
+            ORDER BY m.message_number ASC
+            LIMIT 1
+        )'''
+
+    def _recompute_funnel_due_times(self, cursor, funnel):
+        """Пересчитать время следующего шага у всех идущих по воронке (после изменения сообщений)"""
+        cursor.execute(f'''
+            UPDATE funnel_cursors
+            SET next_due_at = {self._funnel_due_sql(funnel)}, updated_at = CURRENT_TIMESTAMP
+            WHERE funnel = ? AND started_at IS NOT NULL AND next_due_at IS NOT NULL
+        ''', (funnel,))
+        if cursor.rowcount:
+            self._funnel_cursors.clear()
+            logger.info(f"🧭 Пересчитано время следующего шага для {cursor.rowcount} курсоров воронки {funnel}")
+
+    def _start_funnel_cursors(self, cursor, funnel, user_ids, started_at=None):
+        """Запустить воронку с первого шага у пользователей, у которых она не идет (внутри транзакции)"""
+        if not user_ids:
+            return 0
+        started_at = self._epoch(started_at) or int(time.time())
+        placeholders = ','.join('?' * len(user_ids))
+        cursor.execute(f'''
+            INSERT INTO funnel_cursors (user_id, funnel, step, started_at, updated_at)
+            SELECT user_id, ?, 0, ?, CURRENT_TIMESTAMP FROM users WHERE user_id IN ({placeholders})
+            ON CONFLICT(user_id, funnel) DO UPDATE SET
+                step = 0,
+                started_at = excluded.started_at,
+                claimed_by = NULL,
+                lease_until = NULL,
+                updated_at = excluded.updated_at
+            WHERE funnel_cursors.next_due_at IS NULL
+            RETURNING user_id
+        ''', [funnel, started_at, *user_ids])
+        started = [row[0] for row in cursor.fetchall()]
+
+        if started:
+            placeholders = ','.join('?' * len(started))
+            cursor.execute(f'''
+                UPDATE funnel_cursors SET next_due_at = {self._funnel_due_sql(funnel)}
+                WHERE funnel = ? AND user_id IN ({placeholders})
+            ''', [funnel, *started])
+            for user_id in started:
+                self._funnel_cursors.pop((user_id, funnel), None)
+        return len(started)
+
+    def start_funnel_cursor(self, user_id, funnel='free', started_at=None):
+        """Запустить воронку пользователя с первого шага (если она еще не идет)
+
+        Возвращает курсор (step, next_due_at) или None при ошибке.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._start_funnel_cursors(cursor, funnel, [user_id], started_at)
+
             cursor.execute('''
-                INSERT INTO paid_scheduled_broadcasts (message_text, photo_url, scheduled_time)
-                VALUES (?, ?, ?)
-            ''', (message_text, photo_url, scheduled_time))
-            
-            broadcast_id = cursor.lastrowid
-            conn.commit()
-            logger.info(f"Добавлена запланированная рассылка для оплативших #{broadcast_id} на {scheduled_time}")
-            return broadcast_id
+                SELECT step, next_due_at FROM funnel_cursors
+                WHERE user_id = ? AND funnel = ?
+            ''', (user_id, funnel))
+            row = cursor.fetchone()
+            cursor.execute('COMMIT')
+
+            return self._remember_funnel_cursor(user_id, funnel, row)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при запуске воронки {funnel} для пользователя {user_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return None
         finally:
             if conn:
                 conn.close()
 
-    def get_paid_scheduled_broadcasts(self, include_sent=False):
-        """Получение запланированных массовых рассылок для оплативших"""
+    def claim_due_funnel_cursors(self, worker_id, funnel='free', limit=50, lease_seconds=None):
+        """Захватить курсоры, у которых настало время следующего шага
+
+        Возвращает список (user_id, message_number) — какое сообщение отправить.
+        """
+        messages = self.FUNNELS[funnel].messages_table
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            if include_sent:
-                cursor.execute('''
-                    SELECT id, message_text, photo_url, scheduled_time, is_sent, created_at
-                    FROM paid_scheduled_broadcasts 
-                    ORDER BY scheduled_time
-                ''')
-            else:
-                cursor.execute('''
-                    SELECT id, message_text, photo_url, scheduled_time, is_sent, created_at
-                    FROM paid_scheduled_broadcasts 
-                    WHERE is_sent = 0
-                    ORDER BY scheduled_time
-                ''')
-            
-            broadcasts = cursor.fetchall()
-            return broadcasts
+            current_time = datetime.now()
+            lease_until = current_time + timedelta(seconds=lease_seconds or self.DEFAULT_LEASE_SECONDS)
+
+            cursor.execute('BEGIN IMMEDIATE')
+            self._write_off_abandoned_cursors(cursor, funnel, current_time)
+            cursor.execute(f'''
+                UPDATE funnel_cursors
+                SET claimed_by = ?, lease_until = ?
+                WHERE funnel = ? AND user_id IN (
+                    SELECT fc.user_id FROM funnel_cursors fc
+                    JOIN users u ON fc.user_id = u.user_id
+                    WHERE fc.funnel = ?
+                    AND fc.started_at IS NOT NULL
+                    AND fc.next_due_at <= ?
+                    AND (fc.lease_until IS NULL OR fc.lease_until < ?)
+                    AND {self.FUNNELS[funnel].audience_sql()}
+                    ORDER BY fc.next_due_at ASC
+                    LIMIT ?
+                )
+                RETURNING user_id, next_due_at, (
+                    SELECT MIN(m.message_number) FROM {messages} m
+                    WHERE m.message_number > funnel_cursors.step
+                )
+            ''', (worker_id, lease_until, funnel, funnel, self._epoch(current_time), current_time, limit))
+            claimed = sorted(cursor.fetchall(), key=lambda row: row[1])
+
+            # Следующее сообщение успели удалить — воронка пройдена
+            finished = [user_id for user_id, next_due_at, message_number in claimed if message_number is None]
+            if finished:
+                placeholders = ','.join('?' * len(finished))
+                cursor.execute(f'''
+                    UPDATE funnel_cursors
+                    SET next_due_at = NULL, claimed_by = NULL, lease_until = NULL
+                    WHERE funnel = ? AND user_id IN ({placeholders})
+                ''', [funnel] + finished)
+                for user_id in finished:
+                    self._remember_funnel_cursor(user_id, funnel, None)
+
+            cursor.execute('COMMIT')
+            return [(user_id, message_number) for user_id, next_due_at, message_number in claimed if message_number is not None]
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при захвате курсоров воронки {funnel} воркером {worker_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return []
         finally:
             if conn:
                 conn.close()
 
-    def get_pending_paid_broadcasts(self):
-        """Получение рассылок для оплативших, готовых к отправке"""
+    def claim_funnel_cursor(self, worker_id, user_id, funnel='free', after_message_number=None, lease_seconds=None):
+        """Захватить курсор пользователя для досрочной отправки (по кнопке)
+
+        Возвращает номер следующего сообщения после шага кнопки или None.
+        """
+        messages = self.FUNNELS[funnel].messages_table
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
             current_time = datetime.now()
+            lease_until = current_time + timedelta(seconds=lease_seconds or self.DEFAULT_LEASE_SECONDS)
+
+            cursor.execute('BEGIN IMMEDIATE')
             cursor.execute('''
-                SELECT id, message_text, photo_url, scheduled_time
-                FROM paid_scheduled_broadcasts 
-                WHERE is_sent = 0 AND scheduled_time <= ?
-                ORDER BY scheduled_time
-            ''', (current_time,))
-            
-            broadcasts = cursor.fetchall()
-            return broadcasts
+                UPDATE funnel_cursors
+                SET claimed_by = ?, lease_until = ?
+                WHERE user_id = ? AND funnel = ?
+                AND started_at IS NOT NULL AND next_due_at IS NOT NULL
+                AND (lease_until IS NULL OR lease_until < ?)
+                RETURNING step
+            ''', (worker_id, lease_until, user_id, funnel, current_time))
+            claimed = cursor.fetchone()
+
+            message_number = None
+            if claimed:
+                cursor.execute(f'''
+                    SELECT MIN(message_number) FROM {messages}
+                    WHERE message_number > MAX(?, ?)
+                ''', (claimed[0], after_message_number or 0))
+                message_number = cursor.fetchone()[0]
+
+                if message_number is None:
+                    cursor.execute('''
+                        UPDATE funnel_cursors SET claimed_by = NULL, lease_until = NULL
+                        WHERE user_id = ? AND funnel = ?
+                    ''', (user_id, funnel))
+
+            cursor.execute('COMMIT')
+            return message_number
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при захвате курсора воронки {funnel} пользователя {user_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return None
         finally:
             if conn:
                 conn.close()
 
-    def mark_paid_broadcast_sent(self, broadcast_id):
-        """Отметить рассылку для оплативших как отправленную"""
+    def _write_off_abandoned_cursors(self, cursor, funnel, current_time):
+        """Сдвинуть курсоры с истекшей арендой на шаг, который мог уйти (at-most-once, внутри транзакции)"""
+        next_step = f'''COALESCE((
+            SELECT MIN(n.message_number) FROM {self.FUNNELS[funnel].messages_table} n
+            WHERE n.message_number > funnel_cursors.step
+        ), funnel_cursors.step)'''
+        cursor.execute(f'''
+            UPDATE funnel_cursors INDEXED BY idx_funnel_cursors_in_flight
+            SET step = {next_step},
+                next_due_at = {self._funnel_due_sql(funnel, next_step)},
+                claimed_by = NULL,
+                lease_until = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE funnel = ? AND claimed_by IS NOT NULL AND lease_until < ?
+            RETURNING user_id, step, next_due_at
+        ''', (funnel, current_time))
+        abandoned = cursor.fetchall()
+        for user_id, step, next_due_at in abandoned:
+            self._remember_funnel_cursor(user_id, funnel, (step, next_due_at))
+        if abandoned:
+            logger.warning(f"⚠️ Пропущено {len(abandoned)} шагов воронки {funnel} с истекшей арендой курсора (не отправляются повторно)")
+        return len(abandoned)
+
+    def apply_funnel_cursor_outcomes(self, funnel, worker_id, advanced=(), blocked_users=(), retry_users=(), deliveries=()):
+        """Записать итоги пачки движка курсоров одной транзакцией
+
+        advanced — [(user_id, message_number)] шаги, которые больше не
+        отправлять; курсоры сдвигаются и освобождаются. retry_users — курсоры
+        вернуть без сдвига шага, отложив следующую попытку на
+        FUNNEL_RETRY_DELAY_SECONDS. Остальное как в apply_funnel_send_outcomes.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('''
-                UPDATE paid_scheduled_broadcasts SET is_sent = 1 WHERE id = ?
-            ''', (broadcast_id,))
-            
-            conn.commit()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursors = {}
+            for user_id, message_number in advanced:
+                cursor.execute(f'''
+                    UPDATE funnel_cursors
+                    SET step = MAX(step, ?),
+                        next_due_at = {self._funnel_due_sql(funnel, 'MAX(funnel_cursors.step, ?)')},
+                        claimed_by = NULL,
+                        lease_until = NULL,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND funnel = ?
+                    RETURNING step, next_due_at
+                ''', (message_number, message_number, user_id, funnel))
+                cursors[user_id] = cursor.fetchone()
+
+            blocked_users = list(blocked_users)
+            self._deactivate_users(cursor, blocked_users)
+
+            retry_at = self._epoch(datetime.now() + timedelta(seconds=self.FUNNEL_RETRY_DELAY_SECONDS))
+            for user_id in retry_users:
+                cursor.execute('''
+                    UPDATE funnel_cursors
+                    SET claimed_by = NULL, lease_until = NULL, next_due_at = MAX(next_due_at, ?)
+                    WHERE user_id = ? AND funnel = ? AND claimed_by = ?
+                    RETURNING step, next_due_at
+                ''', (retry_at, user_id, funnel, worker_id))
+                row = cursor.fetchone()
+                if row:
+                    cursors[user_id] = row
+            cursor.execute('COMMIT')
+
+            for user_id, row in cursors.items():
+                self._remember_funnel_cursor(user_id, funnel, row)
+            for user_id in blocked_users:
+                self.user_states.update(user_id, is_active=0)
+            self.log_message_deliveries(deliveries)
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при записи итогов пачки курсоров воронки {funnel} воркера {worker_id}: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return False
         finally:
             if conn:
                 conn.close()
 
-    def delete_paid_scheduled_broadcast(self, broadcast_id):
-        """Удаление запланированной рассылки для оплативших"""
+    def advance_funnel_cursor(self, user_id, funnel, message_number):
+        """Сдвинуть курсор на отправленный шаг и снять аренду
+
+        Время следующего шага считается от начала воронки; None — воронка пройдена.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            # Удаляем кнопки
-            cursor.execute('DELETE FROM paid_scheduled_broadcast_buttons WHERE broadcast_id = ?', (broadcast_id,))
-            
-            # Удаляем рассылку
-            cursor.execute('DELETE FROM paid_scheduled_broadcasts WHERE id = ?', (broadcast_id,))
-            
-            conn.commit()
-            logger.info(f"Удалена запланированная рассылка для оплативших #{broadcast_id}")
+            cursor.execute(f'''
+                UPDATE funnel_cursors
+                SET step = MAX(step, ?),
+                    next_due_at = {self._funnel_due_sql(funnel, 'MAX(funnel_cursors.step, ?)')},
+                    claimed_by = NULL,
+                    lease_until = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND funnel = ?
+                RETURNING step, next_due_at
+            ''', (message_number, message_number, user_id, funnel))
+            row = cursor.fetchone()
+
+            return self._remember_funnel_cursor(user_id, funnel, row)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сдвиге курсора воронки {funnel} пользователя {user_id}: {e}")
+            return None
         finally:
             if conn:
                 conn.close()
 
-    # Методы для кнопок массовых рассылок оплативших
-    def get_paid_scheduled_broadcast_buttons(self, broadcast_id):
-        """Получение кнопок для запланированной рассылки оплативших"""
+    def release_funnel_cursor(self, user_id, funnel, worker_id):
+        """Снять аренду курсора без сдвига (временная ошибка отправки)"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
             cursor.execute('''
-                SELECT id, button_text, button_url, position 
-                FROM paid_scheduled_broadcast_buttons 
-                WHERE broadcast_id = ? 
-                ORDER BY position
-            ''', (broadcast_id,))
-            
-            buttons = cursor.fetchall()
-            return buttons
+                UPDATE funnel_cursors SET claimed_by = NULL, lease_until = NULL
+                WHERE user_id = ? AND funnel = ? AND claimed_by = ?
+            ''', (user_id, funnel, worker_id))
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ Ошибка при возврате курсора воронки {funnel} пользователя {user_id}: {e}")
+            return False
         finally:
             if conn:
                 conn.close()
 
-    def add_paid_scheduled_broadcast_button(self, broadcast_id, button_text, button_url, position=1):
-        """Добавление кнопки к запланированной рассылке для оплативших"""
+    def has_pending_funnel_messages(self, user_id, funnel='free'):
+        """Есть ли у пользователя еще не отправленные шаги воронки (для обоих движков)"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
             cursor.execute('''
-                INSERT INTO paid_scheduled_broadcast_buttons (broadcast_id, button_text, button_url, position)
-                VALUES (?, ?, ?, ?)
-            ''', (broadcast_id, button_text, button_url, position))
-            
-            conn.commit()
-            logger.info(f"Добавлена кнопка к рассылке для оплативших #{broadcast_id}")
+                SELECT 1 FROM funnel_cursors
+                WHERE user_id = ? AND funnel = ? AND next_due_at IS NOT NULL
+            ''', (user_id, funnel))
+            return cursor.fetchone() is not None
         finally:
             if conn:
                 conn.close()
 
-    def get_users_with_payment(self):
-        """Получить только пользователей, которые оплатили"""
+    def migrate_funnel_to_cursors(self, funnel='free'):
+        """Перевести запланированные строки воронки на курсоры (повторный запуск ничего не делает)
+
+        Начало воронки восстанавливается как scheduled_time - delay_hours
+        ближайшего неотправленного сообщения, после чего строки очереди удаляются.
+        """
+        table = self.FUNNELS[funnel].queue_table
+        messages = self.FUNNELS[funnel].messages_table
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            cursor.execute('''
-                SELECT user_id, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at 
-                FROM users WHERE is_active = 1 AND has_paid = 1
-            ''')
-            users = cursor.fetchall()
-            return users
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'''
+                INSERT INTO funnel_cursors (user_id, funnel, step, started_at, updated_at)
+                SELECT q.user_id, ?,
+                       COALESCE(MAX(CASE WHEN q.is_sent = 1 THEN q.message_number END), 0),
+                       MIN(CASE WHEN q.is_sent = 0 THEN q.scheduled_time - CAST(ROUND(m.delay_hours * 3600) AS INTEGER) END),
+                       CURRENT_TIMESTAMP
+                FROM {table} q
+                JOIN {messages} m ON q.message_number = m.message_number
+                WHERE true
+                GROUP BY q.user_id
+                HAVING SUM(q.is_sent = 0) > 0
+                ON CONFLICT(user_id, funnel) DO UPDATE SET
+                    step = excluded.step,
+                    started_at = excluded.started_at,
+                    claimed_by = NULL,
+                    lease_until = NULL,
+                    updated_at = excluded.updated_at
+            ''', (funnel,))
+            migrated = cursor.rowcount
+
+            cursor.execute(f'''
+                UPDATE funnel_cursors SET next_due_at = {self._funnel_due_sql(funnel)}
+                WHERE funnel = ? AND user_id IN (SELECT user_id FROM {table} WHERE is_sent = 0)
+            ''', (funnel,))
+
+            cursor.execute(f'DELETE FROM {table}')
+            removed = cursor.rowcount
+            cursor.execute('COMMIT')
+
+            self._funnel_cursors.clear()
+            if removed:
+                logger.info(f"🧭 Воронка {funnel} переведена на курсоры: {migrated} курсоров вместо {removed} строк {table}")
+            return migrated
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при переводе воронки {funnel} на курсоры: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return 0
         finally:
             if conn:
                 conn.close()
-    
+
     # ===== МЕТОДЫ ДЛЯ УПРАВЛЕНИЯ ПРОДЛЕНИЕМ ПОДПИСОК =====
     
-    def get_expired_subscriptions(self):
-        """Получить пользователей с истекшей подпиской на сегодня"""
+    def get_expired_subscription_chunk(self, limit=500, today=None):
+        """Чанк подписок, истекших сегодня или раньше (пропущенные дни тоже попадают)
+
+        Диапазон payed_till < завтра по частичному индексу idx_users_payed_till.
+        Возвращает [(user_id, username, first_name, is_active, bot_started, payed_till)].
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
-        
+
         try:
-            from datetime import date
-            today = date.today()
-            
+            today = today or date.today()
+            # payed_till — полночь дня окончания (местное время)
             cursor.execute('''
-                SELECT user_id, username, first_name, payed_till
-                FROM users 
-                WHERE has_paid = 1 
-                AND is_active = 1 
-                AND payed_till = ?
-            ''', (today,))
-            
-            expired_users = cursor.fetchall()
-            return expired_users
-            
+                SELECT user_id, username, first_name, is_active, bot_started, payed_till
+                FROM users INDEXED BY idx_users_payed_till
+                WHERE has_paid = 1 AND payed_till < ?
+                ORDER BY payed_till, user_id
+                LIMIT ?
+            ''', (self._epoch(today + timedelta(days=1)), -1 if limit is None else limit))
+
+            return [row[:5] + (self._from_epoch(row[5]).date(),) for row in cursor.fetchall()]
+
         except Exception as e:
             logger.error(f"❌ Ошибка при получении истекших подписок: {e}")
             return []
         finally:
             if conn:
                 conn.close()
+
+    def get_expired_subscriptions(self, today=None):
+        """Получить активных пользователей с подпиской, истекшей сегодня или раньше"""
+        return [(user_id, username, first_name, payed_till)
+                for user_id, username, first_name, is_active, bot_started, payed_till
+                in self.get_expired_subscription_chunk(None, today) if is_active]
+
+    def expire_subscriptions(self, user_ids, free_steps=(), free_cursor_users=(), today=None):
+        """Завершить подписки чанка одной транзакцией и перевести пользователей в бесплатную воронку
+
+        Завершаются только подписки, которые к моменту транзакции все еще
+        оплачены и истекли (продленные пропускаются), поэтому повторный запуск
+        ничего не делает. Платные шаги отменяются, бесплатная воронка
+        планируется строками free_steps [(user_id, message_number, scheduled_time)]
+        или курсорами для free_cursor_users. Возвращает список завершенных
+        user_id или None при ошибке.
+        """
+        if not user_ids:
+            return []
+        paid, free = self.FUNNELS['paid'], self.FUNNELS['free']
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        try:
+            today = today or date.today()
+            placeholders = ','.join('?' * len(user_ids))
+
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'''
+                UPDATE users SET has_paid = 0, payed_till = NULL
+                WHERE user_id IN ({placeholders}) AND has_paid = 1 AND payed_till < ?
+                RETURNING user_id
+            ''', [*user_ids, self._epoch(today + timedelta(days=1))])
+            expired = sorted(row[0] for row in cursor.fetchall())
+
+            if expired:
+                placeholders = ','.join('?' * len(expired))
+                cursor.execute(f'''
+                    DELETE FROM {paid.queue_table} WHERE user_id IN ({placeholders}) AND is_sent = 0
+                ''', expired)
+                cancelled_paid_count = cursor.rowcount
+                cursor.execute(f'''
+                    UPDATE funnel_cursors SET next_due_at = NULL, claimed_by = NULL, lease_until = NULL,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE funnel = ? AND user_id IN ({placeholders})
+                ''', [paid.name, *expired])
+                for user_id in expired:
+                    self._funnel_cursors.pop((user_id, paid.name), None)
+
+                expired_set = set(expired)
+                scheduled = self._insert_funnel_steps(cursor, free, [
+                    step for step in free_steps if step[0] in expired_set
+                ])
+                scheduled += self._start_funnel_cursors(cursor, free.name, [
+                    user_id for user_id in free_cursor_users if user_id in expired_set
+                ])
+
+                logger.info(f"✅ Завершено {len(expired)} подписок: отменено {cancelled_paid_count} платных сообщений, "
+                            f"запланировано {scheduled} шагов бесплатной воронки")
+
+            cursor.execute('COMMIT')
+            for user_id in expired:
+                self.user_states.update(user_id, has_paid=0, payed_till=None)
+            return expired
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка при завершении чанка подписок: {e}")
+            try:
+                conn.rollback()
+            except:
+                pass
+            return None
+        finally:
+            if conn:
+                conn.close()
     
     def get_renewal_message(self):
         """Получение сообщения о продлении подписки"""
@@ -3244,8 +5327,10 @@ class Database:
             ''', (user_id,))
             
             cancelled_paid_count = cursor.rowcount
+            self._remember_funnel_cursor(user_id, 'paid', self._sync_funnel_cursor(cursor, 'paid', user_id))
             
             conn.commit()
+            self.user_states.update(user_id, has_paid=0, payed_till=None)
             
             logger.info(f"✅ Подписка пользователя {user_id} завершена, отменено {cancelled_paid_count} платных сообщений")
             return True
@@ -0,0 +1,95 @@
+"""
+Воронки бота: одно описание на воронку вместо параллельных копий кода
+
+Бесплатная и платная воронки были копиями друг друга: свои таблицы сообщений,
+кнопок, расписания и массовых рассылок, свои методы планирования, захвата и
+отправки в планировщике и четыре почти одинаковых цикла рассылки.
+
+Теперь воронка — запись Funnel, а код один для всех:
+
+- таблицы воронки строятся по одному шаблону схемы от префикса
+  (broadcast_messages, message_buttons, scheduled_messages, scheduled_broadcasts,
+  scheduled_broadcast_buttons с префиксом '' у free и 'paid_' у paid);
+- аудитория задается условиями на колонки users — из них получается и SQL
+  для захвата задач, и проверка пользователя перед отправкой;
+- планировщик разбирает все воронки одним диспетчером с общими пачками,
+  арендой и параллельными воркерами.
+
+Новая воронка (trial, win-back) — новая запись в FUNNELS: таблицы для нее
+создаются по шаблону при запуске, диспетчер подхватывает ее сам. Таблицы
+free и paid создают миграции схемы (BUILTIN_FUNNELS).
+"""
+
+# Позиции колонок в строке пользователя Database.get_user
+USER_COLUMNS = {
+    'is_active': 4,
+    'bot_started': 5,
+    'has_paid': 6,
+}
+
+
+class Funnel:
+    """Описание воронки: таблицы, аудитория, формат кнопок и логов"""
+
+    def __init__(self, name, code, table_prefix, audience, broadcast_audience=None, title=None,
+                 click_type='url', step_buttons=False, broadcast_log_offset=0, log_prefix=''):
+        self.name = name
+        self.table_prefix = table_prefix
+        # Код воронки в подписанных ссылках /r/{token} (1 байт)
+        self.code = code
+        self.title = title or name
+        # Тип нажатия URL-кнопки в button_clicks
+        self.click_type = click_type
+        # Callback-кнопки несут номер шага: next_msg_{user_id}_{message_number}
+        self.step_buttons = step_buttons
+        # Массовая рассылка #id пишется в доставки как -(id + offset)
+        self.broadcast_log_offset = broadcast_log_offset
+        self.log_prefix = log_prefix
+
+        self.messages_table = f"{table_prefix}broadcast_messages"
+        self.buttons_table = f"{table_prefix}message_buttons"
+        self.queue_table = f"{table_prefix}scheduled_messages"
+        self.broadcasts_table = f"{table_prefix}scheduled_broadcasts"
+        self.broadcast_buttons_table = f"{table_prefix}scheduled_broadcast_buttons"
+
+        # Условия на колонки users: {'is_active': 1, 'has_paid': 0}
+        self.audience = dict(audience)
+        self.broadcast_audience = dict(broadcast_audience or audience)
+        for conditions in (self.audience, self.broadcast_audience):
+            unknown = set(conditions) - set(USER_COLUMNS)
+            if unknown:
+                raise ValueError(f"Воронка {name}: неизвестные колонки аудитории {sorted(unknown)}")
+
+    def audience_sql(self, alias='u', broadcast=False):
+        """Условие аудитории на таблицу users с псевдонимом alias"""
+        conditions = self.broadcast_audience if broadcast else self.audience
+        return ' AND '.join(f"{alias}.{column} = {int(value)}" for column, value in conditions.items())
+
+    def accepts(self, user):
+        """Подходит ли пользователь под аудиторию воронки: строка get_user или UserState"""
+        if not user:
+            return False
+        if isinstance(user, (tuple, list)):
+            return all(bool(user[USER_COLUMNS[column]]) == bool(value) for column, value in self.audience.items())
+        return all(bool(getattr(user, column)) == bool(value) for column, value in self.audience.items())
+
+    def __repr__(self):
+        return f"Funnel({self.name!r})"
+
+
+# Воронки, таблицы которых создают миграции схемы
+BUILTIN_FUNNELS = ('free', 'paid')
+
+FUNNELS = {funnel.name: funnel for funnel in (
+    Funnel(
+        'free', code=0, table_prefix='',
+        audience={'is_active': 1, 'bot_started': 1, 'has_paid': 0},
+        broadcast_audience={'is_active': 1, 'bot_started': 1},
+        title='воронка', click_type='url', step_buttons=True,
+    ),
+    Funnel(
+        'paid', code=1, table_prefix='paid_',
+        audience={'is_active': 1, 'has_paid': 1},
+        title='платная воронка', click_type='paid_url', broadcast_log_offset=10000, log_prefix='💰 ',
+    ),
+)}
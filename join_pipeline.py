@@ -0,0 +1,216 @@
+"""
+Обработка заявок на вступление в канал пачками
+
+Раньше каждая заявка обрабатывалась целиком внутри своего апдейта:
+approve(), запись пользователя, чтение приветствия и кнопок из БД, отправка.
+Промо, которое приводит тысячи заявок за минуту, выстраивало все это в
+очередь по одной заявке.
+
+Теперь обработчик апдейта только ставит заявку в очередь, а воркер
+разбирает ее пачками по стадиям:
+
+1. approve — все заявки пачки одобряются параллельно под общим лимитом
+   скорости (JOIN_RATE_PER_SECOND, по умолчанию 25 запросов к API в секунду);
+2. upsert — одобренные пользователи записываются одной транзакцией;
+3. welcome — приветствие рассылается параллельно под тем же лимитом.
+   Текст, фото и клавиатура берутся из готового приветствия в памяти,
+   клавиатура собирается один раз на версию приветствия.
+
+По каждой стадии считаются количество, среднее и максимальное время — они
+видны в /health.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+from telegram.error import Forbidden, RetryAfter
+
+from broadcast_jobs import RateLimiter
+from log_pipeline import recipient
+
+logger = logging.getLogger(__name__)
+
+# Клавиатура приветствия, если админ не настроил свои кнопки
+DEFAULT_WELCOME_BUTTONS = (
+    "✅ Согласиться на получение уведомлений",
+    "📋 Что я буду получать?",
+    "ℹ️ Подробнее о боте",
+)
+
+
+class StageMetrics:
+    """Время одной стадии: количество, сумма и максимум"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, ok=True):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_seconds / self.count * 1000, 2) if self.count else 0.0,
+            'max_ms': round(self.max_seconds * 1000, 2),
+        }
+
+
+class JoinPipeline:
+    """Очередь заявок на вступление: approve, запись и приветствие пачками"""
+
+    # Сколько заявок обрабатывается за один проход
+    BATCH_SIZE = 200
+    # Сколько секунд ждать остальные заявки пачки после первой
+    FLUSH_INTERVAL = 0.05
+    STAGES = ('queue_wait', 'approve', 'upsert', 'welcome')
+
+    def __init__(self, db, personalize, rate_per_second=None, batch_size=None, flush_interval=None):
+        self.db = db
+        # personalize(text, user) — подстановка {username}/{first_name}/{last_name}
+        self.personalize = personalize
+        rate = rate_per_second or float(os.environ.get('JOIN_RATE_PER_SECOND', '25'))
+        self.rate_limiter = RateLimiter(rate)
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.flush_interval = self.FLUSH_INTERVAL if flush_interval is None else flush_interval
+
+        self.metrics = {stage: StageMetrics() for stage in self.STAGES}
+        self.batches = 0
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self._welcome_markup = (None, None)  # (версия приветствия, клавиатура)
+
+    async def submit(self, join_request, bot):
+        """Поставить заявку в очередь; обработчик апдейта не ждет ее обработки"""
+        self._queue.put_nowait((join_request, bot, time.perf_counter()))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def drain(self):
+        """Дождаться обработки всех поставленных заявок"""
+        await self._queue.join()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self.flush_interval and self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                await self.process_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка при обработке пачки из {len(batch)} заявок: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def process_batch(self, batch):
+        """Обработать пачку [(join_request, bot, время постановки в очередь)]"""
+        self.batches += 1
+        now = time.perf_counter()
+        for join_request, bot, queued_at in batch:
+            self.metrics['queue_wait'].record(now - queued_at)
+
+        approved = await asyncio.gather(*(self._approve(join_request) for join_request, bot, queued_at in batch))
+        batch = [item for item, ok in zip(batch, approved) if ok]
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        users = [(request.from_user.id, request.from_user.username, request.from_user.first_name)
+                 for request, bot, queued_at in batch]
+        added = await asyncio.to_thread(self.db.add_users_batch, users)
+        self.metrics['upsert'].record(time.perf_counter() - started, ok=added == len(users))
+        logger.info(f"✅ Одобрено и добавлено в базу заявок: {added} из {len(users)}")
+
+        version, text, photo, buttons = await asyncio.to_thread(self.db.get_prepared_welcome)
+        reply_markup = self._get_welcome_markup(version, buttons)
+        await asyncio.gather(*(
+            self._send_welcome(bot, request.from_user, text, photo, reply_markup)
+            for request, bot, queued_at in batch
+        ))
+
+    def _get_welcome_markup(self, version, buttons):
+        """Клавиатура приветствия: собирается один раз на версию приветствия"""
+        cached_version, markup = self._welcome_markup
+        if markup is None or cached_version != version:
+            markup = ReplyKeyboardMarkup(
+                [[KeyboardButton(button_text)] for button_text in buttons or DEFAULT_WELCOME_BUTTONS],
+                resize_keyboard=True,
+                one_time_keyboard=True,
+                input_field_placeholder="Выберите действие...",
+            )
+            self._welcome_markup = (version, markup)
+        return markup
+
+    async def _call_api(self, call):
+        """Вызов Bot API под лимитом скорости; на RetryAfter ждем и повторяем один раз"""
+        await self.rate_limiter.acquire()
+        try:
+            return await call()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning("⚠️ Telegram просит подождать %s сек (заявки на вступление)", retry_after)
+            await self.rate_limiter.penalize(retry_after)
+            await self.rate_limiter.acquire()
+            return await call()
+
+    async def _approve(self, join_request):
+        user = join_request.from_user
+        started = time.perf_counter()
+        try:
+            await self._call_api(join_request.approve)
+        except Exception as e:
+            self.metrics['approve'].record(time.perf_counter() - started, ok=False)
+            logger.error("❌ Ошибка при обработке заявки от %s: %s", user.id, e, extra=recipient(user.id, queue='join'))
+            return False
+        self.metrics['approve'].record(time.perf_counter() - started)
+        logger.info("✅ Одобрена заявка от пользователя %s (@%s)", user.id, user.username,
+                    extra=recipient(user.id, queue='join'))
+        return True
+
+    async def _send_welcome(self, bot, user, text, photo, reply_markup):
+        welcome_text = self.personalize(text, user)
+        started = time.perf_counter()
+        try:
+            if photo:
+                await self._call_api(lambda: bot.send_photo(
+                    chat_id=user.id, photo=photo, caption=welcome_text,
+                    parse_mode='HTML', reply_markup=reply_markup,
+                ))
+            else:
+                await self._call_api(lambda: bot.send_message(
+                    chat_id=user.id, text=welcome_text,
+                    parse_mode='HTML', reply_markup=reply_markup,
+                ))
+        except Forbidden:
+            self.metrics['welcome'].record(time.perf_counter() - started, ok=False)
+            logger.warning("⚠️ Не удалось отправить приветственное сообщение пользователю %s: пользователь не начал диалог с ботом",
+                           user.id, extra=recipient(user.id, queue='join'))
+        except Exception as e:
+            self.metrics['welcome'].record(time.perf_counter() - started, ok=False)
+            logger.error("❌ Не удалось отправить приветственное сообщение пользователю %s: %s", user.id, e,
+                         extra=recipient(user.id, queue='join'))
+        else:
+            self.metrics['welcome'].record(time.perf_counter() - started)
+            logger.info("✅ Персонализированное приветственное сообщение отправлено пользователю %s", user.id,
+                        extra=recipient(user.id, queue='join'))
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'stages': {stage: metrics.as_dict() for stage, metrics in self.metrics.items()},
+        }
@@ -0,0 +1,114 @@
+"""
+Сглаживание нагрузки воронки: календарь емкости по минутам
+
+Все, кто пришел в канал во время промо, получают шаг воронки ровно через
+join + delay_hours. Через N часов очередь получает всплеск, который тик
+send_scheduled_messages проталкивает подряд, а соседние часы простаивают.
+
+С FUNNEL_SEND_BUDGET=<отправок в минуту> при планировании каждое сообщение
+ставится в ближайшую к своему времени минуту, где бюджет еще не выбран,
+в пределах окна ±FUNNEL_JITTER_MINUTES (по умолчанию 30). Если свободной
+минуты в окне нет, сообщение остается на своем времени.
+
+Загрузка минут считается по самим очередям — неотправленным строкам
+очередей всех воронок (funnels.FUNNELS) и следующим шагам курсоров —
+по индексам (is_sent, scheduled_time) и (funnel, next_due_at). Отдельной
+таблицы бронирований, которую пришлось бы чистить после досрочной отправки
+или отмены сообщений, нет.
+
+Без бюджета сглаживание выключено, прогноз загрузки на 24 часа в админке
+работает всегда.
+"""
+
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class SendCalendar:
+    """Бюджет отправок на минуту и выбор ближайшей свободной минуты"""
+
+    SLOT_SECONDS = 60
+
+    def __init__(self, db, budget_per_minute=0, jitter_minutes=30):
+        self.db = db
+        self.budget = max(0, int(budget_per_minute or 0))
+        self.jitter_minutes = max(0, int(jitter_minutes))
+        # Счетчики с момента запуска: сдвинуто сообщений и не нашлось свободной минуты
+        self.shifted = 0
+        self.overflow = 0
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            budget_per_minute=int(os.environ.get('FUNNEL_SEND_BUDGET', '0')),
+            jitter_minutes=int(os.environ.get('FUNNEL_JITTER_MINUTES', '30')),
+        )
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def assign(self, due_times, now=None):
+        """Времена отправки с учетом бюджета: [datetime] -> [datetime] в том же порядке"""
+        due_times = list(due_times)
+        if not self.enabled or not due_times:
+            return due_times
+
+        now = now or datetime.now()
+        first_slot = int(now.timestamp()) // self.SLOT_SECONDS
+        due_epochs = [int(due_time.timestamp()) for due_time in due_times]
+        windows = [
+            (max(first_slot, due_epoch // self.SLOT_SECONDS - self.jitter_minutes) * self.SLOT_SECONDS,
+             (due_epoch // self.SLOT_SECONDS + self.jitter_minutes + 1) * self.SLOT_SECONDS)
+            for due_epoch in due_epochs
+        ]
+        load = self.db.get_send_load(windows)
+
+        assigned = []
+        for due_time, due_epoch in zip(due_times, due_epochs):
+            due_slot = due_epoch // self.SLOT_SECONDS
+            slot = self._nearest_free_slot(load, due_slot, first_slot)
+            if slot is None:
+                self.overflow += 1
+                slot = due_slot
+                logger.debug(f"📈 Нет свободной минуты в окне ±{self.jitter_minutes} мин для {due_time}, оставляем как есть")
+            elif slot != due_slot:
+                self.shifted += 1
+                due_time = datetime.fromtimestamp(slot * self.SLOT_SECONDS + due_epoch % self.SLOT_SECONDS)
+            load[slot] = load.get(slot, 0) + 1
+            assigned.append(due_time)
+        return assigned
+
+    def _nearest_free_slot(self, load, due_slot, first_slot):
+        """Ближайшая к due_slot минута с остатком бюджета: 0, +1, -1, +2, -2, ..."""
+        for distance in range(self.jitter_minutes + 1):
+            for slot in (due_slot + distance, due_slot - distance) if distance else (due_slot,):
+                if slot >= first_slot and load.get(slot, 0) < self.budget:
+                    return slot
+        return None
+
+    def projected_load(self, hours=24, now=None):
+        """Прогноз отправок по часам: [(начало часа, всего, пик в минуту, минут сверх бюджета)]"""
+        now = now or datetime.now()
+        first_slot = int(now.timestamp()) // self.SLOT_SECONDS
+        load = self.db.get_send_load([(first_slot * self.SLOT_SECONDS, (first_slot + hours * 60) * self.SLOT_SECONDS)])
+
+        projection = []
+        for hour in range(hours):
+            hour_start = first_slot + hour * 60
+            minutes = [load.get(slot, 0) for slot in range(hour_start, hour_start + 60)]
+            over_budget = sum(1 for sends in minutes if sends > self.budget) if self.enabled else 0
+            projection.append((datetime.fromtimestamp(hour_start * self.SLOT_SECONDS), sum(minutes), max(minutes), over_budget))
+        return projection
+
+    def stats(self):
+        return {
+            'budget_per_minute': self.budget,
+            'jitter_minutes': self.jitter_minutes,
+            'shifted': self.shifted,
+            'overflow': self.overflow,
+        }
@@ -0,0 +1,173 @@
+"""
+Неблокирующее логирование для горячих циклов рассылок
+
+Раньше каждая строка лога форматировалась и писалась в stdout прямо в потоке
+event loop. Теперь:
+
+- корневой логгер пишет в QueueHandler: вызов logger.info только кладет
+  запись в очередь, форматирование и запись в stdout делает отдельный поток
+  QueueListener;
+- сообщение собирается лениво — logger.info("... %s", user_id) не строит
+  строку, если уровень отключен или запись отброшена семплированием;
+- записи о конкретном получателе (extra с user_id) ограничиваются по скорости:
+  не больше LOG_RECIPIENT_LINES_PER_SECOND строк в секунду на каждый шаблон
+  сообщения. Сколько строк пропущено, видно в следующей прошедшей записи.
+  Предупреждения и ошибки не семплируются никогда;
+- LOG_FORMAT=json печатает записи одной строкой JSON со стабильными полями
+  user_id, message_number, queue и latency_ms — их можно фильтровать в
+  агрегаторе логов, не разбирая текст.
+
+Переменные окружения: LOG_LEVEL (INFO), LOG_FORMAT (text | json),
+LOG_RECIPIENT_LINES_PER_SECOND (20, 0 — без ограничения).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Поля записи, которые попадают в JSON, если переданы через extra
+STRUCTURED_FIELDS = ('user_id', 'message_number', 'queue', 'latency_ms')
+
+
+def recipient(user_id, message_number=None, queue=None, latency_ms=None):
+    """extra для строки лога о конкретном получателе"""
+    extra = {'user_id': user_id}
+    if message_number is not None:
+        extra['message_number'] = message_number
+    if queue is not None:
+        extra['queue'] = queue
+    if latency_ms is not None:
+        extra['latency_ms'] = round(latency_ms, 1)
+    return extra
+
+
+class RecipientSampler(logging.Filter):
+    """Ограничение скорости строк о получателях: per_second на шаблон сообщения
+
+    Шаблон — это record.msg до подстановки аргументов, поэтому все
+    "✅ Отправлено сообщение %s пользователю %s" считаются одним потоком строк.
+    """
+
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self._buckets = {}  # (логгер, шаблон) -> [секунда, пропущено в ней, пропущено всего]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not hasattr(record, 'user_id'):
+            return True
+
+        second = int(time.monotonic())
+        key = (record.name, record.msg)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [second, 0, 0]
+            if bucket[0] != second:
+                bucket[0], bucket[1] = second, 0
+            bucket[1] += 1
+            if bucket[1] > self.per_second:
+                bucket[2] += 1
+                return False
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке
+
+    Стандартный prepare() собирает сообщение до постановки в очередь, то есть
+    все равно в event loop. Аргументы записей в боте — числа, строки и
+    исключения, их безопасно отдать потоку записи как есть.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """QueueListener, который можно остановить повторно (atexit после явного stop)"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            line += f" (+{suppressed} похожих строк пропущено)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=None, fmt=None, per_second=None, stream=None):
+    """Настроить корневой логгер: очередь в event loop, запись в отдельном потоке
+
+    Возвращает запущенный QueueListener; при выходе процесса он
+    останавливается сам и дописывает оставшиеся в очереди записи.
+    """
+    level = level or os.environ.get('LOG_LEVEL', 'INFO').upper()
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'text')
+    if per_second is None:
+        per_second = int(os.environ.get('LOG_RECIPIENT_LINES_PER_SECOND', '20'))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    if per_second > 0:
+        queue_handler.addFilter(RecipientSampler(per_second))
+
+    # Поток и процесс в форматы не попадают — не собираем их в каждую запись
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = _QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -8,21 +8,16 @@ from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatJoinRequest, ChatMemberUpdated, Message, Chat, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, Bot
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, ChatJoinRequestHandler, MessageHandler, filters, ChatMemberHandler
 from telegram.error import Forbidden, BadRequest
-from database import Database
-from admin import AdminPanel
-from scheduler import MessageScheduler
+from click_tracking import ClickTracker
+from join_pipeline import JoinPipeline
+from log_pipeline import setup_logging
+from tenants import Tenant, TenantHost, load_tenants
 from aiohttp import web, ClientSession
 import threading
 import pytz
 
-# Настройка логирования для Render
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Настройка логирования для Render: запись в stdout в отдельном потоке (см. log_pipeline)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Отключаем избыточные логи для чистоты
@@ -40,16 +35,11 @@ if ',' in admin_ids_str:
 else:
     ADMIN_CHAT_IDS = [int(admin_ids_str)]
 
-# Для обратной совместимости (если AdminPanel требует одно значение)
-ADMIN_CHAT_ID = ADMIN_CHAT_IDS[0]
-
-# Функция-помощник для проверки прав админа
-def is_admin(user_id: int) -> bool:
-    """Проверяет, является ли пользователь администратором"""
-    return user_id in ADMIN_CHAT_IDS
-
 CHANNEL_ID = os.environ.get('CHANNEL_ID')
 
+# Мультиарендный режим: JSON-файл со списком ботов вместо BOT_TOKEN/ADMIN_CHAT_ID/CHANNEL_ID
+TENANTS_CONFIG = os.environ.get('TENANTS_CONFIG')
+
 # Настройки для Render
 RENDER_PORT = int(os.environ.get('PORT', '10000'))
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
@@ -59,17 +49,22 @@ USE_WEBHOOK = os.environ.get('USE_WEBHOOK', 'true').lower() == 'true'
 RENDER_DISK_PATH = os.environ.get('RENDER_DISK_PATH', '/data')
 
 # Проверка обязательных переменных
-if not BOT_TOKEN:
-    logger.error("❌ BOT_TOKEN не установлен!")
-    raise ValueError("BOT_TOKEN не установлен в переменных окружения")
+if TENANTS_CONFIG:
+    if not USE_WEBHOOK:
+        logger.error("❌ Мультиарендный режим работает только через webhook!")
+        raise ValueError("TENANTS_CONFIG требует USE_WEBHOOK=true")
+else:
+    if not BOT_TOKEN:
+        logger.error("❌ BOT_TOKEN не установлен!")
+        raise ValueError("BOT_TOKEN не установлен в переменных окружения")
 
-if not ADMIN_CHAT_IDS or ADMIN_CHAT_IDS[0] == 0:
-    logger.error("❌ ADMIN_CHAT_ID не установлен!")
-    raise ValueError("ADMIN_CHAT_ID не установлен в переменных окружения")
+    if not ADMIN_CHAT_IDS or ADMIN_CHAT_IDS[0] == 0:
+        logger.error("❌ ADMIN_CHAT_ID не установлен!")
+        raise ValueError("ADMIN_CHAT_ID не установлен в переменных окружения")
 
-if not CHANNEL_ID:
-    logger.error("❌ CHANNEL_ID не установлен!")
-    raise ValueError("CHANNEL_ID не установлен в переменных окружения")
+    if not CHANNEL_ID:
+        logger.error("❌ CHANNEL_ID не установлен!")
+        raise ValueError("CHANNEL_ID не установлен в переменных окружения")
 
 if USE_WEBHOOK and not WEBHOOK_URL:
     logger.error("❌ WEBHOOK_URL не установлен для режима webhook!")
@@ -80,35 +75,48 @@ logger.info(f"🚀 Конфигурация для Render:")
 logger.info(f"   🌐 aiohttp порт: {RENDER_PORT}")
 logger.info(f"   📱 Webhook URL: {WEBHOOK_URL}")
 logger.info(f"   💾 Render Disk: {RENDER_DISK_PATH}")
-logger.info(f"   👤 Admin IDs: {ADMIN_CHAT_IDS}")
-logger.info(f"   📢 Channel: {CHANNEL_ID}")
+if TENANTS_CONFIG:
+    logger.info(f"   🏢 Арендаторы: {TENANTS_CONFIG}")
+else:
+    logger.info(f"   👤 Admin IDs: {ADMIN_CHAT_IDS}")
+    logger.info(f"   📢 Channel: {CHANNEL_ID}")
 
 # ===== ИНИЦИАЛИЗАЦИЯ КОМПОНЕНТОВ =====
-# Создаём базу данных с учётом Render Disk
+# Каждый бот (арендатор) — своя БД, планировщик и админ-панель
 try:
-    if RENDER_DISK_PATH:
-        logger.info(f"🗄️ Используем Render Disk для базы данных: {RENDER_DISK_PATH}")
-        os.environ['RENDER_DISK_PATH'] = RENDER_DISK_PATH  # Устанавливаем переменную для Database
-        db = Database()
+    if TENANTS_CONFIG:
+        tenants = load_tenants(TENANTS_CONFIG, RENDER_DISK_PATH, WEBHOOK_URL)
     else:
-        logger.warning("⚠️ RENDER_DISK_PATH не настроен, используем локальное хранилище")
-        db = Database()
+        if RENDER_DISK_PATH:
+            logger.info(f"🗄️ Используем Render Disk для базы данных: {RENDER_DISK_PATH}")
+            os.environ['RENDER_DISK_PATH'] = RENDER_DISK_PATH  # Устанавливаем переменную для Database
+        else:
+            logger.warning("⚠️ RENDER_DISK_PATH не настроен, используем локальное хранилище")
+        tenants = [Tenant('main', BOT_TOKEN, CHANNEL_ID, ADMIN_CHAT_IDS, webhook_url=WEBHOOK_URL)]
     
-    # Выводим информацию о базе данных
-    db_info = db.get_database_info()
-    logger.info(f"📊 База данных: {db_info}")
+    # Полная диагностика (integrity_check, подсчет записей) не блокирует старт:
+    # она запускается фоновой задачей после запуска бота
+    for tenant in tenants:
+        logger.info(f"📊 [{tenant.name}] База данных: {tenant.db.db_path}, версия схемы {tenant.db.schema_version}")
     
 except Exception as e:
     logger.error(f"❌ Критическая ошибка инициализации базы данных: {e}")
     raise
 
-# Инициализируем остальные компоненты
-admin_panel = AdminPanel(db, ADMIN_CHAT_ID)
-scheduler = MessageScheduler(db)
+host = TenantHost(tenants)
+
+# Префикс маршрутов платежей, тестов и редиректов: /t/{tenant} в мультиарендном режиме
+ROUTE_PREFIX = '/t/{tenant}' if host.multi_tenant else ''
+
+def get_tenant(context: ContextTypes.DEFAULT_TYPE):
+    """Бот (арендатор), которому пришло обновление"""
+    return context.application.bot_data['tenant']
 
-# Глобальные переменные для интеграции
-bot_application = None
-bot_instance = None
+def request_tenant(request):
+    """Бот (арендатор) HTTP-запроса: по /t/{tenant} или единственный бот"""
+    if host.multi_tenant:
+        return host.by_name(request.match_info['tenant'])
+    return host.default
 
 # ===== ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ДЛЯ ПЕРСОНАЛИЗАЦИИ =====
 def personalize_message(text: str, user) -> str:
@@ -141,7 +149,11 @@ def personalize_message(text: str, user) -> str:
 app = web.Application()
 
 async def telegram_webhook(request):
-    """Обработка Telegram webhook через aiohttp"""
+    """Обработка Telegram webhook через aiohttp: бот определяется по токену в пути"""
+    tenant = host.by_token(request.match_info['token'])
+    if tenant is None or tenant.application is None:
+        return web.json_response({'ok': False}, status=404)
+    
     try:
         # Получаем данные от Telegram
         update_data = await request.json()
@@ -153,22 +165,27 @@ async def telegram_webhook(request):
         logger.debug(f"📱 Получен Telegram update: {update_data.get('update_id')}")
         
         # Создаем Update объект и обрабатываем его асинхронно
-        update = Update.de_json(update_data, bot_instance)
+        update = Update.de_json(update_data, tenant.bot)
         
         # Обрабатываем update напрямую в текущем event loop
-        if bot_application:
-            await bot_application.process_update(update)
+        await tenant.application.process_update(update)
+        tenant.metrics.record_update()
         
         logger.debug(f"✅ Update {update_data.get('update_id')} обработан успешно")
         
         return web.json_response({'ok': True})
         
     except Exception as e:
-        logger.error(f"❌ Ошибка в Telegram webhook: {e}", exc_info=True)
+        tenant.metrics.record_update(ok=False)
+        logger.error(f"❌ [{tenant.name}] Ошибка в Telegram webhook: {e}", exc_info=True)
         return web.json_response({'error': str(e)}, status=500)
 
 async def payment_webhook(request):
     """Обработка Payment webhook"""
+    tenant = request_tenant(request)
+    if tenant is None:
+        return web.json_response({'error': 'Unknown tenant'}, status=404)
+    
     try:
         # Получаем платежные данные
         payment_data = await request.json()
@@ -212,14 +229,14 @@ async def payment_webhook(request):
             return web.json_response({'error': 'Invalid payment_status'}, status=400)
         
         # Проверяем, существует ли пользователь
-        user = db.get_user(user_id)
+        user = tenant.db.get_user_state(user_id)
         if not user:
             logger.error(f"❌ Пользователь {user_id} не найден")
             return web.json_response({'error': 'User not found'}, status=404)
         
         # Обрабатываем только успешные платежи
         if payment_status == 'success':
-            success = await handle_successful_payment(user_id, amount, payment_data)
+            success = await handle_successful_payment(tenant, user_id, amount, payment_data)
             
             if success:
                 logger.info(f"✅ Успешно обработан платеж для пользователя {user_id}")
@@ -233,7 +250,7 @@ async def payment_webhook(request):
                 return web.json_response({'error': 'Payment processing failed'}, status=500)
         else:
             # Логируем неуспешные платежи
-            db.log_payment(user_id, amount, payment_status, payment_data.get('utm_source'), payment_data.get('utm_id'))
+            tenant.db.log_payment(user_id, amount, payment_status, payment_data.get('utm_source'), payment_data.get('utm_id'))
             logger.info(f"📝 Зафиксирован неуспешный платеж: {payment_status} для пользователя {user_id}")
             return web.json_response({
                 'status': 'logged',
@@ -247,24 +264,38 @@ async def payment_webhook(request):
 async def health_check(request):
     """Health check endpoint с подробной диагностикой"""
     try:
-        # Получаем информацию о базе данных
-        db_info = db.get_database_info()
+        # Легкая информация о БД + результат последней фоновой диагностики каждого бота
+        tenants_info = {}
+        for tenant in host.tenants:
+            db_info = tenant.db.get_database_info()
+            db_info['diagnostics'] = tenant.db.last_diagnostics
+            tenants_info[tenant.name] = {
+                'bot_running': tenant.bot is not None,
+                'database': db_info,
+                'metrics': tenant.metrics.as_dict(),
+                'admin_routes': tenant.admin_panel.callback_router.stats(limit=10),
+                'user_state_cache': tenant.db.user_states.stats(),
+                'join_pipeline': tenant.join_pipeline.stats() if tenant.join_pipeline else None
+            }
         
         health_data = {
             'status': 'ok',
             'timestamp': datetime.now().isoformat(),
             'service': 'telegram_bot',
-            'telegram_webhook': f'/bot{BOT_TOKEN}',
-            'payment_webhook': '/webhook/payment',
-            'test_expired_subscriptions': '/test/expired-subscriptions',
-            'test_setup_user': '/test/setup-user',
-            'bot_running': bot_instance is not None,
+            'telegram_webhook': '/bot{token}',
+            'payment_webhook': f'{ROUTE_PREFIX}/webhook/payment',
+            'test_expired_subscriptions': f'{ROUTE_PREFIX}/test/expired-subscriptions',
+            'test_setup_user': f'{ROUTE_PREFIX}/test/setup-user',
+            'bot_running': all(info['bot_running'] for info in tenants_info.values()),
             'aiohttp_port': RENDER_PORT,
-            'database': db_info,
+            'tenants': tenants_info,
+            'telegram_transport': host.transport_metrics(),
             'render_disk_configured': RENDER_DISK_PATH is not None,
             'render_disk_path': RENDER_DISK_PATH,
             'webhook_url': WEBHOOK_URL
         }
+        if host.default:
+            health_data['database'] = tenants_info[host.default.name]['database']
         
         return web.json_response(health_data)
         
@@ -278,15 +309,13 @@ async def health_check(request):
 
 async def test_expired_subscriptions(request):
     """Тестовый эндпоинт для проверки истекших подписок"""
+    tenant = request_tenant(request)
+    if tenant is None:
+        return web.json_response({'status': 'error', 'message': 'Unknown tenant'}, status=404)
+    
     try:
-        if bot_application and bot_application.job_queue:
-            # Создаем простой контекст
-            class SimpleContext:
-                def __init__(self, bot):
-                    self.bot = bot
-                    
-            context = SimpleContext(bot_instance)
-            await scheduler.check_expired_subscriptions(context)
+        if tenant.bot:
+            await tenant.scheduler.check_expired_subscriptions(tenant.context())
             
             return web.json_response({
                 'status': 'success',
@@ -307,6 +336,10 @@ async def test_expired_subscriptions(request):
 
 async def setup_test_user(request):
     """Тестовый эндпоинт для настройки тестового пользователя"""
+    tenant = request_tenant(request)
+    if tenant is None:
+        return web.json_response({'status': 'error', 'message': 'Unknown tenant'}, status=404)
+    
     try:
         data = await request.json()
         user_id = data.get('user_id')
@@ -324,7 +357,7 @@ async def setup_test_user(request):
         today = date.today().strftime('%Y-%m-%d')
         
         # Устанавливаем пользователя как оплатившего с истекающей сегодня подпиской
-        success = db.mark_user_paid(user_id, "999", "success", today)
+        success = tenant.db.mark_user_paid(user_id, "999", "success", today)
         
         if success:
             logger.info(f"🧪 Установлены тестовые данные для пользователя {user_id}: подписка до {today}")
@@ -347,7 +380,7 @@ async def setup_test_user(request):
             'error': str(e)
         }, status=500)
 
-async def handle_successful_payment(user_id: int, amount: str, webhook_data: dict) -> bool:
+async def handle_successful_payment(tenant, user_id: int, amount: str, webhook_data: dict) -> bool:
     """Асинхронная обработка успешного платежа"""
     try:
         # Получаем payed_till из webhook данных
@@ -359,27 +392,21 @@ async def handle_successful_payment(user_id: int, amount: str, webhook_data: dic
         utm_id = webhook_data.get('utm_id', '')
         
         # Отмечаем пользователя как оплатившего
-        success = db.mark_user_paid(user_id, amount, 'success', payed_till)
+        success = tenant.db.mark_user_paid(user_id, amount, 'success', payed_till)
         if not success:
             logger.error(f"❌ Не удалось отметить пользователя {user_id} как оплатившего")
             return False
         
         # Логируем платеж
-        db.log_payment(user_id, amount, 'success', utm_source, utm_id)
+        tenant.db.log_payment(user_id, amount, 'success', utm_source, utm_id)
         
         # Отменяем оставшиеся запланированные сообщения (обычной рассылки)
-        cancelled_count = db.cancel_remaining_messages(user_id)
+        cancelled_count = tenant.db.cancel_remaining_messages(user_id)
         logger.info(f"🚫 Отменено {cancelled_count} запланированных сообщений обычной рассылки для пользователя {user_id}")
         
         # ИСПРАВЛЕНО: Планируем сообщения для оплативших пользователей
-        if bot_application and bot_application.job_queue:
-            # Создаем простой контекст без create_context
-            class SimpleContext:
-                def __init__(self, bot):
-                    self.bot = bot
-                    
-            context = SimpleContext(bot_instance)
-            paid_schedule_success = await scheduler.schedule_paid_user_messages(context, user_id)
+        if tenant.bot:
+            paid_schedule_success = await tenant.scheduler.schedule_paid_user_messages(tenant.context(), user_id)
             
             if paid_schedule_success:
                 logger.info(f"✅ Запланированы сообщения для оплатившего пользователя {user_id}")
@@ -389,8 +416,8 @@ async def handle_successful_payment(user_id: int, amount: str, webhook_data: dic
             logger.warning("⚠️ Bot application не доступен для планирования платных сообщений")
         
         # Отправляем уведомление об успешной оплате
-        if bot_instance:
-            await send_payment_success_notification(user_id, amount)
+        if tenant.bot:
+            await send_payment_success_notification(tenant, user_id, amount)
         else:
             logger.warning("⚠️ Bot не инициализирован, не удалось отправить уведомление")
         
@@ -400,11 +427,11 @@ async def handle_successful_payment(user_id: int, amount: str, webhook_data: dic
         logger.error(f"❌ Ошибка при обработке успешного платежа для пользователя {user_id}: {e}")
         return False
 
-async def send_payment_success_notification(user_id: int, amount: str):
+async def send_payment_success_notification(tenant, user_id: int, amount: str):
     """Отправка уведомления об успешной оплате"""
     try:
         # Получаем настроенное сообщение
-        message_data = db.get_payment_success_message()
+        message_data = tenant.db.get_payment_success_message()
         
         if not message_data or not message_data.get('text'):
             # Сообщение по умолчанию
@@ -422,14 +449,14 @@ async def send_payment_success_notification(user_id: int, amount: str):
         
         # Отправляем сообщение
         if photo_url:
-            await bot_instance.send_photo(
+            await tenant.bot.send_photo(
                 chat_id=user_id,
                 photo=photo_url,
                 caption=message_text,
                 parse_mode='HTML'
             )
         else:
-            await bot_instance.send_message(
+            await tenant.bot.send_message(
                 chat_id=user_id,
                 text=message_text,
                 parse_mode='HTML'
@@ -440,12 +467,20 @@ async def send_payment_success_notification(user_id: int, amount: str):
     except Exception as e:
         logger.error(f"❌ Ошибка при отправке уведомления об оплате пользователю {user_id}: {e}")
 
+async def click_redirect(request):
+    """Редирект по ссылке URL-кнопки с учетом клика в БД своего бота"""
+    tenant = request_tenant(request)
+    if tenant is None:
+        return web.Response(text='Ссылка недействительна', status=404)
+    return await tenant.click_redirect(request)
+
 # ===== НАСТРОЙКА МАРШРУТОВ =====
-app.router.add_post(f'/bot{BOT_TOKEN}', telegram_webhook)
-app.router.add_post('/webhook/payment', payment_webhook)
+app.router.add_post('/bot{token}', telegram_webhook)
+app.router.add_post(f'{ROUTE_PREFIX}/webhook/payment', payment_webhook)
 app.router.add_get('/health', health_check)
-app.router.add_post('/test/expired-subscriptions', test_expired_subscriptions)
-app.router.add_post('/test/setup-user', setup_test_user)
+app.router.add_get(f'{ROUTE_PREFIX}{ClickTracker.ROUTE}', click_redirect)
+app.router.add_post(f'{ROUTE_PREFIX}/test/expired-subscriptions', test_expired_subscriptions)
+app.router.add_post(f'{ROUTE_PREFIX}/test/setup-user', setup_test_user)
 
 # ===== КОНСТАНТЫ ДЛЯ CALLBACK ДАННЫХ =====
 CALLBACK_USER_CONSENT = "user_consent"
@@ -469,7 +504,7 @@ class CallbackHandler:
             logger.info(f"🚀 Выполняем логику /start для пользователя {user_id}")
             
             # Шаг 1: Помечаем пользователя как начавшего разговор с ботом
-            mark_success = db.mark_user_started_bot(user_id)
+            mark_success = self.db.mark_user_started_bot(user_id)
             if not mark_success:
                 logger.error(f"❌ Не удалось пометить пользователя {user_id} как начавшего разговор")
                 return False
@@ -478,7 +513,7 @@ class CallbackHandler:
             await asyncio.sleep(0.1)
             
             # Шаг 2: Планируем сообщения рассылки
-            schedule_success = await scheduler.schedule_user_messages(context, user_id)
+            schedule_success = await self.scheduler.schedule_user_messages(context, user_id)
             if not schedule_success:
                 logger.error(f"❌ Не удалось запланировать сообщения для пользователя {user_id}")
                 return False
@@ -548,33 +583,31 @@ class CallbackHandler:
             logger.error(f"❌ Ошибка при обработке механической кнопки для пользователя {user_id}: {e}")
             return False
 
-# Создаем глобальный экземпляр callback handler
-callback_handler = CallbackHandler(db, scheduler)
-
 # ===== TELEGRAM BOT HANDLERS =====
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # ОБНОВЛЕНО: Проверяем, является ли пользователь админом
-    if is_admin(user.id):
-        await admin_panel.show_main_menu(update, context)
+    if tenant.is_admin(user.id):
+        await tenant.admin_panel.show_main_menu(update, context)
         return
     
     # Для обычных пользователей выполняем логику подписки
     logger.info(f"📋 Обработка команды /start для пользователя {user.id}")
-    success = await callback_handler.execute_start_logic(user.id, context, user)
+    success = await tenant.callback_handler.execute_start_logic(user.id, context, user)
     
     if success:
         # ✅ ИСПРАВЛЕНИЕ: Проверяем статус включения сообщения подтверждения
-        if not db.is_success_message_enabled():
+        if not tenant.db.is_success_message_enabled():
             logger.info(f"ℹ️ Сообщение подтверждения выключено, ничего не отправляем пользователю {user.id}")
             return  # Просто выходим, ничего не отправляем
         
         # Получаем настраиваемое сообщение подтверждения из базы данных
         try:
-            conn = db._get_connection()
+            conn = tenant.db._get_connection()
             cursor = conn.cursor()
             cursor.execute('SELECT value FROM settings WHERE key = "success_message"')
             success_msg = cursor.fetchone()
@@ -629,90 +662,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик заявок на вступление в канал"""
-    chat_join_request = update.chat_join_request
-    user = chat_join_request.from_user
-    
-    try:
-        # Одобряем заявку
-        await chat_join_request.approve()
-        logger.info(f"✅ Одобрена заявка от пользователя {user.id} (@{user.username})")
-        
-        # Добавляем пользователя в базу данных
-        db.add_user(user.id, user.username, user.first_name)
-        
-        # Получаем приветственное сообщение от админа
-        welcome_data = db.get_welcome_message()
-        welcome_buttons = db.get_welcome_buttons()
-        
-        # Персонализируем текст приветствия
-        welcome_text = personalize_message(welcome_data['text'], user)
-        
-        # Создаем клавиатуру
-        reply_markup = None
-        
-        # Сначала проверяем, есть ли кнопки, настроенные админом
-        if welcome_buttons:
-            # Используем механические кнопки (кнопки клавиатуры)
-            keyboard = []
-            for button_id, button_text, position in welcome_buttons:
-                keyboard.append([KeyboardButton(button_text)])
-            
-            reply_markup = ReplyKeyboardMarkup(
-                keyboard, 
-                resize_keyboard=True,
-                one_time_keyboard=True,
-                input_field_placeholder="Выберите действие..."
-            )
-            logger.info(f"📱 Создана клавиатура с {len(welcome_buttons)} механическими кнопками")
-        else:
-            # Используем стандартные кнопки
-            keyboard = [
-                [KeyboardButton("✅ Согласиться на получение уведомлений")],
-                [KeyboardButton("📋 Что я буду получать?")],
-                [KeyboardButton("ℹ️ Подробнее о боте")]
-            ]
-            reply_markup = ReplyKeyboardMarkup(
-                keyboard, 
-                resize_keyboard=True,
-                one_time_keyboard=True,
-                input_field_placeholder="Выберите действие..."
-            )
-            logger.info("📱 Создана стандартная клавиатура")
-        
-        # Отправляем приветственное сообщение с персонализацией
-        try:
-            if welcome_data['photo']:
-                sent_message = await context.bot.send_photo(
-                    chat_id=user.id,
-                    photo=welcome_data['photo'],
-                    caption=welcome_text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
-            else:
-                sent_message = await context.bot.send_message(
-                    chat_id=user.id,
-                    text=welcome_text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
-            
-            logger.info(f"✅ Персонализированное приветственное сообщение отправлено пользователю {user.id}")
-            
-        except Forbidden as e:
-            logger.warning(f"⚠️ Не удалось отправить приветственное сообщение пользователю {user.id}: пользователь не начал диалог с ботом")
-            
-        except Exception as e:
-            logger.error(f"❌ Не удалось отправить приветственное сообщение пользователю {user.id}: {e}")
-        
-        logger.info(f"✅ Пользователь {user.id} добавлен в базу данных с автоматическим приветственным сообщением")
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при обработке заявки от {user.id}: {e}")
+    """Обработчик заявок на вступление в канал: заявка уходит в очередь пачечной обработки"""
+    tenant = get_tenant(context)
+    await tenant.join_pipeline.submit(update.chat_join_request, context.bot)
 
 async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик изменений статуса участника канала"""
+    tenant = get_tenant(context)
     if update.my_chat_member:
         return
     
@@ -720,7 +676,7 @@ async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     # Проверяем, что это наш канал
-    if str(update.chat_member.chat.id) != str(CHANNEL_ID) and update.chat_member.chat.username != CHANNEL_ID.replace('@', ''):
+    if not tenant.is_channel(update.chat_member.chat):
         return
     
     old_status = update.chat_member.old_chat_member.status
@@ -734,16 +690,16 @@ async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.info(f"👋 Пользователь {user.id} (@{user.username}) покинул канал")
         
         # 1. Удаляем ВСЕ запланированные сообщения
-        cancelled = db.cancel_user_messages(user.id)
+        cancelled = tenant.db.cancel_user_messages(user.id)
         logger.info(f"🗑️ Удалено {cancelled} запланированных сообщений")
         
         # 2. Деактивируем пользователя
-        db.deactivate_user(user.id)
+        tenant.db.deactivate_user(user.id)
         
         # 3. Отправляем прощальное сообщение
         # Получаем прощальное сообщение и кнопки
-        goodbye_data = db.get_goodbye_message()
-        goodbye_buttons = db.get_goodbye_buttons()
+        goodbye_data = tenant.db.get_goodbye_message()
+        goodbye_buttons = tenant.db.get_goodbye_buttons()
         
         # Персонализируем текст прощания
         goodbye_text = personalize_message(goodbye_data['text'], user)
@@ -784,10 +740,14 @@ async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_next_message_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатия кнопки 'Следующее сообщение'"""
+    tenant = get_tenant(context)
     query = update.callback_query
     
     if query.data.startswith("next_msg_"):
-        user_id = int(query.data.split("_")[2])
+        # Формат: next_msg_{user_id}_{message_number}; у старых кнопок номера шага нет
+        payload = query.data.split("_")
+        user_id = int(payload[2])
+        current_message_number = int(payload[3]) if len(payload) > 3 else None
         
         # Проверяем права
         if query.from_user.id != user_id:
@@ -796,28 +756,15 @@ async def handle_next_message_callback(update: Update, context: ContextTypes.DEF
             
         await query.answer("📩 Отправляем следующее сообщение...")
         
-        # 📊 НОВОЕ: Логируем клик по callback кнопке
-        # Нужно определить, из какого сообщения был клик
-        # Для этого получаем последнее отправленное сообщение пользователю
+        # 📊 Логируем клик по callback кнопке: номер сообщения берем из кнопки,
+        # для старых кнопок — из курсора воронки пользователя
         try:
-            # Получаем последнее отправленное (но не следующее) сообщение
-            conn = db._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT message_number 
-                FROM scheduled_messages 
-                WHERE user_id = ? AND is_sent = 1 
-                ORDER BY id DESC 
-                LIMIT 1
-            ''', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
+            if current_message_number is None:
+                funnel_cursor = tenant.db.get_funnel_cursor(user_id)
+                current_message_number = funnel_cursor[0] if funnel_cursor else None
             
-            if result:
-                current_message_number = result[0]
-                
-                # Логируем клик
-                db.log_button_click(
+            if current_message_number:
+                tenant.db.log_button_click(
                     user_id=user_id,
                     message_number=current_message_number,
                     button_id=None,  # Для callback кнопок следующего сообщения
@@ -830,7 +777,7 @@ async def handle_next_message_callback(update: Update, context: ContextTypes.DEF
             logger.error(f"❌ Ошибка при логировании клика по кнопке: {e}")
         
         # Отправляем следующее сообщение
-        success = await scheduler.send_next_scheduled_message(context, user_id)
+        success = await tenant.scheduler.send_next_scheduled_message(context, user_id, current_message_number)
         
         if not success:
             await context.bot.send_message(
@@ -840,14 +787,15 @@ async def handle_next_message_callback(update: Update, context: ContextTypes.DEF
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на инлайн-кнопки"""
+    tenant = get_tenant(context)
     query = update.callback_query
     user_id = query.from_user.id
     callback_data = query.data
     
     # ОБНОВЛЕНО: Проверяем, является ли пользователь админом
-    if is_admin(user_id):
+    if tenant.is_admin(user_id):
         await query.answer()
-        await admin_panel.handle_callback(update, context)
+        await tenant.admin_panel.handle_callback(update, context)
         return
     
     # Для остальных callback данных (старые кнопки)
@@ -893,34 +841,35 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений и нажатий на обычные кнопки"""
+    tenant = get_tenant(context)
     user_id = update.effective_user.id
     message_text = update.message.text
     
     # ОБНОВЛЕНО: Проверяем, является ли пользователь админом
-    if is_admin(user_id):
-        await admin_panel.handle_message(update, context)
+    if tenant.is_admin(user_id):
+        await tenant.admin_panel.handle_message(update, context)
         return
     
     # Сначала проверяем, является ли это кнопкой, настроенной админом
-    welcome_buttons = db.get_welcome_buttons()
+    welcome_buttons = tenant.db.get_welcome_buttons()
     admin_button_texts = [button_text for _, button_text, _ in welcome_buttons]
     
     if message_text in admin_button_texts:
         # Обрабатываем нажатие на кнопку, настроенную админом
         try:
-            success = await callback_handler.handle_welcome_button_press(
+            success = await tenant.callback_handler.handle_welcome_button_press(
                 user_id, message_text, context
             )
             
             if success:
                 # ✅ ИСПРАВЛЕНИЕ: Проверяем статус включения сообщения подтверждения
-                if not db.is_success_message_enabled():
+                if not tenant.db.is_success_message_enabled():
                     logger.info(f"ℹ️ Сообщение подтверждения выключено, ничего не отправляем пользователю {user_id}")
                     return  # Просто выходим, ничего не отправляем
                 
                 # Получаем настраиваемое сообщение подтверждения из базы данных
                 try:
-                    conn = db._get_connection()
+                    conn = tenant.db._get_connection()
                     cursor = conn.cursor()
                     cursor.execute('SELECT value FROM settings WHERE key = "success_message"')
                     success_msg = cursor.fetchone()
@@ -992,17 +941,17 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Если это обычное сообщение от пользователя
     else:
-        success = await callback_handler.execute_start_logic(user_id, context, update.effective_user)
+        success = await tenant.callback_handler.execute_start_logic(user_id, context, update.effective_user)
         
         if success:
             # ✅ ИСПРАВЛЕНИЕ: Проверяем статус включения сообщения подтверждения
-            if not db.is_success_message_enabled():
+            if not tenant.db.is_success_message_enabled():
                 logger.info(f"ℹ️ Сообщение подтверждения выключено, ничего не отправляем пользователю {user_id}")
                 return  # Просто выходим, ничего не отправляем
             
             # Получаем настраиваемое сообщение подтверждения
             try:
-                conn = db._get_connection()
+                conn = tenant.db._get_connection()
                 cursor = conn.cursor()
                 cursor.execute('SELECT value FROM settings WHERE key = "success_message"')
                 success_msg = cursor.fetchone()
@@ -1051,6 +1000,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_consent_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатия на кнопку согласия"""
+    tenant = get_tenant(context)
     user_id = update.effective_user.id
     user = update.effective_user
     
@@ -1058,7 +1008,7 @@ async def handle_consent_button(update: Update, context: ContextTypes.DEFAULT_TY
         logger.info(f"🔘 Пользователь {user_id} нажал кнопку согласия")
         
         # Убеждаемся, что пользователь существует и активен
-        user_exists = db.ensure_user_exists_and_active(
+        user_exists = tenant.db.ensure_user_exists_and_active(
             user_id, 
             user.username, 
             user.first_name
@@ -1073,9 +1023,8 @@ async def handle_consent_button(update: Update, context: ContextTypes.DEFAULT_TY
             return
         
         # Проверяем, есть ли уже запланированные сообщения
-        existing_messages = db.get_user_scheduled_messages(user_id)
-        if existing_messages:
-            logger.info(f"ℹ️ Пользователь {user_id} уже имеет {len(existing_messages)} запланированных сообщений")
+        if tenant.db.has_pending_funnel_messages(user_id):
+            logger.info(f"ℹ️ Пользователь {user_id} уже получает сообщения воронки")
             await update.message.reply_text(
                 "✅ <b>Вы уже подписаны на уведомления!</b>\n\n"
                 "📬 Вы будете получать все важные сообщения от нашего бота.\n\n"
@@ -1090,17 +1039,17 @@ async def handle_consent_button(update: Update, context: ContextTypes.DEFAULT_TY
             return
         
         # Выполняем логику start()
-        success = await callback_handler.execute_start_logic(user_id, context, user)
+        success = await tenant.callback_handler.execute_start_logic(user_id, context, user)
         
         if success:
             # ✅ ИСПРАВЛЕНИЕ: Проверяем статус включения сообщения подтверждения
-            if not db.is_success_message_enabled():
+            if not tenant.db.is_success_message_enabled():
                 logger.info(f"ℹ️ Сообщение подтверждения выключено, ничего не отправляем пользователю {user_id}")
                 return  # Просто выходим, ничего не отправляем
             
             # Получаем настраиваемое сообщение подтверждения
             try:
-                conn = db._get_connection()
+                conn = tenant.db._get_connection()
                 cursor = conn.cursor()
                 cursor.execute('SELECT value FROM settings WHERE key = "success_message"')
                 success_msg = cursor.fetchone()
@@ -1193,10 +1142,11 @@ async def handle_bot_info_button(update: Update, context: ContextTypes.DEFAULT_T
 
 async def handle_what_will_receive_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатия на кнопку о содержимом"""
+    tenant = get_tenant(context)
     user_id = update.effective_user.id
     
     # Получаем все сообщения рассылки для показа
-    messages = db.get_all_broadcast_messages()
+    messages = tenant.db.get_all_broadcast_messages()
     
     content_message = (
         "📋 <b>Что вы будете получать:</b>\n\n"
@@ -1267,30 +1217,39 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application) -> None:
     """Инициализация после запуска"""
-    global bot_application, bot_instance
-    bot_application = application
-    bot_instance = application.bot
+    tenant = application.bot_data['tenant']
     
-    logger.info("🚀 Бот с интегрированными webhook'ами успешно запущен!")
-    logger.info(f"📱 Telegram webhook: {WEBHOOK_URL}/bot{BOT_TOKEN}")
-    logger.info(f"💰 Payment webhook: {WEBHOOK_URL}/webhook/payment")
+    logger.info(f"🚀 [{tenant.name}] Бот с интегрированными webhook'ами успешно запущен!")
+    logger.info(f"📱 Telegram webhook: {WEBHOOK_URL}{tenant.webhook_path}")
+    logger.info(f"💰 Payment webhook: {WEBHOOK_URL}{tenant.url_prefix}/webhook/payment")
     logger.info(f"🔍 Health check: {WEBHOOK_URL}/health")
-    logger.info(f"🧪 Test expired subscriptions: {WEBHOOK_URL}/test/expired-subscriptions")
+    logger.info(f"🧪 Test expired subscriptions: {WEBHOOK_URL}{tenant.url_prefix}/test/expired-subscriptions")
     
-    # Выводим информацию о базе данных
-    db_info = db.get_database_info()
-    logger.info(f"📊 База данных готова: {db_info}")
+    logger.info(f"📊 База данных готова: версия схемы {tenant.db.schema_version}")
 
-async def run_telegram_bot():
-    """Запуск Telegram бота в отдельной задаче"""
-    global bot_application, bot_instance
-    
-    logger.info("🚀 Запуск Telegram бота для Render с Disk...")
-    
-    # Создаём Telegram приложение
-    application = Application.builder().token(BOT_TOKEN).build()
-    bot_instance = application.bot
-    bot_application = application
+async def run_database_diagnostics(tenant):
+    """Полная диагностика БД в фоне, чтобы не задерживать старт и health check"""
+    db_info = await asyncio.to_thread(tenant.db.get_database_info, True)
+    logger.info(f"📊 [{tenant.name}] Диагностика базы данных: {db_info}")
+
+async def run_counters_reconciliation(tenant):
+    """Сверка счетчиков статистики с таблицами (исправляет дрейф, если он появился)"""
+    await asyncio.to_thread(tenant.db.reconcile_counters)
+
+def build_application(tenant, with_job_queue: bool) -> Application:
+    """Telegram приложение бота: общие HTTP-клиенты и обработчики с доступом к своему арендатору"""
+    builder = Application.builder().token(tenant.bot_token).request(host.interactive_request)
+    if not with_job_queue:
+        # Фоновые задачи всех ботов крутит одна очередь задач
+        builder = builder.job_queue(None)
+    application = builder.build()
+    application.bot_data['tenant'] = tenant
+    tenant.callback_handler = CallbackHandler(tenant.db, tenant.scheduler)
+    tenant.join_pipeline = JoinPipeline(tenant.db, personalize_message)
+    tenant.application = application
+    # Рассылки (фоновые задачи и массовые рассылки админки) идут через отдельный пул
+    tenant.bulk_bot = Bot(tenant.bot_token, request=host.bulk_request, get_updates_request=host.bulk_request)
+    tenant.admin_panel.job_manager.send_bot = tenant.bulk_bot
     
     # Добавляем обработчик инициализации
     application.post_init = post_init
@@ -1305,72 +1264,87 @@ async def run_telegram_bot():
     
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
-    
-    # ===== ЗАПУСКАЕМ ФОНОВЫЕ ЗАДАЧИ =====
-    # Запускаем фоновую задачу для рассылки
-    application.job_queue.run_repeating(
-        scheduler.send_scheduled_messages,
-        interval=5,  # каждые 60 секунд
-        first=1  # первый запуск через 10 секунд
+    return application
+
+def schedule_background_jobs(job_queue):
+    """Фоновые задачи: каждый запуск проходит по всем ботам"""
+    # Запускаем фоновую задачу для рассылки: один диспетчер разбирает все воронки
+    job_queue.run_repeating(
+        host.for_each_tenant('send_scheduled_messages',
+                             lambda tenant: tenant.scheduler.send_scheduled_messages(tenant.context())),
+        interval=5,  # каждые 5 секунд
+        first=1  # первый запуск через 1 секунду
     )
     
-    # Запускаем фоновую задачу для запланированных массовых рассылок
-    application.job_queue.run_repeating(
-        scheduler.send_scheduled_broadcasts,
+    # Запускаем фоновую задачу для запланированных массовых рассылок всех воронок
+    job_queue.run_repeating(
+        host.for_each_tenant('send_scheduled_broadcasts',
+                             lambda tenant: tenant.scheduler.send_scheduled_broadcasts(tenant.context())),
         interval=120,  # каждые 2 минуты
         first=20  # первый запуск через 20 секунд
     )
     
-    # Запускаем фоновую задачу для рассылки платных сообщений
-    application.job_queue.run_repeating(
-        scheduler.send_scheduled_paid_messages,
-        interval=60,  # каждые 60 секунд
-        first=15  # первый запуск через 15 секунд
+    # Запускаем фоновую задачу для проверки истекших подписок (каждый час)
+    # Истекшие выбираются диапазоном payed_till <= сегодня, повторный запуск ничего не дублирует
+    job_queue.run_repeating(
+        host.for_each_tenant('check_expired_subscriptions',
+                             lambda tenant: tenant.scheduler.check_expired_subscriptions(tenant.context())),
+        interval=60 * 60,
+        first=60,
+        name="check_expired_subscriptions"
     )
-
-    # Запускаем фоновую задачу для запланированных массовых рассылок оплативших
-    application.job_queue.run_repeating(
-        scheduler.send_scheduled_paid_broadcasts,
-        interval=120,  # каждые 2 минуты
-        first=25  # первый запуск через 25 секунд
+    
+    # Полная диагностика БД один раз после старта (integrity_check на большой БД долгий)
+    job_queue.run_once(
+        host.for_each_tenant('database_diagnostics', run_database_diagnostics),
+        when=30,
+        name="database_diagnostics"
     )
     
-    # Запускаем фоновую задачу для проверки истекших подписок (ежедневно в 12:00 МСК)
-    # Переводит пользователей с истекшими подписками обратно в обычную воронку БЕЗ планирования новых сообщений
-    from datetime import time
-    import pytz
+    # Сверка счетчиков статистики раз в 6 часов
+    job_queue.run_repeating(
+        host.for_each_tenant('counters_reconciliation', run_counters_reconciliation),
+        interval=6 * 60 * 60,
+        first=300,
+        name="counters_reconciliation"
+    )
+
+async def run_telegram_bot():
+    """Запуск Telegram ботов в отдельной задаче"""
+    logger.info("🚀 Запуск Telegram бота для Render с Disk...")
     
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    moscow_noon = time(12, 0, 0)  # 12:00 по Москве
+    # Создаём Telegram приложения; очередь фоновых задач — только у первого
+    applications = [
+        build_application(tenant, with_job_queue=(index == 0))
+        for index, tenant in enumerate(host.tenants)
+    ]
     
-    application.job_queue.run_daily(
-        scheduler.check_expired_subscriptions,
-        time=moscow_noon,
-        name="check_expired_subscriptions"
-    )
+    # ===== ЗАПУСКАЕМ ФОНОВЫЕ ЗАДАЧИ =====
+    schedule_background_jobs(applications[0].job_queue)
     
     if USE_WEBHOOK and WEBHOOK_URL:
-        # Настраиваем Telegram webhook
-        webhook_path = f"/bot{BOT_TOKEN}"
-        webhook_url = f"{WEBHOOK_URL}{webhook_path}"
-        
-        logger.info(f"📡 Настройка Telegram webhook: {webhook_url}")
-        
-        # Запускаем только инициализацию бота
-        await application.initialize()
-        await application.start()
-        
-        # Устанавливаем webhook
-        await application.bot.set_webhook(
-            url=webhook_url,
-            drop_pending_updates=True,
-            allowed_updates=["message", "chat_join_request", "chat_member", "callback_query"]
-        )
+        for tenant in host.tenants:
+            # Настраиваем Telegram webhook
+            webhook_url = f"{WEBHOOK_URL}{tenant.webhook_path}"
+            
+            logger.info(f"📡 [{tenant.name}] Настройка Telegram webhook: {webhook_url}")
+            
+            # Запускаем только инициализацию бота
+            await tenant.application.initialize()
+            await tenant.bulk_bot.initialize()
+            await tenant.application.start()
+            
+            # Устанавливаем webhook
+            await tenant.bot.set_webhook(
+                url=webhook_url,
+                drop_pending_updates=True,
+                allowed_updates=["message", "chat_join_request", "chat_member", "callback_query"]
+            )
         
         # Запускаем job queue
-        application.job_queue.start()
+        applications[0].job_queue.start()
         
-        logger.info("✅ Telegram бот инициализирован в webhook режиме")
+        logger.info(f"✅ Telegram боты ({len(applications)}) инициализированы в webhook режиме")
         
         # Держим бота активным
         while True:
@@ -1379,19 +1353,35 @@ async def run_telegram_bot():
         logger.warning("🔄 Запуск в режиме POLLING (не рекомендуется для Render)")
         logger.warning("⚠️ Убедитесь, что установлены USE_WEBHOOK=true и WEBHOOK_URL")
         
-        await application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
-        )
+        for tenant in host.tenants:
+            logger.info(f"🔄 [{tenant.name}] Запуск polling")
+            
+            await tenant.application.initialize()
+            await tenant.bulk_bot.initialize()
+            await tenant.application.start()
+            
+            # Каждый бот опрашивает Telegram своим updater'ом в общем event loop
+            await tenant.application.updater.start_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES
+            )
+        
+        # Очередь фоновых задач первого бота запускается вместе с его application.start()
+        logger.info(f"✅ Telegram боты ({len(applications)}) запущены в режиме polling")
+        
+        # Держим ботов активными
+        while True:
+            await asyncio.sleep(60)
 
 def main():
     """Главная функция запуска"""
     logger.info("🌐 Запуск в режиме WEBHOOK для продакшена на Render...")
-    logger.info(f"📱 Telegram webhook endpoint: /bot{BOT_TOKEN}")
-    logger.info(f"💰 Payment webhook endpoint: /webhook/payment")
+    logger.info(f"📱 Telegram webhook endpoint: /bot{{token}} ({len(host.tenants)} бот(ов))")
+    logger.info(f"💰 Payment webhook endpoint: {ROUTE_PREFIX}/webhook/payment")
     logger.info(f"🔍 Health check endpoint: /health")
-    logger.info(f"🧪 Test expired subscriptions endpoint: /test/expired-subscriptions")
-    logger.info(f"⚙️ Test setup user endpoint: /test/setup-user")
+    logger.info(f"👆 Click redirect endpoint: {ROUTE_PREFIX}{ClickTracker.ROUTE}")
+    logger.info(f"🧪 Test expired subscriptions endpoint: {ROUTE_PREFIX}/test/expired-subscriptions")
+    logger.info(f"⚙️ Test setup user endpoint: {ROUTE_PREFIX}/test/setup-user")
     
     async def init_and_run():
         """Инициализация и запуск всех сервисов"""
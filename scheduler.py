@@ -4,103 +4,155 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import Forbidden, BadRequest
 import logging
 import asyncio
+import os
+import socket
+import time
+import uuid
 import utm_utils
+from click_tracking import ClickTracker
+from load_shaping import SendCalendar
+from log_pipeline import recipient
 
 logger = logging.getLogger(__name__)
 
+
+class SendOutcomes:
+    """Итоги пачки отправок: записываются в БД одной транзакцией после пачки"""
+
+    __slots__ = ('closed', 'blocked_users', 'retry', 'deliveries')
+
+    def __init__(self):
+        # Шаги, которые больше не отправлять (id строки очереди или (user_id, шаг) курсора)
+        self.closed = []
+        self.blocked_users = []
+        # Временные ошибки: вернуть в очередь с отложенной попыткой
+        self.retry = []
+        # Доставленные (user_id, message_number) для аналитики
+        self.deliveries = []
+
+
 class MessageScheduler:
-    def __init__(self, db):
+    # Сколько задач воркер захватывает за один раз
+    CLAIM_BATCH_SIZE = 50
+    # Каждые N получателей массовой рассылки аренда продлевается
+    LEASE_RENEW_EVERY = 50
+    # Сколько истекших подписок завершается одной транзакцией
+    EXPIRY_CHUNK_SIZE = 500
+    # Движки воронки: строка на каждый шаг (rows) или один курсор на пользователя (cursor)
+    ENGINE_ROWS = 'rows'
+    ENGINE_CURSOR = 'cursor'
+
+    def __init__(self, db, workers=None, engine=None, click_tracker=None, send_calendar=None):
         self.db = db
+        # Подписанные ссылки /r/{token} для учета нажатий URL-кнопок воронки
+        self.click_tracker = click_tracker or ClickTracker.from_env()
+        # Бюджет отправок воронки по минутам (FUNNEL_SEND_BUDGET), без него время не сдвигается
+        self.send_calendar = send_calendar or SendCalendar.from_env(db)
+        # Уникальный идентификатор процесса: под ним задачи арендуются в общей БД
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        # Количество asyncio-воркеров, параллельно разбирающих очереди сообщений
+        self.workers = max(1, workers or int(os.environ.get('SCHEDULER_WORKERS', '1')))
+        self.claim_batch_size = self.CLAIM_BATCH_SIZE
+        
+        self.engine = engine or os.environ.get('FUNNEL_ENGINE', self.ENGINE_ROWS)
+        if self.engine not in (self.ENGINE_ROWS, self.ENGINE_CURSOR):
+            logger.warning(f"⚠️ Неизвестный движок воронки {self.engine}, используем {self.ENGINE_ROWS}")
+            self.engine = self.ENGINE_ROWS
+        
+        if self.engine == self.ENGINE_CURSOR:
+            # Уже запланированные строки переводим на курсоры (повторно ничего не делает)
+            for funnel in self.db.FUNNELS:
+                self.db.migrate_funnel_to_cursors(funnel)
     
     async def schedule_user_messages(self, context: ContextTypes.DEFAULT_TYPE, user_id):
         """Запланировать отправку всех сообщений для пользователя"""
+        state = self.db.get_user_state(user_id)
+        
+        # Если пользователь уже оплатил, сообщения бесплатной воронки не планируем
+        if state and state.is_active and state.bot_started and state.has_paid:
+            logger.info(f"💰 Пользователь {user_id} уже оплатил, планирование сообщений пропущено")
+            return True
+        
+        return await self.schedule_funnel(context, user_id, 'free', required=True, state=state)
+    
+    async def schedule_funnel(self, context: ContextTypes.DEFAULT_TYPE, user_id, funnel, required=False, state=None):
+        """Запланировать пользователю все шаги воронки от текущего момента
+
+        required — воронка без сообщений считается ошибкой. Пользователь
+        должен входить в аудиторию воронки.
+        """
+        funnel = self.db.FUNNELS[funnel]
         try:
-            logger.info(f"🔄 Начинаем планирование сообщений для пользователя {user_id}")
+            logger.info(f"{funnel.log_prefix}🔄 Начинаем планирование воронки {funnel.name} для пользователя {user_id}")
             
-            # Получаем актуальную информацию о пользователе
-            user_info = self.db.get_user(user_id)
-            if not user_info:
+            # Состояние пользователя (из кэша, если есть)
+            state = state or self.db.get_user_state(user_id)
+            if not state:
                 logger.error(f"❌ Пользователь {user_id} не найден в базе данных")
                 return False
-                
-            user_id_db, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at = user_info
             
-            # Проверяем, что пользователь активен
-            if not is_active:
-                logger.warning(f"⚠️ Пользователь {user_id} неактивен (is_active = {is_active})")
-                return False
-                
-            # Проверяем, что пользователь дал согласие на получение сообщений
-            if not bot_started:
-                logger.warning(f"⚠️ Пользователь {user_id} не дал согласие на получение сообщений (bot_started = {bot_started})")
+            if not funnel.accepts(state):
+                logger.warning(f"⚠️ Пользователь {user_id} не входит в аудиторию воронки {funnel.name} "
+                               f"(is_active = {state.is_active}, bot_started = {state.bot_started}, has_paid = {state.has_paid})")
                 return False
             
-            # НОВАЯ ПРОВЕРКА: Если пользователь уже оплатил, не планируем сообщения
-            if has_paid:
-                logger.info(f"💰 Пользователь {user_id} уже оплатил, планирование сообщений пропущено")
-                return True
+            if self.engine == self.ENGINE_CURSOR:
+                return self._start_cursor_funnel(user_id, funnel.name)
             
             # Проверяем, есть ли уже запланированные сообщения
-            existing_messages = self.db.get_user_scheduled_messages(user_id)
+            existing_messages = self.db.get_user_funnel_messages(user_id, funnel.name)
             if existing_messages:
-                logger.info(f"ℹ️ Пользователь {user_id} уже имеет {len(existing_messages)} запланированных сообщений")
-                # Выводим детали существующих сообщений
-                for msg_id, message_number, scheduled_time, is_sent in existing_messages:
-                    logger.debug(f"   - Сообщение {message_number}: {scheduled_time} (отправлено: {is_sent})")
+                logger.info(f"ℹ️ Пользователь {user_id} уже имеет {len(existing_messages)} запланированных сообщений воронки {funnel.name}")
                 return True
             
-            # Получаем все сообщения рассылки
-            messages = self.db.get_all_broadcast_messages()
+            messages = self.db.get_funnel_messages(funnel.name)
             if not messages:
-                logger.error("❌ Нет сообщений рассылки в базе данных")
-                return False
-            
-            logger.info(f"📋 Найдено {len(messages)} сообщений рассылки для планирования")
+                if required:
+                    logger.error(f"❌ Нет сообщений воронки {funnel.name} в базе данных")
+                    return False
+                logger.warning(f"⚠️ Нет сообщений воронки {funnel.name} в базе данных")
+                return True  # Это не ошибка, просто нет настроенных сообщений
             
             current_time = datetime.now()
-            logger.info(f"⏰ Планирование сообщений для пользователя {user_id} (@{username}), текущее время: {current_time}")
+            logger.info(f"{funnel.log_prefix}⏰ Планирование {len(messages)} сообщений воронки {funnel.name} для пользователя {user_id}, текущее время: {current_time}")
+            
+            # Время отправки: старт + delay_hours, сдвинутое в ближайшую минуту со свободным бюджетом
+            scheduled_times = self.send_calendar.assign(
+                [current_time + timedelta(hours=delay_hours) for message_number, text, delay_hours, photo_url in messages],
+                current_time
+            )
+            
+            # Все шаги добавляются одной транзакцией
+            scheduled_count = self.db.schedule_funnel_messages(
+                user_id, funnel.name,
+                [(message[0], scheduled_time) for message, scheduled_time in zip(messages, scheduled_times)]
+            )
+            if not scheduled_count:
+                logger.error(f"❌ Не удалось запланировать ни одного сообщения воронки {funnel.name} для пользователя {user_id}")
+                return False
             
-            scheduled_count = 0
-            for message_number, text, delay_hours, photo_url in messages:
-                try:
-                    # Вычисляем время отправки
-                    scheduled_time = current_time + timedelta(hours=delay_hours)
-                    
-                    # Добавляем в расписание
-                    self.db.schedule_message(user_id, message_number, scheduled_time)
-                    scheduled_count += 1
-                    
-                    # Форматируем время для логов
-                    time_diff = scheduled_time - current_time
-                    if time_diff.total_seconds() < 3600:  # Меньше часа
-                        time_str = f"{int(time_diff.total_seconds() / 60)} минут"
-                    else:
-                        time_str = f"{delay_hours} часов"
-                    
-                    logger.info(f"✅ Запланировано сообщение {message_number} для пользователя {user_id} на {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')} (через {time_str})")
-                    
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при планировании сообщения {message_number} для пользователя {user_id}: {e}")
-                    # Продолжаем планирование остальных сообщений
-                    continue
+            # Построчный лог шагов только при включенном DEBUG
+            if logger.isEnabledFor(logging.DEBUG):
+                for (message_number, text, delay_hours, photo_url), scheduled_time in zip(messages, scheduled_times):
+                    logger.debug("✅ Запланировано сообщение %s воронки %s для пользователя %s на %s",
+                                 message_number, funnel.name, user_id, scheduled_time)
             
-            if scheduled_count > 0:
-                logger.info(f"🎉 Всего запланировано {scheduled_count} сообщений для пользователя {user_id}")
-                
-                # Проверяем, что сообщения действительно добавились в БД
-                verification_messages = self.db.get_user_scheduled_messages(user_id)
-                if len(verification_messages) != scheduled_count:
-                    logger.error(f"❌ Проверка не пройдена! Ожидалось {scheduled_count} сообщений, найдено {len(verification_messages)}")
-                    return False
-                
-                return True
-            else:
-                logger.error(f"❌ Не удалось запланировать ни одного сообщения для пользователя {user_id}")
-                return False
+            logger.info(f"{funnel.log_prefix}🎉 Всего запланировано {scheduled_count} сообщений воронки {funnel.name} для пользователя {user_id}")
+            return True
                 
         except Exception as e:
-            logger.error(f"❌ Критическая ошибка при планировании сообщений для пользователя {user_id}: {e}", exc_info=True)
+            logger.error(f"❌ Критическая ошибка при планировании воронки {funnel.name} для пользователя {user_id}: {e}", exc_info=True)
+            return False
+    
+    def _start_cursor_funnel(self, user_id, funnel):
+        """Движок курсоров: одна строка на пользователя вместо строки на каждый шаг"""
+        funnel_cursor = self.db.start_funnel_cursor(user_id, funnel)
+        if funnel_cursor is None:
             return False
+        
+        step, next_due_at = funnel_cursor
+        logger.info(f"🧭 Воронка {funnel} пользователя {user_id}: шаг {step}, следующее сообщение {next_due_at}")
+        return True
     
     async def ensure_user_messages_scheduled(self, context: ContextTypes.DEFAULT_TYPE, user_id):
         """Убедиться, что у пользователя запланированы сообщения"""
@@ -134,11 +186,17 @@ class MessageScheduler:
             # Возвращаем оригинальный контент в случае ошибки
             return text, buttons
     
+    def _funnel_url_button(self, funnel, user_id, message_number, button_id, button_text, button_url):
+        """URL-кнопка воронки: через редирект с учетом клика, если он настроен"""
+        if self.click_tracker.enabled and button_id is not None:
+            button_url = self.click_tracker.redirect_url(funnel, user_id, message_number, button_id)
+        return InlineKeyboardButton(button_text, url=button_url)
+    
     async def send_scheduled_messages(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить все запланированные сообщения, время которых настало"""
+        """Отправить сообщения всех воронок, время которых настало"""
         try:
             current_time = datetime.now()
-            logger.debug(f"🔄 Проверка запланированных сообщений на {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            logger.debug("🔄 Проверка запланированных сообщений на %s", current_time)
             
             # Проверяем статус рассылки
             broadcast_status = self.db.get_broadcast_status()
@@ -158,174 +216,133 @@ class MessageScheduler:
                     logger.debug("❌ Рассылка отключена без таймера")
                     return
             
-            # Получаем сообщения, готовые к отправке (только для пользователей с bot_started = 1 и has_paid = 0)
-            pending_messages = self.db.get_pending_messages_for_active_users()
-            
-            if not pending_messages:
-                logger.debug("📭 Нет сообщений для отправки")
-                return
+            # Несколько воркеров разбирают очереди всех воронок параллельно: каждая
+            # пачка захватывается атомарно через аренду, поэтому дублей не будет
+            stats = {'sent': 0, 'failed': 0}
+            await asyncio.gather(*[
+                self._drain_funnels(context, f"{self.worker_id}:w{n}", stats)
+                for n in range(self.workers)
+            ])
             
-            logger.info(f"📬 Найдено {len(pending_messages)} сообщений для отправки")
+            if stats['sent'] > 0 or stats['failed'] > 0:
+                logger.info("📊 Результаты рассылки: отправлено %s, ошибок %s", stats['sent'], stats['failed'])
+                        
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка в send_scheduled_messages: {e}", exc_info=True)
+    
+    async def _drain_funnels(self, context: ContextTypes.DEFAULT_TYPE, worker_id, stats):
+        """Воркер: по очереди разбирает готовые шаги всех воронок"""
+        drain = self._drain_funnel_cursors if self.engine == self.ENGINE_CURSOR else self._drain_message_queue
+        for funnel in self.db.FUNNELS:
+            await drain(context, worker_id, stats, funnel)
+    
+    async def _drain_message_queue(self, context: ContextTypes.DEFAULT_TYPE, worker_id, stats, funnel):
+        """Воркер: захватывает пачки сообщений воронки и отправляет их
+
+        Итоги пачки (отправлено, заблокировали, BadRequest, повторить позже)
+        копятся в SendOutcomes и записываются одной транзакцией — см.
+        контракт at-most-once в Database (раздел LEASE).
+        """
+        funnel = self.db.FUNNELS[funnel]
+        while True:
+            # Только для пользователей из аудитории воронки
+            pending_messages = self.db.claim_funnel_messages(worker_id, funnel.name, self.claim_batch_size)
             
-            sent_count = 0
-            failed_count = 0
+            if not pending_messages:
+                break
             
-            for message_id, user_id, message_number, text, photo_url in pending_messages:
-                try:
-                    logger.debug(f"📤 Отправляем сообщение {message_number} пользователю {user_id}")
-                    
-                    # НОВАЯ ПРОВЕРКА: Убеждаемся, что пользователь не оплатил за время ожидания
-                    user_info = self.db.get_user(user_id)
-                    if user_info and user_info[6]:  # has_paid = True
-                        logger.info(f"💰 Пользователь {user_id} оплатил, пропускаем сообщение {message_number}")
-                        self.db.mark_message_sent(message_id)
-                        continue
-                    
-                    # Небольшая задержка между отправками для избежания лимитов
-                    await asyncio.sleep(0.1)
-                    
-                    # Получаем кнопки для этого сообщения
-                    buttons = self.db.get_message_buttons(message_number)
-                    
-                    # НОВОЕ: Обрабатываем контент с UTM метками
-                    processed_text, processed_buttons = self.process_message_content(text, buttons, user_id)
-                    
-                    reply_markup = None
-                    if processed_buttons:
-                        keyboard = []
-                        
-                        for button_id, button_text, button_url, position in processed_buttons:
-                            if button_url and button_url.strip():
-                                # Есть URL - создаем URL кнопку
-                                keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                            else:
-                                # Нет URL - создаем callback кнопку для следующего сообщения
-                                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
-                        
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        logger.debug(f"🔘 Добавлены кнопки к сообщению {message_number}: {len(processed_buttons)} кнопок")
-                    
-                    # Отправляем сообщение
-                    if photo_url:
-                        # Отправляем с фото
-                        await context.bot.send_photo(
-                            chat_id=user_id,
-                            photo=photo_url,
-                            caption=processed_text,
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"🖼️ Отправлено сообщение с фото")
-                    else:
-                        # Отправляем только текст
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=processed_text,
-                            parse_mode='HTML',
-                            disable_web_page_preview=True,
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"📝 Отправлено текстовое сообщение")
-                    
-                    # Отмечаем как отправленное
-                    self.db.mark_message_sent(message_id)
-                    
-                    # 📊 НОВОЕ: Логируем отправку для воронки
-                    self.db.log_message_delivery(user_id, message_number)
-                    
-                    sent_count += 1
-                    
-                    logger.info(f"✅ Отправлено сообщение {message_number} пользователю {user_id} с UTM метками")
-                    
-                except Forbidden as e:
-                    # Пользователь заблокировал бота
-                    logger.warning(f"❌ Пользователь {user_id} заблокировал бота: {e}")
-                    # Отмечаем сообщение как отправленное, чтобы не пытаться снова
-                    self.db.mark_message_sent(message_id)
-                    # Деактивируем пользователя
-                    self.db.deactivate_user(user_id)
-                    failed_count += 1
-                    
-                except BadRequest as e:
-                    # Неверный chat_id или другая ошибка
-                    logger.error(f"❌ BadRequest для пользователя {user_id}: {e}")
-                    # Отмечаем как отправленное, чтобы не зацикливаться
-                    self.db.mark_message_sent(message_id)
-                    failed_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить сообщение {message_id} пользователю {user_id}: {e}")
-                    failed_count += 1
-                    # Не отмечаем как отправленное - попробуем еще раз позже
+            logger.info("%s📬 Воркер %s захватил %s сообщений воронки %s для отправки", funnel.log_prefix, worker_id, len(pending_messages), funnel.name)
             
-            if sent_count > 0 or failed_count > 0:
-                logger.info(f"📊 Результаты рассылки: отправлено {sent_count}, ошибок {failed_count}")
+            # Состояния всех получателей пачки за один проход
+            states = self.db.get_user_states(user_id for message_id, user_id, message_number, text, photo_url in pending_messages)
+            outcomes = SendOutcomes()
             
-            # Проверяем, есть ли еще запланированные сообщения
-            remaining_messages = self.db.get_pending_messages_for_active_users()
-            if remaining_messages:
-                next_time = min([datetime.fromisoformat(msg[3]) for msg in remaining_messages if len(msg) > 3])
-                logger.debug(f"⏳ Следующее сообщение запланировано на {next_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            try:
+                for message_id, user_id, message_number, text, photo_url in pending_messages:
+                    try:
+                        logger.debug("%s📤 Отправляем сообщение %s пользователю %s", funnel.log_prefix, message_number, user_id)
                         
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка в send_scheduled_messages: {e}", exc_info=True)
+                        # Убеждаемся, что пользователь не вышел из аудитории за время ожидания (например, оплатил)
+                        if not funnel.accepts(states.get(user_id)):
+                            logger.info("%s⚠️ Пользователь %s больше не входит в аудиторию воронки %s, пропускаем сообщение %s",
+                                        funnel.log_prefix, user_id, funnel.name, message_number,
+                                        extra=recipient(user_id, message_number, funnel.name))
+                            outcomes.closed.append(message_id)
+                            continue
+                        
+                        # Небольшая задержка между отправками для избежания лимитов
+                        await asyncio.sleep(0.1)
+                        
+                        # Кнопки берем из готового контента в памяти
+                        prepared = self.db.get_prepared_broadcast_message(message_number, funnel.name)
+                        buttons = prepared[2] if prepared else ()
+                        
+                        send_started = time.perf_counter()
+                        await self._send_prepared_message(context, user_id, message_number, (text, photo_url, buttons), funnel.name)
+                        
+                        outcomes.closed.append(message_id)
+                        outcomes.deliveries.append((user_id, message_number))
+                        stats['sent'] += 1
+                        
+                        logger.info("✅ Отправлено сообщение %s воронки %s пользователю %s с UTM метками", message_number, funnel.name, user_id,
+                                    extra=recipient(user_id, message_number, funnel.name, (time.perf_counter() - send_started) * 1000))
+                        
+                    except Forbidden as e:
+                        # Пользователь заблокировал бота: шаг закрываем, пользователя деактивируем
+                        logger.warning("❌ Пользователь %s заблокировал бота: %s", user_id, e,
+                                       extra=recipient(user_id, message_number, funnel.name))
+                        outcomes.closed.append(message_id)
+                        outcomes.blocked_users.append(user_id)
+                        stats['failed'] += 1
+                        
+                    except BadRequest as e:
+                        # Неверный chat_id или другая ошибка — закрываем, чтобы не зацикливаться
+                        logger.error("❌ BadRequest для пользователя %s: %s", user_id, e,
+                                     extra=recipient(user_id, message_number, funnel.name))
+                        outcomes.closed.append(message_id)
+                        stats['failed'] += 1
+                        
+                    except Exception as e:
+                        logger.error("❌ Не удалось отправить сообщение %s воронки %s пользователю %s: %s", message_id, funnel.name, user_id, e,
+                                     extra=recipient(user_id, message_number, funnel.name))
+                        stats['failed'] += 1
+                        # Не закрываем - попробуем еще раз позже
+                        outcomes.retry.append(message_id)
+            finally:
+                # Итоги пачки — одной транзакцией, в том числе при отмене задачи;
+                # временные ошибки сразу возвращаются в очередь со сдвигом времени
+                self.db.apply_funnel_send_outcomes(
+                    funnel.name, worker_id, outcomes.closed, outcomes.blocked_users, outcomes.retry,
+                    deliveries=outcomes.deliveries
+                )
     
-    async def send_next_scheduled_message(self, context: ContextTypes.DEFAULT_TYPE, user_id):
-        """Отправить следующее запланированное сообщение для пользователя"""
+    async def send_next_scheduled_message(self, context: ContextTypes.DEFAULT_TYPE, user_id, after_message_number=None):
+        """Отправить следующее сообщение воронки пользователю досрочно (по кнопке)
+
+        after_message_number — шаг, на кнопке которого нажали (из callback payload).
+        Сообщение захватывается по индексу (user_id, message_number), контент
+        берется из памяти — нажатие не сканирует очередь.
+        """
+        if self.engine == self.ENGINE_CURSOR:
+            return await self._send_next_cursor_message(context, user_id, after_message_number)
+        
+        result = None
         try:
-            # Получаем следующее неотправленное сообщение
-            conn = self.db._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT sm.id, sm.message_number, bm.text, bm.photo_url
-                FROM scheduled_messages sm
-                JOIN broadcast_messages bm ON sm.message_number = bm.message_number
-                WHERE sm.user_id = ? AND sm.is_sent = 0
-                ORDER BY sm.message_number ASC
-                LIMIT 1
-            ''', (user_id,))
-            
-            result = cursor.fetchone()
-            conn.close()
+            # Захватываем следующее неотправленное сообщение, чтобы его не отправил воркер
+            result = self.db.claim_user_message_after(self.worker_id, user_id, after_message_number)
             
             if not result:
                 return False  # Нет запланированных сообщений
                 
-            message_id, message_number, text, photo_url = result
+            message_id, message_number = result
             
-            # Отправляем сообщение (используем существующую логику)
-            buttons = self.db.get_message_buttons(message_number)
-            processed_text, processed_buttons = self.process_message_content(text, buttons, user_id)
+            prepared = self.db.get_prepared_broadcast_message(message_number)
+            if not prepared:
+                logger.error(f"❌ Сообщение рассылки {message_number} не найдено")
+                self.db.release_job('scheduled_messages', message_id, self.worker_id)
+                return False
             
-            reply_markup = None
-            if processed_buttons:
-                keyboard = []
-                
-                for button_id, button_text, button_url, position in processed_buttons:
-                    if button_url and button_url.strip():
-                        # URL кнопка
-                        keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                    else:
-                        # Callback кнопка
-                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            if photo_url:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=photo_url,
-                    caption=processed_text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=processed_text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
+            await self._send_prepared_message(context, user_id, message_number, prepared, 'free')
             
             # Отмечаем как отправленное
             self.db.mark_message_sent(message_id)
@@ -338,13 +355,144 @@ class MessageScheduler:
             
         except Exception as e:
             logger.error(f"❌ Ошибка при принудительной отправке сообщения пользователю {user_id}: {e}")
+            if result:
+                self.db.release_job('scheduled_messages', result[0], self.worker_id)
+            return False
+    
+    async def _send_prepared_message(self, context: ContextTypes.DEFAULT_TYPE, user_id, message_number, prepared, funnel):
+        """Отправить готовый контент сообщения воронки с UTM метками"""
+        text, photo_url, buttons = prepared
+        processed_text, processed_buttons = self.process_message_content(text, list(buttons), user_id)
+        
+        reply_markup = None
+        if processed_buttons:
+            keyboard = []
+            
+            for button_id, button_text, button_url, position in processed_buttons:
+                if button_url and button_url.strip():
+                    # URL кнопка
+                    keyboard.append([self._funnel_url_button(funnel, user_id, message_number, button_id, button_text, button_url)])
+                elif self.db.FUNNELS[funnel].step_buttons:
+                    # Callback кнопка с номером шага
+                    keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}_{message_number}")])
+                else:
+                    keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
+            
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await self._send_content(context, user_id, processed_text, photo_url, reply_markup)
+    
+    async def _send_content(self, context: ContextTypes.DEFAULT_TYPE, user_id, text, photo_url=None, reply_markup=None):
+        """Общая отправка готового текста пользователю: с фото или только текст"""
+        if photo_url:
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=photo_url,
+                caption=text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+        else:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode='HTML',
+                disable_web_page_preview=True,
+                reply_markup=reply_markup
+            )
+    
+    # ===== 🧭 ДВИЖОК ВОРОНКИ НА КУРСОРАХ =====
+    
+    async def _drain_funnel_cursors(self, context: ContextTypes.DEFAULT_TYPE, worker_id, stats, funnel):
+        """Воркер движка курсоров: захватывает пользователей, которым пора следующий шаг"""
+        while True:
+            due = self.db.claim_due_funnel_cursors(worker_id, funnel, self.claim_batch_size)
+            
+            if not due:
+                break
+            
+            logger.info("🧭 Воркер %s захватил %s курсоров воронки %s", worker_id, len(due), funnel)
+            outcomes = SendOutcomes()
+            
+            try:
+                for user_id, message_number in due:
+                    try:
+                        prepared = self.db.get_prepared_broadcast_message(message_number, funnel)
+                        if not prepared:
+                            logger.error(f"❌ Сообщение {message_number} воронки {funnel} не найдено, пропускаем")
+                            outcomes.closed.append((user_id, message_number))
+                            continue
+                        
+                        # Небольшая задержка между отправками для избежания лимитов
+                        await asyncio.sleep(0.1)
+                        
+                        send_started = time.perf_counter()
+                        await self._send_prepared_message(context, user_id, message_number, prepared, funnel)
+                        
+                        outcomes.closed.append((user_id, message_number))
+                        outcomes.deliveries.append((user_id, message_number))
+                        stats['sent'] += 1
+                        
+                        logger.info("✅ Отправлено сообщение %s воронки %s пользователю %s", message_number, funnel, user_id,
+                                    extra=recipient(user_id, message_number, funnel, (time.perf_counter() - send_started) * 1000))
+                        
+                    except Forbidden as e:
+                        # Пользователь заблокировал бота — шаг пропускаем, пользователя деактивируем
+                        logger.warning("❌ Пользователь %s заблокировал бота: %s", user_id, e,
+                                       extra=recipient(user_id, message_number, funnel))
+                        outcomes.closed.append((user_id, message_number))
+                        outcomes.blocked_users.append(user_id)
+                        stats['failed'] += 1
+                        
+                    except BadRequest as e:
+                        logger.error("❌ BadRequest для пользователя %s: %s", user_id, e,
+                                     extra=recipient(user_id, message_number, funnel))
+                        outcomes.closed.append((user_id, message_number))
+                        stats['failed'] += 1
+                        
+                    except Exception as e:
+                        logger.error("❌ Не удалось отправить сообщение %s воронки %s пользователю %s: %s", message_number, funnel, user_id, e,
+                                     extra=recipient(user_id, message_number, funnel))
+                        stats['failed'] += 1
+                        # Курсор не сдвигаем - попробуем еще раз позже
+                        outcomes.retry.append(user_id)
+            finally:
+                self.db.apply_funnel_cursor_outcomes(
+                    funnel, worker_id, outcomes.closed, outcomes.blocked_users, outcomes.retry,
+                    deliveries=outcomes.deliveries
+                )
+    
+    async def _send_next_cursor_message(self, context: ContextTypes.DEFAULT_TYPE, user_id, after_message_number=None):
+        """Досрочная отправка следующего шага по кнопке (движок курсоров)"""
+        message_number = self.db.claim_funnel_cursor(self.worker_id, user_id, 'free', after_message_number)
+        if not message_number:
+            return False  # Воронка пройдена или курсор занят воркером
+        
+        try:
+            prepared = self.db.get_prepared_broadcast_message(message_number)
+            if not prepared:
+                logger.error(f"❌ Сообщение рассылки {message_number} не найдено")
+                self.db.release_funnel_cursor(user_id, 'free', self.worker_id)
+                return False
+            
+            await self._send_prepared_message(context, user_id, message_number, prepared, 'free')
+            
+            self.db.advance_funnel_cursor(user_id, 'free', message_number)
+            self.db.log_message_delivery(user_id, message_number)
+            
+            logger.info(f"✅ Принудительно отправлено сообщение {message_number} пользователю {user_id}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка при принудительной отправке сообщения пользователю {user_id}: {e}")
+            self.db.release_funnel_cursor(user_id, 'free', self.worker_id)
             return False
     
     async def send_scheduled_broadcasts(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить запланированные массовые рассылки"""
+        """Отправить запланированные массовые рассылки всех воронок"""
         try:
             current_time = datetime.now()
-            logger.debug(f"📡 Проверка запланированных рассылок на {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            logger.debug("📡 Проверка запланированных рассылок на %s", current_time)
             
             # Проверяем статус рассылки
             broadcast_status = self.db.get_broadcast_status()
@@ -354,124 +502,130 @@ class MessageScheduler:
                 logger.debug("❌ Массовые рассылки отключены")
                 return
             
-            # Получаем рассылки, готовые к отправке
-            pending_broadcasts = self.db.get_pending_broadcasts()
-            
-            if not pending_broadcasts:
-                logger.debug("📭 Нет запланированных рассылок для отправки")
-                return
-            
-            logger.info(f"📡 Найдено {len(pending_broadcasts)} запланированных рассылок для отправки")
-            
-            # Получаем пользователей, которые могут получать рассылки (активные, с bot_started=1)
-            users_with_bot = self.db.get_users_with_bot_started()
-            
-            if not users_with_bot:
-                logger.warning("⚠️ Нет пользователей для массовой рассылки")
-                # Отмечаем рассылки как отправленные
-                for broadcast_id, message_text, photo_url, scheduled_time in pending_broadcasts:
-                    self.db.mark_broadcast_sent(broadcast_id)
-                return
-            
-            logger.info(f"👥 Будем отправлять рассылки {len(users_with_bot)} пользователям")
-            
-            for broadcast_id, message_text, photo_url, scheduled_time in pending_broadcasts:
-                try:
-                    logger.info(f"📤 Начинаем отправку рассылки #{broadcast_id}")
-                    
-                    # Получаем кнопки для этой рассылки
-                    buttons = self.db.get_scheduled_broadcast_buttons(broadcast_id)
-                    
-                    sent_count = 0
-                    failed_count = 0
-                    
-                    # Отправляем всем пользователям
-                    for user in users_with_bot:
-                        user_id = user[0]
-                        has_paid = user[6] if len(user) > 6 else False
-                        
-                        try:
-                            # Небольшая задержка между отправками
-                            await asyncio.sleep(0.1)
-                            
-                            # НОВОЕ: Обрабатываем контент с UTM метками для каждого пользователя
-                            processed_text, processed_buttons = self.process_message_content(message_text, buttons, user_id)
-                            
-                            reply_markup = None
-                            if processed_buttons:
-                                keyboard = []
-                                
-                                for button_id, button_text, button_url, position in processed_buttons:
-                                    if button_url and button_url.strip():
-                                        # URL кнопка
-                                        keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                                    else:
-                                        # Callback кнопка
-                                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
-                                
-                                reply_markup = InlineKeyboardMarkup(keyboard)
-                                logger.debug(f"🔘 Добавлены кнопки к рассылке #{broadcast_id} для пользователя {user_id}: {len(processed_buttons)} кнопок")
-                            
-                            if photo_url:
-                                # Отправляем с фото
-                                await context.bot.send_photo(
-                                    chat_id=user_id,
-                                    photo=photo_url,
-                                    caption=processed_text,
-                                    parse_mode='HTML',
-                                    reply_markup=reply_markup
-                                )
-                            else:
-                                # Отправляем только текст
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=processed_text,
-                                    parse_mode='HTML',
-                                    disable_web_page_preview=True,
-                                    reply_markup=reply_markup
-                                )
-                            
-                            # 📊 НОВОЕ: Логируем отправку массовой рассылки для воронки
-                            # Используем отрицательный ID для отличия от обычных сообщений
-                            self.db.log_message_delivery(user_id, -broadcast_id)
-                            
-                            sent_count += 1
-                            
-                        except Forbidden as e:
-                            # Пользователь заблокировал бота
-                            logger.warning(f"❌ Пользователь {user_id} заблокировал бота при рассылке #{broadcast_id}: {e}")
-                            # Деактивируем пользователя
-                            self.db.deactivate_user(user_id)
-                            failed_count += 1
-                            
-                        except BadRequest as e:
-                            # Неверный chat_id или другая ошибка
-                            logger.error(f"❌ BadRequest для пользователя {user_id} при рассылке #{broadcast_id}: {e}")
-                            failed_count += 1
-                            
-                        except Exception as e:
-                            logger.error(f"❌ Не удалось отправить рассылку #{broadcast_id} пользователю {user_id}: {e}")
-                            failed_count += 1
-                    
-                    # Отмечаем рассылку как отправленную
-                    self.db.mark_broadcast_sent(broadcast_id)
-                    
-                    logger.info(f"✅ Рассылка #{broadcast_id} завершена с UTM метками: отправлено {sent_count}, ошибок {failed_count}")
-                    
-                    # Пауза между разными рассылками
-                    if len(pending_broadcasts) > 1:
-                        await asyncio.sleep(2)
-                    
-                except Exception as e:
-                    logger.error(f"❌ Критическая ошибка при отправке рассылки #{broadcast_id}: {e}")
-                    # Отмечаем как отправленную, чтобы не зацикливаться
-                    self.db.mark_broadcast_sent(broadcast_id)
-            
-            logger.info(f"📊 Обработка запланированных рассылок завершена")
+            for funnel in self.db.FUNNELS:
+                await self._send_funnel_broadcasts(context, funnel)
                         
         except Exception as e:
             logger.error(f"❌ Критическая ошибка в send_scheduled_broadcasts: {e}", exc_info=True)
     
+    async def _send_funnel_broadcasts(self, context: ContextTypes.DEFAULT_TYPE, funnel):
+        """Отправить готовые массовые рассылки одной воронки ее аудитории рассылок"""
+        funnel = self.db.FUNNELS[funnel]
+        queue = f"{funnel.table_prefix}broadcast"
+        
+        # Захватываем рассылки, готовые к отправке (другие воркеры их уже не возьмут)
+        pending_broadcasts = self.db.claim_funnel_broadcasts(self.worker_id, funnel.name, limit=self.claim_batch_size)
+        
+        if not pending_broadcasts:
+            logger.debug("📭 Нет запланированных рассылок воронки %s для отправки", funnel.name)
+            return
+        
+        logger.info(f"{funnel.log_prefix}📡 Найдено {len(pending_broadcasts)} запланированных рассылок воронки {funnel.name}")
+        
+        # Вся аудитория рассылок воронки — загружается один раз, если нужна рассылкам без сегмента
+        audience_ids = None
+        
+        for broadcast_id, message_text, photo_url, scheduled_time in pending_broadcasts:
+            try:
+                logger.info(f"{funnel.log_prefix}📤 Начинаем отправку рассылки воронки {funnel.name} #{broadcast_id}")
+                
+                segment = self.db.get_funnel_broadcast_segment(funnel.name, broadcast_id)
+                if segment:
+                    recipient_ids = self.db.get_segment_user_ids(segment)
+                else:
+                    if audience_ids is None:
+                        audience_ids = [user[0] for user in self.db.get_funnel_broadcast_recipients(funnel.name)]
+                    recipient_ids = audience_ids
+                
+                if not recipient_ids:
+                    logger.warning(f"⚠️ Нет пользователей для массовой рассылки воронки {funnel.name} #{broadcast_id} (сегмент {segment or 'вся аудитория'})")
+                    # Отмечаем рассылку как отправленную
+                    self.db.mark_funnel_broadcast_sent(funnel.name, broadcast_id)
+                    continue
+                
+                logger.info(f"{funnel.log_prefix}👥 Рассылку #{broadcast_id} получат {len(recipient_ids)} пользователей")
+                
+                # Продлеваем аренду: если рассылку уже перехватил другой воркер, пропускаем её
+                if not self.db.renew_job_lease(funnel.broadcasts_table, broadcast_id, self.worker_id):
+                    logger.warning(f"⚠️ Рассылка воронки {funnel.name} #{broadcast_id} захвачена другим воркером, пропускаем")
+                    continue
+                
+                # Получаем кнопки для этой рассылки
+                buttons = self.db.get_funnel_broadcast_buttons(funnel.name, broadcast_id)
+                
+                sent_count = 0
+                failed_count = 0
+                
+                for index, user_id in enumerate(recipient_ids, 1):
+                    # Периодически продлеваем аренду, чтобы долгую рассылку не перехватили
+                    if index % self.LEASE_RENEW_EVERY == 0:
+                        self.db.renew_job_lease(funnel.broadcasts_table, broadcast_id, self.worker_id)
+                    
+                    try:
+                        # Небольшая задержка между отправками
+                        await asyncio.sleep(0.1)
+                        
+                        # Обрабатываем контент с UTM метками для каждого пользователя
+                        processed_text, processed_buttons = self.process_message_content(message_text, buttons, user_id)
+                        
+                        reply_markup = None
+                        if processed_buttons:
+                            keyboard = []
+                            
+                            for button_id, button_text, button_url, position in processed_buttons:
+                                if button_url and button_url.strip():
+                                    # URL кнопка
+                                    keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
+                                else:
+                                    # Callback кнопка
+                                    keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
+                            
+                            reply_markup = InlineKeyboardMarkup(keyboard)
+                            logger.debug("🔘 Добавлены кнопки к рассылке #%s для пользователя %s: %s кнопок", broadcast_id, user_id, len(processed_buttons))
+                        
+                        await self._send_content(context, user_id, processed_text, photo_url, reply_markup)
+                        
+                        # 📊 Логируем отправку массовой рассылки для воронки: отрицательный ID
+                        # со сдвигом воронки, чтобы не пересекаться с сообщениями и другими воронками
+                        self.db.log_message_delivery(user_id, -(broadcast_id + funnel.broadcast_log_offset))
+                        
+                        sent_count += 1
+                        
+                    except Forbidden as e:
+                        # Пользователь заблокировал бота
+                        logger.warning("❌ Пользователь %s заблокировал бота при рассылке воронки %s #%s: %s", user_id, funnel.name, broadcast_id, e,
+                                       extra=recipient(user_id, queue=queue))
+                        # Деактивируем пользователя
+                        self.db.deactivate_user(user_id)
+                        failed_count += 1
+                        
+                    except BadRequest as e:
+                        # Неверный chat_id или другая ошибка
+                        logger.error("❌ BadRequest для пользователя %s при рассылке воронки %s #%s: %s", user_id, funnel.name, broadcast_id, e,
+                                     extra=recipient(user_id, queue=queue))
+                        failed_count += 1
+                        
+                    except Exception as e:
+                        logger.error("❌ Не удалось отправить рассылку воронки %s #%s пользователю %s: %s", funnel.name, broadcast_id, user_id, e,
+                                     extra=recipient(user_id, queue=queue))
+                        failed_count += 1
+                
+                # Отмечаем рассылку как отправленную
+                self.db.mark_funnel_broadcast_sent(funnel.name, broadcast_id)
+                
+                logger.info(f"✅ Рассылка воронки {funnel.name} #{broadcast_id} завершена с UTM метками: отправлено {sent_count}, ошибок {failed_count}")
+                
+                # Пауза между разными рассылками
+                if len(pending_broadcasts) > 1:
+                    await asyncio.sleep(2)
+                
+            except Exception as e:
+                logger.error(f"❌ Критическая ошибка при отправке рассылки воронки {funnel.name} #{broadcast_id}: {e}")
+                # Отмечаем как отправленную, чтобы не зацикливаться
+                self.db.mark_funnel_broadcast_sent(funnel.name, broadcast_id)
+        
+        logger.info(f"{funnel.log_prefix}📊 Обработка запланированных рассылок воронки {funnel.name} завершена")
+    
     def reschedule_all_messages(self):
         """Перепланировать все сообщения для всех пользователей (при изменении задержек)"""
         # Эта функция может быть полезна, если админ изменил задержки
@@ -493,347 +647,21 @@ class MessageScheduler:
 
     async def schedule_paid_user_messages(self, context: ContextTypes.DEFAULT_TYPE, user_id):
         """Запланировать отправку всех сообщений для оплатившего пользователя"""
-        try:
-            logger.info(f"💰 Начинаем планирование платных сообщений для пользователя {user_id}")
-            
-            # Получаем актуальную информацию о пользователе
-            user_info = self.db.get_user(user_id)
-            if not user_info:
-                logger.error(f"❌ Пользователь {user_id} не найден в базе данных")
-                return False
-                
-            user_id_db, username, first_name, joined_at, is_active, bot_started, has_paid, paid_at = user_info
-            
-            # Проверяем, что пользователь активен
-            if not is_active:
-                logger.warning(f"⚠️ Пользователь {user_id} неактивен (is_active = {is_active})")
-                return False
-            
-            # Проверяем, что пользователь оплатил
-            if not has_paid:
-                logger.warning(f"⚠️ Пользователь {user_id} не оплатил (has_paid = {has_paid})")
-                return False
-            
-            # Проверяем, есть ли уже запланированные платные сообщения
-            existing_messages = self.db.get_user_paid_scheduled_messages(user_id)
-            if existing_messages:
-                logger.info(f"ℹ️ Пользователь {user_id} уже имеет {len(existing_messages)} запланированных платных сообщений")
-                return True
-            
-            # Получаем все сообщения рассылки для оплативших
-            messages = self.db.get_all_paid_broadcast_messages()
-            if not messages:
-                logger.warning("⚠️ Нет сообщений платной рассылки в базе данных")
-                return True  # Это не ошибка, просто нет настроенных сообщений
-            
-            logger.info(f"📋 Найдено {len(messages)} платных сообщений рассылки для планирования")
-            
-            current_time = datetime.now()
-            logger.info(f"💰 ⏰ Планирование платных сообщений для пользователя {user_id} (@{username}), текущее время: {current_time}")
-            
-            scheduled_count = 0
-            for message_number, text, delay_hours, photo_url in messages:
-                try:
-                    # Вычисляем время отправки от момента оплаты
-                    scheduled_time = current_time + timedelta(hours=delay_hours)
-                    
-                    # Добавляем в расписание
-                    success = self.db.schedule_paid_message(user_id, message_number, scheduled_time)
-                    if success:
-                        scheduled_count += 1
-                        
-                        # Форматируем время для логов
-                        time_diff = scheduled_time - current_time
-                        if time_diff.total_seconds() < 3600:  # Меньше часа
-                            time_str = f"{int(time_diff.total_seconds() / 60)} минут"
-                        else:
-                            time_str = f"{delay_hours} часов"
-                        
-                        logger.info(f"✅ Запланировано платное сообщение {message_number} для пользователя {user_id} на {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')} (через {time_str})")
-                    else:
-                        logger.error(f"❌ Не удалось запланировать платное сообщение {message_number} для пользователя {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при планировании платного сообщения {message_number} для пользователя {user_id}: {e}")
-                    continue
-            
-            if scheduled_count > 0:
-                logger.info(f"💰 🎉 Всего запланировано {scheduled_count} платных сообщений для пользователя {user_id}")
-                return True
-            else:
-                logger.warning(f"⚠️ Не удалось запланировать ни одного платного сообщения для пользователя {user_id}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка при планировании платных сообщений для пользователя {user_id}: {e}", exc_info=True)
-            return False
-
-    async def send_scheduled_paid_messages(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить все запланированные платные сообщения"""
-        try:
-            current_time = datetime.now()
-            logger.debug(f"💰 🔄 Проверка запланированных платных сообщений на {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Проверяем статус рассылки
-            broadcast_status = self.db.get_broadcast_status()
-            
-            # Если рассылка отключена, пропускаем
-            if not broadcast_status['enabled']:
-                logger.debug("❌ Платные рассылки отключены")
-                return
-            
-            # Получаем платные сообщения, готовые к отправке
-            pending_messages = self.db.get_pending_paid_messages()
-            
-            if not pending_messages:
-                logger.debug("💰 📭 Нет платных сообщений для отправки")
-                return
-            
-            logger.info(f"💰 📬 Найдено {len(pending_messages)} платных сообщений для отправки")
-            
-            sent_count = 0
-            failed_count = 0
-            
-            for message_id, user_id, message_number, text, photo_url in pending_messages:
-                try:
-                    logger.debug(f"💰 📤 Отправляем платное сообщение {message_number} пользователю {user_id}")
-                    
-                    # Убеждаемся, что пользователь еще оплачен и активен
-                    user_info = self.db.get_user(user_id)
-                    if not user_info or not user_info[4] or not user_info[6]:  # is_active, has_paid
-                        logger.warning(f"💰 ⚠️ Пользователь {user_id} больше не активен или не оплачен, пропускаем платное сообщение {message_number}")
-                        self.db.mark_paid_message_sent(message_id)
-                        continue
-                    
-                    # Небольшая задержка между отправками
-                    await asyncio.sleep(0.1)
-                    
-                    # Получаем кнопки для этого сообщения
-                    buttons = self.db.get_paid_message_buttons(message_number)
-                    
-                    # Обрабатываем контент с UTM метками
-                    processed_text, processed_buttons = self.process_message_content(text, buttons, user_id)
-                    
-                    reply_markup = None
-                    if processed_buttons:
-                        keyboard = []
-                        
-                        for button_id, button_text, button_url, position in processed_buttons:
-                            if button_url and button_url.strip():
-                                # URL кнопка
-                                keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                            else:
-                                # Callback кнопка
-                                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
-                        
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        logger.debug(f"💰 🔘 Добавлены кнопки к платному сообщению {message_number}: {len(processed_buttons)} кнопок")
-                    
-                    # Отправляем сообщение
-                    if photo_url:
-                        # Отправляем с фото
-                        await context.bot.send_photo(
-                            chat_id=user_id,
-                            photo=photo_url,
-                            caption=processed_text,
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"💰 🖼️ Отправлено платное сообщение с фото")
-                    else:
-                        # Отправляем только текст
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=processed_text,
-                            parse_mode='HTML',
-                            disable_web_page_preview=True,
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"💰 📝 Отправлено платное текстовое сообщение")
-                    
-                    # Отмечаем как отправленное
-                    self.db.mark_paid_message_sent(message_id)
-                    
-                    # 📊 НОВОЕ: Логируем отправку платного сообщения для воронки
-                    # Используем положительный номер сообщения для платных сообщений
-                    self.db.log_message_delivery(user_id, message_number)
-                    
-                    sent_count += 1
-                    
-                    logger.info(f"✅ Отправлено платное сообщение {message_number} пользователю {user_id} с UTM метками")
-                    
-                except Forbidden as e:
-                    # Пользователь заблокировал бота
-                    logger.warning(f"❌ Пользователь {user_id} заблокировал бота при отправке платного сообщения: {e}")
-                    self.db.mark_paid_message_sent(message_id)
-                    self.db.deactivate_user(user_id)
-                    failed_count += 1
-                    
-                except BadRequest as e:
-                    # Неверный chat_id или другая ошибка
-                    logger.error(f"❌ BadRequest для пользователя {user_id} при отправке платного сообщения: {e}")
-                    self.db.mark_paid_message_sent(message_id)
-                    failed_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить платное сообщение {message_id} пользователю {user_id}: {e}")
-                    failed_count += 1
-            
-            if sent_count > 0 or failed_count > 0:
-                logger.info(f"💰 📊 Результаты платной рассылки: отправлено {sent_count}, ошибок {failed_count}")
-                        
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка в send_scheduled_paid_messages: {e}", exc_info=True)
-
-    async def send_scheduled_paid_broadcasts(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить запланированные массовые рассылки для оплативших"""
-        try:
-            current_time = datetime.now()
-            logger.debug(f"💰 📡 Проверка запланированных рассылок для оплативших на {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Проверяем статус рассылки
-            broadcast_status = self.db.get_broadcast_status()
-            
-            # Если рассылка отключена, пропускаем
-            if not broadcast_status['enabled']:
-                logger.debug("❌ Массовые рассылки для оплативших отключены")
-                return
-            
-            # Получаем рассылки для оплативших, готовые к отправке
-            pending_broadcasts = self.db.get_pending_paid_broadcasts()
-            
-            if not pending_broadcasts:
-                logger.debug("💰 📭 Нет запланированных рассылок для оплативших")
-                return
-            
-            logger.info(f"💰 📡 Найдено {len(pending_broadcasts)} запланированных рассылок для оплативших")
-            
-            # Получаем пользователей, которые оплатили
-            paid_users = self.db.get_users_with_payment()
-            
-            if not paid_users:
-                logger.warning("⚠️ Нет оплативших пользователей для массовой рассылки")
-                # Отмечаем рассылки как отправленные
-                for broadcast_id, message_text, photo_url, scheduled_time in pending_broadcasts:
-                    self.db.mark_paid_broadcast_sent(broadcast_id)
-                return
-            
-            logger.info(f"💰 👥 Будем отправлять рассылки {len(paid_users)} оплатившим пользователям")
-            
-            for broadcast_id, message_text, photo_url, scheduled_time in pending_broadcasts:
-                try:
-                    logger.info(f"💰 📤 Начинаем отправку рассылки для оплативших #{broadcast_id}")
-                    
-                    # Получаем кнопки для этой рассылки
-                    buttons = self.db.get_paid_scheduled_broadcast_buttons(broadcast_id)
-                    
-                    sent_count = 0
-                    failed_count = 0
-                    
-                    # Отправляем всем оплатившим пользователям
-                    for user in paid_users:
-                        user_id = user[0]
-                        
-                        try:
-                            # Небольшая задержка между отправками
-                            await asyncio.sleep(0.1)
-                            
-                            # Обрабатываем контент с UTM метками для каждого пользователя
-                            processed_text, processed_buttons = self.process_message_content(message_text, buttons, user_id)
-                            
-                            reply_markup = None
-                            if processed_buttons:
-                                keyboard = []
-                                
-                                for button_id, button_text, button_url, position in processed_buttons:
-                                    if button_url and button_url.strip():
-                                        # URL кнопка
-                                        keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                                    else:
-                                        # Callback кнопка
-                                        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"next_msg_{user_id}")])
-                                
-                                reply_markup = InlineKeyboardMarkup(keyboard)
-                                logger.debug(f"💰 🔘 Добавлены кнопки к рассылке для оплативших #{broadcast_id} для пользователя {user_id}: {len(processed_buttons)} кнопок")
-                            
-                            if photo_url:
-                                # Отправляем с фото
-                                await context.bot.send_photo(
-                                    chat_id=user_id,
-                                    photo=photo_url,
-                                    caption=processed_text,
-                                    parse_mode='HTML',
-                                    reply_markup=reply_markup
-                                )
-                            else:
-                                # Отправляем только текст
-                                await context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=processed_text,
-                                    parse_mode='HTML',
-                                    disable_web_page_preview=True,
-                                    reply_markup=reply_markup
-                                )
-                            
-                            # 📊 НОВОЕ: Логируем отправку платной массовой рассылки для воронки
-                            # Используем отрицательный ID с префиксом для отличия от обычных рассылок
-                            # Умножаем на 10000 чтобы не пересекаться с обычными рассылками
-                            self.db.log_message_delivery(user_id, -(broadcast_id + 10000))
-                            
-                            sent_count += 1
-                            
-                        except Forbidden as e:
-                            # Пользователь заблокировал бота
-                            logger.warning(f"❌ Пользователь {user_id} заблокировал бота при рассылке для оплативших #{broadcast_id}: {e}")
-                            self.db.deactivate_user(user_id)
-                            failed_count += 1
-                            
-                        except BadRequest as e:
-                            # Неверный chat_id или другая ошибка
-                            logger.error(f"❌ BadRequest для пользователя {user_id} при рассылке для оплативших #{broadcast_id}: {e}")
-                            failed_count += 1
-                            
-                        except Exception as e:
-                            logger.error(f"❌ Не удалось отправить рассылку для оплативших #{broadcast_id} пользователю {user_id}: {e}")
-                            failed_count += 1
-                    
-                    # Отмечаем рассылку как отправленную
-                    self.db.mark_paid_broadcast_sent(broadcast_id)
-                    
-                    logger.info(f"✅ Рассылка для оплативших #{broadcast_id} завершена с UTM метками: отправлено {sent_count}, ошибок {failed_count}")
-                    
-                    # Пауза между разными рассылками
-                    if len(pending_broadcasts) > 1:
-                        await asyncio.sleep(2)
-                    
-                except Exception as e:
-                    logger.error(f"❌ Критическая ошибка при отправке рассылки для оплативших #{broadcast_id}: {e}")
-                    # Отмечаем как отправленную, чтобы не зацикливаться
-                    self.db.mark_paid_broadcast_sent(broadcast_id)
-            
-            logger.info(f"💰 📊 Обработка запланированных рассылок для оплативших завершена")
-                        
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка в send_scheduled_paid_broadcasts: {e}", exc_info=True)
+        return await self.schedule_funnel(context, user_id, 'paid')
 
     async def check_expired_subscriptions(self, context: ContextTypes.DEFAULT_TYPE):
-        """Проверка истекших подписок и отправка уведомлений о продлении"""
+        """Завершить истекшие подписки и отправить уведомления о продлении
+
+        Истекшие выбираются диапазоном payed_till <= сегодня, поэтому
+        пропущенный запуск догоняется. Чанк завершается одной транзакцией
+        вместе с планированием бесплатной воронки, уведомления уходят после
+        нее: завершенная подписка выпадает из диапазона, так что повторный
+        (в том числе ежечасный) запуск ничего не отправит второй раз.
+        """
         try:
-            from datetime import date, datetime
-            import pytz
-            
             current_time = datetime.now()
             logger.info(f"🔄 Проверка истекших подписок на {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
             
-            # Получаем пользователей с истекшей подпиской
-            expired_users = self.db.get_expired_subscriptions()
-            
-            if not expired_users:
-                logger.debug("📭 Нет пользователей с истекшими подписками")
-                return
-            
-            logger.info(f"⏰ Найдено {len(expired_users)} пользователей с истекшими подписками")
-            
             # Получаем настройки сообщения продления
             renewal_data = self.db.get_renewal_message()
             
@@ -841,90 +669,90 @@ class MessageScheduler:
                 logger.error("❌ Не настроено сообщение о продлении подписки")
                 return
             
+            expired_count = 0
             sent_count = 0
             failed_count = 0
             
-            for user_id, username, first_name, payed_till in expired_users:
-                try:
-                    logger.info(f"📤 Отправляем уведомление о продлении пользователю {user_id} (@{username})")
-                    
-                    # Обрабатываем текст с UTM метками
-                    processed_text = utm_utils.process_text_links(renewal_data['text'], user_id)
-                    
-                    # Создаем клавиатуру с кнопкой продления
-                    reply_markup = None
-                    if renewal_data.get('button_text') and renewal_data.get('button_url'):
-                        # Добавляем UTM метки к URL кнопки
-                        processed_url = utm_utils.add_utm_to_url(renewal_data['button_url'], user_id)
-                        
-                        keyboard = [[InlineKeyboardButton(
-                            renewal_data['button_text'], 
-                            url=processed_url
-                        )]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        logger.debug(f"🔘 Добавлена кнопка продления с UTM метками")
-                    
-                    # Отправляем сообщение
-                    if renewal_data.get('photo_url'):
-                        # Отправляем с фото
-                        await context.bot.send_photo(
-                            chat_id=user_id,
-                            photo=renewal_data['photo_url'],
-                            caption=processed_text,
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"🖼️ Отправлено уведомление с фото")
-                    else:
-                        # Отправляем только текст
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=processed_text,
-                            parse_mode='HTML',
-                            disable_web_page_preview=True,
-                            reply_markup=reply_markup
-                        )
-                        logger.debug(f"📝 Отправлено текстовое уведомление")
-                    
-                    # Завершаем подписку пользователя
-                    expire_success = self.db.expire_user_subscription(user_id)
-                    
-                    if expire_success:
-                        # Запланируем обычные сообщения рассылки
-                        schedule_success = await self.schedule_user_messages(context, user_id)
-                        
-                        if schedule_success:
-                            logger.info(f"✅ Пользователь {user_id} переведен на обычные рассылки после истечения подписки")
-                        else:
-                            logger.warning(f"⚠️ Не удалось запланировать обычные сообщения для пользователя {user_id}")
-                    else:
-                        logger.error(f"❌ Не удалось завершить подписку пользователя {user_id}")
-                    
-                    sent_count += 1
-                    
-                    # Небольшая задержка между отправками
-                    await asyncio.sleep(0.2)
-                    
-                except Forbidden as e:
-                    # Пользователь заблокировал бота
-                    logger.warning(f"❌ Пользователь {user_id} заблокировал бота при уведомлении о продлении: {e}")
-                    # Все равно завершаем подписку
-                    self.db.expire_user_subscription(user_id)
-                    self.db.deactivate_user(user_id)
-                    failed_count += 1
-                    
-                except BadRequest as e:
-                    # Неверный chat_id или другая ошибка
-                    logger.error(f"❌ BadRequest для пользователя {user_id} при уведомлении о продлении: {e}")
-                    # Все равно завершаем подписку
-                    self.db.expire_user_subscription(user_id)
-                    failed_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить уведомление о продлении пользователю {user_id}: {e}")
-                    failed_count += 1
-            
-            logger.info(f"📊 Проверка истекших подписок завершена: уведомлений отправлено {sent_count}, ошибок {failed_count}")
+            while True:
+                chunk = self.db.get_expired_subscription_chunk(self.EXPIRY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                
+                free_steps, free_cursor_users = self._plan_free_funnel(chunk, current_time)
+                expired = self.db.expire_subscriptions(
+                    [row[0] for row in chunk], free_steps=free_steps, free_cursor_users=free_cursor_users
+                )
+                if expired is None:
+                    break
+                expired_count += len(expired)
+                expired = set(expired)
+                
+                for user_id, username, first_name, is_active, bot_started, payed_till in chunk:
+                    if user_id not in expired or not is_active:
+                        continue
+                    try:
+                        logger.info("📤 Отправляем уведомление о продлении пользователю %s (@%s)", user_id, username,
+                                    extra=recipient(user_id, queue='renewal'))
+                        
+                        # Небольшая задержка между отправками
+                        await asyncio.sleep(0.1)
+                        await self._send_renewal_notice(context, user_id, renewal_data)
+                        sent_count += 1
+                        
+                        logger.info("✅ Пользователь %s переведен на обычные рассылки после истечения подписки", user_id,
+                                    extra=recipient(user_id, queue='renewal'))
+                        
+                    except Forbidden as e:
+                        # Пользователь заблокировал бота
+                        logger.warning("❌ Пользователь %s заблокировал бота при уведомлении о продлении: %s", user_id, e,
+                                       extra=recipient(user_id, queue='renewal'))
+                        self.db.deactivate_user(user_id)
+                        failed_count += 1
+                        
+                    except BadRequest as e:
+                        # Неверный chat_id или другая ошибка
+                        logger.error("❌ BadRequest для пользователя %s при уведомлении о продлении: %s", user_id, e,
+                                     extra=recipient(user_id, queue='renewal'))
+                        failed_count += 1
+                        
+                    except Exception as e:
+                        logger.error("❌ Не удалось отправить уведомление о продлении пользователю %s: %s", user_id, e,
+                                     extra=recipient(user_id, queue='renewal'))
+                        failed_count += 1
+            
+            if expired_count:
+                logger.info(f"📊 Проверка истекших подписок завершена: завершено {expired_count}, "
+                            f"уведомлений отправлено {sent_count}, ошибок {failed_count}")
+            else:
+                logger.debug("📭 Нет пользователей с истекшими подписками")
                         
         except Exception as e:
             logger.error(f"❌ Критическая ошибка в check_expired_subscriptions: {e}", exc_info=True)
+    
+    def _plan_free_funnel(self, chunk, current_time):
+        """Шаги бесплатной воронки для чанка истекших подписок: (строки очереди, пользователи для курсоров)"""
+        eligible = [user_id for user_id, username, first_name, is_active, bot_started, payed_till in chunk
+                    if is_active and bot_started]
+        if self.engine == self.ENGINE_CURSOR:
+            return [], eligible
+        
+        messages = self.db.get_funnel_messages('free')
+        steps = [(user_id, message_number, current_time + timedelta(hours=delay_hours))
+                 for user_id in eligible
+                 for message_number, text, delay_hours, photo_url in messages]
+        # Чанк стартует воронку одновременно — время сдвигается по бюджету отправок
+        scheduled_times = self.send_calendar.assign([step[2] for step in steps], current_time)
+        return [(user_id, message_number, scheduled_time)
+                for (user_id, message_number, due_time), scheduled_time in zip(steps, scheduled_times)], []
+    
+    async def _send_renewal_notice(self, context: ContextTypes.DEFAULT_TYPE, user_id, renewal_data):
+        """Уведомление о продлении подписки с UTM метками"""
+        processed_text = utm_utils.process_text_links(renewal_data['text'], user_id)
+        
+        # Создаем клавиатуру с кнопкой продления
+        reply_markup = None
+        if renewal_data.get('button_text') and renewal_data.get('button_url'):
+            processed_url = utm_utils.add_utm_to_url(renewal_data['button_url'], user_id)
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(renewal_data['button_text'], url=processed_url)]])
+        
+        await self._send_content(context, user_id, processed_text, renewal_data.get('photo_url'), reply_markup)
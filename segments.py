@@ -0,0 +1,122 @@
+"""
+Сегменты аудитории для массовых рассылок
+
+Раньше рассылку можно было отправить только всем, кто запустил бота
+(get_users_with_bot_started), или всем оплатившим (get_users_with_payment).
+
+Сегмент — условие на пользователей, которое компилируется в один SQL-запрос
+поверх индексов: у каждого вида сегмента есть свой индекс (joined_at,
+доставки и нажатия по номеру сообщения, оплаты по utm_source, частичный
+индекс истекших подписок). Сегмент хранится строкой "вид" или
+"вид:значение" — так он лежит в черновике рассылки и в колонке segment
+запланированной рассылки:
+
+- all — все, кто запустил бота;
+- paid — оплатившие;
+- new:7 — пришли за последние 7 дней;
+- no_click:3 — получили сообщение 3, но не нажали ни одной его кнопки;
+- lapsed — оплатили, но подписка закончилась;
+- utm:vk — оплатили по ссылке с utm_source = vk.
+
+К любому сегменту добавляется аудитория рассылок бесплатной воронки
+(активен и запустил бота) — писать можно только им. Запросы выполняются
+через соединение с аналитической БД, к которой основная подключена как bot.
+"""
+
+import time
+
+# Сегмент по умолчанию: все, кто запустил бота
+DEFAULT_SEGMENT = 'all'
+
+
+class Segment:
+    """Вид сегмента: SQL-условие на bot.users u и параметр из строки сегмента"""
+
+    def __init__(self, kind, title, where, index, param=None, prompt=None, label=None):
+        self.kind = kind
+        self.title = title
+        # Условие с плейсхолдерами ?; значение параметра подставляется во все
+        self.where = where
+        # Индекс users под сегмент: без статистики ANALYZE планировщик выбирает
+        # его не всегда. NOT INDEXED — поиск по первичному ключу из подзапроса
+        self.index = index
+        # Тип параметра (int или str) или None, если сегмент без параметра
+        self.param = param
+        self.prompt = prompt
+        # Подпись с параметром: "Пришли за {value} дн."
+        self.label = label or title
+
+    def parse_value(self, raw):
+        """Значение параметра из ввода админа; ValueError — неверный ввод"""
+        value = self.param(str(raw).strip())
+        if self.param is int and value <= 0:
+            raise ValueError("Параметр сегмента должен быть больше 0")
+        if self.param is str and not value:
+            raise ValueError("Пустой параметр сегмента")
+        return value
+
+    def compile(self, value=None, now=None):
+        """(SQL-условие, параметры) для значения параметра"""
+        if self.param is None:
+            return self.where, []
+        if self.kind == 'new':
+            # Дни -> граница joined_at в секундах unix
+            value = int((now or time.time()) - value * 86400)
+        return self.where, [value] * self.where.count('?')
+
+    def __repr__(self):
+        return f"Segment({self.kind!r})"
+
+
+SEGMENTS = {segment.kind: segment for segment in (
+    Segment('all', "Все, кто запустил бота", '1 = 1', 'INDEXED BY idx_users_audience'),
+    Segment('paid', "Оплатившие", 'u.has_paid = 1', 'INDEXED BY idx_users_audience'),
+    Segment(
+        'new', "Новые за N дней", 'u.joined_at >= ?', 'INDEXED BY idx_users_active_joined', param=int,
+        prompt="📅 За сколько последних дней пришли пользователи?\n\nПример: <code>7</code>",
+        label="Пришли за {value} дн.",
+    ),
+    Segment(
+        'no_click', "Получили сообщение, но не нажали",
+        '''u.user_id IN (SELECT d.user_id FROM message_deliveries d WHERE d.message_number = ?)
+           AND u.user_id NOT IN (SELECT c.user_id FROM button_clicks c WHERE c.message_number = ?)''',
+        'NOT INDEXED', param=int,
+        prompt="📨 Номер сообщения воронки: получили его, но не нажали кнопку\n\nПример: <code>3</code>",
+        label="Получили сообщение {value}, но не нажали",
+    ),
+    Segment('lapsed', "Оплатили, подписка закончилась", 'u.has_paid = 0 AND u.paid_at IS NOT NULL',
+            'INDEXED BY idx_users_lapsed'),
+    Segment(
+        'utm', "Оплатили по utm_source",
+        '''u.user_id IN (SELECT p.user_id FROM payments p
+                         WHERE p.utm_source = ? AND p.payment_status = 'success')''',
+        'NOT INDEXED', param=str,
+        prompt="🔗 Значение utm_source оплаты\n\nПример: <code>vk</code>",
+        label="Оплатили по utm_source = {value}",
+    ),
+)}
+
+
+def parse_segment(spec):
+    """Строка сегмента -> (Segment, значение параметра); ValueError — неизвестный сегмент"""
+    kind, _, raw = (spec or DEFAULT_SEGMENT).partition(':')
+    segment = SEGMENTS.get(kind)
+    if segment is None:
+        raise ValueError(f"Неизвестный сегмент: {spec}")
+    if segment.param is None:
+        return segment, None
+    return segment, segment.parse_value(raw)
+
+
+def segment_spec(kind, value=None):
+    """Строка сегмента для хранения: "вид" или "вид:значение" """
+    return kind if value is None else f"{kind}:{value}"
+
+
+def describe_segment(spec):
+    """Подпись сегмента для админ-панели"""
+    try:
+        segment, value = parse_segment(spec)
+    except ValueError:
+        return f"неизвестный сегмент {spec}"
+    return segment.label.format(value=value)
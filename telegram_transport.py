@@ -0,0 +1,145 @@
+"""
+HTTP-транспорт к Bot API: отдельные пулы для массовых отправок и интерактивных ответов
+
+Раньше все запросы к Telegram шли через один HTTPXRequest: рассылки воронки,
+фоновые массовые рассылки, ответы на нажатия кнопок, approve() заявок и
+редактирование прогресса в админке. Когда рассылка занимала все соединения,
+ответ на нажатие ждал в очереди пула.
+
+Теперь пулов два, у каждого свой профиль нагрузки:
+
+- interactive — обработчики апдейтов: мало соединений, короткие таймауты,
+  ожидание пула не дольше секунды (лучше ошибка, чем зависший ответ);
+- bulk — фоновые рассылки: больше соединений, длинные таймауты чтения и
+  ожидания пула, долгий keep-alive, чтобы соединения не переоткрывались
+  между запусками задач раз в несколько секунд.
+
+Размеры пулов задаются на одного бота и масштабируются числом арендаторов:
+TELEGRAM_INTERACTIVE_CONNECTIONS (8) и TELEGRAM_BULK_CONNECTIONS (16).
+TELEGRAM_HTTP2=on включает HTTP/2, если установлен пакет h2
+(python-telegram-bot[http2]); без него остается HTTP/1.1.
+
+У каждого пула считаются запросы, новые и переиспользованные соединения
+и время ожидания свободного соединения — они видны в /health.
+"""
+
+import importlib.util
+import logging
+import os
+import time
+
+import httpx
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+
+class TransportProfile:
+    """Настройки пула под вид нагрузки"""
+
+    def __init__(self, name, connections_per_bot, connect_timeout, read_timeout,
+                 write_timeout, pool_timeout, keepalive_expiry):
+        self.name = name
+        self.connections_per_bot = connections_per_bot
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+        self.keepalive_expiry = keepalive_expiry
+
+
+INTERACTIVE = TransportProfile(
+    'interactive',
+    connections_per_bot=int(os.environ.get('TELEGRAM_INTERACTIVE_CONNECTIONS', '8')),
+    connect_timeout=5.0, read_timeout=5.0, write_timeout=5.0, pool_timeout=1.0,
+    keepalive_expiry=30.0,
+)
+BULK = TransportProfile(
+    'bulk',
+    connections_per_bot=int(os.environ.get('TELEGRAM_BULK_CONNECTIONS', '16')),
+    connect_timeout=5.0, read_timeout=15.0, write_timeout=15.0, pool_timeout=30.0,
+    keepalive_expiry=120.0,
+)
+
+
+def http2_enabled():
+    """HTTP/2 включен и доступен (нужен пакет h2)"""
+    if os.environ.get('TELEGRAM_HTTP2', 'off') != 'on':
+        return False
+    if importlib.util.find_spec('h2') is None:
+        logger.warning("⚠️ TELEGRAM_HTTP2=on, но пакет h2 не установлен — используем HTTP/1.1")
+        return False
+    return True
+
+
+class PoolMetrics:
+    """Счетчики пула соединений для /health"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.pool_wait_seconds = 0.0
+        self.max_pool_wait_seconds = 0.0
+
+    def record(self, pool_wait, new_connection):
+        self.requests += 1
+        if new_connection:
+            self.new_connections += 1
+        self.pool_wait_seconds += pool_wait
+        self.max_pool_wait_seconds = max(self.max_pool_wait_seconds, pool_wait)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.requests - self.new_connections,
+            'avg_pool_wait_ms': round(self.pool_wait_seconds / self.requests * 1000, 2) if self.requests else 0.0,
+            'max_pool_wait_ms': round(self.max_pool_wait_seconds * 1000, 2),
+        }
+
+
+class TelegramTransport(HTTPXRequest):
+    """HTTPXRequest с профилем нагрузки и метриками пула
+
+    Ожидание пула и переиспользование соединения берутся из трассировки
+    httpcore: первое событие запроса наступает, когда пул выдал соединение;
+    если это connect_tcp — соединение новое, иначе взято из keep-alive.
+    """
+
+    def __init__(self, profile, bots=1, http2=None):
+        self.profile = profile
+        self.metrics = PoolMetrics()
+        connections = profile.connections_per_bot * max(1, bots)
+        http2 = http2_enabled() if http2 is None else http2
+        super().__init__(
+            connection_pool_size=connections,
+            connect_timeout=profile.connect_timeout,
+            read_timeout=profile.read_timeout,
+            write_timeout=profile.write_timeout,
+            pool_timeout=profile.pool_timeout,
+            http_version='2' if http2 else '1.1',
+            httpx_kwargs={
+                'limits': httpx.Limits(
+                    max_connections=connections,
+                    max_keepalive_connections=connections,
+                    keepalive_expiry=profile.keepalive_expiry,
+                ),
+                'event_hooks': {'request': [self._trace_request]},
+            },
+        )
+        logger.info(f"🌐 Пул Bot API {profile.name}: {connections} соединений, HTTP/{'2' if http2 else '1.1'}")
+
+    async def _trace_request(self, request):
+        started = time.perf_counter()
+        state = {'recorded': False}
+
+        async def trace(event_name, info):
+            if state['recorded'] or not event_name.endswith('.started'):
+                return
+            state['recorded'] = True
+            self.metrics.record(time.perf_counter() - started, event_name.startswith('connection.connect_tcp'))
+
+        request.extensions['trace'] = trace
+
+    def stats(self):
+        return dict(self.metrics.as_dict(), connections=self._client_kwargs['limits'].max_connections)
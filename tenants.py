@@ -0,0 +1,242 @@
+"""
+Несколько ботов в одном процессе (мультиарендный режим)
+
+Каждый арендатор (tenant) — отдельный бот со своим токеном, каналом,
+админами и своим файлом БД. Все арендаторы живут в одном event loop:
+aiohttp-приложение одно, Telegram webhook /bot{token} находит бота по токену,
+HTTP-клиенты к Bot API общие (см. telegram_transport), а фоновые задачи
+рассылок крутит одна очередь задач, которая на каждом запуске проходит по
+всем арендаторам.
+
+Список арендаторов задается JSON-файлом (переменная TENANTS_CONFIG):
+
+    {
+      "tenants": [
+        {
+          "name": "school",
+          "bot_token": "123:abc",
+          "channel_id": "@school_channel",
+          "admin_ids": [111, 222],
+          "db_path": "/data/school/bot_database.db",
+          "rate_per_second": 10
+        }
+      ]
+    }
+
+db_path и rate_per_second необязательны: по умолчанию БД лежит в
+{RENDER_DISK_PATH}/{name}/, а бюджет массовых рассылок берется из
+BROADCAST_RATE_PER_SECOND.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from pathlib import Path
+
+from admin import AdminPanel
+from broadcast_jobs import BroadcastJobManager
+from click_tracking import ClickTracker
+from database import Database
+from load_shaping import SendCalendar
+from scheduler import MessageScheduler
+from telegram_transport import BULK, INTERACTIVE, TelegramTransport
+
+logger = logging.getLogger(__name__)
+
+_TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+
+
+class TenantContext:
+    """Минимальный контекст для фоновых задач: планировщику нужен только bot"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+class TenantMetrics:
+    """Счетчики арендатора для /health"""
+
+    def __init__(self):
+        self.updates = 0
+        self.update_errors = 0
+        self.last_update_at = None
+        self.jobs = {}
+
+    def record_update(self, ok=True):
+        self.updates += 1
+        if not ok:
+            self.update_errors += 1
+        self.last_update_at = time.time()
+
+    def record_job(self, name, elapsed, ok=True):
+        runs, errors, total_seconds = self.jobs.get(name, (0, 0, 0.0))
+        self.jobs[name] = (runs + 1, errors + (0 if ok else 1), total_seconds + elapsed)
+
+    def as_dict(self):
+        return {
+            'updates': self.updates,
+            'update_errors': self.update_errors,
+            'last_update_at': self.last_update_at,
+            'jobs': {
+                name: {'runs': runs, 'errors': errors, 'avg_seconds': round(total_seconds / runs, 3)}
+                for name, (runs, errors, total_seconds) in self.jobs.items()
+            },
+        }
+
+
+class Tenant:
+    """Один бот: токен, канал, админы и собственные БД, планировщик и админ-панель"""
+
+    def __init__(self, name, bot_token, channel_id, admin_ids, db_path=None,
+                 rate_per_second=None, url_prefix='', webhook_url=None):
+        self.name = name
+        self.bot_token = bot_token
+        self.channel_id = str(channel_id)
+        self.admin_ids = [int(admin_id) for admin_id in admin_ids]
+        # Префикс маршрутов арендатора: '' у единственного бота, /t/{name} в мультиарендном режиме
+        self.url_prefix = url_prefix
+
+        self.db = Database(db_path)
+        click_tracker = ClickTracker.from_env(bot_token, f"{webhook_url}{url_prefix}" if webhook_url else None)
+        # Один календарь на планировщик и админку: прогноз видит сдвиги планировщика
+        send_calendar = SendCalendar.from_env(self.db)
+        self.scheduler = MessageScheduler(self.db, click_tracker=click_tracker, send_calendar=send_calendar)
+        self.admin_panel = AdminPanel(self.db, self.admin_ids[0])
+        self.admin_panel.send_calendar = send_calendar
+        if rate_per_second:
+            # Собственный бюджет скорости массовых рассылок арендатора
+            self.admin_panel.job_manager = BroadcastJobManager(self.db, rate_per_second=rate_per_second)
+        self.click_redirect = click_tracker.redirect_handler(self.db)
+
+        # Telegram приложение, бот для рассылок, обработчики /start и заявок задает main.build_application
+        self.application = None
+        self.bulk_bot = None
+        self.callback_handler = None
+        self.join_pipeline = None
+        self.metrics = TenantMetrics()
+
+    @property
+    def bot(self):
+        return self.application.bot if self.application else None
+
+    @property
+    def webhook_path(self):
+        return f"/bot{self.bot_token}"
+
+    def is_admin(self, user_id):
+        """Проверяет, является ли пользователь администратором этого бота"""
+        return user_id in self.admin_ids
+
+    def is_channel(self, chat):
+        """Событие пришло из канала этого бота (по ID или @username)"""
+        return str(chat.id) == self.channel_id or chat.username == self.channel_id.replace('@', '')
+
+    def context(self):
+        """Контекст фоновой задачи: рассылки идут через пул bulk, не занимая интерактивный"""
+        return TenantContext(self.bulk_bot or self.bot)
+
+
+class TenantHost:
+    """Все арендаторы процесса: поиск по токену и имени, общие HTTP-клиенты и фоновые задачи"""
+
+    def __init__(self, tenants):
+        self.tenants = list(tenants)
+        self._by_token = {tenant.bot_token: tenant for tenant in self.tenants}
+        self._by_name = {tenant.name: tenant for tenant in self.tenants}
+        # Пулы соединений httpx общие для всех ботов: URL запроса уже содержит токен.
+        # Ответы на апдейты и рассылки ходят через разные пулы и не ждут друг друга
+        self.interactive_request = TelegramTransport(INTERACTIVE, bots=len(self.tenants))
+        self.bulk_request = TelegramTransport(BULK, bots=len(self.tenants))
+
+    @property
+    def multi_tenant(self):
+        return len(self.tenants) > 1 or bool(self.tenants and self.tenants[0].url_prefix)
+
+    @property
+    def default(self):
+        """Бот для маршрутов без /t/{name} — только в режиме одного бота"""
+        return None if self.multi_tenant else self.tenants[0]
+
+    def by_token(self, token):
+        return self._by_token.get(token)
+
+    def by_name(self, name):
+        return self._by_name.get(name)
+
+    def for_each_tenant(self, name, job):
+        """Задача JobQueue, которая выполняет job(tenant) для всех арендаторов параллельно
+
+        Одна очередь задач на процесс вместо своей у каждого бота; ошибка
+        одного арендатора не мешает остальным и попадает в его метрики.
+        """
+        async def run_job(tenant):
+            if tenant.bot is None:
+                return
+            started = time.perf_counter()
+            try:
+                await job(tenant)
+            except Exception as e:
+                tenant.metrics.record_job(name, time.perf_counter() - started, ok=False)
+                logger.error(f"❌ [{tenant.name}] Ошибка фоновой задачи {name}: {e}")
+            else:
+                tenant.metrics.record_job(name, time.perf_counter() - started)
+
+        async def callback(context):
+            await asyncio.gather(*(run_job(tenant) for tenant in self.tenants))
+
+        return callback
+
+    def metrics(self):
+        return {tenant.name: tenant.metrics.as_dict() for tenant in self.tenants}
+
+    def transport_metrics(self):
+        return {
+            'interactive': self.interactive_request.stats(),
+            'bulk': self.bulk_request.stats(),
+        }
+
+
+def load_tenants(config_path, disk_path, webhook_url=None):
+    """Арендаторы из JSON-файла конфигурации (см. описание модуля)"""
+    with open(config_path, encoding='utf-8') as config_file:
+        config = json.load(config_file)
+
+    tenants = []
+    seen_tokens = set()
+    seen_names = set()
+    for entry in config.get('tenants', []):
+        name = entry['name']
+        if not _TENANT_NAME.match(name):
+            raise ValueError(f"Недопустимое имя арендатора {name!r}: a-z, 0-9, '_' и '-', до 32 символов")
+        if name in seen_names:
+            raise ValueError(f"Имя арендатора {name!r} уже используется другим арендатором")
+        if entry['bot_token'] in seen_tokens:
+            raise ValueError(f"Токен бота арендатора {name!r} уже используется другим арендатором")
+        if not entry.get('admin_ids'):
+            raise ValueError(f"У арендатора {name!r} не указаны admin_ids")
+        seen_tokens.add(entry['bot_token'])
+        seen_names.add(name)
+
+        db_path = entry.get('db_path')
+        if not db_path:
+            db_dir = Path(disk_path) / name
+            db_dir.mkdir(parents=True, exist_ok=True)
+            db_path = db_dir / 'bot_database.db'
+
+        tenants.append(Tenant(
+            name=name,
+            bot_token=entry['bot_token'],
+            channel_id=entry['channel_id'],
+            admin_ids=entry['admin_ids'],
+            db_path=db_path,
+            rate_per_second=entry.get('rate_per_second'),
+            url_prefix=f"/t/{name}",
+            webhook_url=webhook_url,
+        ))
+        logger.info(f"🏢 Арендатор {name}: канал {entry['channel_id']}, БД {db_path}")
+
+    if not tenants:
+        raise ValueError(f"В {config_path} нет ни одного арендатора")
+    return tenants
@@ -0,0 +1,122 @@
+"""
+Тест табличного роутера callback-запросов и ввода админ-панели
+"""
+
+import asyncio
+import re
+from pathlib import Path
+
+from admin import AdminPanel
+from admin.router import AdminRouter, prompt, route
+
+# Кнопки, у которых в админ-панели пока нет обработчика
+_UNROUTED_PREFIXES = (
+    "next_msg_", "edit_scheduled_broadcast_", "edit_paid_scheduled_broadcast_",
+    "edit_paid_button_text_", "edit_paid_button_url_", "delete_paid_button_",
+)
+
+
+class FakePanel:
+    CALLBACK_ROUTES = (
+        route("admin_back", "show_main_menu"),
+        route("noop", None),
+        prompt("edit_button_text_{button_id}", "edit_button_text"),
+        route("edit_button_{button_id}", "show_button_edit"),
+        route("export_csv_{export:str}", "export"),
+    )
+
+    def __init__(self):
+        self.calls = []
+
+    async def show_main_menu(self, update, context):
+        self.calls.append(("menu",))
+
+    async def show_button_edit(self, update, context, button_id):
+        self.calls.append(("edit", button_id))
+
+    async def request_text_input(self, update, context, input_type, **kwargs):
+        self.calls.append(("prompt", input_type, kwargs))
+
+    async def export(self, update, context, export):
+        raise RuntimeError(export)
+
+
+def _sample_callback_data():
+    """callback_data всех кнопок админ-панели с подставленными параметрами"""
+    samples = set()
+    for path in Path(__file__).parent.joinpath('admin').glob('*.py'):
+        for data in re.findall(r'callback_data=f?"([^"]+)"', path.read_text(encoding='utf-8')):
+            samples.add(re.sub(r'\{[^}]+\}', '7', data))
+    return samples
+
+
+def test_every_admin_button_has_a_route():
+    """Каждая кнопка админ-панели находит свой маршрут"""
+    router = AdminRouter.collect(AdminPanel, 'CALLBACK_ROUTES')
+    samples = _sample_callback_data()
+    assert len(samples) > 50
+
+    for data in samples:
+        if data.startswith(_UNROUTED_PREFIXES):
+            continue
+        item, params = router.resolve(data)
+        assert item is not None, data
+        assert item.method is None or hasattr(AdminPanel, item.method), item.method
+
+    inputs = AdminRouter.collect(AdminPanel, 'INPUT_ROUTES')
+    for input_type in ("welcome", "mass_text", "renewal_photo", "user_search", "edit_button_url"):
+        assert inputs.resolve(input_type)[0] is not None
+
+
+def test_longest_prefix_and_parameters():
+    """Длинный префикс важнее короткого, параметр должен разобраться"""
+    router = AdminRouter(FakePanel.CALLBACK_ROUTES)
+
+    assert router.resolve("edit_button_text_5")[1] == {"button_id": 5}
+    assert router.resolve("edit_button_text_5")[0].method == "request_text_input"
+    assert router.resolve("edit_button_5")[0].method == "show_button_edit"
+    assert router.resolve("export_csv_users_30")[1] == {"export": "users_30"}
+    # Нечисловой параметр не подходит ни одному маршруту
+    assert router.resolve("edit_button_url_5") == (None, None)
+    assert router.resolve("edit_button_") == (None, None)
+    assert router.resolve("unknown") == (None, None)
+
+    try:
+        AdminRouter(FakePanel.CALLBACK_ROUTES + (route("admin_back", "show_main_menu"),))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Повторный маршрут должен быть отклонен")
+
+
+def test_dispatch_records_metrics():
+    """Вызовы, ошибки и промахи учитываются по маршрутам"""
+    router = AdminRouter(FakePanel.CALLBACK_ROUTES)
+    panel = FakePanel()
+
+    async def run():
+        assert await router.dispatch(panel, "admin_back", None, None)
+        assert await router.dispatch(panel, "edit_button_text_3", None, None)
+        assert await router.dispatch(panel, "noop", None, None)
+        assert not await router.dispatch(panel, "missing", None, None)
+        try:
+            await router.dispatch(panel, "export_csv_users_7", None, None)
+        except RuntimeError:
+            pass
+
+    asyncio.run(run())
+    assert panel.calls == [("menu",), ("prompt", "edit_button_text", {"button_id": 3})]
+
+    stats = router.stats()
+    assert stats['misses'] == 1
+    assert stats['routes']['admin_back']['calls'] == 1
+    assert stats['routes']['export_csv_{export:str}']['errors'] == 1
+    assert 'edit_button_{button_id}' not in stats['routes']
+
+
+if __name__ == "__main__":
+    print("🧪 Тест роутера админ-панели...")
+    test_every_admin_button_has_a_route()
+    test_longest_prefix_and_parameters()
+    test_dispatch_records_metrics()
+    print("✅ Роутер админ-панели работает")
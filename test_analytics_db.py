@@ -0,0 +1,139 @@
+"""
+Тест отдельной аналитической БД
+
+Старая БД с событиями в основном файле переносится миграцией, события
+пишутся через очередь, отчеты читают обе БД через ATTACH.
+"""
+
+import os
+import sqlite3
+import tempfile
+
+from analytics_db import AnalyticsWriteQueue
+from database import Database
+
+DELIVERY_SQL = 'INSERT INTO message_deliveries (user_id, message_number) VALUES (?, ?)'
+
+
+class FlakyWriteQueue(AnalyticsWriteQueue):
+    """Первые две записи пачки упираются в занятую БД"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = 0
+
+    def _write_batch(self, conn, batch):
+        self.attempts += 1
+        if self.attempts <= 2:
+            raise sqlite3.OperationalError('database is locked')
+        super()._write_batch(conn, batch)
+
+
+def _deliveries(db):
+    conn = sqlite3.connect(db.analytics_db_path)
+    try:
+        return sorted(row[0] for row in conn.execute('SELECT user_id FROM message_deliveries'))
+    finally:
+        conn.close()
+
+
+class PreAnalyticsDatabase(Database):
+    """Схема до выноса событий в отдельную БД"""
+    MIGRATIONS = Database.MIGRATIONS[:2]
+
+
+def test_migration_moves_existing_events():
+    """Накопленные события копируются в аналитическую БД без потерь"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        PreAnalyticsDatabase(db_path)
+
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO users (user_id, username, first_name, bot_started, has_paid) VALUES (1, 'u1', 'Анна', 1, 1)")
+        conn.executemany('INSERT INTO message_deliveries (user_id, message_number) VALUES (1, ?)', [(1,), (2,)])
+        conn.execute("INSERT INTO button_clicks (user_id, message_number, button_type, button_text) VALUES (1, 1, 'callback', 'Далее')")
+        conn.execute("INSERT INTO payments (user_id, amount, payment_status) VALUES (1, '990', 'success')")
+        conn.commit()
+        conn.close()
+
+        db = Database(db_path)
+        assert db.schema_version == Database.MIGRATIONS[-1][0]
+
+        analytics = sqlite3.connect(db.analytics_db_path)
+        assert analytics.execute('SELECT COUNT(*) FROM message_deliveries').fetchone()[0] == 2
+        assert analytics.execute('SELECT COUNT(*) FROM button_clicks').fetchone()[0] == 1
+        assert analytics.execute('SELECT COUNT(*) FROM payments').fetchone()[0] == 1
+        analytics.close()
+
+        # В основной БД таблиц событий больше нет, исходные данные сохранены в legacy_*
+        main = sqlite3.connect(db_path)
+        tables = {row[0] for row in main.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        main.close()
+        assert not tables & set(Database.ANALYTICS_TABLES)
+        assert {f"legacy_{table}" for table in Database.ANALYTICS_TABLES} <= tables
+
+        # Отчеты с join на users работают через ATTACH
+        stats = db.get_payment_statistics()
+        assert stats['total_payments'] == 1
+        assert stats['recent_payments'][0][1] == 'Анна'
+
+        details = db.get_message_details(1)
+        assert details['delivered'] == 1
+        assert details['clicked_callback_count'] == 1
+
+
+def test_events_are_written_through_queue():
+    """События из очереди попадают в аналитическую БД пачками"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+
+        for user_id in range(1, 301):
+            assert db.log_message_delivery(user_id, 1)
+        assert db.log_button_click(1, 1, None, 'callback', 'Далее')
+        db.flush_analytics()
+
+        funnel = {row['message_number']: row for row in db.get_funnel_data()}
+        assert funnel[1]['delivered'] == 300
+        assert funnel[1]['clicked_callback'] == 1
+
+        info = db.get_database_info(full=True)
+        assert info['message_deliveries_count'] == 300
+        assert info['button_clicks_count'] == 1
+
+
+def test_locked_database_is_retried():
+    """Временная ошибка (БД занята) повторяется с паузой, пачка не теряется"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        writes = FlakyWriteQueue(db.analytics_db_path, flush_interval=0.05, retry_backoff=0.01)
+        for user_id in (1, 2, 3):
+            writes.put(DELIVERY_SQL, (user_id, 1))
+        writes.flush()
+
+        assert writes.attempts == 3
+        assert _deliveries(db) == [1, 2, 3]
+
+
+def test_bad_event_does_not_discard_batch():
+    """Событие, которое БД отвергает, отбрасывается одно, остальные из пачки записываются"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        writes = AnalyticsWriteQueue(db.analytics_db_path, flush_interval=0.05, retry_backoff=0.01)
+        for user_id in range(1, 11):
+            writes.put(DELIVERY_SQL, (user_id, 1))
+            if user_id == 5:
+                writes.put('INSERT INTO missing_events (user_id) VALUES (?)', (user_id,))
+        writes.flush()
+
+        assert _deliveries(db) == list(range(1, 11))
+
+
+if __name__ == "__main__":
+    print("🧪 Тест переноса событий в аналитическую БД...")
+    test_migration_moves_existing_events()
+    print("✅ События перенесены")
+    print("🧪 Тест очереди записи событий...")
+    test_events_are_written_through_queue()
+    test_locked_database_is_retried()
+    test_bad_event_does_not_discard_batch()
+    print("✅ Очередь записи работает, временные ошибки повторяются, плохое событие не теряет пачку")
@@ -0,0 +1,108 @@
+"""
+Тест отчетов на read-only снимке БД
+"""
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+from analytics_snapshot import AnalyticsSnapshotExecutor
+from database import Database
+
+
+def _add_user(db_path, user_id):
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        'INSERT INTO users (user_id, username, first_name, is_active, bot_started) VALUES (?, ?, ?, 1, 1)',
+        (user_id, f"user{user_id}", "Test")
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_reports_are_memoized_and_refreshed():
+    """Повторный запрос берется из кэша, после сброса — считается на свежем снимке"""
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = Database(os.path.join(tmp_dir, 'bot.db'))
+            _add_user(db.db_path, 1)
+            analytics = AnalyticsSnapshotExecutor(db, max_age=60, ttl=60)
+
+            try:
+                first = await analytics.query('get_user_statistics')
+                assert first['total_users'] == 1
+
+                # Новые данные не видны, пока действуют кэш и снимок
+                _add_user(db.db_path, 2)
+                assert await analytics.query('get_user_statistics') is first
+
+                analytics.invalidate()
+                refreshed = await analytics.query('get_user_statistics')
+                assert refreshed['total_users'] == 2
+
+                details = await analytics.query('get_message_details', 1)
+                assert details['delivered'] == 0
+            finally:
+                analytics.close()
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_is_read_only():
+    """Через снимок нельзя случайно изменить данные"""
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = Database(os.path.join(tmp_dir, 'bot.db'))
+            analytics = AnalyticsSnapshotExecutor(db)
+
+            try:
+                await analytics.query('get_funnel_data')
+                conn = analytics._snapshot._get_connection()
+                with pytest.raises(sqlite3.OperationalError):
+                    conn.execute("INSERT INTO users (user_id) VALUES (1)")
+                conn.close()
+            finally:
+                analytics.close()
+
+    asyncio.run(scenario())
+
+
+def test_retired_snapshot_outlives_running_reports():
+    """Старый снимок удаляется только после того, как на нем завершится последний отчет"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_user(db.db_path, 1)
+        analytics = AnalyticsSnapshotExecutor(db, max_age=60, ttl=60, snapshot_dir=tmp_dir)
+
+        try:
+            running = analytics._acquire()
+            analytics.invalidate()
+            fresh = analytics._acquire()
+            assert fresh is not running and running.retired
+
+            # Отчет на старом снимке открывает новое соединение уже после замены
+            assert running.get_user_statistics()['total_users'] == 1
+            assert os.path.exists(running.db_path)
+
+            analytics._release(running)
+            assert not os.path.exists(running.db_path)
+            analytics._release(fresh)
+            assert os.path.exists(fresh.db_path)
+            assert os.path.dirname(os.path.dirname(fresh.db_path)).startswith(tmp_dir)
+        finally:
+            analytics.close()
+
+
+if __name__ == "__main__":
+    print("🧪 Тест кэша и обновления снимка...")
+    test_reports_are_memoized_and_refreshed()
+    print("✅ Кэш и снимок работают")
+    print("🧪 Тест read-only снимка...")
+    test_snapshot_is_read_only()
+    print("✅ Снимок доступен только на чтение")
+    print("🧪 Тест удаления старого снимка...")
+    test_retired_snapshot_outlives_running_reports()
+    print("✅ Старый снимок живет, пока на нем идут отчеты")
@@ -0,0 +1,225 @@
+"""
+Тест фоновых массовых рассылок: бюджет скорости, одновременные рассылки, пауза/отмена, RetryAfter и троттлинг прогресса
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from broadcast_jobs import BroadcastJob, BroadcastJobManager, ProgressReporter, RateLimiter
+from database import Database
+from test_funnel_engine import FakeBot
+
+
+class FakeMessage:
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.edits.append(text)
+
+
+class ProgressBot(FakeBot):
+    """Бот админа: сообщение прогресса можно редактировать"""
+
+    def __init__(self):
+        super().__init__()
+        self.edits = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await super().send_message(chat_id, text, **kwargs)
+        return FakeMessage(self)
+
+
+class GateBot(FakeBot):
+    """Каждая отправка ждет разрешения из теста"""
+
+    def __init__(self):
+        super().__init__()
+        self.steps = asyncio.Queue()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.steps.get()
+        await super().send_message(chat_id, text, **kwargs)
+
+
+class YieldingBot(FakeBot):
+    """Каждая отправка уступает цикл событий другим задачам"""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        await super().send_message(chat_id, text, **kwargs)
+
+
+class RetryAfterBot(FakeBot):
+    """10 — просит подождать один раз, 11 — каждый раз"""
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts.append(chat_id)
+        if chat_id == 11 or (chat_id == 10 and self.attempts.count(10) == 1):
+            raise RetryAfter(timedelta(milliseconds=50))
+        await super().send_message(chat_id, text, **kwargs)
+
+
+async def _ticks(count=20):
+    for _ in range(count):
+        await asyncio.sleep(0)
+
+
+def test_rate_limiter_paces_sends():
+    """После исчерпания burst отправки идут не чаще rate в секунду, RetryAfter тормозит всех"""
+    async def scenario():
+        limiter = RateLimiter(50, burst=2)
+        started = time.monotonic()
+        for _ in range(7):
+            await limiter.acquire()
+        paced = time.monotonic() - started
+        # 2 из burst сразу, еще 5 — по 20 мс
+        assert 0.09 <= paced < 0.5
+
+        started = time.monotonic()
+        await limiter.penalize(0.05)
+        await limiter.acquire()
+        # Пауза Telegram плюс пустое ведро
+        assert time.monotonic() - started >= 0.065
+
+    asyncio.run(scenario())
+
+
+def test_jobs_send_concurrently():
+    """Рассылки отправляются одновременно; рассылка на паузе не задерживает остальные"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        manager = BroadcastJobManager(db, rate_per_second=1000, progress_interval=0)
+        manager.send_bot = YieldingBot()
+        admin_bot = ProgressBot()
+
+        async def scenario():
+            first = manager.submit(admin_bot, 1, {"message_text": "Первая"}, [10, 11, 12])
+            second = manager.submit(admin_bot, 1, {"message_text": "Вторая"}, [20, 21, 22])
+            paused = manager.submit(admin_bot, 1, {"message_text": "На паузе"}, [30, 31])
+            assert manager.pause(paused.job_id)
+
+            await asyncio.wait_for(asyncio.gather(first.task, second.task), 5)
+            assert (first.status, first.sent) == (BroadcastJob.DONE, 3)
+            assert (second.status, second.sent) == (BroadcastJob.DONE, 3)
+            assert (paused.status, paused.sent) == (BroadcastJob.PAUSED, 0)
+
+            assert manager.resume(paused.job_id)
+            await asyncio.wait_for(paused.task, 5)
+            assert (paused.status, paused.sent) == (BroadcastJob.DONE, 2)
+
+        asyncio.run(scenario())
+        sent = [chat_id for chat_id, text, markup in manager.send_bot.sent]
+        # Вторая рассылка начала отправку до того, как первая закончила
+        assert sent.index(20) < sent.index(12)
+        assert sorted(sent[:6]) == [10, 11, 12, 20, 21, 22] and sent[6:] == [30, 31]
+
+
+def test_max_concurrent_queue_pause_resume_cancel():
+    """С пределом слотов лишние рассылки ждут в очереди, пауза освобождает слот; пауза и отмена работают и в очереди"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        manager = BroadcastJobManager(db, rate_per_second=1000, progress_interval=0, max_concurrent=1)
+        manager.send_bot = GateBot()
+        admin_bot = ProgressBot()
+
+        async def scenario():
+            first = manager.submit(admin_bot, 1, {"message_text": "Первая"}, [10, 11, 12])
+            second = manager.submit(admin_bot, 1, {"message_text": "Вторая"}, [20, 21])
+            third = manager.submit(admin_bot, 1, {"message_text": "Третья"}, [30])
+            await _ticks()
+            assert (first.status, second.status, third.status) == (
+                BroadcastJob.RUNNING, BroadcastJob.QUEUED, BroadcastJob.QUEUED
+            )
+            assert "В очереди" in second.progress_text()
+
+            # Пауза в очереди снимается обратно в очередь, отмена в очереди завершает задачу
+            assert manager.pause(third.job_id) and manager.resume(third.job_id)
+            await _ticks()
+            assert third.status == BroadcastJob.QUEUED
+            assert manager.cancel(third.job_id)
+            await asyncio.wait_for(third.task, 5)
+            assert (third.status, third.sent) == (BroadcastJob.CANCELLED, 0)
+
+            # Первая на паузе отдает слот второй
+            assert manager.pause(first.job_id)
+            manager.send_bot.steps.put_nowait(True)
+            await _ticks()
+            assert (first.status, first.sent) == (BroadcastJob.PAUSED, 1)
+            assert second.status == BroadcastJob.RUNNING
+
+            for _ in range(2):
+                manager.send_bot.steps.put_nowait(True)
+            await asyncio.wait_for(second.task, 5)
+            assert (second.status, second.sent) == (BroadcastJob.DONE, 2)
+            assert (first.status, first.sent) == (BroadcastJob.PAUSED, 1)
+
+            assert manager.resume(first.job_id) and first.status == BroadcastJob.RUNNING
+            for _ in range(2):
+                manager.send_bot.steps.put_nowait(True)
+            await asyncio.wait_for(first.task, 5)
+
+            assert (first.status, first.sent) == (BroadcastJob.DONE, 3)
+            assert not manager.pause(first.job_id) and not manager.cancel(third.job_id)
+            assert first.control_markup() is None
+
+        asyncio.run(scenario())
+        assert [chat_id for chat_id, text, markup in manager.send_bot.sent] == [10, 20, 21, 11, 12]
+
+
+def test_retry_after_penalizes_and_retries_once():
+    """RetryAfter: пауза для всего бюджета и одна повторная попытка"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        manager = BroadcastJobManager(db, rate_per_second=1000, progress_interval=0)
+        manager.send_bot = RetryAfterBot()
+
+        async def scenario():
+            started = time.monotonic()
+            job = manager.submit(ProgressBot(), 1, {"message_text": "Привет"}, [10, 11, 12])
+            await job.task
+            return job, time.monotonic() - started
+
+        job, elapsed = asyncio.run(scenario())
+        assert manager.send_bot.attempts == [10, 10, 11, 11, 12]
+        assert (job.sent, job.failed) == (2, 1)
+        assert elapsed >= 0.15
+
+
+def test_progress_reporter_throttles():
+    """Прогресс редактируется не чаще interval, одинаковый текст не переотправляется"""
+    async def scenario():
+        bot = ProgressBot()
+        reporter = ProgressReporter(bot, 1, interval=60)
+        await reporter.publish("0%", force=True)
+        await reporter.publish("50%")
+        assert len(bot.sent) == 1 and bot.edits == []
+
+        await reporter.publish("100%", force=True)
+        assert bot.edits == ["100%"]
+
+        reporter.interval = 0
+        await reporter.publish("100%")
+        await reporter.publish("✅")
+        assert bot.edits == ["100%", "✅"] and len(bot.sent) == 1
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("🧪 Тест фоновых рассылок...")
+    test_rate_limiter_paces_sends()
+    test_jobs_send_concurrently()
+    test_max_concurrent_queue_pause_resume_cancel()
+    test_retry_after_penalizes_and_retries_once()
+    test_progress_reporter_throttles()
+    print("✅ Одновременные рассылки, очередь слотов, бюджет скорости и прогресс работают")
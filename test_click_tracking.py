@@ -0,0 +1,98 @@
+"""
+Тест учета нажатий URL-кнопок через редирект /r/{token}
+"""
+
+import asyncio
+import os
+import tempfile
+
+from click_tracking import TOKEN_LENGTH, ClickTracker
+from database import Database
+from scheduler import MessageScheduler
+from test_funnel_engine import FakeContext
+
+
+def test_token_roundtrip_and_tampering():
+    """Токен разбирается обратно, подделка и чужой ключ отклоняются"""
+    tracker = ClickTracker('secret', 'https://bot.example.com/')
+    token = tracker.make_token('paid', 123456789012, 7, 42)
+
+    assert len(token) == TOKEN_LENGTH
+    assert tracker.parse_token(token) == ('paid', 123456789012, 7, 42)
+    assert tracker.redirect_url('paid', 123456789012, 7, 42) == f"https://bot.example.com/r/{token}"
+
+    tampered = token[:3] + ('A' if token[3] != 'A' else 'B') + token[4:]
+    assert tracker.parse_token(tampered) is None
+    assert tracker.parse_token(token[:-1]) is None
+    assert tracker.parse_token('!' * TOKEN_LENGTH) is None
+    assert ClickTracker('other', 'https://bot.example.com').parse_token(token) is None
+
+
+def test_tenant_tokens_are_not_interchangeable():
+    """С общим CLICK_TRACKING_SECRET ключ все равно свой у каждого арендатора"""
+    previous = os.environ.get('CLICK_TRACKING_SECRET')
+    os.environ['CLICK_TRACKING_SECRET'] = 'shared'
+    try:
+        school = ClickTracker.from_env('111:school-token', 'https://bot.example.com/school')
+        shop = ClickTracker.from_env('222:shop-token', 'https://bot.example.com/shop')
+    finally:
+        if previous is None:
+            os.environ.pop('CLICK_TRACKING_SECRET')
+        else:
+            os.environ['CLICK_TRACKING_SECRET'] = previous
+
+    token = school.make_token('free', 1, 1, 1)
+    assert school.parse_token(token) == ('free', 1, 1, 1)
+    assert shop.parse_token(token) is None
+    # Общий секрет входит в ключ
+    assert ClickTracker('111:school-token').parse_token(token) is None
+
+
+def test_click_is_logged_and_redirected():
+    """Переход по ссылке пишет клик и ведет на адрес кнопки с UTM метками"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        tracker = ClickTracker('secret', 'https://bot.example.com')
+        db.add_user(1, "user1", "Test")
+        db.mark_user_started_bot(1)
+        db.add_message_button(1, "Сайт", "https://example.com/page")
+
+        # Кнопка в сообщении воронки ведет на редирект, а не прямо на сайт
+        context = FakeContext()
+        scheduler = MessageScheduler(db, engine='cursor', click_tracker=tracker)
+        asyncio.run(scheduler.schedule_user_messages(context, 1))
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1))
+        url = context.bot.sent[0][2].inline_keyboard[0][0].url
+        assert url.startswith("https://bot.example.com/r/")
+
+        target = tracker.resolve_click(db, url.rsplit('/', 1)[1])
+        assert target == "https://example.com/page?utm_source=bot&utm_id=1"
+        assert tracker.resolve_click(db, tracker.make_token('free', 1, 1, 999)) is None
+
+        db.flush_analytics()
+        assert db.get_funnel_data()[0]['clicked_url'] == 1
+
+
+def test_direct_links_without_base_url():
+    """Без адреса бота кнопки остаются прямыми ссылками с UTM метками"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        db.add_user(1, "user1", "Test")
+        db.mark_user_started_bot(1)
+        db.add_message_button(1, "Сайт", "https://example.com/page")
+
+        context = FakeContext()
+        scheduler = MessageScheduler(db, engine='cursor', click_tracker=ClickTracker('secret'))
+        asyncio.run(scheduler.schedule_user_messages(context, 1))
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1))
+        url = context.bot.sent[0][2].inline_keyboard[0][0].url
+        assert url == "https://example.com/page?utm_source=bot&utm_id=1"
+
+
+if __name__ == "__main__":
+    print("🧪 Тест учета нажатий URL-кнопок...")
+    test_token_roundtrip_and_tampering()
+    test_tenant_tokens_are_not_interchangeable()
+    test_click_is_logged_and_redirected()
+    test_direct_links_without_base_url()
+    print("✅ Учет нажатий URL-кнопок работает")
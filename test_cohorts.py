@@ -0,0 +1,146 @@
+"""
+Тест когортного отчета: конверсии по неделе прихода, время до оплаты и инкрементальное дочитывание
+"""
+
+import gzip
+import os
+import tempfile
+import time
+
+from cohorts import CohortColumns, WEEK, WEEK_SHIFT, week_start
+from csv_export import export_cohorts_csv_gzip
+from database import Database
+from test_funnel_engine import _add_started_user
+
+
+def _set_joined(db, user_id, joined_at):
+    conn = db._get_connection()
+    try:
+        conn.execute('UPDATE users SET joined_at = ? WHERE user_id = ?', (joined_at, user_id))
+    finally:
+        conn.close()
+
+
+def _log_payment_at(db, user_id, created_at):
+    payment_id = db.log_payment(user_id, 990, 'success')
+    conn = db._get_analytics_connection()
+    try:
+        conn.execute('UPDATE payments SET created_at = ? WHERE id = ?', (created_at, payment_id))
+        conn.commit()
+    finally:
+        db._release_analytics_connection(conn)
+
+
+def _prepare_db(db_path):
+    """Неделя назад: 1 — оплатил через 2 часа и продлил, 2 — запустил бота, 3 — не запускал.
+    Эта неделя: 4 — получил сообщение воронки и оплатил через 5 дней"""
+    db = Database(db_path)
+    this_week = (int(time.time()) + WEEK_SHIFT) // WEEK * WEEK - WEEK_SHIFT
+    last_week = this_week - WEEK
+
+    for user_id in (1, 2, 4):
+        _add_started_user(db, user_id)
+    db.add_user(3, 'user3', 'User 3')
+    for user_id in (1, 2, 3):
+        _set_joined(db, user_id, last_week + 3600)
+    _set_joined(db, 4, this_week)
+
+    _log_payment_at(db, 1, last_week + 3 * 3600)
+    _log_payment_at(db, 1, last_week + 31 * 86400)
+    db.log_payment(2, 990, 'pending')
+    _log_payment_at(db, 4, this_week + 5 * 86400)
+    db.log_message_deliveries([(4, 1)])
+    db.flush_analytics()
+    return db, this_week, last_week
+
+
+def test_cohort_report():
+    """Каждая неделя считает своих пользователей по шагам воронки"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db, this_week, last_week = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+        report = db.get_cohort_report()
+
+        newest, oldest = report['cohorts']
+        assert newest['week_start'] == week_start((this_week + WEEK_SHIFT) // WEEK)
+        assert newest['week_start'].weekday() == 0
+        steps = ('joined', 'started', 'reached', 'paid', 'renewed')
+        assert [newest[step] for step in steps] == [1, 1, 1, 1, 0]
+        assert [oldest[step] for step in steps] == [3, 2, 0, 1, 1]
+
+        assert oldest['time_to_pay'] == [0, 1, 0, 0, 0, 0]
+        assert newest['time_to_pay'] == [0, 0, 0, 1, 0, 0]
+        assert report['paid_users'] == 2
+        assert [count for label, count in report['time_to_pay']] == [0, 1, 0, 1, 0, 0]
+
+        assert len(db.get_cohort_report(weeks=1)['cohorts']) == 1
+
+        export_file, rows_count = export_cohorts_csv_gzip(db.get_cohort_report(None))
+        try:
+            lines = gzip.decompress(export_file.read()).decode('utf-8').splitlines()
+        finally:
+            export_file.close()
+        assert rows_count == 2 and len(lines) == 3
+        assert lines[2].startswith(f"{oldest['week_start'].isoformat()},3,2,0,1,1,66.7,33.3,100.0")
+
+
+def test_incremental_refresh():
+    """Повторное обновление дочитывает только новое, без изменений отчет берется из кэша"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db, this_week, last_week = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+        first = db.get_cohort_report()
+        assert db.get_cohort_report() is first
+
+        _add_started_user(db, 5)
+        db.mark_user_started_bot(3)
+        db.log_payment(5, 990, 'success')
+        db.log_message_deliveries([(5, 1)])
+        db.flush_analytics()
+
+        conn = db._get_analytics_connection()
+        try:
+            assert db.cohorts.refresh(conn.cursor()) == 4
+        finally:
+            db._release_analytics_connection(conn)
+
+        report = db.get_cohort_report()
+        assert report is not first
+        newest, oldest = report['cohorts']
+        assert (newest['joined'], newest['started'], newest['reached'], newest['paid']) == (2, 2, 2, 2)
+        assert oldest['started'] == 3
+
+        # Полная перестройка дает те же цифры
+        rebuilt = CohortColumns(rebuild_seconds=0)
+        conn = db._get_analytics_connection()
+        try:
+            rebuilt.refresh(conn.cursor())
+            rebuilt.refresh(conn.cursor())
+        finally:
+            db._release_analytics_connection(conn)
+        assert rebuilt.report()['cohorts'] == report['cohorts']
+
+
+def test_reset_bot_started_does_not_force_rescans():
+    """Вернувшийся пользователь (bot_started = 0) вызывает один перечет, а не перечет при каждом обновлении"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db, this_week, last_week = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+        db.get_cohort_report()
+        assert db.cohorts.started_rescans == 0
+
+        _add_started_user(db, 5)
+        db.get_cohort_report()
+        assert db.cohorts.started_rescans == 0
+
+        db.add_users_batch([(2, 'user2', 'User 2')])
+        for _ in range(3):
+            report = db.get_cohort_report()
+        assert db.cohorts.started_rescans == 1
+        # Когорта помнит, что пользователь запускал бота
+        assert report['cohorts'][1]['started'] == 2
+
+
+if __name__ == "__main__":
+    print("🧪 Тест когортного отчета...")
+    test_cohort_report()
+    test_incremental_refresh()
+    test_reset_bot_started_does_not_force_rescans()
+    print("✅ Когорты считаются по колонкам и дочитываются инкрементально")
@@ -0,0 +1,71 @@
+"""
+Тест потоковой выгрузки CSV со сжатием gzip
+"""
+
+import csv
+import gzip
+import io
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+
+from csv_export import export_csv_gzip
+from database import Database
+
+
+def _read_export(export_file):
+    with gzip.open(export_file, 'rt', encoding='utf-8', newline='') as text:
+        return list(csv.reader(text))
+
+
+def test_users_export():
+    """Выгрузка пользователей совпадает с прежним CSV, только сжата"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in range(1, 4):
+            db.add_user(user_id, f"user{user_id}", "Тест")
+        db.deactivate_user(2)
+
+        export_file, rows_count = export_csv_gzip(db, 'users', chunk_size=2)
+        rows = _read_export(export_file)
+        export_file.close()
+
+        assert rows_count == 3
+        assert rows == list(csv.reader(io.StringIO(db.export_users_to_csv())))
+        assert rows[0][0] == 'ID'
+        assert sorted(row[4] for row in rows[1:]) == ['Активен', 'Активен', 'Отписался']
+
+
+def _utc_epoch(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+def test_events_export_with_date_range():
+    """Фильтр по дате оставляет только события из диапазона"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        conn.executemany(
+            'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (?, ?, ?)',
+            [(1, 1, _utc_epoch(2030, 1, 1, 10)), (1, 2, _utc_epoch(2030, 1, 5, 10)), (2, 1, _utc_epoch(2030, 1, 10, 10))]
+        )
+        conn.commit()
+        conn.close()
+
+        export_file, rows_count = export_csv_gzip(
+            db, 'deliveries', date_from=datetime(2030, 1, 2), date_to=datetime(2030, 1, 10)
+        )
+        rows = _read_export(export_file)
+        export_file.close()
+
+        assert rows_count == 1
+        assert rows[1] == ['2', '1', '2', '2030-01-05 10:00:00']
+
+
+if __name__ == "__main__":
+    print("🧪 Тест выгрузки CSV...")
+    test_users_export()
+    test_events_export_with_date_range()
+    print("✅ Выгрузка CSV работает")
@@ -0,0 +1,107 @@
+"""
+Тест колонок времени в секундах unix: миграция текстовых значений и чтение как datetime
+"""
+
+import os
+import sqlite3
+import tempfile
+from datetime import date, datetime, timedelta, timezone
+
+from database import Database
+
+
+class PreEpochDatabase(Database):
+    """Схема до перевода колонок времени в INTEGER"""
+    MIGRATIONS = Database.MIGRATIONS[:8]
+
+
+def test_migration_converts_text_timestamps():
+    """Местное время Python и UTC из CURRENT_TIMESTAMP становятся одними и теми же секундами"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        old_db = PreEpochDatabase(db_path)
+        old_db.add_user(1, "user1", "Тест")
+        old_db.mark_user_started_bot(1)
+        old_db.add_user(2, "user2", "Борис")
+
+        scheduled = datetime(2030, 1, 3, 10, 0)
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE users SET joined_at = '2030-01-01 07:00:00', payed_till = '2030-02-01' WHERE user_id = 1")
+        conn.execute(
+            'INSERT INTO scheduled_messages (user_id, message_number, scheduled_time) VALUES (1, 1, ?)',
+            (str(scheduled),)
+        )
+        conn.execute("INSERT INTO funnel_cursors (user_id, funnel, next_due_at) VALUES (1, 'free', ?)", (str(scheduled),))
+        conn.execute("INSERT INTO scheduled_broadcasts (id, message_text, scheduled_time) VALUES (40, 'x', ?)", (str(scheduled),))
+        conn.execute('DELETE FROM scheduled_broadcasts')
+        conn.commit()
+        conn.close()
+
+        conn = sqlite3.connect(old_db.analytics_db_path)
+        conn.execute("INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (1, 1, '2030-01-03 10:00:00')")
+        conn.commit()
+        conn.close()
+        counters_before = old_db.get_user_statistics()
+
+        db = Database(db_path)
+        assert db.schema_version == Database.MIGRATIONS[-1][0]
+
+        conn = db._get_connection()
+        try:
+            joined_at, payed_till = conn.execute('SELECT joined_at, payed_till FROM users WHERE user_id = 1').fetchone()
+            scheduled_time = conn.execute('SELECT scheduled_time FROM scheduled_messages').fetchone()[0]
+        finally:
+            conn.close()
+        assert joined_at == int(datetime(2030, 1, 1, 7, tzinfo=timezone.utc).timestamp())
+        assert payed_till == int(datetime(2030, 2, 1).timestamp())
+        assert scheduled_time == int(scheduled.timestamp())
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        delivered_at = conn.execute('SELECT delivered_at FROM message_deliveries').fetchone()[0]
+        conn.close()
+        assert delivered_at == int(datetime(2030, 1, 3, 10, tzinfo=timezone.utc).timestamp())
+
+        # Вызывающий код по-прежнему получает datetime
+        assert db.get_user(1)[3] == datetime.fromtimestamp(joined_at)
+        assert db.get_user_scheduled_messages(1)[0][2] == scheduled
+        assert db.get_funnel_cursor(1) == (0, scheduled)
+
+        # Счетчики, поиск и AUTOINCREMENT пережили пересоздание таблиц
+        assert db.get_user_statistics() == counters_before
+        db.add_user(3, "user3", "Вера")
+        assert db.get_user_statistics()['total_users'] == counters_before['total_users'] + 1
+        assert [user[0] for user in db.search_users("вера")[0]] == [3]
+        assert db.add_scheduled_broadcast("новая", datetime.now()) == 41
+
+
+def test_ranges_use_integer_seconds():
+    """Готовые сообщения, новые пользователи и истекающие подписки выбираются по диапазону секунд"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in (1, 2):
+            db.add_user(user_id, f"user{user_id}", "Тест")
+            db.mark_user_started_bot(user_id)
+
+        now = datetime.now()
+        db.schedule_message(1, 1, now - timedelta(minutes=1))
+        db.schedule_message(2, 1, now + timedelta(hours=1))
+        assert [message[1] for message in db.get_pending_messages_for_active_users()] == [1]
+
+        db.add_scheduled_broadcast("скоро", now + timedelta(hours=2))
+        (broadcast,) = db.get_scheduled_broadcasts()
+        assert broadcast[3] == now.replace(microsecond=0) + timedelta(hours=2)
+        assert isinstance(broadcast[5], datetime)
+        assert db.get_pending_broadcasts() == []
+
+        assert db.get_user_statistics()['new_users_24h'] == 2
+
+        db.mark_user_paid(1, 990, 'success', date.today().isoformat())
+        db.mark_user_paid(2, 990, 'success', (date.today() + timedelta(days=1)).isoformat())
+        assert db.get_expired_subscriptions() == [(1, "user1", "Тест", date.today())]
+
+
+if __name__ == "__main__":
+    print("🧪 Тест колонок времени в секундах...")
+    test_migration_converts_text_timestamps()
+    test_ranges_use_integer_seconds()
+    print("✅ Колонки времени хранятся в секундах unix")
@@ -0,0 +1,124 @@
+"""
+Тест курсора воронки и кнопки "следующее сообщение"
+"""
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+from database import Database
+from scheduler import MessageScheduler
+
+
+class PreCursorDatabase(Database):
+    """Схема до появления курсоров воронки"""
+    MIGRATIONS = Database.MIGRATIONS[:3]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text, kwargs.get('reply_markup')))
+
+    async def send_photo(self, chat_id, photo, caption, **kwargs):
+        self.sent.append((chat_id, caption, kwargs.get('reply_markup')))
+
+
+class FakeContext:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+def _schedule_funnel(db, user_id, sent_steps):
+    """Пользователь с запланированной воронкой, первые sent_steps шагов отправлены"""
+    db.add_user(user_id, f"user{user_id}", "Test")
+    db.mark_user_started_bot(user_id)
+    now = datetime.now()
+    for message_number, text, delay_hours, photo_url in db.get_all_broadcast_messages():
+        db.schedule_message(user_id, message_number, now + timedelta(hours=delay_hours))
+
+    for message_id, message_number, scheduled_time, is_sent in sorted(db.get_user_scheduled_messages(user_id), key=lambda m: m[1]):
+        if message_number <= sent_steps:
+            db.mark_message_sent(message_id)
+
+
+def test_cursor_follows_sent_messages():
+    """Курсор хранит последний отправленный шаг и время следующего"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _schedule_funnel(db, 1, sent_steps=2)
+
+        step, next_due_at = db.get_funnel_cursor(1)
+        assert step == 2
+        assert next_due_at is not None
+
+        # После сброса кэша курсор читается из таблицы
+        db._funnel_cursors.clear()
+        assert db.get_funnel_cursor(1)[0] == 2
+
+
+def test_next_message_uses_step_from_payload():
+    """Нажатие на кнопку шага N отправляет шаг N+1 с номером шага в новых кнопках"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _schedule_funnel(db, 1, sent_steps=1)
+        db.add_message_button(2, "Дальше", "")
+        scheduler = MessageScheduler(db)
+        context = FakeContext()
+
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1, 1))
+
+        chat_id, text, reply_markup = context.bot.sent[0]
+        assert text.startswith(db.get_broadcast_message(2)[0][:20])
+        assert reply_markup.inline_keyboard[0][0].callback_data == "next_msg_1_2"
+        assert db.get_funnel_cursor(1)[0] == 2
+
+        # Старая кнопка без номера шага продолжает с курсора
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1))
+        assert db.get_funnel_cursor(1)[0] == 3
+
+
+def test_prepared_content_is_invalidated_on_edit():
+    """Изменение сообщения сбрасывает готовый контент в памяти"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+
+        assert db.get_prepared_broadcast_message(1)[2] == ()
+        db.update_broadcast_message(1, text="Новый текст")
+        db.add_message_button(1, "Сайт", "https://example.com")
+
+        text, photo_url, buttons = db.get_prepared_broadcast_message(1)
+        assert text == "Новый текст"
+        assert [button[1] for button in buttons] == ["Сайт"]
+
+
+def test_migration_backfills_cursors():
+    """Миграция создает курсоры для уже запланированных воронок"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        PreCursorDatabase(db_path)
+
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO users (user_id, bot_started) VALUES (7, 1)")
+        conn.executemany(
+            'INSERT INTO scheduled_messages (user_id, message_number, scheduled_time, is_sent) VALUES (7, ?, ?, ?)',
+            [(1, '2030-01-01 10:00:00', 1), (2, '2030-01-02 10:00:00', 1), (3, '2030-01-03 10:00:00', 0)]
+        )
+        conn.commit()
+        conn.close()
+
+        db = Database(db_path)
+        assert db.get_funnel_cursor(7) == (2, datetime(2030, 1, 3, 10, 0))
+
+
+if __name__ == "__main__":
+    print("🧪 Тест курсора воронки...")
+    test_cursor_follows_sent_messages()
+    test_next_message_uses_step_from_payload()
+    test_prepared_content_is_invalidated_on_edit()
+    test_migration_backfills_cursors()
+    print("✅ Курсор воронки работает")
@@ -0,0 +1,151 @@
+"""
+Тест движка воронки на курсорах (FUNNEL_ENGINE=cursor)
+"""
+
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from database import Database
+from scheduler import MessageScheduler
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text, kwargs.get('reply_markup')))
+
+    async def send_photo(self, chat_id, photo, caption, **kwargs):
+        self.sent.append((chat_id, caption, kwargs.get('reply_markup')))
+
+
+class FakeContext:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+def _add_started_user(db, user_id):
+    db.add_user(user_id, f"user{user_id}", "Test")
+    db.mark_user_started_bot(user_id)
+
+
+def _count(db, table):
+    conn = db._get_connection()
+    try:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _start_funnel_in_past(db, user_id, hours_ago):
+    conn = db._get_connection()
+    try:
+        conn.execute(
+            "UPDATE funnel_cursors SET started_at = ? WHERE user_id = ? AND funnel = 'free'",
+            (int((datetime.now() - timedelta(hours=hours_ago)).timestamp()), user_id)
+        )
+        db._recompute_funnel_due_times(conn.cursor(), 'free')
+    finally:
+        conn.close()
+
+
+def test_one_cursor_row_per_user():
+    """Вся воронка пользователя — одна строка, шаги отправляются по мере наступления"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        scheduler = MessageScheduler(db, engine='cursor')
+        context = FakeContext()
+
+        for user_id in (1, 2, 3):
+            _add_started_user(db, user_id)
+            assert asyncio.run(scheduler.schedule_user_messages(context, user_id))
+
+        assert _count(db, 'scheduled_messages') == 0
+        assert _count(db, 'funnel_cursors') == 3
+
+        # Повторный /start не перезапускает идущую воронку
+        assert asyncio.run(scheduler.schedule_user_messages(context, 1))
+        assert db.get_funnel_cursor(1)[0] == 0
+
+        # Для пользователя 1 прошло больше суток: первый шаг уже пора отправить
+        first_delay = db.get_broadcast_message(1)[1]
+        _start_funnel_in_past(db, 1, first_delay + 0.1)
+        asyncio.run(scheduler.send_scheduled_messages(context))
+
+        assert [chat_id for chat_id, text, markup in context.bot.sent] == [1]
+        step, next_due_at = db.get_funnel_cursor(1)
+        assert step == 1
+        assert next_due_at is not None
+
+
+def test_delay_edit_applies_to_everyone():
+    """Изменение задержки сразу меняет время следующего шага у всех в воронке"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        scheduler = MessageScheduler(db, engine='cursor')
+        _add_started_user(db, 1)
+        asyncio.run(scheduler.schedule_user_messages(FakeContext(), 1))
+        before = db.get_funnel_cursor(1)[1]
+
+        db.update_broadcast_message(1, delay_hours=db.get_broadcast_message(1)[1] + 10)
+
+        after = db.get_funnel_cursor(1)[1]
+        assert abs((after - before) - timedelta(hours=10)) < timedelta(seconds=2)
+
+
+def test_next_button_advances_cursor():
+    """Кнопка "следующее сообщение" работает и на движке курсоров"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        scheduler = MessageScheduler(db, engine='cursor')
+        context = FakeContext()
+        _add_started_user(db, 1)
+        db.add_message_button(1, "Дальше", "")
+        asyncio.run(scheduler.schedule_user_messages(context, 1))
+
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1))
+        chat_id, text, reply_markup = context.bot.sent[0]
+        assert reply_markup.inline_keyboard[0][0].callback_data == "next_msg_1_1"
+        assert db.get_funnel_cursor(1)[0] == 1
+
+        assert asyncio.run(scheduler.send_next_scheduled_message(context, 1, 1))
+        assert db.get_funnel_cursor(1)[0] == 2
+
+
+def test_migration_from_scheduled_rows():
+    """Уже запланированные строки переводятся на курсоры с тем же расписанием"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        rows_scheduler = MessageScheduler(db, engine='rows')
+        for user_id in (1, 2):
+            _add_started_user(db, user_id)
+            asyncio.run(rows_scheduler.schedule_user_messages(FakeContext(), user_id))
+
+        pending = sorted(db.get_user_scheduled_messages(1), key=lambda m: m[1])
+        db.mark_message_sent(pending[0][0])
+        expected_next = pending[1][2]
+        assert _count(db, 'scheduled_messages') > 2
+
+        MessageScheduler(db, engine='cursor')
+
+        assert _count(db, 'scheduled_messages') == 0
+        step, next_due_at = db.get_funnel_cursor(1)
+        assert step == 1
+        assert abs(next_due_at - expected_next) < timedelta(seconds=1)
+        assert db.get_funnel_cursor(2)[0] == 0
+
+        # Повторный запуск ничего не меняет
+        assert db.migrate_funnel_to_cursors('free') == 0
+        assert db.get_funnel_cursor(1)[0] == 1
+
+
+if __name__ == "__main__":
+    print("🧪 Тест движка воронки на курсорах...")
+    test_one_cursor_row_per_user()
+    test_delay_edit_applies_to_everyone()
+    test_next_button_advances_cursor()
+    test_migration_from_scheduled_rows()
+    print("✅ Движок воронки на курсорах работает")
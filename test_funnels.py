@@ -0,0 +1,97 @@
+"""
+Тест общих воронок: free, paid и новая воронка только из конфигурации
+"""
+
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from database import Database
+from funnels import FUNNELS, Funnel
+from scheduler import MessageScheduler
+from test_funnel_engine import FakeContext, _add_started_user, _count
+
+
+class TrialDatabase(Database):
+    """Бот с дополнительной воронкой trial — только запись в FUNNELS"""
+    FUNNELS = {**FUNNELS, 'trial': Funnel(
+        'trial', code=2, table_prefix='trial_',
+        audience={'is_active': 1, 'bot_started': 1, 'has_paid': 0},
+    )}
+
+
+def test_configured_funnel_is_scheduled_and_sent():
+    """Таблицы новой воронки создаются по шаблону, диспетчер отправляет ее шаги"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        db = TrialDatabase(db_path)
+        # Повторный запуск не пересоздает таблицы
+        db = TrialDatabase(db_path)
+
+        conn = db._get_connection()
+        try:
+            conn.execute("INSERT INTO trial_broadcast_messages (message_number, text, delay_hours) VALUES (1, 'Пробный доступ', 0)")
+            conn.commit()
+        finally:
+            conn.close()
+
+        _add_started_user(db, 1)
+        scheduler = MessageScheduler(db, engine='rows')
+        context = FakeContext()
+        assert asyncio.run(scheduler.schedule_funnel(context, 1, 'trial'))
+        assert db.get_user_funnel_messages(1, 'trial')[0][1] == 1
+        assert _count(db, 'scheduled_messages') == 0
+
+        asyncio.run(scheduler.send_scheduled_messages(context))
+        assert [(chat_id, text) for chat_id, text, markup in context.bot.sent] == [(1, 'Пробный доступ')]
+        assert db.get_user_funnel_messages(1, 'trial') == []
+        assert db.get_funnel_cursor(1, 'trial')[0] == 1
+
+        # Вне аудитории воронки шаги не планируются
+        db.mark_user_paid(1, 990, 'success')
+        assert db.schedule_funnel_messages(1, 'trial', [(1, datetime.now())]) is None
+
+
+def test_one_dispatcher_for_free_and_paid():
+    """Один тик отправляет шаги обеих воронок и рассылки каждой своей аудитории"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in (1, 2, 3):
+            _add_started_user(db, user_id)
+        db.mark_user_paid(2, 990, 'success')
+        db.mark_user_paid(3, 990, 'success')
+        db.add_paid_broadcast_message("Спасибо за оплату", 0)
+
+        scheduler = MessageScheduler(db, engine='rows')
+        context = FakeContext()
+        assert asyncio.run(scheduler.schedule_paid_user_messages(context, 2))
+        assert asyncio.run(scheduler.schedule_paid_user_messages(context, 3))
+        db.schedule_message(1, 1, datetime.now() - timedelta(minutes=1))
+
+        # Пользователь 3 вышел из аудитории до отправки — шаг пропускается
+        db.expire_user_subscription(3)
+
+        asyncio.run(scheduler.send_scheduled_messages(context))
+        assert sorted((chat_id, text) for chat_id, text, markup in context.bot.sent) == [
+            (1, db.get_broadcast_message(1)[0]),
+            (2, "Спасибо за оплату"),
+        ]
+        assert db.get_user_paid_scheduled_messages(3) == []
+
+        context = FakeContext()
+        db.add_scheduled_broadcast("Всем", datetime.now() - timedelta(minutes=1))
+        db.add_paid_scheduled_broadcast("Оплатившим", datetime.now() - timedelta(minutes=1))
+        asyncio.run(scheduler.send_scheduled_broadcasts(context))
+        assert sorted((chat_id, text) for chat_id, text, markup in context.bot.sent) == [
+            (1, "Всем"), (2, "Всем"), (2, "Оплатившим"), (3, "Всем"),
+        ]
+        assert db.claim_funnel_broadcasts('w', 'free') == []
+        assert db.claim_funnel_broadcasts('w', 'paid') == []
+
+
+if __name__ == "__main__":
+    print("🧪 Тест общих воронок...")
+    test_configured_funnel_is_scheduled_and_sent()
+    test_one_dispatcher_for_free_and_paid()
+    print("✅ Все воронки разбираются одним движком")
@@ -0,0 +1,148 @@
+"""
+Тест атомарного захвата задач воркерами (lease)
+
+Несколько процессов одновременно разбирают очереди в одной SQLite базе,
+ни одна задача не должна быть захвачена дважды.
+"""
+
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+from database import Database
+
+USERS_COUNT = 200
+MESSAGES_PER_USER = 5
+BROADCASTS_COUNT = 40
+PROCESSES = 4
+
+
+def _prepare_db(db_path):
+    """Создать БД с пользователями и готовыми к отправке задачами во всех очередях"""
+    db = Database(db_path)
+    past = int((datetime.now() - timedelta(minutes=1)).timestamp())
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executemany(
+        'INSERT INTO users (user_id, username, first_name, is_active, bot_started, has_paid) VALUES (?, ?, ?, 1, 1, ?)',
+        [(user_id, f"user{user_id}", "Test", user_id % 2) for user_id in range(1, USERS_COUNT + 1)]
+    )
+    conn.execute("INSERT OR IGNORE INTO paid_broadcast_messages (message_number, text, delay_hours) VALUES (1, 'paid', 0)")
+    conn.executemany(
+        'INSERT INTO scheduled_messages (user_id, message_number, scheduled_time) VALUES (?, ?, ?)',
+        [(user_id, n, past) for user_id in range(1, USERS_COUNT + 1) if user_id % 2 == 0
+         for n in range(1, MESSAGES_PER_USER + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO paid_scheduled_messages (user_id, message_number, scheduled_time) VALUES (?, 1, ?)',
+        [(user_id, past) for user_id in range(1, USERS_COUNT + 1) if user_id % 2 == 1]
+    )
+    for table in ('scheduled_broadcasts', 'paid_scheduled_broadcasts'):
+        conn.executemany(
+            f'INSERT INTO {table} (message_text, scheduled_time) VALUES (?, ?)',
+            [(f"broadcast {i}", past) for i in range(BROADCASTS_COUNT)]
+        )
+    conn.commit()
+    conn.close()
+    return db
+
+
+def _claim_worker(db_path, worker_id, results):
+    """Процесс-воркер: захватывает задачи пачками, пока очереди не опустеют"""
+    db = Database(db_path)
+    claimed = {table: [] for table in Database.JOB_QUEUE_TABLES}
+
+    while True:
+        messages = db.claim_pending_messages(worker_id, limit=7)
+        paid_messages = db.claim_pending_paid_messages(worker_id, limit=7)
+        broadcasts = db.claim_pending_broadcasts(worker_id, limit=3)
+        paid_broadcasts = db.claim_pending_paid_broadcasts(worker_id, limit=3)
+
+        if not (messages or paid_messages or broadcasts or paid_broadcasts):
+            break
+
+        for message in messages:
+            claimed['scheduled_messages'].append(message[0])
+            db.mark_message_sent(message[0])
+        for message in paid_messages:
+            claimed['paid_scheduled_messages'].append(message[0])
+            db.mark_paid_message_sent(message[0])
+        for broadcast in broadcasts:
+            claimed['scheduled_broadcasts'].append(broadcast[0])
+            db.mark_broadcast_sent(broadcast[0])
+        for broadcast in paid_broadcasts:
+            claimed['paid_scheduled_broadcasts'].append(broadcast[0])
+            db.mark_paid_broadcast_sent(broadcast[0])
+
+    results.put(claimed)
+
+
+def test_parallel_workers_never_claim_twice():
+    """Параллельные процессы разбирают все четыре очереди без дублей"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'claims.db')
+        _prepare_db(db_path)
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=_claim_worker, args=(db_path, f"test-worker-{n}", results))
+            for n in range(PROCESSES)
+        ]
+        for process in processes:
+            process.start()
+
+        per_worker = [results.get(timeout=120) for _ in processes]
+        for process in processes:
+            process.join(timeout=30)
+            assert process.exitcode == 0
+
+        expected = {
+            'scheduled_messages': (USERS_COUNT // 2) * MESSAGES_PER_USER,
+            'paid_scheduled_messages': USERS_COUNT // 2,
+            'scheduled_broadcasts': BROADCASTS_COUNT,
+            'paid_scheduled_broadcasts': BROADCASTS_COUNT,
+        }
+        for table, total in expected.items():
+            all_ids = [job_id for claimed in per_worker for job_id in claimed[table]]
+            assert len(all_ids) == len(set(all_ids)), f"Дубли при захвате из {table}"
+            assert len(all_ids) == total, f"{table}: захвачено {len(all_ids)} из {total}"
+
+
+def test_expired_lease_is_reclaimed():
+    """Задачи упавшего воркера возвращаются в очередь после истечения аренды"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _prepare_db(os.path.join(tmp_dir, 'lease.db'))
+
+        first = db.claim_pending_broadcasts('crashed-worker', limit=5, lease_seconds=3600)
+        assert len(first) == 5
+
+        # Пока аренда активна, другой воркер эти задачи не видит
+        second = db.claim_pending_broadcasts('healthy-worker', limit=BROADCASTS_COUNT)
+        assert not {b[0] for b in first} & {b[0] for b in second}
+
+        # Аренда истекла — задачи снова доступны
+        conn = sqlite3.connect(db.db_path)
+        conn.execute(
+            'UPDATE scheduled_broadcasts SET lease_until = ? WHERE claimed_by = ?',
+            (datetime.now() - timedelta(seconds=1), 'crashed-worker')
+        )
+        conn.commit()
+        conn.close()
+
+        reclaimed = db.claim_pending_broadcasts('healthy-worker', limit=BROADCASTS_COUNT)
+        assert {b[0] for b in reclaimed} == {b[0] for b in first}
+
+        # Упавший воркер больше не может продлить чужую аренду
+        assert not db.renew_job_lease('scheduled_broadcasts', first[0][0], 'crashed-worker')
+        assert db.renew_job_lease('scheduled_broadcasts', first[0][0], 'healthy-worker')
+
+
+if __name__ == "__main__":
+    print("🧪 Тест параллельного захвата задач...")
+    test_parallel_workers_never_claim_twice()
+    print("✅ Дублей нет")
+    print("🧪 Тест возврата задач после истечения аренды...")
+    test_expired_lease_is_reclaimed()
+    print("✅ Аренда работает корректно")
@@ -0,0 +1,104 @@
+"""
+Тест пачечной обработки заявок на вступление и UPSERT пользователей
+"""
+
+import asyncio
+import os
+import tempfile
+
+from telegram import User
+
+from database import Database
+from join_pipeline import JoinPipeline
+from test_funnel_engine import FakeBot
+
+
+class FakeJoinRequest:
+    def __init__(self, user_id, fail=False):
+        self.from_user = User(user_id, f"Имя{user_id}", False, username=f"user{user_id}")
+        self.fail = fail
+        self.approved = False
+
+    async def approve(self):
+        if self.fail:
+            raise RuntimeError("HIDE_REQUESTER_MISSING")
+        self.approved = True
+
+
+def _personalize(text, user):
+    return text.replace('{first_name}', user.first_name)
+
+
+def test_returning_user_keeps_paid_state():
+    """Повторное вступление не сбрасывает оплату и дату первого вступления"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        db.add_user(1, "user1", "Test")
+        db.mark_user_started_bot(1)
+        db.mark_user_paid(1, 990, 'succeeded')
+        joined_at = db.get_user(1)[3]
+
+        assert db.add_users_batch([(1, "renamed", "Test"), (2, "user2", "New")]) == 2
+
+        user = db.get_user(1)
+        assert user[1] == "renamed" and user[3] == joined_at
+        assert user[4] == 1 and user[5] == 0 and user[6] == 1  # is_active, bot_started, has_paid
+        assert db.get_user(2)[6] == 0
+        assert db.get_user_statistics()['paid_users'] == 1
+
+
+def test_joins_are_processed_in_batches():
+    """Заявки одобряются, записываются одной пачкой и получают одно приветствие"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        db.set_welcome_message("Привет, {first_name}!")
+        bot = FakeBot()
+        pipeline = JoinPipeline(db, _personalize, rate_per_second=1000, flush_interval=0.01)
+        requests = [FakeJoinRequest(user_id) for user_id in (10, 11, 12)] + [FakeJoinRequest(13, fail=True)]
+
+        async def run():
+            for request in requests:
+                await pipeline.submit(request, bot)
+            await pipeline.drain()
+
+        asyncio.run(run())
+
+        assert [request.approved for request in requests] == [True, True, True, False]
+        assert db.get_user(12) and not db.get_user(13)
+        assert sorted(chat_id for chat_id, text, markup in bot.sent) == [10, 11, 12]
+        assert ("Привет, Имя10!" in [text for chat_id, text, markup in bot.sent])
+        # Клавиатура собрана один раз на всю пачку
+        assert len({id(markup) for chat_id, text, markup in bot.sent}) == 1
+
+        stats = pipeline.stats()
+        assert stats['batches'] == 1
+        assert stats['stages']['approve']['count'] == 4 and stats['stages']['approve']['errors'] == 1
+        assert stats['stages']['upsert']['count'] == 1
+        assert stats['stages']['welcome']['count'] == 3
+
+
+def test_welcome_keyboard_follows_content_version():
+    """Изменение кнопок приветствия меняет версию и пересобирает клавиатуру"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        pipeline = JoinPipeline(db, _personalize)
+
+        version, text, photo, buttons = db.get_prepared_welcome()
+        default_markup = pipeline._get_welcome_markup(version, buttons)
+        assert db.get_prepared_welcome()[0] == version
+        assert pipeline._get_welcome_markup(version, buttons) is default_markup
+
+        db.add_welcome_button("🚀 Начать")
+        version, text, photo, buttons = db.get_prepared_welcome()
+        markup = pipeline._get_welcome_markup(version, buttons)
+        assert buttons == ("🚀 Начать",)
+        assert markup is not default_markup
+        assert markup.keyboard[0][0].text == "🚀 Начать"
+
+
+if __name__ == "__main__":
+    print("🧪 Тест заявок на вступление...")
+    test_returning_user_keeps_paid_state()
+    test_joins_are_processed_in_batches()
+    test_welcome_keyboard_follows_content_version()
+    print("✅ Заявки на вступление обрабатываются пачками")
@@ -0,0 +1,72 @@
+"""
+Тест сглаживания нагрузки воронки: бюджет отправок на минуту и прогноз на 24 часа
+"""
+
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from database import Database
+from load_shaping import SendCalendar
+from scheduler import MessageScheduler
+from test_funnel_engine import FakeContext, _add_started_user, _count
+
+
+def test_promo_spike_is_spread_over_free_minutes():
+    """Всплеск регистраций раскладывается по ближайшим минутам, не превышая бюджет"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        calendar = SendCalendar(db, budget_per_minute=2, jitter_minutes=3)
+        scheduler = MessageScheduler(db, engine='rows', send_calendar=calendar)
+
+        for user_id in range(1, 8):
+            _add_started_user(db, user_id)
+            assert asyncio.run(scheduler.schedule_user_messages(FakeContext(), user_id))
+
+        messages = len(db.get_all_broadcast_messages())
+        assert _count(db, 'scheduled_messages') == 7 * messages
+        load = db.get_send_load([(0, 2 ** 40)])
+        assert sum(load.values()) == 7 * messages
+        assert max(load.values()) == 2
+        assert calendar.shifted > 0 and calendar.overflow == 0
+
+        # Шаг воронки сдвигается не дальше окна
+        due = datetime.now() + timedelta(hours=10)
+        (assigned,) = calendar.assign([due])
+        assert abs(assigned - due) <= timedelta(minutes=3)
+
+
+def test_full_window_keeps_original_time():
+    """Если в окне нет свободной минуты, время не меняется; без бюджета сдвигов нет"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in (1, 2):
+            _add_started_user(db, user_id)
+
+        due = (datetime.now() + timedelta(hours=5)).replace(second=30, microsecond=0)
+        assert SendCalendar(db).assign([due, due]) == [due, due]
+
+        calendar = SendCalendar(db, budget_per_minute=1, jitter_minutes=0)
+        first, second = calendar.assign([due, due])
+        assert first == due and second == due
+        assert calendar.overflow == 1
+
+        calendar = SendCalendar(db, budget_per_minute=1, jitter_minutes=2)
+        db.schedule_message(1, 1, due)
+        (shifted,) = calendar.assign([due])
+        assert shifted == due + timedelta(minutes=1)
+        db.schedule_message(2, 1, shifted)
+
+        projection = calendar.projected_load(24)
+        assert len(projection) == 24
+        assert sum(sends for hour_start, sends, peak, over_budget in projection) == 2
+        assert max(peak for hour_start, sends, peak, over_budget in projection) == 1
+        assert not any(over_budget for hour_start, sends, peak, over_budget in projection)
+
+
+if __name__ == "__main__":
+    print("🧪 Тест сглаживания нагрузки воронки...")
+    test_promo_spike_is_spread_over_free_minutes()
+    test_full_window_keeps_original_time()
+    print("✅ Отправки воронки укладываются в бюджет по минутам")
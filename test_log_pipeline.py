@@ -0,0 +1,95 @@
+"""
+Тест логирования через очередь: JSON поля, семплирование, ленивое форматирование
+"""
+
+import io
+import json
+import logging
+import threading
+
+from log_pipeline import RecipientSampler, recipient, setup_logging
+
+
+class _Recorder:
+    """Аргумент лога, который запоминает, в каком потоке его превратили в строку"""
+
+    def __init__(self):
+        self.formatted_in = []
+
+    def __str__(self):
+        self.formatted_in.append(threading.current_thread().name)
+        return 'recorded'
+
+
+def _run_logging(fmt, per_second, emit):
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    stream = io.StringIO()
+    try:
+        listener = setup_logging('INFO', fmt, per_second, stream)
+        emit(logging.getLogger('scheduler'))
+        listener.stop()
+    finally:
+        root.handlers, root.level = saved_handlers, saved_level
+    return stream.getvalue().splitlines()
+
+
+def test_json_records_have_stable_fields():
+    """В JSON попадают user_id, message_number, queue и latency_ms из extra"""
+    def emit(log):
+        log.info("✅ Отправлено сообщение %s пользователю %s", 3, 42,
+                 extra=recipient(42, 3, 'free', 12.345))
+        log.info("📊 Результаты рассылки: отправлено %s, ошибок %s", 1, 0)
+
+    first, second = [json.loads(line) for line in _run_logging('json', 0, emit)]
+    assert first['msg'] == "✅ Отправлено сообщение 3 пользователю 42"
+    assert (first['user_id'], first['message_number'], first['queue'], first['latency_ms']) == (42, 3, 'free', 12.3)
+    assert first['level'] == 'INFO' and first['logger'] == 'scheduler'
+    assert 'user_id' not in second
+
+
+def test_recipient_lines_are_sampled():
+    """Строки о получателях ограничены по скорости, ошибки и сводки — нет"""
+    def emit(log):
+        for user_id in range(50):
+            log.info("✅ Отправлено сообщение %s пользователю %s", 1, user_id, extra=recipient(user_id, 1))
+        for user_id in range(5):
+            log.error("❌ BadRequest для пользователя %s: %s", user_id, "chat not found", extra=recipient(user_id))
+        log.info("📊 Результаты рассылки: отправлено %s, ошибок %s", 50, 5)
+
+    lines = _run_logging('text', 10, emit)
+    sent = [line for line in lines if '✅' in line]
+    assert 1 <= len(sent) <= 20
+    assert len([line for line in lines if '❌' in line]) == 5
+    assert any('📊' in line for line in lines)
+
+    sampler = RecipientSampler(per_second=1)
+    log = logging.getLogger('scheduler')
+    records = [log.makeRecord('scheduler', logging.INFO, __file__, 1, "✅ %s", (n,), None, extra=recipient(n))
+               for n in range(3)]
+    assert [sampler.filter(record) for record in records[:2]] == [True, False]
+    # Следующая прошедшая запись сообщает, сколько строк было пропущено
+    sampler._buckets[('scheduler', "✅ %s")][0] -= 1
+    assert sampler.filter(records[2]) and records[2].suppressed == 1
+
+
+def test_formatting_happens_off_the_calling_thread():
+    """Аргументы превращаются в строку в потоке записи, а отключенный DEBUG их не трогает"""
+    recorder = _Recorder()
+
+    def emit(log):
+        log.debug("📤 Отправляем сообщение %s", recorder)
+        log.info("📤 Отправляем сообщение %s", recorder)
+
+    lines = _run_logging('text', 0, emit)
+    assert len(lines) == 1 and lines[0].endswith("📤 Отправляем сообщение recorded")
+    assert len(recorder.formatted_in) == 1
+    assert recorder.formatted_in[0] != threading.current_thread().name
+
+
+if __name__ == "__main__":
+    print("🧪 Тест логирования через очередь...")
+    test_json_records_have_stable_fields()
+    test_recipient_lines_are_sampled()
+    test_formatting_happens_off_the_calling_thread()
+    print("✅ Логирование через очередь работает")
@@ -0,0 +1,110 @@
+"""
+Тест миграций схемы: обновление с любой версии дает ту же схему, что и новая установка
+"""
+
+import os
+import re
+import sqlite3
+import tempfile
+
+from database import Database
+from funnels import Funnel
+
+
+def _database_at(version):
+    """Database, у которой последняя миграция — version"""
+    return type(f'DatabaseV{version}', (Database,), {'MIGRATIONS': Database.MIGRATIONS[:version]})
+
+
+def _schema(db):
+    """Объекты обеих БД: (БД, тип, имя) -> SQL без различий в пробелах"""
+    schema = {}
+    for label, path in (('main', db.db_path), ('analytics', db.analytics_db_path)):
+        conn = sqlite3.connect(path)
+        try:
+            for kind, name, sql in conn.execute(
+                "SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"
+            ):
+                schema[(label, kind, name)] = re.sub(r'\s+', ' ', sql or '').replace('( ', '(').replace(' )', ')')
+        finally:
+            conn.close()
+    return schema
+
+
+def _applied(db):
+    conn = sqlite3.connect(db.db_path)
+    try:
+        return conn.execute('SELECT version, name, applied_at FROM schema_version ORDER BY version').fetchall()
+    finally:
+        conn.close()
+
+
+def test_upgrade_matches_fresh_install():
+    """Старая БД любой версии после обновления совпадает по схеме с новой установкой"""
+    latest = Database.MIGRATIONS[-1][0]
+    assert [version for version, name in Database.MIGRATIONS] == list(range(1, latest + 1))
+    for version, name in Database.MIGRATIONS:
+        assert name.startswith(f'_migration_{version:03d}_')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fresh = Database(os.path.join(tmp_dir, 'fresh.db'))
+        assert fresh.schema_version == latest
+        expected = _schema(fresh)
+
+        for version in range(1, latest):
+            db_path = os.path.join(tmp_dir, f'v{version}.db')
+            assert _database_at(version)(db_path).schema_version == version
+
+            upgraded = Database(db_path)
+            assert upgraded.schema_version == latest
+            assert [row[0] for row in _applied(upgraded)] == list(range(1, latest + 1))
+            assert _schema(upgraded) == expected, f"обновление с версии {version}"
+
+
+def test_reopen_is_noop():
+    """Повторное открытие актуальной БД не выполняет ни одной миграции"""
+    class NoMigrations(Database):
+        pass
+
+    def fail(self, cursor):
+        raise AssertionError("миграция не должна выполняться")
+
+    for version, name in Database.MIGRATIONS:
+        setattr(NoMigrations, name, fail)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        applied, schema = _applied(db), _schema(db)
+
+        reopened = NoMigrations(db.db_path)
+        assert reopened.schema_version == Database.MIGRATIONS[-1][0]
+        assert _applied(reopened) == applied
+        assert _schema(reopened) == schema
+
+
+def test_configured_funnel_matches_builtin_schema():
+    """Таблицы воронки из конфигурации создаются с теми же колонками, что и у встроенных"""
+    vip = Funnel('vip', code=2, table_prefix='vip_', audience={'is_active': 1, 'has_paid': 1})
+
+    class VipDatabase(Database):
+        FUNNELS = dict(Database.FUNNELS, vip=vip)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = VipDatabase(os.path.join(tmp_dir, 'bot.db'))
+        conn = sqlite3.connect(db.db_path)
+        try:
+            def columns(table):
+                return [row[1:] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+            assert columns('vip_scheduled_messages') == columns('paid_scheduled_messages')
+            assert columns('vip_scheduled_broadcasts') == columns('paid_scheduled_broadcasts')
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    print("🧪 Тест миграций схемы...")
+    test_upgrade_matches_fresh_install()
+    test_reopen_is_noop()
+    test_configured_funnel_matches_builtin_schema()
+    print("✅ Обновление с любой версии совпадает с новой установкой, повторный запуск ничего не делает")
@@ -0,0 +1,109 @@
+"""
+Тест гистограмм времени реакции на сообщения воронки
+"""
+
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from database import Database
+
+
+class PreHistogramDatabase(Database):
+    """Схема до появления гистограмм реакции"""
+    MIGRATIONS = Database.MIGRATIONS[:7]
+
+
+def _sql_time(seconds_ago):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _epoch(seconds_ago):
+    return int(time.time() - seconds_ago)
+
+
+def test_first_click_per_type_from_memory():
+    """Клик сразу после доставки: повторные нажатия того же типа не учитываются"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        db.add_user(1, "user1", "Test")
+
+        db.log_message_delivery(1, 1)
+        db.log_button_click(1, 1, None, 'callback', 'Дальше')
+        db.log_button_click(1, 1, None, 'callback', 'Дальше')
+        db.log_button_click(1, 1, 5, 'url', 'Сайт')
+        db.flush_analytics()
+
+        callback = db.get_reaction_histogram(1, 'callback')
+        assert list(callback) == [0] and callback[0][0] == 1
+        histogram = db.get_reaction_histogram(1)
+        assert sum(clicks for clicks, seconds_sum in histogram.values()) == 2
+        assert db.reaction_percentiles(histogram) == {50: 1, 90: 1, 99: 1}
+
+        details = db.get_message_details(1)
+        assert details['clicked_within'] == {1: 2, 10: 2, 60: 2}
+        assert details['reaction_percentiles'][99] == 1
+
+
+def test_delivery_from_database_after_restart():
+    """Доставки нет в памяти — время берется из message_deliveries"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+
+        conn = sqlite3.connect(db.analytics_db_path)
+        conn.executemany(
+            'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (?, ?, ?)',
+            [(1, 1, _epoch(5 * 60)), (2, 1, _epoch(30 * 60)), (3, 1, _epoch(3 * 3600))]
+        )
+        conn.commit()
+        conn.close()
+
+        for user_id in (1, 2, 3):
+            db.log_button_click(user_id, 1, None, 'callback', 'Дальше')
+        # Клик без доставки в гистограмму не попадает
+        db.log_button_click(4, 1, None, 'callback', 'Дальше')
+        db.flush_analytics()
+
+        histogram = db.get_reaction_histogram(1)
+        assert db.count_reacted_within(histogram, 60) == 0
+        assert db.count_reacted_within(histogram, 10 * 60) == 1
+        assert db.count_reacted_within(histogram, 3600) == 2
+        assert db.count_reacted_within(histogram, 86400) == 3
+
+        percentiles = db.reaction_percentiles(histogram)
+        assert 5 * 60 < percentiles[50] <= 60 * 60
+        assert 3 * 3600 <= percentiles[99] <= 4 * 3600
+
+
+def test_migration_backfills_existing_clicks():
+    """Миграция строит гистограммы по уже накопленным кликам"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        old_db = PreHistogramDatabase(db_path)
+
+        conn = sqlite3.connect(old_db.analytics_db_path)
+        conn.execute(
+            'INSERT INTO message_deliveries (user_id, message_number, delivered_at) VALUES (1, 2, ?)', (_sql_time(120),)
+        )
+        conn.executemany(
+            "INSERT INTO button_clicks (user_id, message_number, button_type, clicked_at) VALUES (1, 2, 'callback', ?)",
+            [(_sql_time(90),), (_sql_time(10),)]
+        )
+        conn.commit()
+        conn.close()
+
+        db = Database(db_path)
+        histogram = db.get_reaction_histogram(2)
+        assert sum(clicks for clicks, seconds_sum in histogram.values()) == 1
+        assert db.count_reacted_within(histogram, 60) == 1
+        assert db.count_reacted_within(histogram, 10) == 0
+
+
+if __name__ == "__main__":
+    print("🧪 Тест гистограмм времени реакции...")
+    test_first_click_per_type_from_memory()
+    test_delivery_from_database_after_restart()
+    test_migration_backfills_existing_clicks()
+    print("✅ Гистограммы времени реакции работают")
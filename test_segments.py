@@ -0,0 +1,102 @@
+"""
+Тест сегментов аудитории: выборки и счетчики по индексам, рассылка по сегменту
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database import Database
+from scheduler import MessageScheduler
+from segments import describe_segment, parse_segment
+from test_funnel_engine import FakeContext, _add_started_user
+
+
+def _prepare_db(db_path):
+    """1 — новый, 2 — старый, 3 — получил 3 и нажал, 4 — получил 3 без нажатия,
+    5 — оплатил по vk, 6 — оплата истекла, 7 — заблокировал бота"""
+    db = Database(db_path)
+    for user_id in range(1, 8):
+        _add_started_user(db, user_id)
+
+    conn = db._get_connection()
+    try:
+        month_ago = int(time.time()) - 30 * 86400
+        conn.execute('UPDATE users SET joined_at = ? WHERE user_id != 1', (month_ago,))
+    finally:
+        conn.close()
+
+    db.log_message_deliveries([(3, 3), (4, 3)])
+    db.log_button_click(3, 3, None, 'callback', "Дальше")
+    db.mark_user_paid(5, 990, 'success')
+    db.log_payment(5, 990, 'success', utm_source='vk')
+    db.mark_user_paid(6, 990, 'success')
+    db.expire_user_subscription(6)
+    db.deactivate_user(7)
+    db.flush_analytics()
+    return db
+
+
+def test_segments_select_expected_users():
+    """Каждый сегмент выбирает свою аудиторию, заблокировавшие не попадают никуда"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+
+        expected = {
+            'all': [1, 2, 3, 4, 5, 6],
+            'paid': [5],
+            'new:7': [1],
+            'no_click:3': [4],
+            'lapsed': [6],
+            'utm:vk': [5],
+            'utm:fb': [],
+        }
+        for segment, user_ids in expected.items():
+            assert db.get_segment_user_ids(segment) == user_ids, segment
+            assert db.count_segment(segment, fresh=True) == len(user_ids), segment
+
+        assert describe_segment('new:7') == "Пришли за 7 дн."
+        for bad in ('vip', 'new:abc', 'new:0', 'utm:'):
+            try:
+                parse_segment(bad)
+            except ValueError:
+                continue
+            raise AssertionError(bad)
+
+
+def test_segment_queries_use_indexes():
+    """План запроса каждого сегмента не сканирует таблицы целиком"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+        conn = db._get_analytics_connection()
+        try:
+            for segment in ('paid', 'new:7', 'no_click:3', 'lapsed', 'utm:vk'):
+                sql, params = db._segment_query(segment, 'COUNT(*)')
+                plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+                assert not any(step.startswith('SCAN') for step in plan), (segment, plan)
+        finally:
+            db._release_analytics_connection(conn)
+
+
+def test_scheduled_broadcast_goes_to_segment():
+    """Запланированная рассылка с сегментом уходит только его получателям"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _prepare_db(os.path.join(tmp_dir, 'bot.db'))
+        db.add_scheduled_broadcast("Вернитесь к нам", datetime.now() - timedelta(minutes=1), segment='lapsed')
+        db.add_scheduled_broadcast("Всем", datetime.now() - timedelta(minutes=1))
+
+        context = FakeContext()
+        asyncio.run(MessageScheduler(db, engine='rows').send_scheduled_broadcasts(context))
+        sent = sorted((chat_id, text) for chat_id, text, markup in context.bot.sent)
+        assert [chat_id for chat_id, text in sent if text == "Вернитесь к нам"] == [6]
+        assert [chat_id for chat_id, text in sent if text == "Всем"] == [1, 2, 3, 4, 5, 6]
+
+
+if __name__ == "__main__":
+    print("🧪 Тест сегментов аудитории...")
+    test_segments_select_expected_users()
+    test_segment_queries_use_indexes()
+    test_scheduled_broadcast_goes_to_segment()
+    print("✅ Сегменты компилируются в запросы по индексам")
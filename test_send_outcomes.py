@@ -0,0 +1,177 @@
+"""
+Тест итогов пачки отправок: одна транзакция на пачку и списание брошенных аренд (at-most-once)
+"""
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+from telegram.error import BadRequest, Forbidden
+
+from database import Database
+from scheduler import MessageScheduler
+from test_funnel_engine import FakeBot, FakeContext, _add_started_user, _start_funnel_in_past
+
+
+class FailingBot(FakeBot):
+    """2 заблокировал бота, 3 — неверный chat_id, 4 — временная ошибка сети"""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 2:
+            raise Forbidden("bot was blocked by the user")
+        if chat_id == 3:
+            raise BadRequest("Chat not found")
+        if chat_id == 4:
+            raise ConnectionError("timeout")
+        await super().send_message(chat_id, text, **kwargs)
+
+
+class SlowDrainBot(FailingBot):
+    """Пока идет отправка 5, аренды истекают: обход длится дольше аренды"""
+
+    def __init__(self, db, table):
+        super().__init__()
+        self.db, self.table = db, table
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 5:
+            _expire_leases(self.db, self.table)
+        await super().send_message(chat_id, text, **kwargs)
+
+
+def _queue_rows(db):
+    conn = db._get_connection()
+    try:
+        return {row[0]: row[1:] for row in conn.execute(
+            'SELECT user_id, is_sent, claimed_by FROM scheduled_messages ORDER BY user_id'
+        )}
+    finally:
+        conn.close()
+
+
+def _expire_leases(db, table):
+    conn = db._get_connection()
+    try:
+        conn.execute(f'UPDATE {table} SET lease_until = ? WHERE claimed_by IS NOT NULL',
+                     (datetime.now() - timedelta(minutes=1),))
+    finally:
+        conn.close()
+
+
+def test_batch_outcomes_are_applied_together():
+    """Отправленные, заблокировавшие и BadRequest закрываются, временная ошибка возвращается в очередь"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in (1, 2, 3, 4):
+            _add_started_user(db, user_id)
+            db.schedule_message(user_id, 1, datetime.now() - timedelta(minutes=1))
+        db.get_user_states([1, 2, 3, 4])
+
+        context = FakeContext()
+        context.bot = FailingBot()
+        asyncio.run(MessageScheduler(db, engine='rows').send_scheduled_messages(context))
+
+        assert [chat_id for chat_id, text, markup in context.bot.sent] == [1]
+        assert _queue_rows(db) == {1: (1, None), 2: (1, None), 3: (1, None), 4: (0, None)}
+        assert db.get_user(2)[4] == 0 and db.get_user_state(2).is_active == 0
+        assert db.get_funnel_cursor(1)[0] == 1 and db.get_funnel_cursor(4)[0] == 0
+
+        db.flush_analytics()
+        conn = sqlite3.connect(db.analytics_db_path)
+        try:
+            assert conn.execute('SELECT user_id, message_number FROM message_deliveries').fetchall() == [(1, 1)]
+        finally:
+            conn.close()
+
+
+def test_abandoned_rows_are_written_off():
+    """Шаги упавшего воркера не отправляются повторно после истечения аренды"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_started_user(db, 1)
+        db.schedule_message(1, 1, datetime.now() - timedelta(minutes=1))
+        db.schedule_message(1, 2, datetime.now() + timedelta(hours=1))
+
+        assert len(db.claim_funnel_messages('crashed-worker', 'free')) == 1
+        _expire_leases(db, 'scheduled_messages')
+
+        assert db.claim_funnel_messages('healthy-worker', 'free') == []
+        assert db.get_user_scheduled_messages(1)[0][1] == 2
+        assert db.get_funnel_cursor(1)[0] == 1
+
+
+def test_abandoned_cursors_skip_the_claimed_step():
+    """Курсор упавшего воркера сдвигается за захваченный шаг"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_started_user(db, 1)
+        scheduler = MessageScheduler(db, engine='cursor')
+        assert asyncio.run(scheduler.schedule_user_messages(FakeContext(), 1))
+        _start_funnel_in_past(db, 1, hours_ago=24 * 365)
+
+        assert db.claim_due_funnel_cursors('crashed-worker', 'free') == [(1, 1)]
+        _expire_leases(db, 'funnel_cursors')
+
+        assert db.claim_due_funnel_cursors('healthy-worker', 'free') == [(1, 2)]
+        assert db.get_funnel_cursor(1)[0] == 1
+
+
+def test_retry_survives_drain_longer_than_lease():
+    """Временная ошибка возвращается в очередь в итогах своей пачки и не списывается, когда обход переживает аренду"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id, minutes_ago in ((4, 2), (5, 1)):
+            _add_started_user(db, user_id)
+            db.schedule_message(user_id, 1, datetime.now() - timedelta(minutes=minutes_ago))
+
+        context = FakeContext()
+        context.bot = SlowDrainBot(db, 'scheduled_messages')
+        scheduler = MessageScheduler(db, engine='rows')
+        scheduler.claim_batch_size = 1
+        asyncio.run(scheduler.send_scheduled_messages(context))
+
+        assert [chat_id for chat_id, text, markup in context.bot.sent] == [5]
+        assert _queue_rows(db) == {4: (0, None), 5: (1, None)}
+        # Повтор отложен, курсор указывает на него
+        retry_at = db.get_user_scheduled_messages(4)[0][2]
+        assert retry_at > datetime.now()
+        assert db.get_funnel_cursor(4) == (0, retry_at)
+
+
+def test_cursor_retry_survives_drain_longer_than_lease():
+    """То же для движка курсоров: курсор с временной ошибкой не сдвигается и не списывается"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        scheduler = MessageScheduler(db, engine='cursor')
+        for user_id, hours_ago in ((4, 2), (5, 1)):
+            _add_started_user(db, user_id)
+            assert asyncio.run(scheduler.schedule_user_messages(FakeContext(), user_id))
+            _start_funnel_in_past(db, user_id, hours_ago=24 * 365 + hours_ago)
+
+        context = FakeContext()
+        context.bot = SlowDrainBot(db, 'funnel_cursors')
+        scheduler.claim_batch_size = 1
+        asyncio.run(scheduler.send_scheduled_messages(context))
+
+        assert 4 not in [chat_id for chat_id, text, markup in context.bot.sent]
+        conn = db._get_connection()
+        try:
+            step, next_due_at, claimed_by = conn.execute(
+                "SELECT step, next_due_at, claimed_by FROM funnel_cursors WHERE user_id = 4 AND funnel = 'free'"
+            ).fetchone()
+        finally:
+            conn.close()
+        assert (step, claimed_by) == (0, None)
+        assert db._from_epoch(next_due_at) > datetime.now()
+
+
+if __name__ == "__main__":
+    print("🧪 Тест итогов пачки отправок...")
+    test_batch_outcomes_are_applied_together()
+    test_abandoned_rows_are_written_off()
+    test_abandoned_cursors_skip_the_claimed_step()
+    test_retry_survives_drain_longer_than_lease()
+    test_cursor_retry_survives_drain_longer_than_lease()
+    print("✅ Итоги пачки пишутся одной транзакцией, брошенные аренды не отправляются повторно, повторы не списываются")
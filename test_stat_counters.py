@@ -0,0 +1,98 @@
+"""
+Тест счетчиков статистики, которые ведут триггеры
+"""
+
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+
+from database import Database
+
+
+class PreCounterDatabase(Database):
+    """Схема до появления счетчиков"""
+    MIGRATIONS = Database.MIGRATIONS[:5]
+
+
+def _fill(db):
+    for user_id in range(1, 6):
+        db.add_user(user_id, f"user{user_id}", "Test")
+    db.mark_user_started_bot(1)
+    db.mark_user_started_bot(2)
+    db.deactivate_user(3)
+    db.mark_user_paid(2, "990", "success")
+
+    db.schedule_message(1, 1, datetime.now())
+    db.schedule_message(1, 2, datetime.now())
+    message_id = db.get_user_scheduled_messages(1)[0][0]
+    db.mark_message_sent(message_id)
+
+    db.log_payment(2, "990", "success")
+    db.log_payment(2, "10", "success")
+    db.log_payment(4, "", "fail")
+    db.flush_analytics()
+
+
+def test_counters_follow_changes():
+    """Статистика из счетчиков совпадает с полным пересчетом"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _fill(db)
+
+        stats = db.get_user_statistics()
+        assert stats['total_users'] == 4
+        assert stats['bot_started_users'] == 2
+        assert stats['unsubscribed'] == 1
+        assert stats['paid_users'] == 1
+        assert stats['sent_messages'] == 1
+
+        payments = db.get_payment_statistics()
+        assert payments['total_payments'] == 2
+        assert payments['total_revenue'] == 1000
+        assert payments['avg_amount'] == 500
+
+        health = db.get_database_health_check()
+        assert health['pending_messages'] == 1
+        assert health['total_payments'] == 3
+
+        db.cancel_user_messages(1)
+        assert db.get_database_health_check()['pending_messages'] == 0
+
+        # Триггеры ничего не упустили — сверке нечего исправлять
+        assert db.reconcile_counters() == {}
+
+
+def test_reconciliation_repairs_drift():
+    """Сверка находит и исправляет расхождение счетчика"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _fill(db)
+
+        conn = sqlite3.connect(db.db_path)
+        conn.execute("UPDATE counters SET value = 100 WHERE name = 'users_paid'")
+        conn.commit()
+        conn.close()
+
+        assert db.reconcile_counters() == {'users_paid': (100, 1)}
+        assert db.get_user_statistics()['paid_users'] == 1
+
+
+def test_migration_initializes_counters():
+    """Миграция заполняет счетчики по уже существующим данным"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        _fill(PreCounterDatabase(db_path))
+
+        db = Database(db_path)
+        assert db.get_user_statistics()['total_users'] == 4
+        assert db.get_payment_statistics()['total_payments'] == 2
+        assert db.reconcile_counters() == {}
+
+
+if __name__ == "__main__":
+    print("🧪 Тест счетчиков статистики...")
+    test_counters_follow_changes()
+    test_reconciliation_repairs_drift()
+    test_migration_initializes_counters()
+    print("✅ Счетчики статистики работают")
@@ -0,0 +1,75 @@
+"""
+Тест завершения подписок: диапазон по payed_till, чанки в одной транзакции, повторный запуск
+"""
+
+import asyncio
+import os
+import tempfile
+from datetime import date, timedelta
+
+from database import Database
+from load_shaping import SendCalendar
+from scheduler import MessageScheduler
+from test_funnel_engine import FakeContext, _add_started_user, _count
+
+
+def _paid_users(db):
+    """1 — истекла 3 дня назад (пропущенный запуск), 2 — сегодня, 3 — завтра, 4 — вчера, но неактивен"""
+    for user_id, days in ((1, -3), (2, 0), (3, 1), (4, -1)):
+        _add_started_user(db, user_id)
+        db.mark_user_paid(user_id, 990, 'success', (date.today() + timedelta(days=days)).isoformat())
+    db.deactivate_user(4)
+    db.set_renewal_message(text="Продлите подписку", button_text="Продлить", button_url="https://example.com/pay")
+
+
+def test_expiry_catches_up_and_is_idempotent():
+    """Пропущенные дни догоняются, чанк завершается целиком, повторный запуск ничего не шлет"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _paid_users(db)
+        db.add_paid_broadcast_message("Платный шаг", 24)
+
+        scheduler = MessageScheduler(db, engine='rows', send_calendar=SendCalendar(db, budget_per_minute=1, jitter_minutes=60))
+        scheduler.EXPIRY_CHUNK_SIZE = 2
+        assert asyncio.run(scheduler.schedule_paid_user_messages(FakeContext(), 1))
+        assert [row[0] for row in db.get_expired_subscription_chunk(10)] == [1, 4, 2]
+
+        context = FakeContext()
+        asyncio.run(scheduler.check_expired_subscriptions(context))
+        assert sorted(chat_id for chat_id, text, markup in context.bot.sent) == [1, 2]
+        assert {text for chat_id, text, markup in context.bot.sent} == {"Продлите подписку"}
+
+        assert [user_id for user_id in (1, 2, 3, 4) if db.get_user(user_id)[6]] == [3]
+        assert db.get_user_paid_scheduled_messages(1) == []
+        messages = len(db.get_all_broadcast_messages())
+        assert len(db.get_user_scheduled_messages(1)) == len(db.get_user_scheduled_messages(2)) == messages
+        assert db.get_user_scheduled_messages(4) == []
+        # Шаги чанка разложены по бюджету отправок
+        assert max(db.get_send_load([(0, 2 ** 40)]).values()) == 1
+
+        context = FakeContext()
+        asyncio.run(scheduler.check_expired_subscriptions(context))
+        assert context.bot.sent == []
+        assert _count(db, 'scheduled_messages') == 2 * messages
+
+
+def test_renewed_users_are_skipped():
+    """Продленная между выборкой и транзакцией подписка не завершается; курсоры стартуют чанком"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _paid_users(db)
+        chunk = db.get_expired_subscription_chunk(10)
+
+        db.mark_user_paid(2, 990, 'success', (date.today() + timedelta(days=30)).isoformat())
+        assert db.expire_subscriptions([row[0] for row in chunk], free_cursor_users=[1, 2]) == [1, 4]
+        assert db.get_user(2)[6] and not db.get_user(1)[6]
+        assert db.get_funnel_cursor(1)[1] is not None
+        assert db.get_funnel_cursor(2) is None
+        assert db.expire_subscriptions([1, 2, 4]) == []
+
+
+if __name__ == "__main__":
+    print("🧪 Тест завершения подписок...")
+    test_expiry_catches_up_and_is_idempotent()
+    test_renewed_users_are_skipped()
+    print("✅ Истекшие подписки завершаются чанками и без повторов")
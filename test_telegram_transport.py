@@ -0,0 +1,91 @@
+"""
+Тест транспорта Bot API: метрики пула и раздельные боты для рассылок и ответов
+"""
+
+import asyncio
+import os
+import tempfile
+
+from aiohttp import web
+from telegram import Bot
+
+from broadcast_jobs import BroadcastJobManager
+from tenants import Tenant
+from telegram_transport import TelegramTransport, TransportProfile
+from test_funnel_engine import FakeBot
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+async def _fake_bot_api():
+    async def handle(request):
+        await asyncio.sleep(0.01)
+        if request.match_info['method'] == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+        else:
+            result = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/bot"
+
+
+def test_pool_metrics():
+    """Запросы, новые и переиспользованные соединения, ожидание пула"""
+    async def run():
+        runner, base_url = await _fake_bot_api()
+        transport = TelegramTransport(TransportProfile('test', 2, 5.0, 5.0, 5.0, 5.0, 60.0), http2=False)
+        bot = Bot('1:a', base_url=base_url, request=transport, get_updates_request=transport)
+        try:
+            await bot.initialize()
+            await asyncio.gather(*(bot.send_message(chat_id=1, text="x") for _ in range(6)))
+        finally:
+            await bot.shutdown()
+            await runner.cleanup()
+        return transport.stats()
+
+    stats = asyncio.run(run())
+    assert stats['connections'] == 2
+    assert stats['requests'] == 7  # getMe + 6 отправок
+    assert stats['new_connections'] == 2
+    assert stats['reused_connections'] == 5
+    # Шесть запросов на два соединения: кто-то ждал свободного соединения
+    assert stats['max_pool_wait_ms'] > 0
+
+
+def test_background_jobs_use_bulk_bot():
+    """Фоновые задачи и массовые рассылки отправляют через бота пула bulk"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tenant = Tenant('main', '1:a', '@channel', [1], db_path=os.path.join(tmp_dir, 'bot.db'))
+        tenant.application = FakeApplication()
+        assert tenant.context().bot is tenant.bot
+
+        tenant.bulk_bot = FakeBot()
+        assert tenant.context().bot is tenant.bulk_bot
+
+        manager = BroadcastJobManager(tenant.db, rate_per_second=1000, progress_interval=0)
+        manager.send_bot = tenant.bulk_bot
+
+        async def run():
+            job = manager.submit(tenant.bot, 1, {"message_text": "Привет"}, [10, 11])
+            await job.task
+
+        asyncio.run(run())
+        assert [chat_id for chat_id, text, markup in tenant.bulk_bot.sent] == [10, 11]
+        # Админу уходит только сообщение о прогрессе
+        assert all(chat_id == 1 for chat_id, text, markup in tenant.bot.sent)
+
+
+if __name__ == "__main__":
+    print("🧪 Тест транспорта Bot API...")
+    test_pool_metrics()
+    test_background_jobs_use_bulk_bot()
+    print("✅ Пулы Bot API работают")
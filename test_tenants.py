@@ -0,0 +1,95 @@
+"""
+Тест мультиарендного режима: несколько ботов в одном процессе
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+from tenants import TenantHost, load_tenants
+from test_funnel_engine import FakeBot
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+def _write_config(tmp_dir, tenants):
+    config_path = os.path.join(tmp_dir, 'tenants.json')
+    with open(config_path, 'w', encoding='utf-8') as config_file:
+        json.dump({'tenants': tenants}, config_file)
+    return config_path
+
+
+def _tenant_entry(name, token, **extra):
+    return dict({'name': name, 'bot_token': token, 'channel_id': f'@{name}', 'admin_ids': [1]}, **extra)
+
+
+def test_config_validation():
+    """Имя, уникальность имени и токена и админы проверяются при загрузке"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bad_configs = [
+            [_tenant_entry('School', '1:a')],
+            [_tenant_entry('a', '1:a'), _tenant_entry('b', '1:a')],
+            [_tenant_entry('a', '1:a'), _tenant_entry('a', '2:b')],
+            [_tenant_entry('a', '1:a', admin_ids=[])],
+            [],
+        ]
+        for tenants in bad_configs:
+            try:
+                load_tenants(_write_config(tmp_dir, tenants), tmp_dir)
+            except ValueError:
+                continue
+            raise AssertionError(f"Конфигурация {tenants} должна быть отклонена")
+
+
+def test_tenants_are_isolated():
+    """У каждого бота своя БД, маршруты и бюджет рассылок"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = _write_config(tmp_dir, [
+            _tenant_entry('school', '1:a'),
+            _tenant_entry('shop', '2:b', channel_id='-100123', admin_ids=[7, 8], rate_per_second=5),
+        ])
+        school, shop = load_tenants(config_path, tmp_dir, 'https://bot.example.com')
+        host = TenantHost([school, shop])
+
+        assert host.multi_tenant and host.default is None
+        assert host.by_token('2:b') is shop and host.by_name('school') is school
+        assert school.db.db_path != shop.db.db_path
+        assert school.scheduler.click_tracker.base_url == 'https://bot.example.com/t/school'
+        assert shop.admin_panel.job_manager is not school.admin_panel.job_manager
+        assert shop.is_admin(8) and not school.is_admin(8)
+
+        school.db.add_user(1, "user1", "Test")
+        assert school.db.get_user(1) and not shop.db.get_user(1)
+
+
+def test_jobs_run_for_every_tenant():
+    """Одна фоновая задача обходит всех ботов; ошибка одного не мешает остальным"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = _write_config(tmp_dir, [_tenant_entry('a', '1:a'), _tenant_entry('b', '2:b')])
+        host = TenantHost(load_tenants(config_path, tmp_dir))
+        for tenant in host.tenants:
+            tenant.application = FakeApplication()
+
+        async def job(tenant):
+            if tenant.name == 'a':
+                raise RuntimeError("сбой")
+            await tenant.context().bot.send_message(chat_id=1, text=tenant.name)
+
+        asyncio.run(host.for_each_tenant('demo', job)(None))
+
+        metrics = host.metrics()
+        assert metrics['a']['jobs']['demo']['errors'] == 1
+        assert metrics['b']['jobs']['demo']['errors'] == 0
+        assert len(host.tenants[1].bot.sent) == 1
+
+
+if __name__ == "__main__":
+    print("🧪 Тест мультиарендного режима...")
+    test_config_validation()
+    test_tenants_are_isolated()
+    test_jobs_run_for_every_tenant()
+    print("✅ Несколько ботов в одном процессе работают")
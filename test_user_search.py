@@ -0,0 +1,85 @@
+"""
+Тест поиска пользователей и постраничного списка на keyset-курсорах
+"""
+
+import os
+import sqlite3
+import tempfile
+
+from database import Database
+
+
+class PreSearchDatabase(Database):
+    """Схема до появления поискового индекса"""
+    MIGRATIONS = Database.MIGRATIONS[:6]
+
+
+def _add_users(db, count):
+    for user_id in range(1, count + 1):
+        db.add_user(user_id, f"user{user_id}", "Анна" if user_id % 2 else "Борис")
+
+
+def test_pages_cover_all_users_once():
+    """Страницы идут от новых к старым, без пропусков и повторов"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_users(db, 25)
+        db.deactivate_user(7)
+
+        seen = []
+        users, cursor = db.get_users_page(10)
+        while True:
+            seen.extend(user[0] for user in users)
+            if cursor is None:
+                break
+            users, cursor = db.get_users_page(10, cursor)
+
+        assert seen == [user_id for user_id in range(25, 0, -1) if user_id != 7]
+        assert [user[0] for user in db.get_latest_users(3)] == [25, 24, 23]
+
+
+def test_search_by_name_username_and_id():
+    """Поиск по началу имени, @username и ID; индекс следует за изменениями"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_users(db, 25)
+
+        users, cursor, total = db.search_users("бор", limit=5)
+        assert total == 12
+        assert [user[0] for user in users] == [24, 22, 20, 18, 16]
+        users, cursor, total = db.search_users("бор", limit=5, after=cursor)
+        assert [user[0] for user in users] == [14, 12, 10, 8, 6]
+
+        assert [user[0] for user in db.search_users("@user13")[0]] == [13]
+        assert [user[0] for user in db.search_users("3")[0]] == [3]
+        # Кавычки и операторы FTS5 в запросе не ломают поиск
+        assert db.search_users('"user1 OR') == ([], None, 0)
+
+        # Повторное добавление (INSERT OR REPLACE) обновляет индекс, а не дублирует
+        db.add_user(13, "renamed", "Вера")
+        assert db.search_users("user13")[2] == 0
+        assert [user[0] for user in db.search_users("вера")[0]] == [13]
+        assert db.reconcile_counters() == {}
+
+
+def test_migration_indexes_existing_users():
+    """Миграция индексирует пользователей, добавленных до нее"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bot.db')
+        _add_users(PreSearchDatabase(db_path), 4)
+
+        db = Database(db_path)
+        assert [user[0] for user in db.search_users("анна")[0]] == [3, 1]
+
+        # integrity-check падает, если индекс разошелся с таблицей users
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO users_fts (users_fts) VALUES ('integrity-check')")
+        conn.close()
+
+
+if __name__ == "__main__":
+    print("🧪 Тест поиска пользователей...")
+    test_pages_cover_all_users_once()
+    test_search_by_name_username_and_id()
+    test_migration_indexes_existing_users()
+    print("✅ Поиск и постраничный список пользователей работают")
@@ -0,0 +1,133 @@
+"""
+Тест кэша состояний пользователей: пачка за один проход, write-through, LRU и TTL
+"""
+
+import os
+import tempfile
+from datetime import date, timedelta
+
+from database import Database
+from test_funnel_engine import _add_started_user
+from user_state import UserState, UserStateCache
+
+
+class RacingCache(UserStateCache):
+    """Перед первой записью в кэш выполняет on_put — изменение между чтением из БД и put"""
+
+    on_put = None
+
+    def put(self, user_id, state, generation=None):
+        hook, self.on_put = self.on_put, None
+        if hook:
+            hook(user_id)
+        super().put(user_id, state, generation)
+
+
+def test_write_through_keeps_cache_fresh():
+    """Методы, меняющие состояние, обновляют кэш — повторный запрос к БД не нужен"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        for user_id in (1, 2, 3):
+            _add_started_user(db, user_id)
+
+        states = db.get_user_states([1, 2, 3, 404])
+        assert sorted(states) == [1, 2, 3]
+        assert db.user_states.misses == 4
+
+        payed_till = date.today() + timedelta(days=30)
+        db.mark_user_paid(1, 990, 'success', payed_till.isoformat())
+        db.deactivate_user(2)
+        db.expire_user_subscription(3)
+
+        states = db.get_user_states([1, 2, 3])
+        assert db.user_states.hits == 3
+        assert (states[1].has_paid, states[1].payed_till) == (1, payed_till)
+        assert states[2].is_active == 0
+        assert states[3].has_paid == 0
+        assert not db.FUNNELS['free'].accepts(states[1])
+        assert db.FUNNELS['paid'].accepts(states[1])
+
+        # Кэш совпадает с тем, что лежит в БД
+        db.user_states.clear()
+        fresh = db.get_user_states([1, 2, 3])
+        for user_id in (1, 2, 3):
+            assert repr(fresh[user_id]) == repr(states[user_id])
+
+        db.expire_subscriptions([1], today=payed_till + timedelta(days=1))
+        assert db.get_user_state(1).has_paid == 0
+
+
+def test_reactivation_reaches_db_before_cache():
+    """Реактивация уже запустившего бота пользователя записана в БД, а кэш совпадает с ней"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_started_user(db, 1)
+        db.deactivate_user(1)
+        assert db.get_user_state(1).is_active == 0
+
+        assert db.mark_user_started_bot(1)
+        assert db.get_user_state(1).is_active == 1
+        assert db.get_user(1)[4] == 1
+
+        db.user_states.clear()
+        assert db.get_user_state(1).is_active == 1
+
+
+def test_lru_and_ttl():
+    """Вытесняется самая давняя запись, устаревшая по TTL считается промахом"""
+    cache = UserStateCache(maxsize=2, ttl=60)
+    cache.put(1, UserState(1, 1, 0))
+    cache.put(2, UserState(1, 1, 0))
+    assert cache.get(1) is not None
+    cache.put(3, UserState(1, 1, 0))
+    assert cache.get(2) is None and len(cache) == 2
+
+    cache.put(4, UserState(1, 1, 0, loaded_at=0))
+    assert cache.get(4) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+def test_stale_put_is_skipped():
+    """Прочитанное до update/discard состояние в кэш не попадает, в том числе для отсутствующей записи"""
+    cache = UserStateCache(maxsize=2, ttl=60)
+    before = cache.generation
+    cache.update(1, is_active=0)
+    cache.put(1, UserState(1, 1, 0), before)
+    assert cache.get(1) is None
+    cache.put(1, UserState(0, 1, 0), cache.generation)
+    assert cache.get(1).is_active == 0
+
+    before = cache.generation
+    cache.discard(2)
+    cache.put(2, UserState(1, 1, 0), before)
+    cache.put(3, UserState(1, 1, 0), before)
+    assert cache.get(2) is None and cache.get(3) is not None
+
+    # Забытые изменения (сверх maxsize) делают устаревшим все, что читалось до них
+    cache.update(4)
+    cache.update(5)
+    cache.put(1, UserState(1, 1, 0), before)
+    assert cache.get(1).is_active == 0
+
+
+def test_change_during_load_does_not_cache_stale_state():
+    """Деактивация между SELECT и put: кэш не запоминает прочитанное до нее состояние"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'bot.db'))
+        _add_started_user(db, 1)
+        db.user_states = RacingCache()
+        db.user_states.on_put = db.deactivate_user
+
+        assert db.get_user_states([1])[1].is_active == 1
+        assert len(db.user_states) == 0
+        assert db.get_user_state(1).is_active == 0
+
+
+if __name__ == "__main__":
+    print("🧪 Тест кэша состояний пользователей...")
+    test_write_through_keeps_cache_fresh()
+    test_reactivation_reaches_db_before_cache()
+    test_lru_and_ttl()
+    test_stale_put_is_skipped()
+    test_change_during_load_does_not_cache_stale_state()
+    print("✅ Кэш состояний обновляется при записи, не запоминает устаревшее и ограничен по размеру")
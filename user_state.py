@@ -0,0 +1,143 @@
+"""
+Кэш состояния пользователей: is_active, bot_started, has_paid, payed_till
+
+Перед каждой отправкой шага воронки бот проверяет, что пользователь все еще
+в аудитории воронки (не оплатил, не заблокировал бота). Раньше это был
+get_user — отдельное соединение и SELECT на каждого получателя.
+
+Теперь состояния лежат в ограниченном LRU компактных записей (__slots__).
+Методы Database, меняющие эти колонки, обновляют запись сразу после записи
+в БД (write-through). Пачка получателей проверяется за один проход: что
+есть в кэше — берется из памяти, остальное одним запросом IN (...).
+
+Записи живут USER_STATE_TTL_SECONDS: изменения, сделанные другим процессом
+с той же БД, видны не позже чем через TTL.
+
+Кэш общий для event loop и потоков (asyncio.to_thread), поэтому защищен
+блокировкой. Чтение из БД и запись в кэш разнесены во времени: если между
+ними состояние пользователя изменили (update/discard), прочитанная запись
+устарела, и put ее не кладет — для этого у кэша есть счетчик поколений.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserState:
+    """Состояние пользователя, от которого зависят аудитории воронок"""
+
+    __slots__ = ('is_active', 'bot_started', 'has_paid', 'payed_till', 'loaded_at')
+
+    def __init__(self, is_active, bot_started, has_paid, payed_till=None, loaded_at=None):
+        self.is_active = int(is_active or 0)
+        self.bot_started = int(bot_started or 0)
+        self.has_paid = int(has_paid or 0)
+        # date окончания подписки или None
+        self.payed_till = payed_till
+        self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+
+    def __repr__(self):
+        return (f"UserState(is_active={self.is_active}, bot_started={self.bot_started}, "
+                f"has_paid={self.has_paid}, payed_till={self.payed_till})")
+
+
+class UserStateCache:
+    """LRU состояний пользователей с TTL и счетчиками попаданий"""
+
+    def __init__(self, maxsize=50000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        # Поколение растет при каждом изменении; для ключа помним поколение его
+        # последнего изменения, а для вытесненных из этой памяти — самое позднее
+        self._generation = 0
+        self._changed_at = OrderedDict()
+        self._forgotten_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        """Поколение на момент начала чтения из БД — передается в put"""
+        return self._generation
+
+    def get(self, user_id):
+        """Состояние из памяти или None (промах, в том числе устаревшая запись)"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None and time.monotonic() - state.loaded_at > self.ttl:
+                del self._states[user_id]
+                state = None
+
+            if state is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._states.move_to_end(user_id)
+            return state
+
+    def put(self, user_id, state, generation=None):
+        """Положить прочитанное из БД состояние
+
+        generation — поколение до чтения: если запись с тех пор менялась,
+        прочитанное состояние устарело и в кэш не попадает.
+        """
+        with self._lock:
+            if generation is not None and (
+                self._changed_at.get(user_id, self._forgotten_at) > generation
+            ):
+                return
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def _mark_changed(self, user_id):
+        """Отметить изменение записи (под блокировкой)"""
+        self._generation += 1
+        self._changed_at[user_id] = self._generation
+        self._changed_at.move_to_end(user_id)
+        while len(self._changed_at) > self.maxsize:
+            self._forgotten_at = self._changed_at.popitem(last=False)[1]
+
+    def update(self, user_id, **fields):
+        """Write-through: поменять поля записи, если она есть в кэше"""
+        with self._lock:
+            self._mark_changed(user_id)
+            state = self._states.get(user_id)
+            if state is not None:
+                for name, value in fields.items():
+                    setattr(state, name, value)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._mark_changed(user_id)
+            self._states.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            # Все, что читалось до очистки, считается устаревшим
+            self._generation += 1
+            self._changed_at.clear()
+            self._forgotten_at = self._generation
+            self._states.clear()
+
+    def __len__(self):
+        return len(self._states)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._states),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 4),
+        }